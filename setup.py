@@ -49,6 +49,7 @@ setup(
       packages=["actuator",
                 "actuator.exec_agents",
                 "actuator.exec_agents.ansible",
+                "actuator.exec_agents.local",
                 "actuator.provisioners",
                 "actuator.provisioners.openstack"],
       package_dir={'':'src'},
@@ -53,6 +53,7 @@ if not os.environ.get("ACTUATOR_ALLOW_SSH_ARGS"):
     os.environ['ANSIBLE_SSH_ARGS'] = "-oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null"
 import traceback
 import time
+import threading
 
 
 from modeling import (MultiComponent, MultiComponentGroup, ComponentGroup,
@@ -65,10 +66,17 @@ from config import (ConfigModel, with_searchpath, with_dependencies,
                     ConfigException, TaskGroup, NullTask, MultiTask,
                     ConfigClassTask, with_config_options)
 from provisioners.core import ProvisionerException, BaseProvisioner
-from exec_agents.core import ExecutionAgent, ExecutionException
+from exec_agents.core import (ExecutionAgent, ExecutionException,
+                              HostUnreachableException)
 from exec_agents.ansible.agent import AnsibleExecutionAgent
+from exec_agents.history import LatencyHistory
+from exec_agents.hedging import StragglerHedger
+from exec_agents.simulate import SimulationResult, simulate_run, what_if
+from exec_agents.local.agent import LocalExecutionAgent
 from config_tasks import (PingTask, CommandTask, ScriptTask, ShellTask,
                           CopyFileTask, ProcessCopyFileTask)
+from readiness import (ResourceReadiness, PipelineGate, HostProber,
+                       HostCircuitBreaker, run_hosts)
 from utils import (LOG_CRIT, LOG_DEBUG, LOG_ERROR, LOG_INFO, LOG_WARN, root_logger)
 
 
@@ -97,7 +105,9 @@ class ActuatorOrchestration(object):
     def __init__(self, infra_model_inst=None, provisioner=None,
                  namespace_model_inst=None, config_model_inst=None,
                  log_level=LOG_INFO, no_delay=False, num_threads=5,
-                 post_prov_pause=60):
+                 post_prov_pause=60, pipeline=False, host_prober=None,
+                 persistent_ssh=False, fuse_tasks=False, host_breaker=None,
+                 latency_history=None, hedger=None, max_threads=None):
         """
         Create an instance of the orchestrator to operate on the supplied models/provisioner
         
@@ -137,7 +147,15 @@ class ActuatorOrchestration(object):
             more parallel tasks your model has the higher this number can be to have
             a positive impact on the overall task completion rate. There is no value
             in making this larger than the largest number of tasks you may have
-            running in parallel.
+            running in parallel. If max_threads is given, this is the fewest
+            threads config will use.
+        @keyword max_threads: Optional; int, default None. If given, the
+            number of config threads is adjusted while config runs, between
+            num_threads and max_threads, according to how many tasks are
+            ready to run and how long they are taking, and never exceeds the
+            number of tasks in the config model that can run at once, so
+            num_threads needn't be tuned to the model. Provisioners take a
+            max_threads argument of their own.
         @keyword post_prov_pause: Optional: int, default is 60. The number of seconds
             to pause after provision is done before starting on configuration. The
             reason this is useful is because virtual/cloud systems may complete
@@ -146,6 +164,44 @@ class ActuatorOrchestration(object):
             virtual/cloud systems a chance to stabilize before starting on
             configuration tasks. If no provisioning was done (a static infra model
             or simply no infra/provisioner), then the pause is skipped.
+        @keyword pipeline: Optional; boolean, default False. If True, and there
+            are infra, namespace and config models and a provisioner, then
+            configuration is started while provisioning is still under way.
+            Each config task is held back only until the resources its Roles
+            refer to (the host_ref and any model references in visible Vars)
+            are provisioned, rather than until all provisioning is done, and
+            post_prov_pause isn't used. See L{actuator.readiness.PipelineGate}
+            for what can't be detected this way. If the provisioner can't
+            report on individual resources, config tasks that need infra
+            simply wait for provisioning to finish.
+        @keyword host_prober: Optional; an L{actuator.readiness.HostProber}.
+            If supplied, it is used instead of post_prov_pause: config starts
+            as soon as every host that config tasks will run on accepts ssh
+            connections, and orchestration is aborted if any host can't be
+            reached before the prober's timeout. With pipeline=True, each
+            config task instead waits only for its own host.
+        @keyword persistent_ssh: Optional; boolean, default False. If True,
+            config tasks on the same host share a single ssh connection that
+            is kept open for the whole config phase; see
+            L{actuator.exec_agents.ansible.agent.AnsibleExecutionAgent}.
+        @keyword fuse_tasks: Optional; boolean, default False. If True, chains
+            of command and shell tasks that run one after the other on the
+            same host are each run as a single remote script; see
+            L{actuator.exec_agents.ansible.agent.AnsibleExecutionAgent}.
+        @keyword host_breaker: Optional; an
+            L{actuator.readiness.HostCircuitBreaker}. If supplied, config
+            tasks for a host that has stopped responding are failed or
+            parked as the breaker directs rather than each being retried.
+        @keyword latency_history: Optional; an
+            L{actuator.exec_agents.history.LatencyHistory}. If supplied, the
+            time each config task takes is recorded in it and saved when
+            config is done; agents that can learn their timeouts from it
+            (see L{actuator.exec_agents.ansible.agent.AnsibleExecutionAgent})
+            do so.
+        @keyword hedger: Optional; an
+            L{actuator.exec_agents.hedging.StragglerHedger}. If supplied,
+            rerun_safe MultiTask instances that take much longer than their
+            siblings are hedged with a second attempt.
             
         @raise ExecutionException: In the following circumstances this method
         will raise actuator.ExecutionException:
@@ -180,6 +236,8 @@ class ActuatorOrchestration(object):
         root_logger.setLevel(log_level)
         self.logger = root_logger.getChild("orchestrator")
         self.post_prov_pause = post_prov_pause
+        self.pipeline = pipeline
+        self.host_prober = host_prober
         self.status = self.NOT_STARTED
         
         if self.config_model_inst is not None:
@@ -187,7 +245,13 @@ class ActuatorOrchestration(object):
                                                    namespace_model_instance=self.namespace_model_inst,
                                                    num_threads=num_threads,
                                                    no_delay=no_delay,
-                                                   log_level=log_level)
+                                                   log_level=log_level,
+                                                   persistent_ssh=persistent_ssh,
+                                                   fuse_tasks=fuse_tasks,
+                                                   host_breaker=host_breaker,
+                                                   latency_history=latency_history,
+                                                   hedger=hedger,
+                                                   max_threads=max_threads)
             
     def is_running(self):
         """
@@ -236,37 +300,33 @@ class ActuatorOrchestration(object):
         @return: True if initiation was successful, False otherwise.
         """
         self.logger.info("Orchestration starting")
+        if (self.pipeline and self.infra_model_inst is not None and
+                self.provisioner is not None and
+                self.config_model_inst is not None and
+                self.namespace_model_inst is not None):
+            return self._initiate_pipelined()
         did_provision = False
         if self.infra_model_inst is not None and self.provisioner is not None:
             try:
                 self.status = self.PERFORMING_PROVISION
                 self.logger.info("Starting provisioning phase")
-                if self.namespace_model_inst:
-                    self.namespace_model_inst.set_infra_model(self.infra_model_inst)
-                    self.namespace_model_inst.compute_provisioning_for_environ(self.infra_model_inst)
-                _ = self.infra_model_inst.refs_for_components()
+                self._prepare_for_provisioning()
                 self.provisioner.provision_infra_model(self.infra_model_inst)
                 self.logger.info("Provisioning phase complete")
                 did_provision = True
             except ProvisionerException, e:
-                self.status = self.ABORT_PROVISION
-                self.logger.critical(">>> Provisioner failed "
-                                     "with '%s'; failed resources shown below" % e.message)
-                if self.provisioner.agent is not None:
-                    for t, et, ev, tb in self.provisioner.agent.get_aborted_tasks():
-                        self.logger.critical("Task %s named %s id %s" %
-                                             (t.__class__.__name__, t.name, str(t._id)),
-                                             exc_info=(et, ev, tb))
-                else:
-                    self.logger.critical("No further information")
-                self.logger.critical("Aborting orchestration")
+                self._provisioning_failed(e)
                 return False
         else:
             self.logger.info("No infra model or provisioner; skipping provisioning step")
             
         if self.config_model_inst is not None and self.namespace_model_inst is not None:
             pause = self.post_prov_pause
-            if pause and did_provision:
+            if self.host_prober is not None:
+                self.status = self.PERFORMING_CONFIG
+                if not self._probe_hosts():
+                    return False
+            elif pause and did_provision:
                 self.logger.info("Pausing %d secs before starting config" % pause)
                 while pause:
                     time.sleep(5)
@@ -278,22 +338,161 @@ class ActuatorOrchestration(object):
                 self.config_ea.perform_config()
                 self.logger.info("Config phase complete")
             except ExecutionException, e:
-                self.status = self.ABORT_CONFIG
-                self.logger.critical(">>> Config exec agent failed with '%s'; "
-                                     "failed tasks shown below" % e.message)
-                for t, et, ev, tb in self.config_ea.get_aborted_tasks():
-                    self.logger.critical("Task %s named %s id %s" %
-                                         (t.__class__.__name__, t.name, str(t._id)),
-                                         exc_info=(et, ev, tb))
-                    self.logger.critical("Response: %s" % ev.response
-                                         if hasattr(ev, "response")
-                                         else "NO RESPONSE")
-                    self.logger.critical("")
-                self.logger.critical("Aborting orchestration")
+                self._config_failed(e)
                 return False
             
         self.logger.info("Orchestration complete")
         self.status = self.COMPLETE
         return True
     
+    def simulate(self, num_threads=None, provision_threads=None, **kwargs):
+        """
+        Predict how long initiate_system() would take, without provisioning
+        or configuring anything.
+        
+        Each phase is simulated on a virtual clock by the agent that would
+        perform it (see L{actuator.exec_agents.simulate.simulate_run}), using
+        the task duration estimates supplied. The phases are taken to run
+        one after the other, with post_prov_pause between them if there is
+        provisioning, so for pipelined orchestration the prediction is an
+        upper bound; time spent waiting for hosts to be reachable isn't
+        predicted.
+        
+        @keyword num_threads: Optional; int. The number of config threads to
+            simulate; defaults to the num_threads given to the orchestrator
+        @keyword provision_threads: Optional; int. The number of provisioning
+            threads to simulate; defaults to the provisioner's own
+        @keyword **kwargs: passed to the simulation of each phase; see
+            L{actuator.exec_agents.simulate.simulate_run}. Durations should
+            cover both provisioning and config tasks.
+            
+        @return: a list of L{actuator.exec_agents.simulate.SimulationResult}s,
+            one for each phase: "provision", "pause" (which has no tasks) and
+            "config", for the phases there would be. The sum of their
+            makespans is the predicted time for the whole run.
+        """
+        results = []
+        if self.infra_model_inst is not None and self.provisioner is not None:
+            self._prepare_for_provisioning()
+            results.append(self.provisioner.simulate(self.infra_model_inst,
+                                                     num_threads=provision_threads,
+                                                     **kwargs))
+            if self.post_prov_pause and self.host_prober is None and not self.pipeline:
+                results.append(SimulationResult("pause", self.post_prov_pause, 0, 0,
+                                                0, [], 0.0, {}, False))
+        if self.config_model_inst is not None and self.namespace_model_inst is not None:
+            results.append(self.config_ea.simulate(num_threads=num_threads,
+                                                   phase="config", **kwargs))
+        return results
+    
+    def _initiate_pipelined(self):
+        #internal; initiate_system() when provisioning and config overlap.
+        #Provisioning runs on its own thread and reports each resource to a
+        #ResourceReadiness as it is done; the config agent's PipelineGate
+        #holds each config task until the resources it needs are ready
+        self.status = self.PERFORMING_PROVISION
+        self.logger.info("Starting pipelined provisioning and config")
+        self._prepare_for_provisioning()
+        #the config graph is settled before provisioning starts so that the
+        #two don't fix arguments on the same components at the same time
+        self.config_model_inst.update_nexus(self.namespace_model_inst.nexus)
+        _ = self.config_model_inst.get_graph(with_fix=True)
+        readiness = ResourceReadiness()
+        self.config_ea.task_gate = PipelineGate(readiness, self.infra_model_inst,
+                                                prober=self.host_prober)
+        self.provisioner.set_resource_listener(readiness.resource_provisioned)
+        prov_failure = []
+        
+        def provision():
+            try:
+                self.provisioner.provision_infra_model(self.infra_model_inst)
+            except ProvisionerException, e:
+                prov_failure.append(e)
+                readiness.provisioning_failed(e)
+                #tasks still waiting on infra never will be able to run
+                self.config_ea.abort_process_tasks()
+            else:
+                self.logger.info("Provisioning phase complete")
+                if self.status == self.PERFORMING_PROVISION:
+                    self.status = self.PERFORMING_CONFIG
+                readiness.provisioning_complete()
+                
+        prov_thread = threading.Thread(target=provision, name="provisioner")
+        prov_thread.start()
+        config_failure = None
+        try:
+            try:
+                self.config_ea.perform_config()
+            except ExecutionException, e:
+                config_failure = e
+        finally:
+            prov_thread.join()
+            self.provisioner.set_resource_listener(None)
+        if prov_failure:
+            self._provisioning_failed(prov_failure[0])
+            return False
+        if config_failure is not None:
+            self._config_failed(config_failure)
+            return False
+        self.logger.info("Config phase complete; %d tasks waited for infra" %
+                         self.config_ea.task_gate.parked)
+        self.logger.info("Orchestration complete")
+        self.status = self.COMPLETE
+        return True
+    
+    def _probe_hosts(self):
+        #internal; wait for all the hosts config tasks run on to be reachable.
+        #Returns False, having logged the problem, if any can't be reached
+        self.config_model_inst.update_nexus(self.namespace_model_inst.nexus)
+        graph = self.config_model_inst.get_graph(with_fix=True)
+        hosts = run_hosts(graph.nodes())
+        self.logger.info("Waiting for %d hosts to be reachable before starting config"
+                         % len(hosts))
+        start = time.time()
+        unreachable = self.host_prober.wait_for(hosts)
+        if unreachable:
+            self.status = self.ABORT_CONFIG
+            self.logger.critical(">>> These hosts couldn't be reached: %s" %
+                                 ", ".join(sorted(unreachable)))
+            self.logger.critical("Aborting orchestration")
+            return False
+        self.logger.info("All hosts reachable after %.1f secs" % (time.time() - start))
+        return True
+    
+    def _prepare_for_provisioning(self):
+        #internal; work out what the namespace needs from the infra model
+        if self.namespace_model_inst:
+            self.namespace_model_inst.set_infra_model(self.infra_model_inst)
+            self.namespace_model_inst.compute_provisioning_for_environ(self.infra_model_inst)
+        _ = self.infra_model_inst.refs_for_components()
+        
+    def _provisioning_failed(self, e):
+        #internal; record and log a failed provisioning phase
+        self.status = self.ABORT_PROVISION
+        self.logger.critical(">>> Provisioner failed "
+                             "with '%s'; failed resources shown below" % e.message)
+        if self.provisioner.agent is not None:
+            for t, et, ev, tb in self.provisioner.agent.get_aborted_tasks():
+                self.logger.critical("Task %s named %s id %s" %
+                                     (t.__class__.__name__, t.name, str(t._id)),
+                                     exc_info=(et, ev, tb))
+        else:
+            self.logger.critical("No further information")
+        self.logger.critical("Aborting orchestration")
+        
+    def _config_failed(self, e):
+        #internal; record and log a failed config phase
+        self.status = self.ABORT_CONFIG
+        self.logger.critical(">>> Config exec agent failed with '%s'; "
+                             "failed tasks shown below" % e.message)
+        for t, et, ev, tb in self.config_ea.get_aborted_tasks():
+            self.logger.critical("Task %s named %s id %s" %
+                                 (t.__class__.__name__, t.name, str(t._id)),
+                                 exc_info=(et, ev, tb))
+            self.logger.critical("Response: %s" % ev.response
+                                 if hasattr(ev, "response")
+                                 else "NO RESPONSE")
+            self.logger.critical("")
+        self.logger.critical("Aborting orchestration")
+    
                 
\ No newline at end of file
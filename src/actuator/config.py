@@ -240,12 +240,19 @@ class _ConfigTask(Orable, ModelComponent):
     @keyword private_key_file: String, default None. Path to private key file
         for the remote user, as generated by ssh-keygen. This is the key file
         that will be used for whatever remote user has been determined.
+    @keyword rerun_safe: boolean, defaults to None. Flags that the task can be
+        run more than once, even at the same time on the same host, without
+        harm, so that an execution agent may start another attempt at it
+        while one is still under way (see
+        L{actuator.exec_agents.hedging.StragglerHedger}). If not specified,
+        the value is taken from the task's container (such as a MultiTask),
+        and is otherwise False.
     @keyword delegate: internal
     """
     def __init__(self, name, task_role=None, run_from=None,
                  repeat_til_success=True, repeat_count=1, repeat_interval=15,
                  remote_user=None, remote_pass=None, private_key_file=None,
-                 delegate=None):
+                 rerun_safe=None, delegate=None):
         super(_ConfigTask, self).__init__(name)
         self.task_role = None
         self._task_role = task_role
@@ -263,6 +270,8 @@ class _ConfigTask(Orable, ModelComponent):
         self._remote_pass = remote_pass
         self.private_key_file = None
         self._private_key_file = private_key_file
+        self.rerun_safe = None
+        self._rerun_safe = rerun_safe
         self.delegate = delegate
         
     def task_variables(self, for_env=False):
@@ -341,6 +350,18 @@ class _ConfigTask(Orable, ModelComponent):
                                   if self.delegate is not None
                                   else None))
         return private_key_file
+    
+    def is_rerun_safe(self):
+        """
+        Return True if the task can safely be run more than once at the same
+        time.
+        """
+        rerun_safe = (self.rerun_safe
+                      if self.rerun_safe is not None
+                      else (self.delegate.is_rerun_safe()
+                            if self.delegate is not None
+                            else False))
+        return bool(rerun_safe)
         
     def get_task_host(self):
         """
@@ -406,7 +427,8 @@ class _ConfigTask(Orable, ModelComponent):
                               "repeat_interval":self._repeat_interval,
                               "remote_user":self._remote_user,
                               "remote_pass":self._remote_pass,
-                              "private_key_file":self._private_key_file
+                              "private_key_file":self._private_key_file,
+                              "rerun_safe":self._rerun_safe
                               })
         
     def _get_arg_value(self, arg):
@@ -438,6 +460,7 @@ class _ConfigTask(Orable, ModelComponent):
         self.remote_user = self._get_arg_value(self._remote_user)
         self.remote_pass = self._get_arg_value(self._remote_pass)
         self.private_key_file = self._get_arg_value(self._private_key_file)
+        self.rerun_safe = self._get_arg_value(self._rerun_safe)
         
     def _or_result_class(self):
         return _Dependency
@@ -651,6 +674,16 @@ class ConfigModel(ModelBase):
                                   if self.delegate is not None
                                   else None))
         return private_key_file
+    
+    def is_rerun_safe(self):
+        """
+        Returns whether tasks in the model that don't say otherwise can safely
+        be run more than once at the same time; this comes from the delegate
+        if there is one, and is otherwise False.
+        """
+        return (self.delegate.is_rerun_safe()
+                if self.delegate is not None
+                else False)
         
     def set_task_role(self, task_role):
         """
@@ -996,9 +1029,9 @@ class ConfigClassTask(_ConfigTask, _Unpackable, StructuralTask):
         graph = self.get_graph(with_fix=True)
         entry_nodes = [n for n in graph.nodes() if graph.in_degree(n) == 0]
         exit_nodes = [n for n in graph.nodes() if graph.out_degree(n) == 0]
-        self.dependencies = itertools.chain(self.instance.get_dependencies(),
-                                            [_Dependency(self, c) for c in entry_nodes],
-                                            [_Dependency(c, self.rendezvous) for c in exit_nodes])
+        self.dependencies = list(itertools.chain(self.instance.get_dependencies(),
+                                                 [_Dependency(self, c) for c in entry_nodes],
+                                                 [_Dependency(c, self.rendezvous) for c in exit_nodes]))
 
     def exit_nodes(self):
         """
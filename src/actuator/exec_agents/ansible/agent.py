@@ -24,17 +24,24 @@ Created on Oct 21, 2014
 '''
 
 import os.path
+import posixpath
+import re
 import json
 import getpass
 import pprint
+import shlex
+import pipes
 # import sys
 # import subprocess32
 # import json_runner
 
-from actuator.exec_agents.core import ExecutionAgent, ExecutionException
-from actuator.config import StructuralTask, NullTask
+from actuator.exec_agents.core import (ExecutionAgent, ExecutionException,
+                                       HostUnreachableException)
+from actuator.exec_agents.ansible.connections import SSHConnectionManager
+from actuator.exec_agents.ansible.transfer import PayloadStage, TransferStats
+from actuator.config import StructuralTask, NullTask, _ConfigTask
 from actuator.config_tasks import *
-from actuator.utils import capture_mapping, get_mapper
+from actuator.utils import capture_mapping, get_mapper, root_logger
 from actuator.namespace import _ComputableValue
 
 from ansible.runner import Runner
@@ -56,15 +63,19 @@ class TaskProcessor(object):
         """
         raise TypeError("Derived class must implement module_name()")
     
-    def make_args(self, task, hlist):
+    def make_args(self, task, hlist, env=None):
         """
         Make the genericargument structure to use with the Ansible Runner object.
         
         @param task: the task object to process
         @param hlist: A list of host names/IPs to apply the task to.
+        @keyword env: Optional; dict of the environment variables for the
+            task. If not supplied, they are taken from the task's Vars.
         """
         kwargs = {"host_list":hlist,
-                  "environment":task.task_variables(for_env=True)
+                  "environment":(env
+                                 if env is not None
+                                 else task.task_variables(for_env=True))
                   }
         remote_user = task.get_remote_user()
         if remote_user is not None:
@@ -86,6 +97,31 @@ class TaskProcessor(object):
         """
         raise TypeError("derived class must implement")
     
+    def perform(self, agent, task, kwargs, logfile=None):
+        """
+        Performs the task by running the module with the Runner keyword args
+        from make_args(), and checks the result. Returns the result dict.
+        Derived classes may override this if a task needs more than one
+        module run.
+        
+        @param agent: the L{AnsibleExecutionAgent} performing the task
+        @param task: the task object to process
+        @param kwargs: the Runner keyword args for the task
+        @keyword logfile: If present, a file-like object that log messages will
+            be written, regardless of the log level.
+        @raise ExecutionException: Raised if the task fails
+        """
+        result = agent.run_module(kwargs, logfile=logfile)
+        self.result_check(task, result, logfile=logfile)
+        return result
+    
+    def host_result(self, kwargs, result):
+        """
+        Returns the part of a Runner result for the host the task ran on, or
+        an empty dict if the host couldn't be reached
+        """
+        return result.get("contacted", {}).get(kwargs["host_list"][0], {})
+    
     def result_check(self, task, result, logfile=None):
         """
         Checks the result of a Ansible Runner invocation. If there is a problem,
@@ -111,9 +147,11 @@ class TaskProcessor(object):
                                              cmd_msg=cmd_msg))
             if logfile:
                 logfile.write("{}\n".format(emessage))
-            raise ExecutionException(emessage, response=pprint.pformat(result,
-                                                                       indent=1,
-                                                                       width=1))
+            raise HostUnreachableException(emessage,
+                                           response=pprint.pformat(result,
+                                                                   indent=1,
+                                                                   width=1),
+                                           host=result["dark"].keys()[0])
         else:
             if "msg" in result["contacted"][host]:
                 emessage = ("{module} {task} failed on {host} with the following emessage: {msg}"
@@ -230,6 +268,135 @@ class CopyFileProcessor(TaskProcessor):
         if task.validate is not None: cmplx["validate"] = task.validate
         return args
     
+    def perform(self, agent, task, kwargs, logfile=None):
+        """
+        Copies the task's file. Inline content is staged to a local file
+        first (see L{PayloadStage}). Files at least as big as the agent's
+        compress_threshold are first checked against the host's copy, and
+        are sent compressed only if the host's copy differs; smaller files
+        are left to the copy module, which does its own check.
+        """
+        cmplx = kwargs["complex_args"]
+        if "content" in cmplx:
+            cmplx["src"] = agent.payloads.stage(cmplx.pop("content"),
+                                                name=os.path.basename(task.src or "")
+                                                     or "content")
+        src = cmplx["src"]
+        if not os.path.isfile(src):
+            #directories, or a missing file the copy module will complain about
+            return super(CopyFileProcessor, self).perform(agent, task, kwargs,
+                                                          logfile=logfile)
+        digest, size = agent.payloads.checksum(src)
+        if (agent.compress_threshold is not None and size >= agent.compress_threshold and
+                self._can_compress(cmplx)):
+            return self._compressed_copy(agent, task, kwargs, digest, size, logfile)
+        result = super(CopyFileProcessor, self).perform(agent, task, kwargs,
+                                                        logfile=logfile)
+        changed = self.host_result(kwargs, result).get("changed", True)
+        agent.transfer_stats.record(size, size if changed else 0, skipped=not changed)
+        return result
+    
+    def unpack_script(self, packed, dest, cmplx, current_mode=None):
+        """
+        Returns a shell script that unpacks the gzipped file packed into
+        dest on the host, applying the copy arguments in cmplx. The new
+        content replaces dest in a single move, as the copy module does.
+        
+        @param packed: path on the host of the gzipped content
+        @param dest: path on the host to put the content
+        @param cmplx: the copy module arguments
+        @keyword current_mode: the mode of the existing dest, if any, which
+            is kept if cmplx doesn't supply one
+        """
+        q = pipes.quote
+        lines = ["set -e",
+                 "packed=%s" % q(packed),
+                 "dest=%s" % q(dest),
+                 'part="$dest.actuator-part"',
+                 """trap 'rm -f "$packed" "$part"' EXIT""",
+                 'gzip -dc "$packed" > "$part"']
+        if cmplx.get("validate"):
+            lines.append(cmplx["validate"].replace("%s", '"$part"'))
+        if cmplx.get("backup") == "yes":
+            lines.append('if [ -e "$dest" ]; then '
+                         'cp -p "$dest" "$dest.$(date +%Y-%m-%d@%H:%M:%S)~"; fi')
+        mode = cmplx.get("mode") or current_mode
+        if mode:
+            lines.append('chmod %s "$part"' % q(str(mode)))
+        if cmplx.get("owner"):
+            lines.append('chown %s "$part"' % q(cmplx["owner"]))
+        if cmplx.get("group"):
+            lines.append('chgrp %s "$part"' % q(cmplx["group"]))
+        lines.append('mv -f "$part" "$dest"')
+        return "\n".join(lines) + "\n"
+    
+    def _can_compress(self, cmplx):
+        #internal; SELinux contexts are only set by the copy module
+        return not (cmplx.get("seuser") or cmplx.get("serole") or cmplx.get("setype"))
+    
+    def _stat(self, agent, kwargs, path, logfile):
+        #internal; the stat module's view of path on the host, or an empty
+        #dict if it can't be had
+        args = dict(kwargs)
+        args.update({"module_name":"stat", "module_args":"",
+                     "complex_args":{"path":path, "get_md5":False}})
+        try:
+            result = agent.run_module(args, logfile=logfile)
+        except Exception, _:
+            return {}
+        return self.host_result(kwargs, result).get("stat", {})
+    
+    def _unchanged(self, st, digest, cmplx):
+        #internal; True if the host's file described by st already is what
+        #the copy would make it
+        if not st.get("exists") or st.get("checksum") != digest:
+            return False
+        if cmplx.get("mode") is not None:
+            try:
+                if int(st.get("mode", "0"), 8) != int(str(cmplx["mode"]), 8):
+                    return False
+            except ValueError, _:
+                #symbolic modes; let the copy happen
+                return False
+        return ((cmplx.get("owner") is None or st.get("pw_name") == cmplx["owner"]) and
+                (cmplx.get("group") is None or st.get("gr_name") == cmplx["group"]))
+    
+    def _compressed_copy(self, agent, task, kwargs, digest, size, logfile):
+        #internal; check the host's copy, and if it differs send the content
+        #gzipped and unpack it there
+        cmplx = kwargs["complex_args"]
+        src = cmplx["src"]
+        dest = cmplx["dest"]
+        st = self._stat(agent, kwargs, dest, logfile)
+        if st.get("isdir"):
+            dest = posixpath.join(dest, os.path.basename(src))
+            st = self._stat(agent, kwargs, dest, logfile)
+        if st.get("exists") and (cmplx.get("force") == "no" or
+                                 self._unchanged(st, digest, cmplx)):
+            agent.transfer_stats.record(size, 0, skipped=True)
+            return {"contacted":{kwargs["host_list"][0]:{"changed":False,
+                                                         "dest":dest,
+                                                         "checksum":digest}},
+                    "dark":{}}
+        packed = agent.payloads.compressed(src, digest)
+        remote_packed = "%s.actuator-%s.gz" % (dest, digest[:12])
+        args = dict(kwargs)
+        args["complex_args"] = {"src":packed, "dest":remote_packed,
+                                "mode":"0600", "force":"yes"}
+        self.result_check(task, agent.run_module(args, logfile=logfile), logfile=logfile)
+        args = dict(kwargs)
+        args.update({"module_name":"shell", "complex_args":{},
+                     "module_args":self.unpack_script(remote_packed, dest, cmplx,
+                                                      current_mode=st.get("mode")
+                                                                   if st.get("exists")
+                                                                   else None)})
+        result = agent.run_module(args, logfile=logfile)
+        self.result_check(task, result, logfile=logfile)
+        agent.transfer_stats.record(size, os.path.getsize(packed), compressed=True)
+        host_result = self.host_result(kwargs, result)
+        host_result.update({"changed":True, "dest":dest, "checksum":digest})
+        return result
+    
     
 @capture_mapping(_agent_domain, ProcessCopyFileTask)
 class ProcessCopyFileProcessor(CopyFileProcessor):
@@ -256,41 +423,361 @@ class ProcessCopyFileProcessor(CopyFileProcessor):
         return args
     
 
+class FusedTask(_ConfigTask):
+    """
+    Internal; stands in for a chain of L{CommandTask}s and L{ShellTask}s that
+    each only depend on the one before, and that all run on the same host as
+    the same user with the same environment, so that the whole chain can be
+    run as a single shell script with one remote execution.
+    
+    The tasks in the chain are in the fused_tasks attribute. If one of them
+    fails, the ExecutionException raised names that task in its failed_task
+    attribute.
+    """
+    def __init__(self, tasks):
+        super(FusedTask, self).__init__("{}..{}-fused".format(tasks[0].name,
+                                                              tasks[-1].name))
+        self.fused_tasks = list(tasks)
+        
+    def _fix_arguments(self):
+        for task in self.fused_tasks:
+            task.fix_arguments()
+        self.repeat_count = 1
+        self.repeat_interval = self.fused_tasks[0].repeat_interval
+        
+    def refix_arguments(self):
+        for task in self.fused_tasks:
+            task.refix_arguments()
+        super(FusedTask, self).refix_arguments()
+        
+    #the chain runs where, and as who, its first task would
+    def get_task_role(self):
+        return self.fused_tasks[0].get_task_role()
+    
+    def get_run_from(self):
+        return self.fused_tasks[0].get_run_from()
+    
+    def get_task_host(self):
+        return self.fused_tasks[0].get_task_host()
+    
+    def get_run_host(self):
+        return self.fused_tasks[0].get_run_host()
+    
+    def get_remote_user(self):
+        return self.fused_tasks[0].get_remote_user()
+    
+    def get_remote_pass(self):
+        return self.fused_tasks[0].get_remote_pass()
+    
+    def get_private_key_file(self):
+        return self.fused_tasks[0].get_private_key_file()
+    
+    def task_variables(self, for_env=False):
+        return self.fused_tasks[0].task_variables(for_env=for_env)
+    
+    def perform(self):
+        return
+    
+    
+@capture_mapping(_agent_domain, FusedTask)
+class FusedTaskProcessor(TaskProcessor):
+    """
+    Runs the tasks of a L{FusedTask} as one shell script that stops at the
+    first failing task, and works out which task that was.
+    """
+    _failed_marker = "actuator-fused-task-failed"
+    _failed_pattern = re.compile(r"%s (\d+) rc=(-?\d+)" % _failed_marker)
+    
+    def module_name(self):
+        return "shell"
+    
+    def _make_args(self, task):
+        return {"module_name":self.module_name(),
+                "complex_args":{"executable":"/bin/sh"},
+                "module_args":self.script(task)}
+    
+    def script(self, task):
+        """
+        Returns the text of the shell script that runs all the tasks in
+        fused task 'task'
+        
+        Each task's steps are in the order the command module takes them:
+        change to chdir, then check creates and removes (so relative paths
+        are relative to chdir), then run the command. Arguments are quoted,
+        so only tasks whose arguments the module wouldn't expand are fused
+        (see L{AnsibleExecutionAgent._fusion_key}).
+        """
+        q = pipes.quote
+        lines = ["_actuator_failed() { echo \"%s $1 rc=$2\" >&2; exit $2; }" %
+                 self._failed_marker]
+        for i, t in enumerate(task.fused_tasks):
+            if isinstance(t, ShellTask):
+                cmd = "%s -c %s" % (q(t.executable or "/bin/sh"), q(t.free_form))
+            else:
+                cmd = " ".join([q(a) for a in shlex.split(t.free_form)])
+            if t.removes:
+                cmd = "if [ -e %s ]; then %s; fi" % (q(t.removes), cmd)
+            if t.creates:
+                cmd = "if [ ! -e %s ]; then %s; fi" % (q(t.creates), cmd)
+            if t.chdir:
+                cmd = "cd %s && %s" % (q(t.chdir), cmd)
+            lines.append("( %s ) || _actuator_failed %d $?" % (cmd, i))
+        return "\n".join(lines) + "\n"
+    
+    def result_check(self, task, result, logfile=None):
+        try:
+            super(FusedTaskProcessor, self).result_check(task, result,
+                                                         logfile=logfile)
+        except ExecutionException, e:
+            failed = task.fused_tasks[0]
+            detail = result.get("contacted", {}).get(task.get_task_host(), {})
+            m = self._failed_pattern.search(detail.get("stderr") or "")
+            if m:
+                failed = task.fused_tasks[int(m.group(1))]
+            emessage = ("{task} (fused with {count} other tasks in {fused}) failed: {msg}"
+                        .format(task=failed.name, count=len(task.fused_tasks) - 1,
+                                fused=task.name, msg=e.message))
+            if logfile:
+                logfile.write("{}\n".format(emessage))
+            if isinstance(e, HostUnreachableException):
+                raise HostUnreachableException(emessage, response=e.response,
+                                               failed_task=failed, host=e.host)
+            raise ExecutionException(emessage, response=e.response,
+                                     failed_task=failed)
+        
+    
+#options the command module accepts inline in its free form argument; a
+#command that uses them is left to the module rather than fused
+_command_inline_options = ("chdir=", "creates=", "removes=", "executable=",
+                           "warn=")
+
+
+def _module_expands(arg):
+    #internal; True if the command module would expand arg, which it does
+    #with os.path.expandvars(os.path.expanduser(arg))
+    return arg.startswith("~") or "$" in arg
+
+
 class AnsibleExecutionAgent(ExecutionAgent):
     """
     Specific execution agent to run on top of Ansible.
     """
-    def _get_run_host(self, task):
-        #NOTE about task_role and run_from:
-        # the task role provides the focal point for tasks to be performed
-        # in a system, but it is NOT necessarily the place where the task
-        # runs. by default the task_role identifies where to run the task,
-        # but the task supports an optional arg, run_from, that determines
-        # where to actually execute the task. In this latter case, the
-        # task_role anchors the task to a role in the namespace, hence
-        # defining where to get its Var values, but looks elsewhere for
-        # a place to run the task. Any Vars attached to the run_from role
-        # aren't used.
-        run_role = task.get_run_from()
-        if run_role is not None:
-            run_role.fix_arguments()
-            run_host = task.get_run_host()
-            if run_host is None:
-                raise ExecutionException("A run_from role was supplied that doesn't "
-                                         "result in a host for task {}; run_from is {}"
-                                         .format(task.name, run_role.name))
-        else:
-            run_role = task.get_task_role()
-            if run_role is not None:
-                run_role.fix_arguments()
-                run_host = task.get_task_host()
-                if run_host is None:
-                    raise ExecutionException("A host can't be determined from a task_role; "
-                                             "task:{}, task_role={}"
-                                             .format(task.name, run_role.name))
-            else:
-                raise ExecutionException("Can't determine a place to run task {}".format(task.name))
-        return run_host
+    def __init__(self, persistent_ssh=False, ssh_persist=600, fuse_tasks=False,
+                 compress_threshold=65536, **kwargs):
+        """
+        Make a new AnsibleExecutionAgent
+        
+        @keyword persistent_ssh: Optional; boolean, default False. If True,
+            a single ssh connection is kept open to each host and user for
+            the whole config run and shared by all the tasks run there (see
+            L{SSHConnectionManager}), rather than each task making its own.
+            The pause before a task is skipped when its host is already
+            connected. The number of connections opened and reused and the
+            time spent opening them are logged when the run ends, and are
+            available from the connections attribute afterwards.
+        @keyword ssh_persist: Optional; int, default 600. With persistent_ssh,
+            the number of seconds an idle connection is kept if the run
+            doesn't get to close it.
+        @keyword fuse_tasks: Optional; boolean, default False. If True, each
+            chain of L{CommandTask}s and L{ShellTask}s in which every task
+            only depends on the one before and is the only task to depend
+            on it, and which all run on the same host as the same user
+            with the same environment, is run as a single shell script
+            rather than a remote execution per task. Only tasks with a
+            repeat_count of 1 are fused, and a failure is reported against
+            the task in the chain that failed. L{CommandTask}s with arguments
+            that the command module would expand (a leading ~ or a $), and
+            tasks whose creates or removes start with ~, aren't fused. Hosts
+            are determined when the run starts, so in pipelined orchestration
+            tasks on hosts that aren't provisioned yet aren't fused.
+        @keyword compress_threshold: Optional; int, default 65536. Files
+            copied by L{CopyFileTask}s and L{ProcessCopyFileTask}s that are
+            at least this many bytes are compared with the host's copy
+            before being sent, and if they differ are sent gzipped and
+            unpacked on the host. Smaller files are left to Ansible's copy
+            module, which also skips hosts that already have the content.
+            None means never compress. Counts of the copies made and skipped
+            and the bytes sent are logged when the run ends, and are
+            available from the transfer_stats attribute afterwards.
+        @keyword **kwargs: see L{ExecutionAgent}. Ansible's timeout only
+            covers connecting to a host, not running the module, so if a
+            latency_history is given along with persistent_ssh, the time
+            taken to open each connection is recorded in it under the
+            L{connect_key} of the task that opened it, and the connect
+            timeout for tasks is derived from that (see L{connect_timeout}).
+            Without persistent_ssh no connect times are recorded, so the
+            history never changes any timeout and the connect timeout is
+            always 20 seconds. Task latencies are recorded by module (see
+            L{latency_key}) either way.
+        """
+        super(AnsibleExecutionAgent, self).__init__(**kwargs)
+        self.persistent_ssh = persistent_ssh
+        self.ssh_persist = ssh_persist
+        self.fuse_tasks = fuse_tasks
+        self.compress_threshold = compress_threshold
+        self.connections = None
+        self.payloads = PayloadStage()
+        self.transfer_stats = TransferStats()
+        
+    def perform_config(self, completion_record=None):
+        logger = root_logger.getChild(self.exec_agent)
+        self.transfer_stats = TransferStats()
+        if self.persistent_ssh:
+            self.connections = SSHConnectionManager(persist=self.ssh_persist).open()
+        try:
+            return super(AnsibleExecutionAgent, self).perform_config(completion_record)
+        finally:
+            self.payloads.close()
+            logger.info(self.transfer_stats.summary())
+            if self.persistent_ssh:
+                self.connections.close()
+                logger.info(self.connections.summary())
+            
+    def run_module(self, kwargs, logfile=None):
+        """
+        Run an Ansible module with the Runner keyword args kwargs, returning
+        the Runner's result dict.
+        
+        @param kwargs: dict of Runner keyword args, as from
+            L{TaskProcessor.make_args}
+        @keyword logfile: If present, a file-like object that the args and
+            result are written to
+        """
+        if logfile:
+            logfile.write(">>>Params:\n{}\n".format(json.dumps(kwargs)))
+        runner = Runner(**kwargs)
+        result = runner.run()
+        if logfile:
+            logfile.write(">>>Result:\n{}\n".format(json.dumps(result)))
+        return result
+            
+    def record_aborted_task(self, task, etype, value, tb):
+        #failures in fused tasks are reported against the task that failed
+        failed = getattr(value, "failed_task", None)
+        if failed is not None:
+            task = failed
+        super(AnsibleExecutionAgent, self).record_aborted_task(task, etype, value, tb)
+        
+    def _prepare_graph(self, graph):
+        if self.fuse_tasks:
+            graph = self.fuse_task_chains(graph)
+        return graph
+        
+    def fuse_task_chains(self, graph):
+        """
+        Returns a copy of a NetworkX DiGraph of tasks in which each chain of
+        tasks that can be run as one remote execution (see the fuse_tasks
+        keyword on __init__) is replaced by a single L{FusedTask}.
+        
+        @param graph: a NetworkX DiGraph of fixed tasks
+        """
+        graph = graph.copy()
+        keys = {}
+        for task in graph.nodes():
+            key = self._fusion_key(task)
+            if key is not None:
+                keys[task] = key
+        
+        def links(a, b):
+            return (b in keys and keys[a] == keys[b] and
+                    graph.out_degree(a) == 1 and graph.in_degree(b) == 1)
+        
+        chains = []
+        for task in keys:
+            preds = graph.predecessors(task)
+            if len(preds) == 1 and preds[0] in keys and links(preds[0], task):
+                continue    #not the start of a chain
+            chain = [task]
+            while graph.out_degree(chain[-1]) == 1:
+                succ = graph.successors(chain[-1])[0]
+                if not links(chain[-1], succ):
+                    break
+                chain.append(succ)
+            if len(chain) > 1:
+                chains.append(chain)
+        
+        for chain in chains:
+            fused = FusedTask(chain)
+            fused.fix_arguments()
+            graph.add_node(fused)
+            graph.add_edges_from([(p, fused) for p in graph.predecessors(chain[0])])
+            graph.add_edges_from([(fused, s) for s in graph.successors(chain[-1])])
+            graph.remove_nodes_from(chain)
+        if chains:
+            root_logger.getChild(self.exec_agent).info("Fused %d tasks into %d chains" %
+                                                       (sum([len(c) for c in chains]),
+                                                        len(chains)))
+        return graph
+    
+    def _fusion_key(self, task):
+        #internal; returns a hashable value that's the same for tasks that
+        #can be run in the same script, or None if the task can't be fused
+        if type(task) not in (CommandTask, ShellTask):
+            return None
+        task.fix_arguments()
+        if (task.repeat_count != 1 or not task.free_form or
+                task.warn is not None):
+            return None
+        if (type(task) is CommandTask and
+                (task.executable is not None or
+                 [a for a in shlex.split(task.free_form)
+                  if (a.startswith(_command_inline_options) or
+                      _module_expands(a))])):
+            return None
+        #the module expands a leading ~ in these, which a quoted path in the
+        #fused script wouldn't get
+        if [p for p in (task.creates, task.removes) if p and p.startswith("~")]:
+            return None
+        try:
+            host = self._get_run_host(task)
+        except Exception, _:
+            return None
+        if host is None:
+            return None
+        env = task.task_variables(for_env=True)
+        return (host, task.get_remote_user(), task.get_remote_pass(),
+                task.get_private_key_file(), tuple(sorted(env.items())))
+    
+    def latency_key(self, task):
+        """
+        Keys latencies by the Ansible module the task runs rather than the
+        task's class, followed by the name of the task's role
+        """
+        try:
+            module = get_mapper(_agent_domain)[task.__class__]().module_name()
+        except Exception, _:
+            return super(AnsibleExecutionAgent, self).latency_key(task)
+        return "%s/%s" % (module, self._role_kind(task))
+    
+    def connect_key(self, task):
+        """
+        Returns the key the times taken to connect to task's host are kept
+        under in the latency_history: 'connect/' followed by the name of the
+        task's role
+        """
+        return "connect/%s" % self._role_kind(task)
+    
+    def connect_timeout(self, task, default=20):
+        """
+        Returns the timeout in seconds for connecting to task's host: the one
+        the latency_history gives for the task's L{connect_key}, or default
+        if there is no history or not enough of it
+        """
+        if self.latency_history is None:
+            return default
+        return self.latency_history.timeout(self.connect_key(task), default=default)
+    
+    def _pre_task_delay(self, task):
+        #the pause is only there to spread out ssh handshakes
+        if self.connections is not None:
+            try:
+                host = self._get_run_host(task)
+            except Exception, _:
+                #_perform_task will report this properly
+                host = None
+            if host is not None and self.connections.is_connected(host, task.get_remote_user()):
+                return 0
+        return super(AnsibleExecutionAgent, self)._pre_task_delay(task)
         
     def _perform_task(self, task, logfile=None):
         task.fix_arguments()
@@ -309,11 +796,18 @@ class AnsibleExecutionAgent(ExecutionAgent):
                 hlist = [task_host]
             else:
                 raise ExecutionException("We need a default execution host")
-            kwargs = processor.make_args(task, hlist)
+            kwargs = processor.make_args(task, hlist, env=self.role_environment(task))
             kwargs["forks"] = 1
-            kwargs["timeout"] = 20
-            if logfile:
-                logfile.write(">>>Params:\n{}\n".format(json.dumps(kwargs)))
+            kwargs["timeout"] = self.connect_timeout(task)
+            if self.connections is not None:
+                secs = self.connections.acquire(task_host,
+                                                user=kwargs.get("remote_user"),
+                                                private_key_file=kwargs.get("private_key_file"),
+                                                password=kwargs.get("remote_pass"),
+                                                timeout=kwargs["timeout"])
+                if secs is not None and self.latency_history is not None:
+                    self.latency_history.record(self.connect_key(task), secs)
+                kwargs["transport"] = self.connections.transport
             
 #             msg = json.dumps(kwargs)
 #             runner_file = find_file(json_runner.__file__)
@@ -331,10 +825,5 @@ class AnsibleExecutionAgent(ExecutionAgent):
 #                 logfile.write(">>>Result:\n{}\n".format(reply))
 #             result = json.loads(reply)
             
-            runner = Runner(**kwargs)
-            result = runner.run()
-            
-            if logfile:
-                logfile.write(">>>Result:\n{}\n".format(json.dumps(result)))
-            processor.result_check(task, result, logfile=logfile)
+            processor.perform(self, task, kwargs, logfile=logfile)
         return
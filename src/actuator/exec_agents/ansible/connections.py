@@ -0,0 +1,245 @@
+#
+# Copyright (c) 2015 Tom Carroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Persistent ssh connections for the Ansible execution agent.
+'''
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import ansible.constants as C
+from ansible.runner.connection_plugins import paramiko_ssh
+
+from actuator.utils import root_logger
+
+
+class SSHConnectionManager(object):
+    """
+    Keeps a single ssh connection open to each host/user pair for the life of
+    a config run, so that tasks on the same host don't each pay for a full
+    ssh handshake.
+
+    While the manager is open, Ansible's ssh arguments are extended with
+    ControlMaster/ControlPersist options that make every ssh process Ansible
+    starts go through a control socket in a directory private to the
+    manager. Before a task runs, acquire() makes sure the host's master
+    connection exists, opening it if need be; concurrent tasks for the same
+    host wait for the first one to open it rather than each racing to become
+    the master. close() shuts the master connections down and removes the
+    directory.
+
+    If the local ssh doesn't support ControlPersist, the manager has Ansible
+    use its paramiko transport instead, which keeps its connections for the
+    life of the process; handshake times aren't available then.
+
+    The counts of handshakes, reuses and failed handshakes, and the total
+    time spent on handshakes, are kept in the attributes of the same names;
+    see summary().
+    """
+    def __init__(self, persist=600, connect_timeout=20, ssh_command="ssh"):
+        """
+        @keyword persist: Optional; int, default 600. Seconds an idle master
+            connection stays open; this only matters if close() isn't called.
+        @keyword connect_timeout: Optional; int, default 20. Seconds allowed
+            for opening a master connection.
+        @keyword ssh_command: Optional; default "ssh". The ssh client to run.
+        """
+        self.persist = persist
+        self.connect_timeout = connect_timeout
+        self.ssh_command = ssh_command
+        self.lock = threading.Lock()
+        self.host_locks = {}
+        self.control_dir = None
+        self.transport = "ssh"
+        self.saved_ssh_args = None
+        self.handshakes = 0
+        self.handshake_time = 0.0
+        self.reuses = 0
+        self.failures = 0
+        self.logger = root_logger.getChild("ssh_connections")
+
+    def open(self):
+        """
+        Create the control socket directory and point Ansible's ssh
+        connections at it. Returns self.
+        """
+        self.control_dir = tempfile.mkdtemp(prefix="actuator-cp-")
+        if not self._supports_persist():
+            self.logger.info("ssh doesn't support ControlPersist; using paramiko")
+            self.transport = "paramiko"
+            return self
+        self.saved_ssh_args = C.ANSIBLE_SSH_ARGS
+        #ssh uses the first value it is given for an option, so these have to
+        #come before any the user supplied
+        C.ANSIBLE_SSH_ARGS = " ".join(self.mux_args() +
+                                      [self.saved_ssh_args or ""]).strip()
+        return self
+
+    def close(self):
+        """
+        Shut down all the master connections and remove the control socket
+        directory, restoring Ansible's ssh arguments
+        """
+        if self.control_dir is None:
+            return
+        if self.transport == "ssh":
+            C.ANSIBLE_SSH_ARGS = self.saved_ssh_args
+            #Ansible may have opened masters itself if acquire() couldn't
+            for name in os.listdir(self.control_dir):
+                self._run_ssh(["-o", "ControlPath=%s" % os.path.join(self.control_dir, name),
+                               "-O", "exit", "actuator-control-host"])
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
+
+    def mux_args(self):
+        """
+        Returns the list of ssh arguments that make a connection use the
+        manager's control sockets
+        """
+        return ["-o", "ControlMaster=auto",
+                "-o", "ControlPersist=%ds" % self.persist,
+                "-o", "ControlPath=%s" % os.path.join(self.control_dir, "%r@%h:%p")]
+
+    def control_path(self, host, user=None, port=22):
+        """
+        Returns the path of the control socket for a host and user
+        """
+        return os.path.join(self.control_dir,
+                            "%s@%s:%d" % (user or C.DEFAULT_REMOTE_USER, host, port))
+
+    def is_connected(self, host, user=None):
+        """
+        Returns True if there is an open connection to host for user
+        """
+        if self.transport == "ssh":
+            return os.path.exists(self.control_path(host, user))
+        return self._paramiko_key(host, user) in paramiko_ssh.SSH_CONNECTION_CACHE
+
+    def acquire(self, host, user=None, private_key_file=None, password=None,
+                timeout=None):
+        """
+        Called before a task is run on a host; makes sure a connection to the
+        host is open, opening one if there isn't. Failures aren't raised;
+        Ansible will report an unreachable host when it tries to run the task.
+        
+        Returns the seconds taken to open the connection if this call opened
+        it, otherwise None.
+
+        @param host: host name or IP the task is run on
+        @keyword user: the remote user; None means Ansible's default
+        @keyword private_key_file: the key file to log in with, if any
+        @keyword password: the remote user's password, if any. The master
+            connection can't be opened with a password, so Ansible opens it
+            when the task runs.
+        @keyword timeout: Optional; seconds allowed for opening the
+            connection, if not the manager's connect_timeout
+        """
+        user = user or C.DEFAULT_REMOTE_USER
+        with self._host_lock(host, user):
+            if self.is_connected(host, user):
+                with self.lock:
+                    self.reuses += 1
+                return None
+            if self.transport != "ssh" or password is not None:
+                #the connection is opened by Ansible when it runs the task
+                with self.lock:
+                    self.handshakes += 1
+                return None
+            args = self.mux_args()
+            if self.saved_ssh_args:
+                args.extend(shlex.split(self.saved_ssh_args))
+            args.extend(["-o", "ConnectTimeout=%d" % (timeout or self.connect_timeout),
+                         "-o", "BatchMode=yes",
+                         "-o", "User=%s" % user])
+            if private_key_file is not None:
+                args.extend(["-o", "IdentityFile=%s" % private_key_file])
+            args.extend(["-M", "-N", "-f", host])
+            start = time.time()
+            rc, err = self._run_ssh(args)
+            elapsed = time.time() - start
+            with self.lock:
+                opened = rc == 0 and self.is_connected(host, user)
+                if opened:
+                    self.handshakes += 1
+                    self.handshake_time += elapsed
+                else:
+                    self.failures += 1
+            if rc != 0:
+                self.logger.warning("Couldn't open a connection to %s@%s (%d): %s" %
+                                    (user, host, rc, err.strip()))
+            return elapsed if opened else None
+
+    def reuse_rate(self):
+        """
+        Returns the fraction of task connections that reused an open
+        connection
+        """
+        total = self.handshakes + self.reuses + self.failures
+        return float(self.reuses) / total if total else 0.0
+
+    def summary(self):
+        """
+        Returns a one line description of the connections made
+        """
+        avg = (self.handshake_time / self.handshakes
+               if self.handshakes and self.transport == "ssh"
+               else 0.0)
+        return ("ssh connections: %d opened (avg handshake %.2fs, total %.2fs), "
+                "%d reused (%.0f%% reuse), %d failed" %
+                (self.handshakes, avg, self.handshake_time, self.reuses,
+                 self.reuse_rate() * 100, self.failures))
+
+    def _host_lock(self, host, user):
+        #internal; the lock that serialises opening a host's connection
+        with self.lock:
+            return self.host_locks.setdefault((host, user), threading.Lock())
+
+    def _paramiko_key(self, host, user):
+        #internal; how Ansible's paramiko transport keys its connection cache
+        return "%s__%s__" % (host, user or C.DEFAULT_REMOTE_USER)
+
+    def _supports_persist(self):
+        #internal; the same check Ansible makes for its 'smart' transport
+        try:
+            proc = subprocess.Popen([self.ssh_command, "-o", "ControlPersist"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _, err = proc.communicate()
+        except OSError, _:
+            return False
+        return "Bad configuration option" not in err
+
+    def _run_ssh(self, args):
+        #internal; runs ssh with args, returning the exit code and stderr.
+        #Output goes to files, as a backgrounded master keeps pipes open
+        with tempfile.TemporaryFile() as errfile:
+            with open(os.devnull, "r+") as devnull:
+                try:
+                    rc = subprocess.call([self.ssh_command] + args, stdin=devnull,
+                                         stdout=devnull, stderr=errfile)
+                except OSError, e:
+                    return -1, str(e)
+            errfile.seek(0)
+            return rc, errfile.read()
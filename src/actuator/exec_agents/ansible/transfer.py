@@ -0,0 +1,175 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Support for copying file content to hosts with the Ansible execution agent:
+local staging of content by digest, compression of large payloads, and
+per-run transfer statistics.
+'''
+import os
+import os.path
+import gzip
+import hashlib
+import shutil
+import tempfile
+import threading
+
+
+class PayloadStage(object):
+    """
+    Holds the content copy tasks send to hosts in local files named for the
+    content's SHA1 digest, so that the same content is only written, hashed
+    and compressed once however many hosts it goes to, and so content
+    doesn't have to be passed inline in module arguments (and so in logs).
+    
+    The staging directory is created when first needed and removed by
+    close().
+    """
+    def __init__(self, compress_level=6):
+        """
+        @keyword compress_level: Optional; int, default 6. The gzip
+            compression level for compressed payloads
+        """
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+        self.stage_dir = None
+        self.checksums = {}
+        self.compressed_paths = {}
+        
+    def stage(self, content, name="content"):
+        """
+        Returns the path of a local file holding content. The file's name is
+        name, so that copies to a destination directory end up with the
+        right file name.
+        
+        @param content: string; the content to stage
+        @keyword name: the base name for the staged file
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        digest = hashlib.sha1(content).hexdigest()
+        with self.lock:
+            path = os.path.join(self._dir(), digest, os.path.basename(name) or "content")
+            if not os.path.exists(path):
+                #the directory is shared by content staged under other names
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, "wb") as f:
+                    f.write(content)
+            self.checksums[path] = (os.path.getmtime(path), len(content), digest)
+        return path
+    
+    def checksum(self, path):
+        """
+        Returns a (digest, size) tuple for a local file; the digest is the
+        hex SHA1 Ansible uses as a file's checksum. Results are cached until
+        the file changes.
+        """
+        mtime, size = os.path.getmtime(path), os.path.getsize(path)
+        with self.lock:
+            cached = self.checksums.get(path)
+        if cached is not None and cached[:2] == (mtime, size):
+            return cached[2], size
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(65536), ""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self.lock:
+            self.checksums[path] = (mtime, size, digest)
+        return digest, size
+    
+    def compressed(self, path, digest):
+        """
+        Returns the path of a gzipped copy of local file path, whose digest
+        is digest, making it if this is the first request for that digest.
+        """
+        with self.lock:
+            gz_path = self.compressed_paths.get(digest)
+            if gz_path is None:
+                gz_path = os.path.join(self._dir(), "%s.gz" % digest)
+                with open(path, "rb") as src:
+                    gz = gzip.GzipFile(gz_path, "wb", compresslevel=self.compress_level)
+                    try:
+                        shutil.copyfileobj(src, gz)
+                    finally:
+                        gz.close()
+                self.compressed_paths[digest] = gz_path
+        return gz_path
+    
+    def close(self):
+        """
+        Remove all staged files
+        """
+        with self.lock:
+            if self.stage_dir is not None:
+                shutil.rmtree(self.stage_dir, ignore_errors=True)
+            self.stage_dir = None
+            self.checksums = {}
+            self.compressed_paths = {}
+            
+    def _dir(self):
+        #internal; must be called with the lock held
+        if self.stage_dir is None:
+            self.stage_dir = tempfile.mkdtemp(prefix="actuator-stage-")
+        return self.stage_dir
+    
+    
+class TransferStats(object):
+    """
+    Counts of the file copies made in a config run: copies attempted, copies
+    skipped because the host already had the content, copies sent
+    compressed, the bytes of content involved, and the bytes actually sent.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.copies = 0
+        self.skipped = 0
+        self.compressed = 0
+        self.payload_bytes = 0
+        self.sent_bytes = 0
+        
+    def record(self, size, sent, skipped=False, compressed=False):
+        """
+        Record a file copy
+        
+        @param size: size of the file's content in bytes
+        @param sent: bytes transferred to the host for it
+        @keyword skipped: True if the host already had the content
+        @keyword compressed: True if the content was sent compressed
+        """
+        with self.lock:
+            self.copies += 1
+            self.payload_bytes += size
+            self.sent_bytes += sent
+            if skipped:
+                self.skipped += 1
+            if compressed:
+                self.compressed += 1
+                
+    def summary(self):
+        """
+        Returns a one line description of the copies made
+        """
+        return ("file copies: %d (%d skipped as unchanged, %d compressed), "
+                "%d bytes of content, %d bytes sent" %
+                (self.copies, self.skipped, self.compressed,
+                 self.payload_bytes, self.sent_bytes))
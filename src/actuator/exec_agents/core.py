@@ -32,14 +32,111 @@ import random
 from actuator import ConfigModel, NamespaceModel, InfraModel, ActuatorException
 from actuator.utils import LOG_INFO, root_logger
 from actuator.modeling import AbstractModelReference
+from actuator.namespace import MultiRole
+from actuator.config import StructuralTask, NullTask
+from actuator.exec_agents.pool import PoolSizer, antichain_width
+from actuator.exec_agents.simulate import simulate_run
 
 
 class ExecutionException(ActuatorException):
-    def __init__(self, message=None, response="None available"):
+    def __init__(self, message=None, response="None available", failed_task=None):
         super(ExecutionException, self).__init__(message)
         self.response = response
+        #set when the task that failed isn't the one that was being performed
+        self.failed_task = failed_task
 
 
+class HostUnreachableException(ExecutionException):
+    """
+    Raised when a task fails because its host can't be reached, as opposed
+    to the task failing on the host.
+    """
+    def __init__(self, message=None, response="None available", failed_task=None,
+                 host=None):
+        super(HostUnreachableException, self).__init__(message, response=response,
+                                                       failed_task=failed_task)
+        self.host = host
+
+
+class TaskFuture(object):
+    """
+    The eventual outcome of a task whose work finishes after _perform_task()
+    returns.
+    
+    An agent's _perform_task() may return one of these instead of blocking
+    until a long-running operation completes; the worker thread is then free
+    to perform other tasks, and the task is only considered complete (and its
+    successors queued) when set_result() or set_exception() is called on the
+    future, which may happen on any thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+        self.result = None
+        self.exception = None
+        self.traceback = None
+        
+    def done(self):
+        """
+        Returns True if the future has a result or an exception
+        """
+        return self.event.is_set()
+    
+    def wait(self, timeout=None):
+        """
+        Block until the future is done or timeout secs have passed. Returns
+        True if the future is done.
+        """
+        self.event.wait(timeout)
+        return self.event.is_set()
+    
+    def add_done_callback(self, callback):
+        """
+        Arrange for callback to be called with this future as its only
+        argument when the future is done. If the future is already done the
+        callback is called immediately on the calling thread.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        self._call(callback)
+        
+    def set_result(self, result=None):
+        """
+        Complete the future successfully
+        """
+        self._complete(result, None, None)
+        
+    def set_exception(self, exception, tb=None):
+        """
+        Complete the future with an exception
+        
+        @param exception: the exception instance
+        @keyword tb: optional traceback object for the exception
+        """
+        self._complete(None, exception, tb)
+        
+    def _complete(self, result, exception, tb):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.result = result
+            self.exception = exception
+            self.traceback = tb
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+            
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception, _:
+            root_logger.getChild("task_future").exception("Task future callback raised")
+            
+
 class ConfigRecord(object):
     """
     Returned by the execution agent; a record of the tasks that have been
@@ -65,6 +162,18 @@ class ConfigRecord(object):
         return task in set([r[0] for r in self.completed_tasks])
 
 
+class RoleEnvironment(dict):
+    """
+    The environment variables for the tasks of a Role: a snapshot of the
+    Role's Vars, as from task_variables(for_env=True), that is shared by all
+    of the Role's tasks and so can't be changed.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("a RoleEnvironment is shared by all tasks of a Role "
+                        "and can't be changed")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+    
+    
 class ExecutionAgent(object):
     """
     Base class for execution agents. The mechanics of actually executing a task
@@ -73,10 +182,14 @@ class ExecutionAgent(object):
     when.
     """
     exception_class = ExecutionException
+    #bounds of the random pause before a task; see _pre_task_delay()
+    pre_task_delay_range = (0.2, 2.5)
     exec_agent = "exec_agent"
     def __init__(self, exec_model_instance=None, config_model_instance=None,
                  namespace_model_instance=None, infra_model_instance=None,
-                 num_threads=5, do_log=False, no_delay=False, log_level=LOG_INFO):
+                 num_threads=5, do_log=False, no_delay=False, log_level=LOG_INFO,
+                 host_breaker=None, latency_history=None, hedger=None,
+                 max_threads=None, max_per_host=None):
         """
         Make a new ExecutionAgent
         
@@ -88,7 +201,8 @@ class ExecutionAgent(object):
         @keyword infra_model_instance: UNUSED; an instance of a derived class of
             InfraModel
         @keyword num_threads: Integer, default 5. The number of worker threads
-            to spin up to perform tasks.
+            to spin up to perform tasks. If max_threads is given, this is the
+            fewest the agent will have.
         @keyword do_log: boolean, default False. If True, creates a log file
             that contains more detailed logs of the activities carried out.
             Independent of log_level (see below).
@@ -99,6 +213,37 @@ class ExecutionAgent(object):
             tasks can all start in parallel on the same Role's host.
         @keyword log_level: Any of the symbolic log levels in the actuator root
             package, LOG_CRIT, LOG_DEBUG, LOG_ERROR, LOG_INFO, or LOG_WARN
+        @keyword host_breaker: Optional; a
+            L{actuator.readiness.HostCircuitBreaker}. If supplied, it is told
+            of each task that reaches its host and each that fails with a
+            L{HostUnreachableException}, and once a host's circuit opens its
+            tasks are failed or parked as the breaker directs instead of
+            being retried.
+        @keyword latency_history: Optional; a
+            L{actuator.exec_agents.history.LatencyHistory}. If supplied, the
+            time each task takes to succeed is recorded in it under the task's
+            L{latency_key}, and it is saved when the run is done. The
+            latencies recorded here don't change any timeouts; derived agents
+            that can learn a timeout from the history record what they need
+            for it themselves (see
+            L{actuator.exec_agents.ansible.agent.AnsibleExecutionAgent}).
+        @keyword hedger: Optional; a
+            L{actuator.exec_agents.hedging.StragglerHedger}. If supplied,
+            rerun_safe tasks made by a MultiTask that run much longer than
+            their siblings get a second attempt started alongside the first,
+            and the first of the two to succeed is used. Hedging attempts
+            run in threads of their own, beyond num_threads.
+        @keyword max_threads: Optional; int. If supplied, the number of
+            worker threads is adjusted while tasks are performed, between
+            num_threads and max_threads, to suit the number of tasks ready
+            and waiting and how long tasks are taking; see
+            L{actuator.exec_agents.pool.PoolSizer}. The agent never has more
+            workers than the number of tasks in its graph that could be
+            running at once. If not supplied, num_threads workers are used
+            throughout.
+        @keyword max_per_host: Optional; int. With max_threads, the most
+            tasks each host is expected to run at once; the pool is kept to
+            no more than this many workers per host the tasks run on.
         """
         #@TODO: need to add a test for the type of the exec_model_instance 
         self.exec_mi = exec_model_instance
@@ -127,6 +272,24 @@ class ExecutionAgent(object):
         self.num_threads = num_threads
         self.do_log = do_log
         self.no_delay = no_delay
+        #optional object with an admit(task, release) method that can hold
+        #tasks back even though their predecessors are done; see
+        #_admit_task()
+        self.task_gate = None
+        #RoleEnvironments for the run, keyed by Role id; see role_environment()
+        self.role_environments = {}
+        self.env_lock = threading.Lock()
+        self.host_breaker = host_breaker
+        self.latency_history = latency_history
+        self.hedger = hedger
+        self.max_threads = max_threads
+        self.max_per_host = max_per_host
+        #see _size_pool()
+        self.pool_sizer = None
+        self.pool_lock = threading.Lock()
+        self.workers = 0
+        self.busy = 0
+        self.retiring = 0
         
     def record_aborted_task(self, task, etype, value, tb):
         """
@@ -176,11 +339,18 @@ class ExecutionAgent(object):
             role_id = ""
         logger.info(add_suffix(task, "processing started for role %s(%s)"
                                % (role_name, role_id)))
-        if not self.no_delay:
-            time.sleep(random.uniform(0.2, 2.5))
+        delay = self._pre_task_delay(task)
+        if delay:
+            time.sleep(delay)
         try_count = 0
         success = False
-        while try_count < task.repeat_count and not success:
+        deferred = False
+        #set when an open host circuit means the task isn't to be retried
+        held = parked = False
+        hedge_key = (self.hedger.sibling_key(task)
+                     if self.hedger is not None
+                     else None)
+        while try_count < task.repeat_count and not success and not held:
             try_count += 1
             if self.do_log:
                 logfile=open("{}.{}-try{}.txt".format(task.name, str(task._id)[-4:], try_count), "w")
@@ -189,9 +359,18 @@ class ExecutionAgent(object):
             try:
                 logger.info(add_suffix(task, "start performing task for role %s(%s)"
                                        % (role_name, role_id)))
-                self._perform_task(task, logfile=logfile)
-                logger.info(add_suffix(task, "task succeeded for role %s(%s)"
-                                       % (role_name, role_id)))
+                started = time.time()
+                if hedge_key is not None:
+                    result = self._perform_hedged(task, hedge_key, logfile=logfile)
+                else:
+                    result = self._perform_task(task, logfile=logfile)
+                if isinstance(result, TaskFuture):
+                    logger.info(add_suffix(task, "task handed off for completion for role %s(%s)"
+                                           % (role_name, role_id)))
+                    deferred = result
+                else:
+                    logger.info(add_suffix(task, "task succeeded for role %s(%s)"
+                                           % (role_name, role_id)))
                 success = True
             except Exception, e:
                 logger.warning(add_suffix(task, "task failed for role %s(%s)"
@@ -200,7 +379,18 @@ class ExecutionAgent(object):
                 if logfile:
                     logfile.write("{}\n".format(msg))
                 tb = sys.exc_info()[2]
-                if try_count < task.repeat_count:
+                open_host = self._breaker_opened(task, e)
+                if open_host is not None:
+                    held = True
+                    if self.host_breaker.hold(open_host, self._breaker_release(graph, task)):
+                        logger.warning(add_suffix(task, "host %s circuit open; parking task"
+                                                  % open_host))
+                        parked = True
+                    else:
+                        logger.error(add_suffix(task, "host %s circuit open; task aborting"
+                                                % open_host))
+                        self.record_aborted_task(task, type(e), e, tb)
+                elif try_count < task.repeat_count:
                     retry_wait = try_count * task.repeat_interval
                     logger.warning(add_suffix(task, "retrying after %d secs" % retry_wait))
                     msg = "Retrying {} again in {} secs".format(task.name, retry_wait)
@@ -214,50 +404,374 @@ class ExecutionAgent(object):
                 del tb
                 sys.exc_clear()
             else:
-                self.node_lock.acquire()
-                self.num_tasks_to_perform -= 1
-                if self.num_tasks_to_perform == 0:
-                    self.stop = True
-                else:
-                    for successor in graph.successors_iter(task):
-                        graph.node[successor]["ins_traversed"] += 1
-                        if graph.in_degree(successor) == graph.node[successor]["ins_traversed"]:
-                            logger.debug(add_suffix(successor, "queueing up for performance"))
-                            self.task_queue.put((graph, successor))
-                self.node_lock.release()
+                if self.host_breaker is not None:
+                    host = self._task_host(task)
+                    if host is not None:
+                        self.host_breaker.record_success(host)
+                if deferred is False:
+                    if hedge_key is not None:
+                        self.hedger.record(hedge_key, time.time() - started)
+                    self._record_latency(task, time.time() - started)
+                    self._task_succeeded(graph, task)
             if logfile:
                 logfile.flush()
                 logfile.close()
                 del logfile
-        if not success:
+        if deferred is not False:
+            deferred.add_done_callback(lambda f: self._deferred_task_done(graph, task, f))
+        if not success and not parked:
 #             print "ABORTING"
             self.abort_process_tasks()
+            
+    def role_environment(self, task):
+        """
+        Returns the environment variables for task as a L{RoleEnvironment}.
+        All tasks with the same task_role get the same RoleEnvironment, made
+        the first time one of them asks for it during a run, so the Role's
+        Vars are only expanded once per run however many tasks it has.
+        
+        @param task: the task whose environment is wanted; its task_role must
+            have had its arguments fixed
+        """
+        role = task.get_task_role()
+        key = role._id if role is not None else None
+        env = self.role_environments.get(key)
+        if env is None:
+            env = RoleEnvironment(task.task_variables(for_env=True))
+            with self.env_lock:
+                env = self.role_environments.setdefault(key, env)
+        return env
+        
+    def _perform_hedged(self, task, key, logfile=None):
+        #internal; performs task in a thread of its own, and if it runs past
+        #the hedger's threshold for its siblings starts a second attempt.
+        #Returns the result of the first attempt to succeed, or raises the
+        #original attempt's exception if both fail; the other attempt is left
+        #to finish on its own, and its outcome is ignored
+        outcomes = Queue.Queue()
+        started = time.time()
+        state = {"winner":None}
+        lock = threading.Lock()
+        
+        def attempt(hedge, logfile):
+            try:
+                outcome = (hedge, self._perform_task(task, logfile=logfile), None)
+            except Exception, _:
+                outcome = (hedge, None, sys.exc_info())
+            finished = time.time()
+            with lock:
+                winner = state["winner"]
+            if winner is not None and winner[0] and not hedge:
+                #the original was beaten by its hedge
+                self.hedger.record_abandoned(finished - winner[1])
+            outcomes.put(outcome)
+            
+        def launch(hedge, logfile):
+            t = threading.Thread(target=attempt, args=(hedge, logfile))
+            t.daemon = True
+            t.start()
+            
+        launch(False, logfile)
+        running = 1
+        hedged = False
+        failure = None
+        while running:
+            try:
+                hedge, result, exc = outcomes.get(timeout=0.1)
+            except Queue.Empty:
+                elapsed = time.time() - started
+                if (not hedged and not self.stop and
+                        self.hedger.should_hedge(key, elapsed)):
+                    hedged = True
+                    running += 1
+                    self.hedger.record_hedge(task, elapsed)
+                    launch(True, None)
+                continue
+            running -= 1
+            if exc is None:
+                with lock:
+                    state["winner"] = (hedge, time.time())
+                if hedged:
+                    self.hedger.record_outcome(hedge)
+                return result
+            if failure is None or not hedge:
+                failure = exc
+        if hedged:
+            self.hedger.record_outcome(None)
+        raise failure[0], failure[1], failure[2]
+        
+    def latency_key(self, task):
+        """
+        Returns the key task's latencies are kept under in the
+        latency_history: the task's class and the name of its task_role
+        (for the Roles of a MultiRole, the name of the MultiRole's template),
+        joined with a '/', so that the same kind of work on the same kind of
+        host is grouped together. Derived classes can use keys that say more
+        about what the task does.
+        """
+        return "%s/%s" % (task.__class__.__name__, self._role_kind(task))
+    
+    def _role_kind(self, task):
+        #internal; the name of task's role, or of its template if it is one
+        #of a MultiRole's, or 'default' if it has none
+        try:
+            role = task.get_task_role()
+            if isinstance(role, AbstractModelReference):
+                role = role.value()
+            if isinstance(role.parent_container, MultiRole):
+                role = role.parent_container.get_prototype()
+            name = role.name
+            if isinstance(name, AbstractModelReference):
+                name = name.value()
+        except Exception, _:
+            name = None
+        return name or "default"
+    
+    def _record_latency(self, task, secs):
+        #internal; add a successful task's duration to the latency history
+        if (self.latency_history is None or
+                isinstance(task, (StructuralTask, NullTask))):
+            return
+        self.latency_history.record(self.latency_key(task), secs)
+        
+    def _task_host(self, task):
+        #internal; the host task runs on, or None if there isn't one or the
+        #task doesn't connect to it
+        if isinstance(task, (StructuralTask, NullTask)):
+            return None
+        try:
+            return self._get_run_host(task)
+        except Exception, _:
+            return None
+        
+    def _breaker_opened(self, task, exc):
+        #internal; if exc says task couldn't reach its host, tell the breaker,
+        #and return the host if its circuit is now open
+        if self.host_breaker is None or not isinstance(exc, HostUnreachableException):
+            return None
+        host = exc.host if exc.host is not None else self._task_host(task)
+        if host is None:
+            return None
+        self.host_breaker.record_unreachable(host)
+        return host if self.host_breaker.is_open(host) else None
+    
+    def _breaker_release(self, graph, task):
+        #internal; returns the callback for a task parked by the breaker
+        def released(ok):
+            if ok:
+                self.task_queue.put((graph, task))
+            else:
+                e = self.host_breaker.unreachable_exception(self._task_host(task), task)
+                self.record_aborted_task(task, type(e), e, None)
+                self.abort_process_tasks()
+        return released
+    
+    def _breaker_holds(self, graph, task):
+        #internal; returns True if task's host has an open circuit, in which
+        #case the task has been parked, or failed
+        if self.host_breaker is None:
+            return False
+        host = self._task_host(task)
+        if host is None or not self.host_breaker.is_open(host):
+            return False
+        if not self.host_breaker.hold(host, self._breaker_release(graph, task)):
+            e = self.host_breaker.unreachable_exception(host, task)
+            self.record_aborted_task(task, type(e), e, None)
+            self.abort_process_tasks()
+        return True
+        
+    def _pre_task_delay(self, task):
+        """
+        Returns the number of seconds to pause before starting a task: a
+        random time of up to 2.5 seconds, unless no_delay was specified.
+        """
+        return 0 if self.no_delay else random.uniform(*self.pre_task_delay_range)
+        
+    def _task_succeeded(self, graph, task):
+        #internal; account for a completed task and queue up any successors
+        #that now have all their predecessors done
+        logger = root_logger.getChild(self.exec_agent)
+        self.node_lock.acquire()
+        try:
+            self.num_tasks_to_perform -= 1
+            if self.num_tasks_to_perform == 0:
+                self.stop = True
+            else:
+                for successor in graph.successors_iter(task):
+                    graph.node[successor]["ins_traversed"] += 1
+                    if graph.in_degree(successor) == graph.node[successor]["ins_traversed"]:
+                        logger.debug("task %s named %s id %s->queueing up for performance" %
+                                     (successor.__class__.__name__, successor.name,
+                                      successor._id))
+                        self.task_queue.put((graph, successor))
+        finally:
+            self.node_lock.release()
+            
+    def _deferred_task_done(self, graph, task, future):
+        #internal; called when a TaskFuture returned by _perform_task completes
+        logger = root_logger.getChild(self.exec_agent)
+        if future.exception is None:
+            logger.info("task %s named %s id %s->task succeeded" %
+                        (task.__class__.__name__, task.name, task._id))
+            self._task_succeeded(graph, task)
+        else:
+            logger.error("task %s named %s id %s->task failed after hand off; aborting" %
+                         (task.__class__.__name__, task.name, task._id))
+            self.record_aborted_task(task, type(future.exception),
+                                     future.exception, future.traceback)
+            self.abort_process_tasks()
+        
+    def _get_run_host(self, task):
+        #NOTE about task_role and run_from:
+        # the task role provides the focal point for tasks to be performed
+        # in a system, but it is NOT necessarily the place where the task
+        # runs. by default the task_role identifies where to run the task,
+        # but the task supports an optional arg, run_from, that determines
+        # where to actually execute the task. In this latter case, the
+        # task_role anchors the task to a role in the namespace, hence
+        # defining where to get its Var values, but looks elsewhere for
+        # a place to run the task. Any Vars attached to the run_from role
+        # aren't used.
+        run_role = task.get_run_from()
+        if run_role is not None:
+            run_role.fix_arguments()
+            run_host = task.get_run_host()
+            if run_host is None:
+                raise ExecutionException("A run_from role was supplied that doesn't "
+                                         "result in a host for task {}; run_from is {}"
+                                         .format(task.name, run_role.name))
+        else:
+            run_role = task.get_task_role()
+            if run_role is not None:
+                run_role.fix_arguments()
+                run_host = task.get_task_host()
+                if run_host is None:
+                    raise ExecutionException("A host can't be determined from a task_role; "
+                                             "task:{}, task_role={}"
+                                             .format(task.name, run_role.name))
+            else:
+                raise ExecutionException("Can't determine a place to run task {}".format(task.name))
+        return run_host
         
     def _perform_task(self, task, logfile=None):
         """
         Actually do the task; the default asks the task to perform itself,
         which usually means that it does nothing.
+        
+        Derived classes may return a L{TaskFuture} if the task's work will
+        complete after this method returns; the task's successors will then
+        only be run once the future is given a result.
         """
         task.perform()
         
     def abort_process_tasks(self):
         """
-        The the agent to abort performing any further tasks.
+        The the agent to abort performing any further tasks. If the agent
+        hasn't started its run yet, the run stops as soon as it starts.
         """
         self.stop = True
         
+    def _admit_task(self, graph, task):
+        """
+        Internal; returns True if a task whose predecessors are done can be
+        performed now. If a task_gate has been set and it isn't ready for the
+        task, the gate holds on to it and the task is put back on the queue
+        once the gate lets it go. If the gate raises, the task is aborted.
+        """
+        if self.task_gate is None:
+            return True
+        try:
+            return self.task_gate.admit(task, lambda: self.task_queue.put((graph, task)))
+        except Exception, e:
+            self.record_aborted_task(task, type(e), e, sys.exc_info()[2])
+            self.abort_process_tasks()
+            return False
+        
     def process_tasks(self):
         """
         Tell the agent to start performing tasks; results in calls to
         self.perform_task()
         """
-        while not self.stop:
-            try:
-                graph, task = self.task_queue.get(block=True, timeout=0.2)
-                if not self.stop:
-                    self.perform_task(graph, task)
-            except Queue.Empty, _:
-                pass
+        try:
+            while not self.stop:
+                try:
+                    graph, task = self.task_queue.get(block=True, timeout=0.2)
+                    if (not self.stop and self._admit_task(graph, task) and
+                            not self._breaker_holds(graph, task)):
+                        self._perform_counted(graph, task)
+                except Queue.Empty, _:
+                    if self._retire_worker():
+                        break
+        finally:
+            with self.pool_lock:
+                self.workers -= 1
+                
+    def _perform_counted(self, graph, task):
+        #internal; perform_task, keeping track of busy workers and task times
+        #for the pool sizer
+        with self.pool_lock:
+            self.busy += 1
+        started = time.time()
+        try:
+            self.perform_task(graph, task)
+        finally:
+            with self.pool_lock:
+                self.busy -= 1
+                if self.pool_sizer is not None:
+                    self.pool_sizer.observe(time.time() - started)
+                    
+    def _start_worker(self):
+        #internal; add a worker thread to the pool
+        with self.pool_lock:
+            self.workers += 1
+        worker = threading.Thread(target=self.process_tasks)
+        worker.start()
+        
+    def _await_workers(self, timeout=5.0):
+        #internal; wait for the worker threads to exit
+        give_up = time.time() + timeout
+        while time.time() < give_up:
+            with self.pool_lock:
+                if self.workers <= 0:
+                    return
+            time.sleep(0.05)
+            
+    def _retire_worker(self):
+        #internal; called by an idle worker; returns True if the worker
+        #should exit to shrink the pool
+        with self.pool_lock:
+            if self.retiring > 0:
+                self.retiring -= 1
+                return True
+        return False
+    
+    def _make_pool_sizer(self, graph, num_threads=None, max_threads=None):
+        #internal; the PoolSizer for a run over graph, whose ceiling is
+        #limited by the graph's width and the capacity of its hosts
+        num_threads = num_threads if num_threads is not None else self.num_threads
+        max_threads = max_threads if max_threads is not None else self.max_threads
+        width = antichain_width(graph)
+        host_capacity = None
+        if self.max_per_host is not None:
+            hosts = set([self._task_host(t) for t in graph.nodes()])
+            hosts.discard(None)
+            if hosts:
+                host_capacity = len(hosts) * self.max_per_host
+        return PoolSizer(num_threads, max_threads, width=width,
+                         host_capacity=host_capacity)
+        
+    def _size_pool(self):
+        #internal; start or retire workers as the pool sizer says
+        with self.pool_lock:
+            current = self.workers - self.retiring
+            busy = self.busy
+        want = self.pool_sizer.target(current, busy, self.task_queue.qsize())
+        if want > current:
+            for _ in range(want - current):
+                self._start_worker()
+        elif want < current:
+            with self.pool_lock:
+                self.retiring += current - want
         
     def perform_config(self, completion_record=None):
         """
@@ -267,33 +781,100 @@ class ExecutionAgent(object):
         
         @keyword completion_record: currently unused
         """
+        self._run_graph(self.get_graph(with_fix=True))
+        
+    def get_graph(self, with_fix=False):
+        """
+        Returns the NetworkX DiGraph of the tasks the agent is to perform,
+        where the edges go from a task to the tasks that can only start once
+        it has completed.
+        
+        @keyword with_fix: boolean, default False. If True, fix_arguments()
+            is called on the tasks first
+        """
+        if not (self.namespace_mi and self.config_mi):
+            raise ExecutionException("either namespace_model_instance or config_model_instance weren't specified")
+        self.config_mi.update_nexus(self.namespace_mi.nexus)
+        return self.config_mi.get_graph(with_fix=with_fix)
+    
+    def simulate(self, num_threads=None, max_threads=None, jitter=None,
+                 durations=None, default_duration=1.0, history=None,
+                 seed=None, phase="config"):
+        """
+        Predict how long performing the agent's tasks will take, without
+        performing any of them. See L{actuator.exec_agents.simulate.simulate_run}
+        for the arguments; the graph is the one L{perform_config} would use.
+        Returns a L{actuator.exec_agents.simulate.SimulationResult}.
+        """
+        graph = self._prepare_graph(self.get_graph(with_fix=True))
+        return simulate_run(self, graph, num_threads=num_threads,
+                            max_threads=max_threads, jitter=jitter,
+                            durations=durations,
+                            default_duration=default_duration,
+                            history=history, seed=seed, phase=phase)
+        
+    def _prepare_graph(self, graph):
+        """
+        Internal; returns the graph of tasks that is actually run for graph;
+        derived classes may restructure it. The default returns graph as is.
+        """
+        return graph
+        
+    def _run_graph(self, graph):
+        """
+        Internal; perform all the tasks in a NetworkX DiGraph of tasks, where
+        the edges go from a task to the tasks that can only start once it has
+        completed. Returns once all tasks are done, or raises exception_class
+        if any are aborted.
+        """
         logger = root_logger.getChild(self.exec_agent)
         logger.info("Agent starting task processing")
-        if self.namespace_mi and self.config_mi:
-            self.config_mi.update_nexus(self.namespace_mi.nexus)
-            graph = self.config_mi.get_graph(with_fix=True)
-            self.num_tasks_to_perform = len(graph.nodes())
-            for n in graph.nodes():
-                graph.node[n]["ins_traversed"] = 0
-                n.fix_arguments()
-            self.stop = False
-            #start the workers
-            logger.info("Starting workers...")
-            for _ in range(self.num_threads):
-                worker = threading.Thread(target=self.process_tasks)
-                worker.start()
-            logger.info("...workers started")
-            #queue the initial tasks
-            for task in (t for t in graph.nodes() if graph.in_degree(t) == 0):
-                logger.debug("Queueing up %s named %s id %s for performance" %
-                             (task.__class__.__name__, task.name, str(task._id)))
-                self.task_queue.put((graph, task))
-            logger.info("Initial tasks queued; waiting for completion")
-            #now wait to be signaled it finished
-            while not self.stop:
-                time.sleep(0.2)
+        graph = self._prepare_graph(graph)
+        self.num_tasks_to_perform = len(graph.nodes())
+        if not self.num_tasks_to_perform:
             logger.info("Agent task processing complete")
-            if self.aborted_tasks:
-                raise self.exception_class("Tasks aborted causing config to abort; see the execution agent's aborted_tasks list for details")
-        else:
-            raise ExecutionException("either namespace_model_instance or config_model_instance weren't specified")
+            return
+        for n in graph.nodes():
+            graph.node[n]["ins_traversed"] = 0
+            n.fix_arguments()
+        self.role_environments = {}
+        self.pool_sizer = (self._make_pool_sizer(graph)
+                           if self.max_threads is not None
+                           else None)
+        #start the workers
+        logger.info("Starting workers...")
+        with self.pool_lock:
+            self.retiring = 0
+        for _ in range(self.num_threads):
+            self._start_worker()
+        logger.info("...workers started")
+        #queue the initial tasks
+        for task in (t for t in graph.nodes() if graph.in_degree(t) == 0):
+            logger.debug("Queueing up %s named %s id %s for performance" %
+                         (task.__class__.__name__, task.name, str(task._id)))
+            self.task_queue.put((graph, task))
+        logger.info("Initial tasks queued; waiting for completion")
+        #now wait to be signaled it finished
+        while not self.stop:
+            time.sleep(0.2)
+            if self.pool_sizer is not None and not self.stop:
+                self._size_pool()
+        logger.info("Agent task processing complete")
+        if self.num_tasks_to_perform == 0:
+            #the run finished rather than being aborted; once the workers
+            #have seen that, the agent can be run again
+            self._await_workers()
+            self.stop = False
+        if self.pool_sizer is not None:
+            logger.info(self.pool_sizer.summary())
+        if self.host_breaker is not None:
+            logger.info(self.host_breaker.summary())
+        if self.hedger is not None:
+            logger.info(self.hedger.summary())
+        if self.latency_history is not None:
+            try:
+                self.latency_history.save()
+            except (IOError, OSError), e:
+                logger.warning("Couldn't save the latency history: %s" % e)
+        if self.aborted_tasks:
+            raise self.exception_class("Tasks aborted causing config to abort; see the execution agent's aborted_tasks list for details")
@@ -0,0 +1,173 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+Speculative re-execution of straggling tasks.
+
+In a large MultiTask a few slow hosts can hold up the MultiTask's rendezvous
+while everything else waits. A L{StragglerHedger} given to an execution agent
+watches how long the instances of each MultiTask take, and when an instance
+that is flagged as rerun_safe runs longer than most of its siblings did, has
+the agent start a second attempt at it; whichever attempt succeeds first is
+used.
+'''
+import bisect
+import math
+import threading
+
+from actuator.config import MultiTask, StructuralTask, NullTask
+from actuator.utils import root_logger
+
+
+class StragglerHedger(object):
+    """
+    Decides when an execution agent should start a second, hedging attempt at
+    a task, and keeps count of how that turned out.
+    
+    A task is a candidate if it is rerun_safe (see
+    L{actuator.config._ConfigTask}) and is one of the tasks a L{MultiTask}
+    makes for its Roles, either directly or inside a ConfigClassTask; its
+    siblings are the tasks made from the same template task for the
+    MultiTask's other Roles. Once min_siblings siblings have succeeded, a
+    task still running after the percentile'th percentile of their times,
+    times factor (but at least min_wait seconds), is hedged. Only one hedge
+    is made per attempt. The attempt that loses is abandoned rather than
+    stopped, as a remote execution can't be interrupted part way; its
+    result is ignored.
+    
+    The counts of tasks hedged, hedges that finished first (won), originals
+    that finished first, and hedged tasks where both attempts failed are
+    kept in the attributes hedged, hedge_wins, original_wins and
+    both_failed. When an abandoned original finishes, the time it would
+    have cost is added to time_saved. See summary().
+    """
+    def __init__(self, percentile=90, factor=1.0, min_siblings=3, min_wait=1.0):
+        """
+        @keyword percentile: Optional; number, default 90. The percentile of
+            the siblings' times a task has to exceed to be hedged.
+        @keyword factor: Optional; float, default 1.0. Multiplies the
+            percentile to give the time allowed before hedging.
+        @keyword min_siblings: Optional; int, default 3. The number of
+            siblings that must have succeeded before any of them is hedged.
+        @keyword min_wait: Optional; float, default 1.0. The shortest time in
+            seconds a task is allowed before it is hedged.
+        """
+        self.percentile = percentile
+        self.factor = factor
+        self.min_siblings = min_siblings
+        self.min_wait = min_wait
+        self.lock = threading.Lock()
+        #sorted lists of sibling success times, by sibling key
+        self.times = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.original_wins = 0
+        self.both_failed = 0
+        self.time_saved = 0.0
+        self.logger = root_logger.getChild("hedger")
+        
+    def sibling_key(self, task):
+        """
+        Returns a hashable key that is the same for task and its siblings, or
+        None if the task can't be hedged
+        """
+        if (isinstance(task, (StructuralTask, NullTask)) or
+                not task.is_rerun_safe()):
+            return None
+        if isinstance(task.delegate, MultiTask):
+            #MultiTask instances are named for their Roles
+            return (task.delegate._id,)
+        #otherwise the task is in a model made for each Role, and has the
+        #same name in each
+        comp = task.delegate
+        while comp is not None:
+            if isinstance(comp, MultiTask):
+                return (comp._id, task.__class__.__name__, task.name)
+            comp = getattr(comp, "delegate", None)
+        return None
+    
+    def record(self, key, secs):
+        """
+        Record that a task with sibling key key succeeded in secs seconds
+        """
+        with self.lock:
+            bisect.insort(self.times.setdefault(key, []), secs)
+            
+    def threshold(self, key):
+        """
+        Returns the number of seconds a task with sibling key key may run
+        before it is hedged, or None if not enough of its siblings are done
+        """
+        with self.lock:
+            times = self.times.get(key, ())
+            if len(times) < self.min_siblings:
+                return None
+            rank = max(int(math.ceil(len(times) * self.percentile / 100.0)), 1)
+            limit = times[rank - 1] * self.factor
+        return max(limit, self.min_wait)
+    
+    def should_hedge(self, key, elapsed):
+        """
+        Returns True if a task with sibling key key that has been running for
+        elapsed seconds should be hedged
+        """
+        limit = self.threshold(key)
+        return limit is not None and elapsed > limit
+    
+    def record_hedge(self, task, elapsed):
+        """
+        Record that task is being hedged after elapsed seconds
+        """
+        with self.lock:
+            self.hedged += 1
+        self.logger.info("Hedging task %s after %.2fs" % (task.name, elapsed))
+        
+    def record_outcome(self, hedge_won):
+        """
+        Record which attempt at a hedged task succeeded first; hedge_won is
+        True if it was the hedge, False if the original, and None if both
+        failed
+        """
+        with self.lock:
+            if hedge_won is None:
+                self.both_failed += 1
+            elif hedge_won:
+                self.hedge_wins += 1
+            else:
+                self.original_wins += 1
+                
+    def record_abandoned(self, secs):
+        """
+        Record that an abandoned original attempt finished secs seconds after
+        the hedge that beat it
+        """
+        with self.lock:
+            self.time_saved += max(secs, 0.0)
+            
+    def summary(self):
+        """
+        Returns a one line description of the hedging done
+        """
+        return ("hedging: %d tasks hedged, %d won by the hedge (%.2fs saved), "
+                "%d by the original, %d failed both" %
+                (self.hedged, self.hedge_wins, self.time_saved,
+                 self.original_wins, self.both_failed))
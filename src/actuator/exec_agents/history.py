@@ -0,0 +1,246 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Task latency histories kept across config runs.
+
+A L{LatencyHistory} records how long tasks take, grouped by a key such as the
+module a task runs and the kind of host it runs on, in histograms with
+logarithmically sized buckets. The history can be saved to and loaded from a
+JSON file, so what is learned in one run is available to the next, and it
+derives timeouts from the latencies seen.
+'''
+import json
+import math
+import os
+import os.path
+import tempfile
+import threading
+
+from actuator.utils import root_logger
+
+
+class LatencyHistogram(object):
+    """
+    A histogram of latencies in seconds. Bucket i holds the latencies from
+    base * growth**(i-1) up to base * growth**i; bucket 0 holds everything
+    up to base. Percentiles are estimated as the upper bound of the bucket
+    they fall in, so they err on the long side.
+    """
+    base = 0.01
+    growth = 1.25
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        #sparse; bucket index -> count
+        self.buckets = {}
+        
+    def add(self, secs):
+        """
+        Add a latency of secs seconds to the histogram
+        """
+        secs = max(float(secs), 0.0)
+        self.count += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+        i = self.bucket_for(secs)
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+        
+    def bucket_for(self, secs):
+        """
+        Returns the index of the bucket for a latency of secs seconds
+        """
+        if secs <= self.base:
+            return 0
+        return int(math.ceil(math.log(secs / self.base) / math.log(self.growth)))
+    
+    def upper_bound(self, i):
+        """
+        Returns the largest latency in bucket i
+        """
+        return self.base * self.growth ** i
+    
+    def percentile(self, p):
+        """
+        Returns an estimate of the p'th percentile latency (p from 0 to
+        100), or None if the histogram is empty. The estimate is never more
+        than the largest latency seen.
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(self.count * p / 100.0)), 1)
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min(self.upper_bound(i), self.max)
+        return self.max
+    
+    def mean(self):
+        """
+        Returns the mean latency, or None if the histogram is empty
+        """
+        return self.total / self.count if self.count else None
+    
+    def to_dict(self):
+        """
+        Returns a dict of the histogram's data, with percentile summaries,
+        suitable for JSON
+        """
+        return {"count":self.count,
+                "total":self.total,
+                "max":self.max,
+                "p50":self.percentile(50),
+                "p90":self.percentile(90),
+                "p99":self.percentile(99),
+                "buckets":dict([(str(i), c) for i, c in self.buckets.items()])}
+    
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Returns a histogram made from a dict from to_dict()
+        """
+        h = cls()
+        h.count = int(d.get("count", 0))
+        h.total = float(d.get("total", 0.0))
+        h.max = float(d.get("max", 0.0))
+        h.buckets = dict([(int(i), int(c)) for i, c in d.get("buckets", {}).items()])
+        return h
+    
+    
+class LatencyHistory(object):
+    """
+    Latency histograms by key, optionally persisted to a JSON file, from
+    which timeouts are derived.
+    
+    The timeout for a key is the key's p99 latency times factor, kept
+    between min_timeout and max_timeout; until a key has min_samples
+    latencies the default timeout is used instead.
+    """
+    version = 1
+    
+    def __init__(self, path=None, factor=3.0, min_timeout=5, max_timeout=120,
+                 min_samples=20):
+        """
+        @keyword path: Optional; path of the JSON file the history is kept in.
+            If it exists it is loaded now, and save() writes to it.
+        @keyword factor: Optional; float, default 3.0. The safety factor
+            applied to p99 latencies to get timeouts
+        @keyword min_timeout: Optional; int, default 5. The shortest timeout
+            given, in seconds
+        @keyword max_timeout: Optional; int, default 120. The longest timeout
+            given, in seconds
+        @keyword min_samples: Optional; int, default 20. The number of
+            latencies a key needs before its timeout is derived from them
+        """
+        self.path = path
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.logger = root_logger.getChild("latency_history")
+        if path is not None and os.path.exists(path):
+            self.load(path)
+            
+    def record(self, key, secs):
+        """
+        Record that something with key took secs seconds
+        """
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = LatencyHistogram()
+            h.add(secs)
+            
+    def histogram(self, key):
+        """
+        Returns the L{LatencyHistogram} for key, or None if there isn't one
+        """
+        with self.lock:
+            return self.histograms.get(key)
+        
+    def percentile(self, key, p):
+        """
+        Returns the p'th percentile latency for key, or None if nothing has
+        been recorded for it
+        """
+        with self.lock:
+            h = self.histograms.get(key)
+            return h.percentile(p) if h is not None else None
+        
+    def timeout(self, key, default=20):
+        """
+        Returns the timeout in whole seconds for key, or default if there
+        isn't enough history for it
+        """
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None or h.count < self.min_samples:
+                return default
+            p99 = h.percentile(99)
+        timeout = int(math.ceil(p99 * self.factor))
+        return max(self.min_timeout, min(timeout, self.max_timeout))
+    
+    def export(self):
+        """
+        Returns a dict of all the histograms, with their percentiles, keyed
+        by key; this is what save() writes
+        """
+        with self.lock:
+            return {"version":self.version,
+                    "histograms":dict([(k, h.to_dict())
+                                       for k, h in self.histograms.items()])}
+            
+    def load(self, path):
+        """
+        Replace this history's histograms with those saved in the JSON file
+        path. If the file can't be read, the histograms are left as they are.
+        """
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (IOError, ValueError), e:
+            self.logger.warning("Can't load latency history from %s: %s" % (path, e))
+            return
+        loaded = dict([(k, LatencyHistogram.from_dict(d))
+                       for k, d in data.get("histograms", {}).items()])
+        with self.lock:
+            self.histograms = loaded
+                        
+    def save(self, path=None):
+        """
+        Write the history to the JSON file path, or the path it was created
+        with if path isn't supplied. The file is replaced in one step, so a
+        reader never sees a partly written history.
+        """
+        path = path or self.path
+        if path is None:
+            return
+        data = self.export()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                   prefix=".latency-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.rename(tmp, path)
@@ -0,0 +1,440 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+An execution agent that performs config tasks in local processes instead of
+on remote hosts.
+
+Each host that tasks would run on gets its own sandbox directory on the local
+machine; tasks for that host run with the sandbox as their working directory
+and HOME, and paths in their arguments are put in the sandbox, so that files
+a model writes stay separate for each host. This makes it possible to run
+large config models deterministically on a single box, for testing and for
+measuring config throughput, without any ssh targets.
+'''
+import os
+import os.path
+import re
+import pprint
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from actuator.exec_agents.core import ExecutionAgent, ExecutionException
+from actuator.config import StructuralTask, NullTask
+from actuator.config_tasks import *
+from actuator.utils import capture_mapping, get_mapper
+from actuator.namespace import _ComputableValue
+
+_agent_domain = "LOCAL_AGENT"
+
+
+class LocalTaskProcessor(object):
+    """
+    Base class for all local task processing classes. A processor performs
+    a task in the sandbox directory of the host the task would have run on.
+    """
+    def __init__(self, commands=None, absolute_paths=False):
+        """
+        @keyword commands: Optional; dict mapping the path of a program to the
+            command to run in its place; see L{LocalExecutionAgent}
+        @keyword absolute_paths: Optional; boolean, default False. If True,
+            absolute paths are used as is rather than put in the sandbox;
+            see L{LocalExecutionAgent}
+        """
+        self.commands = commands or {}
+        self.absolute_paths = absolute_paths
+        
+    def module_name(self):
+        """
+        Returns the name of the Ansible module whose work the processor does
+        locally.
+        """
+        raise TypeError("Derived class must implement module_name()")
+    
+    def perform(self, task, host, sandbox, env, logfile=None):
+        """
+        Perform the task locally. The derived class must implement this.
+        
+        @param task: the task object to process
+        @param host: the host name/IP the task would have run on
+        @param sandbox: path to the host's sandbox directory; relative paths
+            in the task are relative to this directory
+        @param env: dict of environment variables to run processes with
+        @keyword logfile: If present, a file-like object that log messages
+            will be written to
+        @raise ExecutionException: Raised if the task fails
+        """
+        raise TypeError("derived class must implement")
+    
+    def sandbox_path(self, sandbox, path):
+        """
+        Returns the local path for a path on the host; relative paths, and
+        paths starting with '~/', are taken to be relative to the host's
+        sandbox. Absolute paths are put under the sandbox too, unless the
+        processor was made with absolute_paths.
+        """
+        if path == "~" or path.startswith("~/"):
+            path = path[2:]
+        elif os.path.isabs(path) and not self.absolute_paths:
+            path = path.lstrip("/")
+        return os.path.join(sandbox, path)
+    
+    def should_skip(self, task, sandbox):
+        """
+        Returns True if the task's creates or removes arguments mean it
+        shouldn't be performed
+        """
+        creates = getattr(task, "creates", None)
+        if creates and os.path.exists(self.sandbox_path(sandbox, creates)):
+            return True
+        removes = getattr(task, "removes", None)
+        if removes and not os.path.exists(self.sandbox_path(sandbox, removes)):
+            return True
+        return False
+    
+    def substitute(self, command):
+        """
+        Returns a command line with the program it starts with replaced as
+        given in the processor's commands, if it is one of them
+        """
+        stripped = command.lstrip()
+        for program, replacement in self.commands.items():
+            if (stripped == program or
+                    stripped.startswith(program) and stripped[len(program)].isspace()):
+                return replacement + stripped[len(program):]
+        return command
+    
+    def run(self, task, host, args, cwd, env, logfile=None, shell=False,
+            executable=None):
+        """
+        Run a process for a task, raising ExecutionException if it exits with
+        a non-zero return code. Returns a dict with the return code, stdout and
+        stderr, much like the result Ansible would return.
+        """
+        if logfile:
+            logfile.write(">>>Running in {}:\n{}\n".format(cwd, args))
+        try:
+            proc = subprocess.Popen(args, cwd=cwd, env=env, shell=shell,
+                                    executable=executable,
+                                    stdin=open(os.devnull, "r"),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate()
+        except OSError, e:
+            emessage = ("{module} {task} failed on {host} with the following emessage: {msg}"
+                        .format(module=self.module_name(), task=task.name,
+                                host=host, msg=str(e)))
+            if logfile:
+                logfile.write("{}\n".format(emessage))
+            raise ExecutionException(emessage, response=str(e))
+        result = {"rc":proc.returncode, "stdout":stdout, "stderr":stderr,
+                  "cmd":args}
+        if logfile:
+            logfile.write(">>>Result:\n{}\n".format(pprint.pformat(result)))
+        if proc.returncode != 0:
+            emessage = ("{module} {task} failed on {host} with the following return code: {rc}"
+                        .format(module=self.module_name(), task=task.name,
+                                host=host, rc=proc.returncode))
+            if logfile:
+                logfile.write("{}\n".format(emessage))
+            raise ExecutionException(emessage, response=pprint.pformat(result,
+                                                                       indent=1,
+                                                                       width=1))
+        return result
+
+
+@capture_mapping(_agent_domain, PingTask)
+class LocalPingProcessor(LocalTaskProcessor):
+    """
+    A local host is always reachable; its sandbox exists by the time the task
+    is performed.
+    """
+    def module_name(self):
+        return "ping"
+    
+    def perform(self, task, host, sandbox, env, logfile=None):
+        return
+    
+    
+@capture_mapping(_agent_domain, ScriptTask)
+class LocalScriptProcessor(LocalTaskProcessor):
+    """
+    Runs a local script, as the Ansible 'script' module would run it once it
+    had been transferred to the host.
+    """
+    def module_name(self):
+        return "script"
+    
+    def perform(self, task, host, sandbox, env, logfile=None):
+        if self.should_skip(task, sandbox):
+            return
+        args = shlex.split(task.free_form)
+        #the script is found relative to where actuator runs, not the sandbox
+        args[0] = os.path.abspath(args[0])
+        if not os.access(args[0], os.X_OK):
+            args.insert(0, "/bin/sh")
+        self.run(task, host, args, sandbox, env, logfile=logfile)
+        
+        
+@capture_mapping(_agent_domain, CommandTask)
+class LocalCommandProcessor(LocalTaskProcessor):
+    """
+    Runs a command without a shell, as the Ansible 'command' module does.
+    """
+    def module_name(self):
+        return "command"
+    
+    def working_dir(self, task, sandbox):
+        return (self.sandbox_path(sandbox, task.chdir)
+                if task.chdir
+                else sandbox)
+    
+    def perform(self, task, host, sandbox, env, logfile=None):
+        if self.should_skip(task, sandbox):
+            return
+        args = shlex.split(self.substitute(task.free_form))
+        self.run(task, host, args, self.working_dir(task, sandbox), env,
+                 logfile=logfile)
+        
+        
+@capture_mapping(_agent_domain, ShellTask)
+class LocalShellProcessor(LocalCommandProcessor):
+    """
+    Runs a command in a shell, as the Ansible 'shell' module does.
+    """
+    def module_name(self):
+        return "shell"
+    
+    def perform(self, task, host, sandbox, env, logfile=None):
+        if self.should_skip(task, sandbox):
+            return
+        self.run(task, host, self.substitute(task.free_form),
+                 self.working_dir(task, sandbox), env, logfile=logfile,
+                 shell=True, executable=task.executable or "/bin/sh")
+        
+
+@capture_mapping(_agent_domain, CopyFileTask)
+class LocalCopyFileProcessor(LocalTaskProcessor):
+    """
+    Copies a file or directory into a host's sandbox, as the Ansible 'copy'
+    module would copy it to the host. Ownership and SELinux arguments are
+    ignored.
+    """
+    def module_name(self):
+        return "copy"
+    
+    def content(self, task):
+        """
+        Returns the content to copy, or None if the task copies src as is
+        """
+        return task.content
+    
+    def perform(self, task, host, sandbox, env, logfile=None):
+        dest = self.sandbox_path(sandbox, task.dest)
+        content = self.content(task)
+        if content is None and os.path.isdir(task.src):
+            self._copy_dir(task, dest)
+            return
+        if (task.dest.endswith("/") or os.path.isdir(dest)) and task.src is not None:
+            dest = os.path.join(dest, os.path.basename(task.src))
+        if content is None:
+            with open(task.src, "rb") as f:
+                content = f.read()
+        self._write(task, dest, content)
+        
+    def _write(self, task, dest, content):
+        #internal; put content in file dest according to the task's arguments
+        if os.path.exists(dest):
+            if task.force == "no":
+                return
+            with open(dest, "rb") as f:
+                if f.read() == content:
+                    self._set_mode(task.mode, dest)
+                    return
+            if task.backup == "yes":
+                shutil.copy2(dest, "{}.{}~".format(dest, time.strftime("%Y-%m-%d@%H:%M:%S")))
+        self._make_dirs(task, os.path.dirname(dest))
+        with open(dest, "wb") as f:
+            f.write(content)
+        self._set_mode(task.mode, dest)
+        
+    def _copy_dir(self, task, dest):
+        #internal; a src ending in '/' copies the directory's contents,
+        #otherwise the directory itself is copied into dest
+        src = task.src
+        if not src.endswith("/"):
+            dest = os.path.join(dest, os.path.basename(src))
+        for dirpath, _, filenames in os.walk(src):
+            target = os.path.join(dest, os.path.relpath(dirpath, src))
+            self._make_dirs(task, target)
+            for fname in filenames:
+                with open(os.path.join(dirpath, fname), "rb") as f:
+                    self._write(task, os.path.join(target, fname), f.read())
+                    
+    def _make_dirs(self, task, path):
+        #internal
+        if path and not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, _:
+                #another task may have made it first
+                if not os.path.isdir(path):
+                    raise
+            self._set_mode(task.directory_mode, path)
+            
+    def _set_mode(self, mode, path):
+        #internal; only octal modes are supported
+        if mode is None:
+            return
+        try:
+            os.chmod(path, int(str(mode), 8))
+        except ValueError, _:
+            raise ExecutionException("Only octal modes can be set by the local "
+                                     "agent; got {}".format(mode))
+        
+        
+@capture_mapping(_agent_domain, ProcessCopyFileTask)
+class LocalProcessCopyFileProcessor(LocalCopyFileProcessor):
+    """
+    Copies a file into a host's sandbox after replacing the Var replacement
+    patterns in it.
+    """
+    def content(self, task):
+        if task.src is not None:
+            if not os.path.exists(task.src):
+                raise ExecutionException("Can't find the file {}".format(task.src))
+            content = file(task.src, "r").read()
+        else:
+            content = task.content
+        cv = _ComputableValue(content)
+        return cv.expand(task.get_task_role(), raise_on_unexpanded=True)
+    
+    
+class LocalExecutionAgent(ExecutionAgent):
+    """
+    Execution agent that performs config tasks on the local machine instead of
+    on the hosts the tasks are for.
+    
+    Each host gets a sandbox directory, named for the host, under a sandbox
+    root directory. A task runs with its host's sandbox as its working
+    directory and HOME, and the paths in its arguments (chdir, creates,
+    removes, a copy's dest) are taken to be in the sandbox, so that an
+    absolute dest of /etc/hosts is the sandbox's etc/hosts; only with the
+    absolute_paths keyword are absolute paths used as is. Paths inside
+    command lines aren't changed. Processes get the environment actuator runs with
+    plus the task's Vars, just as the Ansible agent supplies them, along with
+    ACTUATOR_HOST and ACTUATOR_SANDBOX naming the host and its sandbox.
+    
+    Commands that only make sense on a real host, such as package installs,
+    can be replaced with the commands keyword. There is no pause before a
+    task is started, as there are no ssh connections to stagger.
+    """
+    def __init__(self, sandbox_root=None, commands=None, absolute_paths=False,
+                 **kwargs):
+        """
+        Make a new LocalExecutionAgent
+        
+        @keyword sandbox_root: Optional; path of the directory to create host
+            sandboxes in. If not supplied, a temporary directory is used and
+            removed once the config run is done; a supplied directory is
+            left in place.
+        @keyword commands: Optional; dict mapping the path of a program to
+            the command line that replaces it when a CommandTask or ShellTask
+            starts with that program; the rest of the task's command line is
+            kept. For instance, {"/usr/bin/sudo":"/bin/true"} makes all sudo
+            commands succeed without doing anything.
+        @keyword absolute_paths: Optional; boolean, default False. If True,
+            absolute paths in task arguments refer to the local machine's
+            real filesystem, shared by all hosts, rather than to a path in
+            each host's sandbox
+        @keyword **kwargs: see L{ExecutionAgent}
+        """
+        super(LocalExecutionAgent, self).__init__(**kwargs)
+        self.sandbox_root = sandbox_root
+        self.commands = dict(commands) if commands else {}
+        self.absolute_paths = absolute_paths
+        self.sandboxes = {}
+        self.sandbox_lock = threading.Lock()
+        
+    def perform_config(self, completion_record=None):
+        if self.sandbox_root is not None:
+            return super(LocalExecutionAgent, self).perform_config(completion_record)
+        self.sandbox_root = tempfile.mkdtemp(prefix="actuator-local-")
+        try:
+            return super(LocalExecutionAgent, self).perform_config(completion_record)
+        finally:
+            shutil.rmtree(self.sandbox_root, ignore_errors=True)
+            self.sandbox_root = None
+            self.sandboxes = {}
+            
+    def sandbox_for(self, host):
+        """
+        Returns the path of the sandbox directory for host, creating it if
+        needed.
+        """
+        with self.sandbox_lock:
+            sandbox = self.sandboxes.get(host)
+            if sandbox is None:
+                if self.sandbox_root is None:
+                    self.sandbox_root = tempfile.mkdtemp(prefix="actuator-local-")
+                sandbox = os.path.join(self.sandbox_root,
+                                       re.sub(r"[^\w.-]", "_", str(host)))
+                if not os.path.isdir(sandbox):
+                    os.makedirs(sandbox)
+                self.sandboxes[host] = sandbox
+            return sandbox
+        
+    def task_environment(self, task, host, sandbox):
+        """
+        Returns the environment to run task's processes with
+        """
+        env = dict(os.environ)
+        env["HOME"] = sandbox
+        env["ACTUATOR_HOST"] = str(host)
+        env["ACTUATOR_SANDBOX"] = sandbox
+        for k, v in self.role_environment(task).items():
+            if v is not None:
+                env[str(k)] = str(v)
+        return env
+        
+    def _pre_task_delay(self, task):
+        return 0
+    
+    def _perform_task(self, task, logfile=None):
+        task.fix_arguments()
+        if isinstance(task, (NullTask, StructuralTask)):
+            task.perform()
+        else:
+            processor = get_mapper(_agent_domain)[task.__class__](commands=self.commands,
+                                                                  absolute_paths=self.absolute_paths)
+            host = self._get_run_host(task)
+            sandbox = self.sandbox_for(host)
+            if logfile:
+                logfile.write("Task {} being run locally for {} in {}\n"
+                              .format(task.name, host, sandbox))
+            processor.perform(task, host, sandbox,
+                              self.task_environment(task, host, sandbox),
+                              logfile=logfile)
+        return
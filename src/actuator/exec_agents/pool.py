@@ -0,0 +1,232 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+Sizing an execution agent's pool of worker threads while it runs.
+
+A L{PoolSizer} decides how many workers an agent should have from moment to
+moment, between a floor and a ceiling, from how many tasks are ready and
+waiting, how many workers are busy, and how long tasks are taking. The
+ceiling is further limited by L{antichain_width}, the most tasks of the
+agent's graph that could ever be running at once (or a bound on it), and by
+any limit on how many tasks may run on the graph's hosts at the same time.
+'''
+import networkx as nx
+
+
+def antichain_width(graph, exact_limit=300):
+    """
+    Returns the largest number of tasks in a NetworkX DiGraph of tasks that
+    don't depend on each other, directly or indirectly, and so could all be
+    running at the same time.
+    
+    By Dilworth's theorem this is the number of tasks less the size of a
+    maximum matching between tasks and the tasks that can be reached from
+    them. That needs the graph's transitive closure, so it is only done for
+    graphs of up to exact_limit tasks; for larger graphs L{chain_cover_width}
+    is returned instead, which is never less than the true width and so is
+    safe to use as a limit on the number of workers.
+    
+    @param graph: a NetworkX DiGraph with no cycles
+    @keyword exact_limit: Optional; int, default 300. The largest graph for
+        which the exact width is computed.
+    """
+    nodes = nx.topological_sort(graph)
+    if not nodes:
+        return 0
+    if len(nodes) > exact_limit:
+        return chain_cover_width(graph)
+    index = dict([(n, i) for i, n in enumerate(nodes)])
+    #reach[i] is a bit set of the tasks that can be reached from task i
+    reach = [0] * len(nodes)
+    for n in reversed(nodes):
+        bits = 0
+        for d in graph.successors(n):
+            bits |= reach[index[d]] | (1 << index[d])
+        reach[index[n]] = bits
+    adj = []
+    for bits in reach:
+        adj.append([j for j in range(len(nodes)) if bits >> j & 1])
+    return len(nodes) - _max_matching(adj)
+
+
+def chain_cover_width(graph):
+    """
+    Returns the number of chains in a cover of a NetworkX DiGraph of tasks
+    by paths, found by linking each task to a successor that hasn't already
+    been linked to. No more tasks than this can run at once, though there
+    may be fewer (see L{antichain_width}); it takes time proportional to
+    the number of dependencies.
+    """
+    linked = set()
+    links = 0
+    for n in nx.topological_sort(graph):
+        for d in graph.successors(n):
+            if d not in linked:
+                linked.add(d)
+                links += 1
+                break
+    return len(graph) - links
+
+
+def _max_matching(adj):
+    #internal; the size of a maximum matching in the bipartite graph where
+    #adj[u] lists the right-hand vertices of left-hand vertex u, found with
+    #augmenting paths. The search keeps its own stack rather than recursing,
+    #as paths can be as long as the graph
+    match = {}
+    size = 0
+    for u in range(len(adj)):
+        seen = set()
+        stack = [(u, iter(adj[u]))]
+        path = []
+        found = False
+        while stack and not found:
+            for v in stack[-1][1]:
+                if v in seen:
+                    continue
+                seen.add(v)
+                path.append(v)
+                if v not in match:
+                    found = True
+                else:
+                    stack.append((match[v], iter(adj[match[v]])))
+                break
+            else:
+                stack.pop()
+                if path:
+                    path.pop()
+        if found:
+            #path[i] was reached from stack[i]'s vertex; flip the path
+            for (w, _), v in zip(stack, path):
+                match[v] = w
+            size += 1
+    return size
+
+
+class PoolSizer(object):
+    """
+    Works out how many worker threads an execution agent should have.
+    
+    The agent calls target() a few times a second with the number of
+    workers it has, how many of them are busy performing a task, and how
+    many tasks are ready and waiting for a worker, and starts or retires
+    workers to match the answer. The agent also reports how long each task
+    takes with observe().
+    
+    The pool grows when ready tasks are waiting for workers: by enough to
+    take them all when tasks are slow, but only a worker at a time when
+    tasks take less than quick_task seconds, as such tasks clear from the
+    queue quickly on their own and more threads would mostly add contention.
+    It shrinks, a worker at a time, once workers have been idle with nothing
+    waiting for idle_ticks calls in a row. It never goes below min_threads
+    or above the smallest of max_threads, the width hint and the host
+    capacity.
+    
+    The largest pool, and the number of times it grew and shrank, are in the
+    attributes peak, grown and shrunk; see summary().
+    """
+    def __init__(self, min_threads, max_threads, width=None, host_capacity=None,
+                 quick_task=0.1, idle_ticks=10):
+        """
+        @param min_threads: int; the fewest workers to have
+        @param max_threads: int; the most workers to have
+        @keyword width: Optional; int. The most tasks that can run at once,
+            as from L{antichain_width}; there is no point having more workers
+            than this
+        @keyword host_capacity: Optional; int. The most tasks the hosts
+            involved can run at once
+        @keyword quick_task: Optional; float, default 0.1. Tasks that take
+            less than this many seconds on average only grow the pool a
+            worker at a time
+        @keyword idle_ticks: Optional; int, default 10. The number of calls
+            to target() in a row that must find idle workers and nothing
+            waiting before the pool shrinks
+        """
+        self.min_threads = max(min_threads, 1)
+        self.max_threads = max(max_threads, self.min_threads)
+        self.width = width
+        self.host_capacity = host_capacity
+        self.quick_task = quick_task
+        self.idle_ticks = idle_ticks
+        #exponentially weighted mean task time; None until a task is done
+        self.latency = None
+        self.idle_run = 0
+        self.peak = 0
+        self.grown = 0
+        self.shrunk = 0
+        
+    def ceiling(self):
+        """
+        Returns the most workers the pool may have
+        """
+        limits = [self.max_threads] + [l for l in (self.width, self.host_capacity)
+                                       if l is not None]
+        return max(min(limits), self.min_threads)
+    
+    def observe(self, secs):
+        """
+        Note that a task took secs seconds
+        """
+        self.latency = (secs
+                        if self.latency is None
+                        else 0.8 * self.latency + 0.2 * secs)
+        
+    def target(self, current, busy, ready):
+        """
+        Returns the number of workers the pool should have now
+        
+        @param current: the number of workers the pool has
+        @param busy: the number of them performing a task
+        @param ready: the number of tasks waiting for a worker
+        """
+        idle = current - busy
+        want = current
+        if ready > idle:
+            self.idle_run = 0
+            if self.latency is not None and self.latency < self.quick_task:
+                want = current + 1
+            else:
+                want = busy + ready
+        elif idle > 0 and ready == 0:
+            self.idle_run += 1
+            if self.idle_run >= self.idle_ticks:
+                self.idle_run = 0
+                want = current - 1
+        else:
+            self.idle_run = 0
+        want = max(min(want, self.ceiling()), self.min_threads)
+        if want > current:
+            self.grown += 1
+        elif want < current:
+            self.shrunk += 1
+        self.peak = max(self.peak, want, current)
+        return want
+    
+    def summary(self):
+        """
+        Returns a one line description of how the pool was sized
+        """
+        return ("worker pool: %d to %d threads (width %s, host capacity %s), "
+                "peak %d, grew %d times, shrank %d times" %
+                (self.min_threads, self.ceiling(), self.width,
+                 self.host_capacity, self.peak, self.grown, self.shrunk))
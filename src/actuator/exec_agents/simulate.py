@@ -0,0 +1,291 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+Predicting how long a run will take, without running it.
+
+L{simulate_run} plays an execution agent's scheduling of a graph of tasks
+against a virtual clock: tasks become ready as their predecessors complete,
+wait in order for one of the agent's worker threads, take the pause before
+each task, and then take as long as their estimated duration. Nothing is
+performed, so no host or cloud is touched. Durations come from hints, from a
+L{actuator.exec_agents.history.LatencyHistory}, or from a default; the
+result gives the predicted makespan, the critical path, and the most tasks
+running at once.
+
+ExecutionAgents, and so the Openstack provisioner's agents, have a
+simulate() method that simulates the graph they would run, and
+L{what_if} compares runs with different numbers of threads and with and
+without the pause before each task.
+'''
+import heapq
+import random
+from collections import deque
+
+import networkx as nx
+
+from actuator.config import StructuralTask, NullTask
+
+
+class SimulationResult(object):
+    """
+    The outcome of a simulated run.
+    
+    @ivar phase: the name of the run, such as "config" or "provision"
+    @ivar makespan: seconds from the start of the run until the last task
+        completed
+    @ivar num_threads: the number of worker threads the run started with
+    @ivar peak_threads: the most worker threads there were at once
+    @ivar peak_parallelism: the most tasks being performed at once
+    @ivar critical_path: the list of tasks in the longest chain of dependent
+        tasks, timed as in the simulation; no number of threads can make the
+        run shorter than this chain
+    @ivar critical_length: the time the critical path takes
+    @ivar times: dict; for each task, a tuple of the time it got a worker,
+        the time its pause ended, and the time it completed
+    @ivar jitter: whether any task was paused before being performed
+    """
+    def __init__(self, phase, makespan, num_threads, peak_threads,
+                 peak_parallelism, critical_path, critical_length, times,
+                 jitter):
+        self.phase = phase
+        self.makespan = makespan
+        self.num_threads = num_threads
+        self.peak_threads = peak_threads
+        self.peak_parallelism = peak_parallelism
+        self.critical_path = critical_path
+        self.critical_length = critical_length
+        self.times = times
+        self.jitter = jitter
+        
+    def summary(self):
+        """
+        Returns a one line description of the simulated run
+        """
+        return ("%s: makespan %.1fs with %d threads (peak %d threads, %d tasks "
+                "at once%s); critical path %.1fs over %d tasks" %
+                (self.phase, self.makespan, self.num_threads, self.peak_threads,
+                 self.peak_parallelism, ", with jitter" if self.jitter else "",
+                 self.critical_length, len(self.critical_path)))
+        
+        
+def task_duration(agent, task, durations=None, default_duration=1.0,
+                  history=None):
+    """
+    Returns the estimated duration of a task as a tuple of the seconds it
+    keeps a worker busy and the seconds it then takes to complete after
+    releasing the worker (as a task that returns a TaskFuture does).
+    
+    The estimate is the first of:
+        - what durations gives for the task: if durations is a callable, its
+          result for the task unless that is None; if it is a dict, its value
+          for the task's name, the agent's latency_key for the task, or the
+          task's class name, in that order. A value is either a number of
+          seconds or a (busy, completion) tuple;
+        - the mean latency for the task's latency_key in history;
+        - 0 for structural tasks and NullTasks;
+        - default_duration.
+        
+    @param agent: the L{actuator.exec_agents.core.ExecutionAgent} whose run
+        is being simulated
+    @param task: the task
+    @keyword durations: Optional; a dict or a callable as described above
+    @keyword default_duration: Optional; float, default 1.0
+    @keyword history: Optional; a LatencyHistory
+    """
+    value = None
+    if callable(durations):
+        value = durations(task)
+    elif durations:
+        for key in (task.name, agent.latency_key(task), task.__class__.__name__):
+            if key in durations:
+                value = durations[key]
+                break
+    if value is None and history is not None:
+        h = history.histogram(agent.latency_key(task))
+        if h is not None and h.count:
+            value = h.mean()
+    if value is None:
+        value = (0.0
+                 if isinstance(task, (StructuralTask, NullTask))
+                 else default_duration)
+    if isinstance(value, (tuple, list)):
+        return float(value[0]), float(value[1])
+    return float(value), 0.0
+
+
+def simulate_run(agent, graph, num_threads=None, max_threads=None, jitter=None,
+                 durations=None, default_duration=1.0, history=None, seed=None,
+                 phase="run", tick=0.2):
+    """
+    Simulate an agent performing a graph of tasks on a virtual clock, and
+    return a L{SimulationResult}.
+    
+    Ready tasks are handed to idle workers in the order they became ready,
+    as the agent's queue does. If the agent has a max_threads, or one is
+    given, workers are added and retired every tick seconds by the same
+    L{actuator.exec_agents.pool.PoolSizer} the agent would use. Tasks are
+    assumed to succeed on their first attempt, so retries, hedging and
+    hosts that can't be reached aren't simulated.
+    
+    @param agent: an L{actuator.exec_agents.core.ExecutionAgent}
+    @param graph: NetworkX DiGraph of fixed tasks, as the agent would run it
+    @keyword num_threads: Optional; int. The number of threads to simulate;
+        defaults to the agent's num_threads
+    @keyword max_threads: Optional; int. Simulate an adaptive pool with this
+        ceiling; defaults to the agent's max_threads
+    @keyword jitter: Optional. True pauses each task for a random time within
+        the agent's pre_task_delay_range, False doesn't pause, and None (the
+        default) uses the agent's own pause
+    @keyword durations, default_duration, history: see L{task_duration};
+        history defaults to the agent's latency_history
+    @keyword seed: Optional; seed for the random pauses when jitter is True
+    @keyword phase: Optional; string, default "run". Name for the run in the
+        result
+    @keyword tick: Optional; float, default 0.2. Seconds between pool sizing
+        decisions
+    """
+    num_threads = num_threads if num_threads is not None else agent.num_threads
+    max_threads = max_threads if max_threads is not None else agent.max_threads
+    history = history if history is not None else agent.latency_history
+    rng = random.Random(seed)
+    sizer = (agent._make_pool_sizer(graph, num_threads=num_threads,
+                                    max_threads=max_threads)
+             if max_threads is not None
+             else None)
+    
+    def pause(task):
+        if jitter is None:
+            return agent._pre_task_delay(task)
+        return rng.uniform(*agent.pre_task_delay_range) if jitter else 0.0
+    
+    waiting = dict([(t, graph.in_degree(t)) for t in graph.nodes()])
+    ready = deque([t for t in graph.nodes() if waiting[t] == 0])
+    #(time, sequence, event, task); the sequence keeps ties in order
+    events = []
+    seq = [0]
+    
+    def post(when, event, task=None):
+        seq[0] += 1
+        heapq.heappush(events, (when, seq[0], event, task))
+        
+    times = {}
+    spans = {}
+    state = {"now":0.0, "workers":num_threads, "idle":num_threads, "busy":0,
+             "peak_busy":0, "peak_threads":num_threads, "left":len(waiting)}
+    
+    def dispatch():
+        while state["idle"] > 0 and ready:
+            task = ready.popleft()
+            state["idle"] -= 1
+            state["busy"] += 1
+            state["peak_busy"] = max(state["peak_busy"], state["busy"])
+            delay = pause(task)
+            busy, after = task_duration(agent, task, durations=durations,
+                                        default_duration=default_duration,
+                                        history=history)
+            times[task] = [state["now"], state["now"] + delay, None]
+            spans[task] = (delay + busy, after)
+            post(state["now"] + delay + busy, "free", task)
+            
+    def complete(task):
+        times[task][2] = state["now"]
+        state["left"] -= 1
+        for succ in graph.successors(task):
+            waiting[succ] -= 1
+            if waiting[succ] == 0:
+                ready.append(succ)
+                
+    if sizer is not None:
+        post(tick, "tick")
+    dispatch()
+    while events and state["left"]:
+        state["now"], _, event, task = heapq.heappop(events)
+        if event == "free":
+            state["busy"] -= 1
+            state["idle"] += 1
+            held, after = spans[task]
+            if sizer is not None:
+                sizer.observe(held)
+            if after > 0:
+                post(state["now"] + after, "done", task)
+            else:
+                complete(task)
+        elif event == "done":
+            complete(task)
+        elif event == "tick":
+            want = sizer.target(state["workers"], state["busy"], len(ready))
+            if want > state["workers"]:
+                state["idle"] += want - state["workers"]
+                state["workers"] = want
+            elif want < state["workers"]:
+                #only idle workers retire
+                retire = min(state["workers"] - want, state["idle"])
+                state["idle"] -= retire
+                state["workers"] -= retire
+            state["peak_threads"] = max(state["peak_threads"], state["workers"])
+            post(state["now"] + tick, "tick")
+        dispatch()
+        
+    makespan = max([t[2] for t in times.values()] or [0.0])
+    path, length = _critical_path(graph, spans)
+    return SimulationResult(phase, makespan, num_threads, state["peak_threads"],
+                            state["peak_busy"], path, length,
+                            dict([(t, tuple(v)) for t, v in times.items()]),
+                            any([t[1] > t[0] for t in times.values()]))
+    
+    
+def _critical_path(graph, spans):
+    #internal; the longest chain of tasks in graph, using each task's
+    #simulated time from getting a worker to completing
+    finish = {}
+    best = {}
+    for task in nx.topological_sort(graph):
+        preds = graph.predecessors(task)
+        prev = max(preds, key=lambda p: finish[p]) if preds else None
+        start = finish[prev] if prev is not None else 0.0
+        finish[task] = start + sum(spans.get(task, (0.0, 0.0)))
+        best[task] = prev
+    if not finish:
+        return [], 0.0
+    #a longest chain can always be extended to a task nothing depends on
+    task = max([t for t in finish if graph.out_degree(t) == 0],
+               key=lambda t: finish[t])
+    length = finish[task]
+    path = []
+    while task is not None:
+        path.append(task)
+        task = best[task]
+    path.reverse()
+    return path, length
+
+
+def what_if(agent, thread_counts=(5, 20, 50), jitters=(False, True), **kwargs):
+    """
+    Simulate the agent's run with each number of threads in thread_counts,
+    with and without jitter as given in jitters, and return the list of
+    L{SimulationResult}s. Other keyword arguments are passed to the agent's
+    simulate().
+    """
+    return [agent.simulate(num_threads=n, jitter=j, **kwargs)
+            for n in thread_counts
+            for j in jitters]
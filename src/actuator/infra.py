@@ -23,6 +23,8 @@
 Support for creating Actuator infrastructure models
 '''
 
+import threading
+
 from actuator.utils import ClassModifier, process_modifiers
 from actuator.modeling import (ActuatorException,ModelBaseMeta, ModelBase,
                                ModelComponent, AbstractModelingEntity,
@@ -128,6 +130,10 @@ class InfraModel(ModelBase):
     """
     __metaclass__ = InfraModelMeta
     ref_class = ModelInstanceReference
+    #private; (structure version, result) pairs for components() and
+    #refs_for_components()
+    _components_index = None
+    _refs_index = None
     
     def __init__(self, name):
         """
@@ -140,6 +146,9 @@ class InfraModel(ModelBase):
         """
         super(InfraModel, self).__init__()
         self.name = name
+        #private; bumped when a MultiComponent in this model adds an instance
+        self._structure_version = 0
+        self._structure_lock = threading.Lock()
         ga = super(InfraModel, self).__getattribute__
         attrdict = self.__dict__
         for k, v in ga(InfraModelMeta._COMPONENTS).items():
@@ -163,7 +172,16 @@ class InfraModel(ModelBase):
     def components(self):
         """
         Returns a set with the unique resources to provision on this instance.
+        
+        The set is computed once and then kept up to date as this model's
+        MultiComponents create new instances, so repeated calls are cheap.
+        Each call returns a new set that the caller may change.
         """
+        with self._structure_lock:
+            version = self._structure_version
+            cached = self._components_index
+            if cached is not None and cached[0] == version:
+                return set(cached[1])
         _resources = super(InfraModel, self).components()
         #We need some place where we have a reasonable expectations
         #that all logical refs have been eval'd against the model instance
@@ -177,10 +195,53 @@ class InfraModel(ModelBase):
         #sort of stateful API elements
         for resource in _resources:
             resource._set_model_instance(self)
+        with self._structure_lock:
+            #if an instance was added meanwhile the version has moved on, and
+            #the next call will compute the set again
+            self._components_index = (version, set(_resources))
         return _resources
     
     resources = components
     
+    def refs_for_components(self, my_ref=None):
+        """
+        Returns a set of model references for all ModelComponents within self.
+        
+        The result is computed once and then reused until one of this model's
+        MultiComponents creates a new instance. Each call returns a new set
+        that the caller may change.
+        
+        @keyword my_ref: Ignored for model instances; kept for compatibility
+            with the containers that share this method's signature.
+        """
+        with self._structure_lock:
+            version = self._structure_version
+            cached = self._refs_index
+            if cached is not None and cached[0] == version:
+                return set(cached[1])
+        refs = super(InfraModel, self).refs_for_components(my_ref=my_ref)
+        with self._structure_lock:
+            self._refs_index = (version, set(refs))
+        return refs
+    
+    def _structure_changed(self, component):
+        #internal; a MultiComponent in this model has added component. The
+        #components index is brought up to date rather than recomputed; the
+        #refs are, as the new component's refs depend on where it is
+        if isinstance(component, ModelComponent):
+            added = [component]
+        elif isinstance(component, _ComputeModelComponents):
+            added = component.components()
+        else:
+            added = []
+        with self._structure_lock:
+            cached = self._components_index
+            current = cached is not None and cached[0] == self._structure_version
+            self._structure_version += 1
+            if current:
+                cached[1].update(added)
+                self._components_index = (self._structure_version, cached[1])
+    
     def compute_provisioning_from_refs(self, modelrefs, exclude_refs=None):
         """
         Take a collection of model reference objects and compute the Provisionables needed
@@ -26,6 +26,7 @@ import uuid
 import sys
 import re
 import itertools
+import bisect
 
 from actuator.utils import ClassMapper
 
@@ -60,25 +61,76 @@ class ContextExpr(object):
     that path later against a materialized object when it is available. Use
     ctxt to generate references into your various models. This supports both
     attribute access and key access on any Multi* objects
+    
+    The path is compiled into a list of per-hop closures the first time the
+    expression is evaluated. If the class attribute cache_fixed_results is set
+    to True, the result of evaluating an expression is also cached for each
+    (model, component) pair in the CallContext, but only when the result is a
+    reference to a modeling entity that has already been fixed. The cache is
+    kept on the model instance, so it goes when the model does.
     """
+    cache_fixed_results = False
+    
     def __init__(self, *path):
         self._path = path
+        #private; these names are set here so that __getattr__ never sees them
+        self._ce_steps = None
         
     def __getattr__(self, item):
         return ContextExpr(item, *self._path)
         
     def __getitem__(self, key):
         return ContextExpr(KeyItem(key), *self._path)
-        
-    def __call__(self, ctx):
-        ref = ctx
+    
+    def _compile(self):
+        #private; turn the path into a list of callables, one per hop, each
+        #of which takes the ref so far and the CallContext
+        steps = []
         for p in reversed(self._path):
             if isinstance(p, KeyItem):
-                ref = ref[p.value(ctx)]
+                if callable(p.key):
+                    step = lambda ref, ctx, f=p.key: ref[f(ctx)]
+                else:
+                    step = lambda ref, ctx, k=p.key: ref[k]
             else:
-                ref = getattr(ref, p)
-                if callable(ref):
-                    ref = ref(ctx)
+                def step(ref, ctx, name=p):
+                    ref = getattr(ref, name)
+                    return ref(ctx) if callable(ref) else ref
+            steps.append(step)
+        self._ce_steps = steps
+        return steps
+        
+    def _results(self, ctx, create=False):
+        #private; the model instance's cache of fixed results, keyed by
+        #expression and component, or None if there isn't one
+        try:
+            mdict = ctx.model.__dict__
+        except AttributeError, _:
+            return None
+        results = mdict.get("_ce_results")
+        if results is None and create:
+            results = mdict["_ce_results"] = {}
+        return results
+        
+    def __call__(self, ctx):
+        if self.cache_fixed_results:
+            try:
+                return self._results(ctx)[(self, ctx.comp)]
+            except (KeyError, AttributeError, TypeError), _:
+                pass
+        steps = self._ce_steps
+        if steps is None:
+            steps = self._compile()
+        ref = ctx
+        for step in steps:
+            ref = step(ref, ctx)
+        if self.cache_fixed_results and isinstance(ref, AbstractModelReference):
+            value = ref.value()
+            if isinstance(value, AbstractModelingEntity) and value.fixed:
+                try:
+                    self._results(ctx, create=True)[(self, ctx.comp)] = ref
+                except (AttributeError, TypeError), _:
+                    pass
         return ref
     
         
@@ -415,6 +467,12 @@ class ComponentGroup(AbstractModelingEntity, _ComputeModelComponents):
     def _comp_source(self):
         return {k:getattr(self, k) for k in self._kwargs}
     
+    def _set_model_instance(self, inst):
+        #private; see MultiComponent._set_model_instance()
+        super(ComponentGroup, self)._set_model_instance(inst)
+        for c in self._comp_source().values():
+            c._set_model_instance(inst)
+    
     def get_init_args(self):
         __doc__ = AbstractModelingEntity.get_init_args.__doc__
         return ((self.name,), self._comp_source())
@@ -454,6 +512,13 @@ class MultiComponent(AbstractModelingEntity, _ComputeModelComponents):
         super(MultiComponent, self).__init__("")
         self.template_component = template_component.clone()
         self._instances = {}
+        #bumped whenever a new key is added; lets selection caches know
+        #when their view of this container's keys has gone stale
+        self._key_version = 0
+        #sorted index of the keys in _instances; only built when an ordered
+        #lookup such as key_range() or key_prefix() is made, and then kept
+        #up to date by get_instance()
+        self._sorted_keys = None
         
     def _fix_arguments(self):
         for i in self._instances.values():
@@ -505,32 +570,114 @@ class MultiComponent(AbstractModelingEntity, _ComputeModelComponents):
         """
         Returns an iterator for all the instances.
         """
-        return (self.get(k) for k in self.iterkeys())
+        return (v for _, v in self.iteritems())
     
     def iteritems(self):
         """
         Returns an iterator of all the (key, instance) pairs
         """
-        return ((k, self.get(k)) for k in self.iterkeys())
+        ref = AbstractModelReference.find_ref_for_obj(self)
+        return ((k, ref[k]) for k in list(self._instances))
     
     def keys(self):
         """
-        Returns an iterable of all keys used to generate instances of the template
+        Returns a list of all keys used to generate instances of the template
         """
         return self._instances.keys()
     
     def values(self):
         """
-        Returns an iterable of references to all template instances generated for supplied keys
+        Returns a list of references to all template instances generated for supplied keys
         """
         return [self.get(k) for k in self.keys()]
     
     def items(self):
         """
-        Returns an iterable so (key, ref) tuples for all keyed template instances
+        Returns a list of (key, ref) tuples for all keyed template instances
         """
         return [(k, self.get(k)) for k in self.keys()]
     
+    def viewkeys(self):
+        """
+        Returns a lazy view of the keys of all instances
+        
+        The view supports len() and 'in' without building a list of the keys.
+        """
+        return _MultiComponentView(self, _MultiComponentView.KEYS)
+    
+    def viewvalues(self):
+        """
+        Returns a lazy view of references to all instances
+        
+        References are only created as the returned view is iterated over.
+        """
+        return _MultiComponentView(self, _MultiComponentView.VALUES)
+    
+    def viewitems(self):
+        """
+        Returns a lazy view of (key, ref) tuples for all instances
+        
+        References are only created as the returned view is iterated over.
+        """
+        return _MultiComponentView(self, _MultiComponentView.ITEMS)
+    
+    def _key_index(self):
+        #private; builds the sorted key index on first use
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted([KeyAsAttr(k) for k in self._instances])
+        return self._sorted_keys
+    
+    def sorted_keys(self):
+        """
+        Returns an iterator over the keys of all instances in sorted order
+        """
+        return iter(list(self._key_index()))
+    
+    def key_range(self, lo=None, hi=None):
+        """
+        Returns an iterator over the keys k where lo <= k < hi
+        
+        If either bound is an int then the range is numeric, and only keys that
+        are the string form of an integer in the range are returned; this is
+        the usual case for containers indexed with ints. Otherwise the keys are
+        compared as strings using the sorted key index. A bound of None leaves
+        that end of the range open.
+        
+        A numeric range is answered with direct lookups only when both bounds
+        are given and the range is no wider than the number of instances;
+        otherwise every key is examined, as the sorted index orders keys as
+        strings rather than as numbers.
+        
+        @keyword lo: inclusive lower bound, or None
+        @keyword hi: exclusive upper bound, or None
+        """
+        if _is_numeric_range(lo, hi):
+            if (lo is not None and hi is not None and
+                    hi - lo <= len(self._instances)):
+                instances = self._instances
+                return (KeyAsAttr(i) for i in xrange(lo, hi)
+                        if KeyAsAttr(i) in instances)
+            return (k for k in self._key_index()
+                    if _in_numeric_range(k, lo, hi))
+        index = self._key_index()
+        start = 0 if lo is None else bisect.bisect_left(index, lo)
+        end = len(index) if hi is None else bisect.bisect_left(index, hi)
+        return iter(index[start:end])
+    
+    def key_prefix(self, prefix):
+        """
+        Returns an iterator over the keys that start with prefix, in sorted order
+        
+        @param prefix: string that all returned keys start with
+        """
+        index = self._key_index()
+        prefix = KeyAsAttr(prefix)
+        start = bisect.bisect_left(index, prefix)
+        end = start
+        while end < len(index) and index[end].startswith(prefix):
+            end += 1
+        return iter(index[start:end])
+    
     def has_key(self, key):
         """
         Returns True if an instance has been created for the supplied key, False otherwise
@@ -562,7 +709,7 @@ class MultiComponent(AbstractModelingEntity, _ComputeModelComponents):
         @param key: immutable key value; coerced to string
         """
         inst = self._instances.get(key)
-        if not inst:
+        if inst is None:
             prototype = self.get_prototype()
             args, kwargs = prototype.get_init_args()
             #args[0] is the name of the prototype
@@ -571,8 +718,22 @@ class MultiComponent(AbstractModelingEntity, _ComputeModelComponents):
             logicalName = "%s_%s" % (args[0], str(key))
             inst = prototype.get_class()(logicalName, *args[1:], **kwargs)
             self._instances[key] = inst
+            self._key_version += 1
+            if self._sorted_keys is not None:
+                bisect.insort(self._sorted_keys, KeyAsAttr(key))
+            model = self._model_instance
+            if model is not None:
+                inst._set_model_instance(model)
+                model._structure_changed(inst)
         return inst
     
+    def _set_model_instance(self, inst):
+        #private; instances belong to the same model, so they can tell it
+        #when they add instances of their own
+        super(MultiComponent, self)._set_model_instance(inst)
+        for c in self._instances.values():
+            c._set_model_instance(inst)
+    
     def instances(self):
         """
         Returns a dict, key:component, for all instances created thus far.
@@ -582,6 +743,60 @@ class MultiComponent(AbstractModelingEntity, _ComputeModelComponents):
         return dict(self._instances)
     
 
+def _is_numeric_range(lo, hi):
+    #internal
+    return isinstance(lo, (int, long)) or isinstance(hi, (int, long))
+
+
+def _in_numeric_range(key, lo, hi):
+    #internal
+    try:
+        value = int(key)
+    except ValueError, _:
+        return False
+    return (str(value) == key and
+            (lo is None or lo <= value) and
+            (hi is None or value < hi))
+
+
+class _MultiComponentView(object):
+    """
+    Internal to Actuator
+    
+    Lazy view of the keys, values or items of a L{MultiComponent}. Iteration
+    works from a snapshot of the keys present when iteration starts, so new
+    instances may be created while iterating.
+    """
+    KEYS = "keys"
+    VALUES = "values"
+    ITEMS = "items"
+    def __init__(self, mc, kind):
+        self.mc = mc
+        self.kind = kind
+        
+    def __len__(self):
+        return len(self.mc)
+    
+    def __iter__(self):
+        if self.kind == self.KEYS:
+            return iter(list(self.mc._instances))
+        elif self.kind == self.VALUES:
+            return self.mc.itervalues()
+        else:
+            return self.mc.iteritems()
+        
+    def __contains__(self, item):
+        if self.kind == self.KEYS:
+            return item in self.mc
+        elif self.kind == self.ITEMS:
+            try:
+                key, value = item
+            except (TypeError, ValueError), _:
+                return False
+            return key in self.mc and self.mc.get(key) == value
+        return any(v == item for v in self)
+        
+
 class MultiComponentGroup(MultiComponent):
     """
     A mixture of ComponentGroup and MultiComponent.
@@ -870,6 +1085,10 @@ class SelectElement(object):
         self.parent = parent
         self.ref = ref
         self.tests = []
+        #private; the compiled form of self.tests (see _SelectStep); the
+        #results of previous evaluations are kept on each model instance
+        #(see RefSelectBuilder._execute())
+        self._step = None
         
     def all(self):
         self.tests.append(RefSelTest(self.builder.ALL))
@@ -880,7 +1099,8 @@ class SelectElement(object):
         return self
     
     def keyin(self, keyiter):
-        self.tests.append(RefSelTest(self.builder.KEYIN, set(keyiter)))
+        self.tests.append(RefSelTest(self.builder.KEYIN,
+                                     frozenset([KeyAsAttr(k) for k in keyiter])))
         return self
         
     def match(self, regexp_pattern):
@@ -898,6 +1118,14 @@ class SelectElement(object):
             raise ActuatorException("The provided predicate isn't callable")
         self.tests.append(RefSelTest(self.builder.PRED, predicate))
         return self
+    
+    def range(self, lo=None, hi=None):
+        self.tests.append(RefSelTest(self.builder.RANGE, (lo, hi)))
+        return self
+    
+    def prefix(self, prefix):
+        self.tests.append(RefSelTest(self.builder.PREFIX, KeyAsAttr(prefix)))
+        return self
         
     def __getattr__(self, attrname):
         try:
@@ -918,6 +1146,87 @@ class SelectElement(object):
         else:
             return [self]
 
+    def _get_step(self):
+        #private; recompile if tests were added since the last compile
+        step = self._step
+        if step is None or step.num_tests != len(self.tests):
+            step = self._step = _SelectStep(self.name, self.tests, self.builder)
+        return step
+
+
+class _SelectStep(object):
+    """
+    Internal to Actuator
+    
+    The compiled form of the tests on a single L{SelectElement}. Key and keyin
+    tests are reduced to a single set of candidate keys that can be looked up
+    directly in a MultiComponent's instances, so that the remaining pattern
+    and predicate tests only need to be applied to the keys that survive
+    those lookups. Filters are kept in the order they were supplied.
+    """
+    def __init__(self, name, tests, builder):
+        self.name = name
+        self.num_tests = len(tests)
+        self.candidates = None
+        self.source = None
+        self.filters = []
+        for test in tests:
+            if test.test_op == builder.ALL:
+                continue
+            elif test.test_op in (builder.RANGE, builder.PREFIX):
+                #the first range/prefix test can generate candidates from the
+                #sorted key index; any others just filter
+                if test.test_op == builder.RANGE:
+                    lo, hi = test.test_arg
+                    source = lambda mc, lo=lo, hi=hi: mc.key_range(lo, hi)
+                    check = ((lambda k, lo=lo, hi=hi: _in_numeric_range(k, lo, hi))
+                             if _is_numeric_range(lo, hi)
+                             else (lambda k, lo=lo, hi=hi:
+                                   (lo is None or lo <= k) and (hi is None or k < hi)))
+                else:
+                    source = lambda mc, p=test.test_arg: mc.key_prefix(p)
+                    check = lambda k, p=test.test_arg: k.startswith(p)
+                if self.source is None:
+                    self.source = (source, check)
+                else:
+                    self.filters.append(check)
+            elif test.test_op in (builder.KEY, builder.KEYIN):
+                keys = (frozenset([KeyAsAttr(test.test_arg)])
+                        if test.test_op == builder.KEY
+                        else test.test_arg)
+                self.candidates = (keys
+                                   if self.candidates is None
+                                   else self.candidates & keys)
+            elif test.test_op == builder.PATRN:
+                self.filters.append(test.test_arg.search)
+            elif test.test_op == builder.NOT_PATRN:
+                self.filters.append(lambda k, s=test.test_arg.search: not s(k))
+            else:
+                self.filters.append(test.test_arg)
+                
+    def select_keys(self, mc):
+        """
+        Return the keys of MultiComponent mc that pass this step's tests
+        """
+        instances = mc._instances
+        filters = self.filters
+        if self.candidates is None:
+            if self.source is not None:
+                keys = list(self.source[0](mc))
+            else:
+                keys = [(k if isinstance(k, KeyAsAttr) else KeyAsAttr(k))
+                        for k in instances]
+        else:
+            if len(self.candidates) <= len(instances):
+                keys = [k for k in self.candidates if k in instances]
+            else:
+                keys = [k for k in instances if k in self.candidates]
+            if self.source is not None:
+                filters = [self.source[1]] + filters
+        for f in filters:
+            keys = [k for k in keys if f(k)]
+        return keys
+
 
 class RefSelectBuilder(object):
     #internal
@@ -927,7 +1236,9 @@ class RefSelectBuilder(object):
     PATRN = "pattern"
     NOT_PATRN = "not pattern"
     PRED = "predicate"
-    filter_ops = [ALL, KEY, KEYIN, PATRN, NOT_PATRN, PRED]
+    RANGE = "range"
+    PREFIX = "prefix"
+    filter_ops = [ALL, KEY, KEYIN, PATRN, NOT_PATRN, PRED, RANGE, PREFIX]
     def __init__(self, model):
         super(RefSelectBuilder, self).__init__()
         
@@ -941,7 +1252,9 @@ class RefSelectBuilder(object):
                          self.KEYIN:self._keyin_test,
                          self.PATRN:self._pattern_test,
                          self.NOT_PATRN:self._not_pattern_test,
-                         self.PRED:self._pred_test}
+                         self.PRED:self._pred_test,
+                         self.RANGE:self._range_test,
+                         self.PREFIX:self._prefix_test}
         
     def _all_test(self, key, test):
         return True
@@ -950,7 +1263,7 @@ class RefSelectBuilder(object):
         return key == test.test_arg
     
     def _keyin_test(self, key, test):
-        return key in [KeyAsAttr(k) for k in test.test_arg]
+        return key in test.test_arg
     
     def _pattern_test(self, key, test):
         return test.test_arg.search(key)
@@ -961,15 +1274,21 @@ class RefSelectBuilder(object):
     def _pred_test(self, key, test):
         return test.test_arg(key)
     
+    def _range_test(self, key, test):
+        lo, hi = test.test_arg
+        if _is_numeric_range(lo, hi):
+            return _in_numeric_range(key, lo, hi)
+        return (lo is None or lo <= key) and (hi is None or key < hi)
+    
+    def _prefix_test(self, key, test):
+        return key.startswith(test.test_arg)
+    
     def _do_test(self, key, element):
         key = KeyAsAttr(key)
-        tests = element.tests[:]
-        result = True
-        while result and tests:
-            test = tests[0]
-            tests = tests[1:]
-            result = self.test_map[test.test_op](key, test)
-        return result
+        for test in element.tests:
+            if not self.test_map[test.test_op](key, test):
+                return False
+        return True
 
     def __getattr__(self, attrname):
         ref = getattr(self.model, attrname)
@@ -981,19 +1300,51 @@ class RefSelectBuilder(object):
                 raise ActuatorException("The following arg is not a select expression: %s" % str(expr))
         return RefSelectUnion(self, *exprs)
      
+    def _results(self, model, create=False):
+        #private; the model instance's cache of selections, keyed by select
+        #element, or None if there isn't one. The cache lives on the model
+        #since the selections refer to it
+        try:
+            mdict = model.__dict__
+        except AttributeError, _:
+            return None
+        results = mdict.get("_sel_results")
+        if results is None and create:
+            results = mdict["_sel_results"] = {}
+        return results
+    
     def _execute(self, element, ctxt):
-        work_list = element._expand()
-        selected = [ctxt.model]
-        while work_list:
-            item = work_list[0]
-            named = [getattr(i, item.name) for i in selected]
-            next_selected = [([v for k, v in n.items() if self._do_test(k, item)]
-                              if isinstance(n.value(), MultiComponent)
-                              else [n])
-                             for n in named]
-            selected = itertools.chain(*next_selected)
-            work_list = work_list[1:]
-        return set(selected)
+        model = ctxt.model
+        items = element._expand()
+        #tests can be added to any element in the chain after an evaluation
+        num_tests = tuple([len(item.tests) for item in items])
+        results = self._results(model)
+        cached = results.get(element) if results is not None else None
+        if cached is not None:
+            cached_tests, versions, result = cached
+            if (cached_tests == num_tests and
+                    all(mc._key_version == v for mc, v in versions)):
+                return set(result)
+        
+        versions = []
+        selected = [model]
+        for item in items:
+            step = item._get_step()
+            next_selected = []
+            for i in selected:
+                n = getattr(i, step.name)
+                mc = n.value()
+                if isinstance(mc, MultiComponent):
+                    versions.append((mc, mc._key_version))
+                    next_selected.extend([n[k] for k in step.select_keys(mc)])
+                else:
+                    next_selected.append(n)
+            selected = next_selected
+        result = frozenset(selected)
+        results = self._results(model, create=True)
+        if results is not None:
+            results[element] = (num_tests, versions, result)
+        return set(result)
     
     
 class RefSelectUnion(object):
@@ -1099,6 +1450,14 @@ class ModelBase(_NexusMember, _ComputeModelComponents):
             else:
                 ref = getattr(ref, p)
         return ref if ref != self else None
+    
+    def _structure_changed(self, component):
+        """
+        Internal; called when a MultiComponent in this model adds an instance,
+        component. Models that keep indexes of their components can update
+        them here.
+        """
+        pass
 
     def __getattribute__(self, attrname):
         ga = super(ModelBase, self).__getattribute__
@@ -35,6 +35,20 @@ class BaseProvisioner(object):
     """
     Base class for all provisioners.
     """
+    resource_listener = None
+    def set_resource_listener(self, listener):
+        """
+        Supply a callable that is to be called with each resource of the
+        infra model as soon as it has been provisioned, rather than only when
+        the whole model is done. Provisioners that can't tell when individual
+        resources are done never call it.
+        
+        @param listener: a callable that takes a resource as its only
+            argument, or None to stop notifications. It is called on a
+            provisioning thread and should return quickly.
+        """
+        self.resource_listener = listener
+        
     def provision_infra_model(self, inframodel_instance):
         """
         Instructs the provisioner to do the work to provision the supplied
@@ -50,13 +64,35 @@ class BaseProvisioner(object):
     def _provision(self, inframodel_instance):
         raise TypeError("Derived class must implement _provision()")
     
+    def simulate(self, inframodel_instance, **kwargs):
+        """
+        Predicts how long provisioning the supplied infra model would take,
+        without provisioning anything; returns an
+        L{actuator.exec_agents.simulate.SimulationResult}
+        
+        @param inframodel_instance: An instance of a derived class of InfraModel
+        @keyword **kwargs: see L{actuator.exec_agents.simulate.simulate_run}
+        """
+        if not isinstance(inframodel_instance, InfraModel):
+            raise ProvisionerException("Provisioner asked to simulate something not an InfraModel")
+        _ = inframodel_instance.refs_for_components()
+        return self._simulate(inframodel_instance, **kwargs)
+    
+    def _simulate(self, inframodel_instance, **kwargs):
+        raise TypeError("Derived class must implement _simulate()")
+    
     def deprovision_infra_from_record(self, record):
         """
-        Not implemented.
+        Instructs the provisioner to remove the resources captured in a
+        provisioning record; returns the record, which no longer contains the
+        resources that were removed
+        
+        @param record: An instance of a derived class of
+            BaseProvisioningRecord, as returned by L{provision_infra_model}
         """
         if not isinstance(record, BaseProvisioningRecord):
             raise ProvisionerException("Record must be a kind of BaseProvisioningRecord")
-        self._deprovision(record)
+        return self._deprovision(record)
         
     def _deprovision(self, record):
         raise TypeError("Derived class must implement _deprovision()")
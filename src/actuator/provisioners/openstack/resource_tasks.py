@@ -25,44 +25,70 @@ Internal to Actuator; responsible for processing Openstack resource objects
 import time
 import threading
 import uuid
-import string
+import sys
 import logging
+import os
+import re
 import threading
 
-from actuator.namespace import NamespaceModel
+import networkx as nx
+
 from actuator.provisioners.openstack import openstack_class_factory as ocf
-NovaClient = ocf.get_nova_client_class()
-NeutronClient = ocf.get_neutron_client_class()
 from actuator.provisioners.core import ProvisionerException, BaseProvisioner
 from actuator.provisioners.openstack.resources import *
-from actuator.provisioners.openstack.support import (_OSMaps,
-                                                     OpenstackProvisioningRecord)
-from actuator.config import _ConfigTask, ConfigModel, with_dependencies
-from actuator.exec_agents.core import ExecutionAgent
+from actuator.provisioners.openstack.support import (_OSMaps, ClientPool,
+                                                     OpenstackProvisioningRecord,
+                                                     DEFAULT_LOOKUP_TTLS,
+                                                     ServerReadinessPoller,
+                                                     ProvisioningJournal,
+                                                     load_journal)
+from actuator.config import _ConfigTask
+from actuator.exec_agents.core import ExecutionAgent, TaskFuture
 from actuator.utils import (capture_mapping, get_mapper, root_logger, LOG_INFO,
                             LOG_WARN)
 
 _rt_domain = "resource_task_domain"
 
 
+def _new_nvclient(username, password, tenant_name, auth_url):
+    #internal
+    return ocf.get_nova_client_class()("1.1", username, password,
+                                       tenant_name, auth_url)
+
+
+def _new_nuclient(username, password, tenant_name, auth_url):
+    #internal
+    return ocf.get_neutron_client_class()(username=username, password=password,
+                                          auth_url=auth_url,
+                                          tenant_name=tenant_name)
+
+
 class RunContext(object):
-    def __init__(self, record, username, password, tenant_name, auth_url):
+    def __init__(self, record, username, password, tenant_name, auth_url,
+                 nova_pool=None, neutron_pool=None, maps=None, poller=None):
         self.username = username
         self.password = password
         self.tenant_name = tenant_name
         self.auth_url = auth_url
         self.record = record
-        self.maps = _OSMaps(self)
+        creds = (username, password, tenant_name, auth_url)
+        self.nova_pool = (nova_pool
+                          if nova_pool is not None
+                          else ClientPool(lambda: _new_nvclient(*creds), size=1))
+        self.neutron_pool = (neutron_pool
+                             if neutron_pool is not None
+                             else ClientPool(lambda: _new_nuclient(*creds), size=1))
+        self.maps = maps if maps is not None else _OSMaps(self)
+        #if None, server tasks wait for their own servers to get addresses
+        self.poller = poller
     
     def _nuclient(self):
-        return NeutronClient(username=self.username, password=self.password,
-                             auth_url=self.auth_url, tenant_name=self.tenant_name)
+        return self.neutron_pool.get()
         
     nuclient = property(_nuclient)
     
     def _nvclient(self):
-        return NovaClient("1.1", self.username, self.password,
-                          self.tenant_name, self.auth_url)
+        return self.nova_pool.get()
         
     nvclient = property(_nvclient)
 
@@ -88,13 +114,39 @@ class _ProvisioningTask(_ConfigTask):
         return []
     
     def provision(self, run_context):
-        self._provision(run_context)
+        return self._provision(run_context)
     
     def _provision(self, run_context):
         return
     
     def get_init_args(self):
         return ((self.rsrc,), {"repeat_count":self.repeat_count})
+    
+    def journal_rsrcs(self):
+        """
+        Returns the list of resources this task provisions
+        """
+        return [self.rsrc]
+    
+    def done_state(self, rsrc):
+        """
+        Returns a dict of JSON-able values, other than the resource's osid,
+        needed to put the provisioned resource back into the same state when
+        provisioning is resumed from a journal, or None if there are none
+        """
+        return None
+    
+    def restore(self, rsrc, osid, state):
+        """
+        Put a resource into the state it was in after being provisioned,
+        using data read from a journal, instead of provisioning it.
+        
+        @param rsrc: the resource to restore
+        @param osid: the resource's Openstack id
+        @param state: the dict that done_state() returned when it was
+            provisioned
+        """
+        rsrc.set_osid(osid)
 
 
 @capture_mapping(_rt_domain, Network)
@@ -103,6 +155,7 @@ class ProvisionNetworkTask(_ProvisioningTask):
         msg = {u'network': {u'name':self.rsrc.name,
                             u'admin_state_up':self.rsrc.admin_state_up}}
         response = run_context.nuclient.create_network(body=msg)
+        run_context.maps.invalidate(_OSMaps.NETWORKS)
         self.rsrc.set_osid(response['network']['id'])
         run_context.record.add_network_id(self.rsrc._id, self.rsrc.osid)
         
@@ -125,6 +178,7 @@ class ProvisionSubnetTask(_ProvisioningTask):
                             'dns_nameservers':self.rsrc.dns_nameservers,
                             'name':self.rsrc.name}]}
         sn = run_context.nuclient.create_subnet(body=msg)
+        run_context.maps.invalidate(_OSMaps.SUBNETS)
         self.rsrc.set_osid(sn["subnets"][0]["id"])
         run_context.record.add_subnet_id(self.rsrc._id, self.rsrc.osid)
 
@@ -149,6 +203,7 @@ class ProvisionSecGroupTask(_ProvisioningTask):
                                                                    description=self.rsrc.description)
         finally:
             self._sg_create_lock.release()
+        run_context.maps.invalidate(_OSMaps.SECGROUPS)
         self.rsrc.set_osid(response.id)
         run_context.record.add_secgroup_id(self.rsrc._id, self.rsrc.osid)
 
@@ -176,39 +231,50 @@ class ProvisionSecGroupRuleTask(_ProvisioningTask):
 @capture_mapping(_rt_domain, Server)
 class ProvisionServerTask(_ProvisioningTask):
     def depends_on_list(self):
-        return ([i for i in self.rsrc.security_groups
+        return self._server_deps(self.rsrc)
+    
+    @staticmethod
+    def _server_deps(rsrc):
+        return ([i for i in rsrc.security_groups
                 if isinstance(i, SecGroup)] +
-                [j for j in self.rsrc.nics
+                [j for j in rsrc.nics
                  if isinstance(j, Network)])
 
-    def  _process_server_addresses(self, addr_dict):
-        self.rsrc.set_addresses(addr_dict)
+    def done_state(self, rsrc):
+        return {"addresses":rsrc.addresses}
+    
+    def restore(self, rsrc, osid, state):
+        super(ProvisionServerTask, self).restore(rsrc, osid, state)
+        self._process_server_addresses(state["addresses"], rsrc)
+        
+    def  _process_server_addresses(self, addr_dict, rsrc=None):
+        rsrc = rsrc if rsrc is not None else self.rsrc
+        rsrc.set_addresses(addr_dict)
         for i, (k, v) in enumerate(addr_dict.items()):
-            iface = getattr(self.rsrc, "iface%d" % i)
+            iface = getattr(rsrc, "iface%d" % i)
             iface.name = k
             for j, iface_addr in enumerate(v):
                 setattr(iface, "addr%d" % j, iface_addr['addr'])
-
-    def _provision(self, run_context):
-        run_context.maps.refresh_images()
-        run_context.maps.refresh_flavors()
-        run_context.maps.refresh_networks()
-        args, kwargs = self.rsrc.get_fixed_args()
+                
+    def _creation_args(self, run_context, rsrc):
+        #internal; returns the name, image, flavor, and kwargs for
+        #servers.create() for the supplied server resource
+        maps = run_context.maps
+        args, kwargs = rsrc.get_fixed_args()
         name, image_name, flavor_name = args
-        image = run_context.maps.image_map.get(image_name)
+        image = maps.lookup(maps.IMAGES, image_name)
         if image is None:
             raise ProvisionerException("Image %s doesn't seem to exist" % image_name,
                                        record=run_context.record)
-        flavor = run_context.maps.flavor_map.get(flavor_name)
+        flavor = maps.lookup(maps.FLAVORS, flavor_name)
         if flavor is None:
             raise ProvisionerException("Flavor %s doesn't seem to exist" % flavor_name,
                                        record=run_context.record)
         secgroup_list = []
-        if self.rsrc.security_groups:
-            run_context.maps.refresh_secgroups()
-            for sgname in self.rsrc.security_groups:
-                sgname = self.rsrc._get_arg_msg_value(sgname, SecGroup, "osid", sgname)
-                sg = run_context.maps.secgroup_map.get(sgname)
+        if rsrc.security_groups:
+            for sgname in rsrc.security_groups:
+                sgname = rsrc._get_arg_msg_value(sgname, SecGroup, "osid", sgname)
+                sg = maps.lookup(maps.SECGROUPS, sgname)
                 if sg is None:
                     raise ProvisionerException("Security group %s doesn't seem to exist" % sgname,
                                                record=run_context.record)
@@ -216,24 +282,176 @@ class ProvisionServerTask(_ProvisioningTask):
             kwargs["security_groups"] = secgroup_list
             
         nics_list = []
-        if self.rsrc.nics:
-            for nicname in self.rsrc.nics:
-                nicname = self.rsrc._get_arg_msg_value(nicname, Network, "osid", nicname)
-                nic = run_context.maps.network_map.get(nicname)
+        if rsrc.nics:
+            for nicname in rsrc.nics:
+                nicname = rsrc._get_arg_msg_value(nicname, Network, "osid", nicname)
+                nic = maps.lookup(maps.NETWORKS, nicname)
                 if nic is None:
                     raise ProvisionerException("NIC %s doesn't seem to exist" % nicname,
                                                record=run_context.record)
                 nics_list.append({'net-id':nic.id})
             kwargs['nics'] = nics_list
-            
+        return name, image, flavor, kwargs
+    
+    def _await_servers(self, run_context, pairs):
+        #internal; pairs is a list of (server resource, novaclient server)
+        #tuples. Either waits for all the servers to get addresses, or
+        #returns a TaskFuture that completes when they all have
+        if run_context.poller is None:
+            for rsrc, srvr in pairs:
+                while not srvr.addresses:
+                    time.sleep(0.25)
+                    srvr.get()
+                self._process_server_addresses(srvr.addresses, rsrc)
+            return None
+        #let the poller tell us when the servers are up so this thread can
+        #go on to do other tasks in the meantime
+        done = TaskFuture()
+        remaining = [len(pairs)]
+        lock = threading.Lock()
+        def when_ready(rsrc, ready):
+            if ready.exception is not None:
+                done.set_exception(ready.exception, ready.traceback)
+                return
+            try:
+                self._process_server_addresses(ready.result.addresses, rsrc)
+            except Exception, e:
+                done.set_exception(e, sys.exc_info()[2])
+                return
+            with lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                done.set_result()
+        for rsrc, srvr in pairs:
+            (run_context.poller.watch(srvr.id)
+             .add_done_callback(lambda ready, rsrc=rsrc: when_ready(rsrc, ready)))
+        return done
+
+    def _provision(self, run_context):
+        name, image, flavor, kwargs = self._creation_args(run_context, self.rsrc)
         srvr = run_context.nvclient.servers.create(name, image, flavor, **kwargs)
         self.rsrc.set_osid(srvr.id)
         run_context.record.add_server_id(self.rsrc._id, self.rsrc.osid)
+        return self._await_servers(run_context, [(self.rsrc, srvr)])
+    
+    
+class ProvisionServerGroupTask(ProvisionServerTask):
+    """
+    Internal; creates a group of identically configured servers with a single
+    servers.create() call using min_count/max_count, and then maps the
+    created servers back onto the individual Server resources.
+    
+    Nova doesn't tell the client which servers a request created, so each
+    request tags its servers with a unique id in their metadata, and the
+    servers are then found by listing those with the group's name and tag.
+    """
+    batch_tag = "actuator_batch"
+    def __init__(self, rsrcs, repeat_count=1):
+        super(ProvisionServerGroupTask, self).__init__(rsrcs[0],
+                                                       repeat_count=repeat_count)
+        for rsrc in rsrcs[1:]:
+            self._rsrc_by_id[rsrc._id] = rsrc
+        self.member_ids = [rsrc._id for rsrc in rsrcs]
+        self.name = "{}_x{}_provisioning_Server_group_task".format(rsrcs[0].name,
+                                                                   len(rsrcs))
         
-        while not srvr.addresses:
-            time.sleep(0.25)
-            srvr.get()
-        self._process_server_addresses(srvr.addresses)
+    def _get_members(self):
+        return [self._rsrc_by_id[rid] for rid in self.member_ids]
+    
+    members = property(_get_members)
+    
+    def depends_on_list(self):
+        deps = []
+        for rsrc in self.members:
+            for d in self._server_deps(rsrc):
+                if not [x for x in deps if x is d]:
+                    deps.append(d)
+        return deps
+    
+    def get_init_args(self):
+        return ((self.members,), {"repeat_count":self.repeat_count})
+    
+    def journal_rsrcs(self):
+        return self.members
+    
+    @staticmethod
+    def _base_name(names):
+        #the common prefix of the member names, less trailing separators;
+        #Nova adds a "-<n>" suffix to each server's name
+        prefix = os.path.commonprefix(names).rstrip("_-")
+        return prefix if prefix else names[0]
+    
+    @staticmethod
+    def _launch_order(srvr):
+        index = getattr(srvr, "OS-EXT-SRV-ATTR:launch_index", None)
+        if index is not None:
+            return (0, int(index), "")
+        name = getattr(srvr, "name", "") or ""
+        _, _, suffix = name.rpartition("-")
+        if suffix.isdigit():
+            return (1, int(suffix), name)
+        return (2, 0, name)
+    
+    def _provision(self, run_context):
+        members = self.members
+        count = len(members)
+        _, image, flavor, kwargs = self._creation_args(run_context, members[0])
+        name = self._base_name([m.name for m in members])
+        batch_id = str(uuid.uuid4())
+        meta = dict(kwargs.get("meta") or {})
+        meta[self.batch_tag] = batch_id
+        kwargs.update({"min_count":count, "max_count":count, "meta":meta})
+        nvclient = run_context.nvclient
+        nvclient.servers.create(name, image, flavor, **kwargs)
+        #Nova's name filter is a regular expression
+        found = nvclient.servers.list(search_opts={"name":"^%s" % re.escape(name)})
+        servers = [srvr for srvr in found
+                   if (getattr(srvr, "metadata", None) or {}).get(self.batch_tag) == batch_id]
+        servers.sort(key=self._launch_order)
+        pairs = zip(members, servers)
+        for rsrc, srvr in pairs:
+            rsrc.set_osid(srvr.id)
+            rsrc.provisionedName = getattr(srvr, "name", None)
+            run_context.record.add_server_id(rsrc._id, rsrc.osid)
+        #any extras still have to be recorded so they get deprovisioned
+        for i, srvr in enumerate(servers[count:]):
+            run_context.record.add_server_id("%s-extra-%d" % (members[0]._id, i),
+                                             srvr.id)
+        if len(servers) != count:
+            raise ProvisionerException("Asked for %d servers in batch %s but "
+                                       "%d were created" % (count, batch_id,
+                                                            len(servers)),
+                                       record=run_context.record)
+        return self._await_servers(run_context, pairs)
+
+
+#the Server arguments that must be equal for servers to be created together
+_server_group_attrs = ("imageName", "flavorName", "security_groups", "nics",
+                       "key_name", "meta", "files", "userdata",
+                       "availability_zone", "block_device_mapping",
+                       "block_device_mapping_v2", "scheduler_hints",
+                       "config_drive", "disk_config")
+
+
+def _server_groups(servers):
+    #internal; partitions fixed Server resources into lists of servers that
+    #can be created with a single request. Servers that specify their own
+    #min/max count or reservation id are always left on their own.
+    groups = []
+    for rsrc in sorted(servers, key=lambda r: r.name):
+        if (rsrc.min_count is not None or rsrc.max_count is not None or
+                rsrc.reservation_id is not None):
+            groups.append((None, [rsrc]))
+            continue
+        sig = [getattr(rsrc, a) for a in _server_group_attrs]
+        for gsig, members in groups:
+            if gsig is not None and gsig == sig:
+                members.append(rsrc)
+                break
+        else:
+            groups.append((sig, [rsrc]))
+    return [members for _, members in groups]
 
                 
 @capture_mapping(_rt_domain, Router)
@@ -243,6 +461,7 @@ class ProvisionRouterTask(_ProvisioningTask):
         msg = {u'router': {u'admin_state_up':self.rsrc.admin_state_up,
                            u'name':self.rsrc.name}}
         reply = run_context.nuclient.create_router(body=msg)
+        run_context.maps.invalidate(_OSMaps.ROUTERS)
         self.rsrc.set_osid(reply["router"]["id"])
         run_context.record.add_router_id(self.rsrc._id, self.rsrc.osid)
 
@@ -256,8 +475,8 @@ class ProvisionRouterGatewayTask(_ProvisioningTask):
         
     def _provision(self, run_context):
         router_id = self.rsrc._get_arg_msg_value(self.rsrc.router, Router, "osid", "router")
-        run_context.maps.refresh_networks()
-        ext_net = run_context.maps.network_map.get(self.rsrc.external_network_name)
+        ext_net = run_context.maps.lookup(_OSMaps.NETWORKS,
+                                          self.rsrc.external_network_name)
         msg = {u'network_id':ext_net.id}
         _ = run_context.nuclient.add_gateway_router(router_id, msg)
 
@@ -279,12 +498,22 @@ class ProvisionRouterInterfaceTask(_ProvisioningTask):
                                                       {u'subnet_id':subnet,
                                                        u'name':self.rsrc.name})
         run_context.record.add_router_iface_id(self.rsrc._id, response[u'id'])
+        #the port is what's needed to remove the interface later
+        if response.get(u'port_id') is not None:
+            run_context.record.add_port_id(self.rsrc._id, response[u'port_id'])
 
 
 @capture_mapping(_rt_domain, FloatingIP)
 class ProvisionFloatingIPTask(_ProvisioningTask):
     def depends_on_list(self):
         return [self.rsrc.server] if isinstance(self.rsrc.server, Server) else []
+    
+    def done_state(self, rsrc):
+        return {"ip":rsrc.ip}
+    
+    def restore(self, rsrc, osid, state):
+        super(ProvisionFloatingIPTask, self).restore(rsrc, osid, state)
+        rsrc.set_addresses(state["ip"])
         
     def _provision(self, run_context):
         self.rsrc.refix_arguments()
@@ -300,6 +529,195 @@ class ProvisionFloatingIPTask(_ProvisioningTask):
             run_context.nvclient.servers.add_floating_ip(server, fip, associated_ip)
             
             
+def _is_not_found(exc):
+    #internal; True if exc is the Nova or Neutron client's way of saying the
+    #resource is already gone
+    return (getattr(exc, "code", None) == 404 or
+            getattr(exc, "status_code", None) == 404 or
+            exc.__class__.__name__.endswith("NotFound"))
+
+
+class _DeprovisioningTask(_ConfigTask):
+    """
+    Internal; base for the tasks that delete a single Openstack resource
+    named in an L{OpenstackProvisioningRecord}. Derived classes set the kind
+    of the resource and the name of the record attribute with the ids of
+    this kind, and implement _delete(). After a successful deletion (or if
+    the resource was already gone), the resource's entries are removed from
+    the record so that a record from a failed deprovisioning can be retried.
+    """
+    clone_attrs = False
+    kind = None
+    record_attr = None
+    def __init__(self, osid, rids, repeat_count=1):
+        super(_DeprovisioningTask, self).__init__("deprovision_{}_{}_task"
+                                                  .format(self.kind, osid),
+                                                  repeat_count=repeat_count)
+        self.osid = osid
+        self.rids = list(rids)
+        
+    def get_init_args(self):
+        return ((self.osid, self.rids), {"repeat_count":self._repeat_count})
+        
+    def provision(self, run_context):
+        #this is what the task sequencer agent calls to perform a task
+        try:
+            self._delete(run_context)
+        except Exception, e:
+            if not _is_not_found(e):
+                raise
+        ids = getattr(run_context.record, self.record_attr)
+        for rid in self.rids:
+            ids.pop(rid, None)
+            
+    def _delete(self, run_context):
+        raise TypeError("Derived class must implement _delete()")
+    
+    
+class _DeprovisionFloatingIPTask(_DeprovisioningTask):
+    kind = "floating_ip"
+    record_attr = "floating_ip_ids"
+    def _delete(self, run_context):
+        run_context.nvclient.floating_ips.delete(self.osid)
+        
+        
+class _DeprovisionServerTask(_DeprovisioningTask):
+    kind = "server"
+    record_attr = "server_ids"
+    #servers go away asynchronously, but their ports must be gone before
+    #their networks and security groups can be deleted, so wait for that
+    min_interval = 0.25
+    max_interval = 5.0
+    timeout = 600
+    def _delete(self, run_context):
+        nvclient = run_context.nvclient
+        nvclient.servers.delete(self.osid)
+        interval = self.min_interval
+        give_up = time.time() + self.timeout
+        while True:
+            try:
+                nvclient.servers.get(self.osid)
+            except Exception, e:
+                if _is_not_found(e):
+                    return
+                raise
+            if time.time() > give_up:
+                raise ProvisionerException("Timed out waiting for server %s "
+                                           "to be deleted" % self.osid,
+                                           record=run_context.record)
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.max_interval)
+            
+            
+class _DeprovisionRouterInterfaceTask(_DeprovisioningTask):
+    kind = "router_iface"
+    record_attr = "router_iface_ids"
+    def __init__(self, osid, rids, port_ids=None, repeat_count=1):
+        super(_DeprovisionRouterInterfaceTask, self).__init__(osid, rids,
+                                                              repeat_count=repeat_count)
+        #osid is the router's id; port_ids are the interfaces' ports
+        self.port_ids = list(port_ids) if port_ids else []
+        
+    def get_init_args(self):
+        return ((self.osid, self.rids), {"port_ids":self.port_ids,
+                                         "repeat_count":self._repeat_count})
+        
+    def _delete(self, run_context):
+        nuclient = run_context.nuclient
+        port_ids = self.port_ids
+        if len(port_ids) < len(self.rids):
+            #a record from before ports were captured; the router is being
+            #deleted as well, so take off all of its interfaces
+            ports = nuclient.list_ports(device_id=self.osid,
+                                        device_owner="network:router_interface")
+            port_ids = [p["id"] for p in ports.get("ports", [])]
+        for port_id in port_ids:
+            try:
+                nuclient.remove_interface_router(self.osid, {u'port_id':port_id})
+            except Exception, e:
+                if not _is_not_found(e):
+                    raise
+        for rid in self.rids:
+            run_context.record.port_ids.pop(rid, None)
+            
+            
+class _DeprovisionRouterTask(_DeprovisioningTask):
+    kind = "router"
+    record_attr = "router_ids"
+    def _delete(self, run_context):
+        nuclient = run_context.nuclient
+        nuclient.remove_gateway_router(self.osid)
+        nuclient.delete_router(self.osid)
+        
+        
+class _DeprovisionSubnetTask(_DeprovisioningTask):
+    kind = "subnet"
+    record_attr = "subnet_ids"
+    def _delete(self, run_context):
+        run_context.nuclient.delete_subnet(self.osid)
+        
+        
+class _DeprovisionNetworkTask(_DeprovisioningTask):
+    kind = "network"
+    record_attr = "network_ids"
+    def _delete(self, run_context):
+        run_context.nuclient.delete_network(self.osid)
+        
+        
+class _DeprovisionSecGroupRuleTask(_DeprovisioningTask):
+    kind = "secgroup_rule"
+    record_attr = "secgroup_rule_ids"
+    def _delete(self, run_context):
+        run_context.nvclient.security_group_rules.delete(self.osid)
+        
+        
+class _DeprovisionSecGroupTask(_DeprovisioningTask):
+    kind = "secgroup"
+    record_attr = "secgroup_ids"
+    def _delete(self, run_context):
+        run_context.nvclient.security_groups.delete(self.osid)
+        
+        
+class _DeprovisionPhaseTask(_ConfigTask):
+    """
+    Internal; does nothing, but marks the completion of all the deletions of
+    one kind of resource so that the tasks for the kinds that have to wait
+    for them only need a single dependency.
+    """
+    clone_attrs = False
+    def __init__(self, kind, repeat_count=1):
+        super(_DeprovisionPhaseTask, self).__init__("{}_deprovisioning_phase"
+                                                    .format(kind),
+                                                    repeat_count=repeat_count)
+        self.kind = kind
+        
+    def get_init_args(self):
+        return ((self.kind,), {"repeat_count":self._repeat_count})
+        
+    def provision(self, run_context):
+        return
+    
+    
+#deletion task classes in the order that their kinds are first considered
+_deprovisioning_tasks = (_DeprovisionFloatingIPTask, _DeprovisionServerTask,
+                         _DeprovisionRouterInterfaceTask, _DeprovisionRouterTask,
+                         _DeprovisionSubnetTask, _DeprovisionNetworkTask,
+                         _DeprovisionSecGroupRuleTask, _DeprovisionSecGroupTask)
+
+#for each kind, the kinds whose deletion must finish first; this is the
+#reverse of the provisioning dependencies, plus Openstack's own rules (ports
+#of servers and router interfaces keep subnets, networks and security groups
+#in use, and floating IPs keep the router interface to their network in use)
+_deprovisioning_waits_for = {"floating_ip":(),
+                             "server":("floating_ip",),
+                             "router_iface":("floating_ip",),
+                             "router":("router_iface",),
+                             "subnet":("router_iface", "server"),
+                             "network":("subnet", "server"),
+                             "secgroup_rule":(),
+                             "secgroup":("secgroup_rule", "server")}
+
+
 class OpenstackCredentials(object):
     def __init__(self, username, password, tenant_name, auth_url):
         self.username = username
@@ -309,21 +727,64 @@ class OpenstackCredentials(object):
 
 
 class ResourceTaskSequencerAgent(ExecutionAgent):
-    no_punc = string.maketrans(string.punctuation, "_"*len(string.punctuation))
     exception_class = ProvisionerException
-    def __init__(self, infra_model, os_creds, num_threads=5):
-        self.logger = root_logger.getChild("os_prov_agent")
-        self.infra_config_model = self.compute_model(infra_model)
-        class ShutupNamespace(NamespaceModel): pass
-        nmi = ShutupNamespace()
-        super(ResourceTaskSequencerAgent, self).__init__(config_model_instance=self.infra_config_model,
-                                                         namespace_model_instance=nmi,
-                                                         no_delay=True,
+    LOG_SUFFIX = "os_prov_agent"
+    def __init__(self, infra_model, os_creds, num_threads=5,
+                 client_pool_size=None, client_max_age=3000, lookup_ttls=None,
+                 poll_servers=True, batch_servers=False, journal=None,
+                 resume_state=None, resource_listener=None, max_threads=None):
+        self.logger = root_logger.getChild(self.LOG_SUFFIX)
+        self.batch_servers = batch_servers
+        self.journal = journal
+        self.resume_state = resume_state
+        self.resource_listener = resource_listener
+        self.restored = set()
+        self.record = OpenstackProvisioningRecord(uuid.uuid4())
+        #the graph of provisioning tasks is built directly rather than by
+        #way of a ConfigModel; the tasks have no roles or config to resolve
+        self.task_graph = self.compute_model(infra_model)
+        super(ResourceTaskSequencerAgent, self).__init__(no_delay=True,
                                                          num_threads=num_threads,
+                                                         max_threads=max_threads,
                                                          log_level=self.logger.getEffectiveLevel())
         self.run_contexts = {}  #keys are threads, values are RunContext objects
-        self.record = OpenstackProvisioningRecord(uuid.uuid4())
+        #(task name, thread name, start, end) for each task performed; a
+        #task that hands off to the server poller ends when it hands off
+        self.task_timings = []
         self.os_creds = os_creds
+        if client_pool_size is None:
+            #one for each worker, plus one for the server poller
+            client_pool_size = max(num_threads, max_threads or 0) + 1
+        #the pools are shared by all RunContexts, which in turn are per-thread,
+        #so each thread keeps reusing the clients it first authenticated with
+        creds = (os_creds.username, os_creds.password, os_creds.tenant_name,
+                 os_creds.auth_url)
+        self.nova_pool = ClientPool(lambda: _new_nvclient(*creds),
+                                    size=client_pool_size,
+                                    max_age=client_max_age)
+        self.neutron_pool = ClientPool(lambda: _new_nuclient(*creds),
+                                       size=client_pool_size,
+                                       max_age=client_max_age)
+        ttls = dict(DEFAULT_LOOKUP_TTLS)
+        if lookup_ttls:
+            ttls.update(lookup_ttls)
+        #one set of lookup maps for all threads; it gets its clients from
+        #the nvclient/nuclient properties below, and hence from the calling
+        #thread's pooled clients
+        self.maps = _OSMaps(self, ttls=ttls)
+        self.poller = (ServerReadinessPoller(self.nova_pool.get)
+                       if poll_servers
+                       else None)
+        
+    def _nvclient(self):
+        return self.nova_pool.get()
+    
+    nvclient = property(_nvclient)
+    
+    def _nuclient(self):
+        return self.neutron_pool.get()
+    
+    nuclient = property(_nuclient)
         
     def get_context(self):
         context = self.run_contexts.get(threading.current_thread())
@@ -331,23 +792,100 @@ class ResourceTaskSequencerAgent(ExecutionAgent):
             context = RunContext(self.record, self.os_creds.username,
                                  self.os_creds.password,
                                  self.os_creds.tenant_name,
-                                 self.os_creds.auth_url)
+                                 self.os_creds.auth_url,
+                                 nova_pool=self.nova_pool,
+                                 neutron_pool=self.neutron_pool,
+                                 maps=self.maps,
+                                 poller=self.poller)
             self.run_contexts[threading.current_thread()] = context
         return context
     
     def _perform_task(self, task, logfile=None):
         self.logger.info("Starting provisioning task %s named %s, id %s" %
                          (task.__class__.__name__, task.name, str(task._id)))
+        start = time.time()
         try:
-            task.provision(self.get_context())
+            return task.provision(self.get_context())
         finally:
+            self.task_timings.append((task.name, threading.current_thread().name,
+                                      start, time.time()))
             self.logger.info("Completed provisioning task %s named %s, id %s" %
                              (task.__class__.__name__, task.name, str(task._id)))
+            
+    def _task_succeeded(self, graph, task):
+        #note the task's resources in the journal before anything that
+        #depends on them can start
+        if self.journal is not None and isinstance(task, _ProvisioningTask):
+            for rsrc in task.journal_rsrcs():
+                self.record.journal_done(rsrc._id, getattr(rsrc, "osid", None),
+                                         task.done_state(rsrc))
+        if self.resource_listener is not None and isinstance(task, _ProvisioningTask):
+            for rsrc in task.journal_rsrcs():
+                self._notify_listener(rsrc)
+        super(ResourceTaskSequencerAgent, self)._task_succeeded(graph, task)
+        
+    def _notify_listener(self, rsrc):
+        #internal; tell the resource listener a resource is provisioned
+        try:
+            self.resource_listener(rsrc)
+        except Exception, _:
+            self.logger.exception("Resource listener raised for %s" % rsrc.name)
+            
+    def perform_config(self, completion_record=None):
+        if self.resource_listener is not None:
+            for rsrc in self.restored:
+                self._notify_listener(rsrc)
+        try:
+            self._run_graph(self.task_graph)
+        finally:
+            if self.poller is not None:
+                self.poller.stop()
+            if self.journal is not None:
+                self.journal.sync()
+                
+    def _restore_from_journal(self, infra_mi, keys, class_mapper):
+        #internal; restores the resources the resume state says are done,
+        #and puts their ids and any orphaned ids in the record. Returns the
+        #set of restored resources
+        restored = set()
+        for rsrc in infra_mi.components():
+            done = self.resume_state.done.get(keys.get(rsrc._id))
+            if done is None:
+                continue
+            osid, state, ids = done
+            task_class = class_mapper.get(rsrc.__class__)
+            if task_class is None:
+                continue
+            task_class(rsrc).restore(rsrc, osid, state)
+            for attr, id_ in ids:
+                getattr(self.record, attr)[rsrc._id] = id_
+            restored.add(rsrc)
+        #created by runs that didn't finish with them; they get created anew,
+        #but these are kept in the record so they get deprovisioned
+        for attr, key, osid in self.resume_state.orphans:
+            getattr(self.record, attr)["orphaned:%s:%s" % (key, osid)] = osid
+        self.logger.info("%d components restored from the journal; %d orphaned "
+                         "ids" % (len(restored), len(self.resume_state.orphans)))
+        return restored
         
     def get_graph(self, with_fix=False):
-        return self.infra_config_model.get_graph(with_fix=with_fix)
+        """
+        Returns the NetworkX DiGraph of tasks this agent performs
+        
+        @keyword with_fix: boolean, default False. If True, fix_arguments()
+            is called on the tasks first
+        """
+        if with_fix:
+            for task in self.task_graph.nodes():
+                task.fix_arguments()
+        return self.task_graph
     
     def compute_model(self, infra_mi):
+        """
+        Returns a NetworkX DiGraph whose nodes are the tasks to provision
+        the resources in the infra model instance, and whose edges go from
+        each task to the tasks that depend on it
+        """
         all_resources = set(infra_mi.components())
         self.logger.info("%d components to provision" % len(all_resources))
         dependencies = []
@@ -357,6 +895,32 @@ class ResourceTaskSequencerAgent(ExecutionAgent):
         class_mapper = get_mapper(_rt_domain)
         for rsrc in all_resources:
             rsrc.fix_arguments()
+        restored = set()
+        if self.journal is not None or self.resume_state is not None:
+            #the Actuator ids of resources change from run to run, but
+            #their paths in the model don't
+            keys = dict([(ref.value()._id, ".".join(ref.get_path()))
+                         for ref in infra_mi.refs_for_components()])
+            if self.resume_state is not None:
+                restored = self._restore_from_journal(infra_mi, keys, class_mapper)
+                all_resources -= restored
+                self.restored = restored
+            if self.journal is not None:
+                self.record.attach_journal(self.journal, keys)
+        if self.batch_servers:
+            #identical servers get a single task that creates them all at once
+            for group in _server_groups([r for r in all_resources
+                                         if isinstance(r, Server)]):
+                if len(group) > 1:
+                    task = ProvisionServerGroupTask(group, repeat_count=1)
+                    for rsrc in group:
+                        rsrc_task_map[rsrc] = task
+            if rsrc_task_map:
+                self.logger.info("%d servers will be created in batches" %
+                                 len(rsrc_task_map))
+        for rsrc in all_resources:
+            if rsrc in rsrc_task_map:
+                continue
             task_class = class_mapper.get(rsrc.__class__)
             if task_class is None:
                 raise ProvisionerException("Unable to find a task class for resource {}, class {}"
@@ -365,27 +929,104 @@ class ResourceTaskSequencerAgent(ExecutionAgent):
             rsrc_task_map[rsrc] = task
         
         #next, find all the dependencies between components, and hence tasks
+        seen = set()
         for rsrc, task in rsrc_task_map.items():
             for d in task.depends_on_list():
+                if d in restored:
+                    continue
                 if d not in rsrc_task_map:
                     raise ProvisionerException("Resource {} says it depends on {}, "
                                                "but the latter isn't in the "
                                                "list of all components"
                                                .format(rsrc.name, d.name))
                 dtask = rsrc_task_map[d]
-                dependencies.append(dtask | task)
+                #grouped servers share a task, so skip repeats
+                if (dtask, task) in seen:
+                    continue
+                seen.add((dtask, task))
+                dependencies.append((dtask, task))
                 
         self.logger.info("%d resource dependencies" % len(dependencies))
-                
-        #now we can make a config class with these tasks and dependencies
-        class ProvConfig(ConfigModel):
-            for task in rsrc_task_map.values():
-                exec "%s_%d = task" % (string.translate(task.name, self.no_punc),
-                                       id(task))
-            del task
-            with_dependencies(*dependencies)
-            
-        return ProvConfig()
+        return self._make_graph(set(rsrc_task_map.values()), dependencies)
+    
+    def _make_graph(self, tasks, dependencies):
+        #internal; makes the task graph from the tasks and the (before, after)
+        #pairs of tasks in dependencies
+        graph = nx.DiGraph()
+        graph.add_nodes_from(tasks)
+        graph.add_edges_from(dependencies)
+        if not nx.is_directed_acyclic_graph(graph):
+            raise ProvisionerException("The resources have circular dependencies: %s" %
+                                       ", ".join([t.name for t in
+                                                  nx.simple_cycles(graph).next()]))
+        return graph
+    
+    
+class DeprovisioningTaskSequencerAgent(ResourceTaskSequencerAgent):
+    """
+    Internal; deletes the Openstack resources named in an
+    L{OpenstackProvisioningRecord}, in parallel where Openstack allows it.
+    
+    The record only has the ids of the resources that were created, not how
+    they related to each other, so the graph is organised by kind of resource:
+    every resource of a kind is deleted only after all resources of the kinds
+    it must wait for are gone (see _deprovisioning_waits_for). Ids are removed
+    from the record as their resources are deleted.
+    """
+    LOG_SUFFIX = "os_deprov_agent"
+    def __init__(self, record, os_creds, num_threads=5, client_pool_size=None,
+                 client_max_age=3000, max_threads=None):
+        super(DeprovisioningTaskSequencerAgent, self).__init__(record, os_creds,
+                                                               num_threads=num_threads,
+                                                               max_threads=max_threads,
+                                                               client_pool_size=client_pool_size,
+                                                               client_max_age=client_max_age,
+                                                               poll_servers=False)
+        self.record = record
+        
+    def compute_model(self, record):
+        tasks_by_kind = {}
+        for task_class in _deprovisioning_tasks:
+            by_osid = {}
+            for rid, osid in getattr(record, task_class.record_attr).items():
+                by_osid.setdefault(osid, []).append(rid)
+            if task_class is _DeprovisionRouterInterfaceTask:
+                tasks = [task_class(osid, rids,
+                                    port_ids=[record.port_ids[rid] for rid in rids
+                                              if rid in record.port_ids])
+                         for osid, rids in by_osid.items()]
+            else:
+                tasks = [task_class(osid, rids) for osid, rids in by_osid.items()]
+            if tasks:
+                tasks_by_kind[task_class.kind] = tasks
+        self.logger.info("%d resources to deprovision" %
+                         sum([len(t) for t in tasks_by_kind.values()]))
+        
+        #each kind that something waits for gets a phase task that all of
+        #that kind's deletions lead into
+        phases = {}
+        dependencies = []
+        for kind, tasks in tasks_by_kind.items():
+            waits_for = set()
+            pending = list(_deprovisioning_waits_for[kind])
+            while pending:
+                w = pending.pop()
+                if w not in waits_for:
+                    waits_for.add(w)
+                    pending.extend(_deprovisioning_waits_for[w])
+            for w in waits_for:
+                if w not in tasks_by_kind:
+                    continue
+                phase = phases.get(w)
+                if phase is None:
+                    phase = phases[w] = _DeprovisionPhaseTask(w)
+                    dependencies.extend([(t, phase) for t in tasks_by_kind[w]])
+                dependencies.extend([(phase, t) for t in tasks])
+        all_tasks = set(phases.values())
+        for tasks in tasks_by_kind.values():
+            all_tasks.update(tasks)
+        self.logger.info("%d deprovisioning dependencies" % len(dependencies))
+        return self._make_graph(all_tasks, dependencies)
                 
 
 class OpenstackProvisioner(BaseProvisioner):
@@ -402,7 +1043,10 @@ class OpenstackProvisioner(BaseProvisioner):
     """
     LOG_SUFFIX = "os_provisioner"
     def __init__(self, username, password, tenant_name, auth_url, num_threads=5,
-                 log_level=LOG_INFO):
+                 log_level=LOG_INFO, client_pool_size=None, client_max_age=3000,
+                 lookup_ttls=None, poll_servers=True, batch_servers=False,
+                 deprovision_threads=None, journal_path=None, resume=False,
+                 max_threads=None):
         """
         @param username: String; the Openstack user name
         @param password: String; the Openstack password for username
@@ -411,22 +1055,147 @@ class OpenstackProvisioner(BaseProvisioner):
             authenticate the username/password to allow them to perform the
             resource provisioning tasks.
         @keyword num_threads: Optional. Integer, default 5. The number of threads
-            to spawn to handle parallel provisioning tasks
+            to spawn to handle parallel provisioning tasks; with max_threads,
+            the fewest there will be
         @keyword log_level: Optional; default LOG_INFO. One of the logging values
             from actuator: LOG_CRIT, LOG_ERROR, LOG_WARN, LOG_INFO, LOG_DEBUG.
+        @keyword client_pool_size: Optional; default None. The number of
+            authenticated Nova and Neutron clients to retain for reuse. None
+            means to use num_threads + 1, so that each thread (including the
+            server readiness poller) keeps its own.
+        @keyword client_max_age: Optional; default 3000. Number of seconds to
+            reuse an authenticated client before replacing it; this should be
+            less than the lifetime of a Keystone token. None means to never
+            replace clients.
+        @keyword lookup_ttls: Optional; default None. A dict that overrides
+            the number of seconds that lists of images, flavors, networks,
+            security groups, etc, fetched from Openstack are reused by all
+            provisioning threads. See DEFAULT_LOOKUP_TTLS in the
+            support module for the keys and default values.
+        @keyword poll_servers: Optional; default True. If True, a single
+            thread polls for all booting servers to get their addresses, and
+            provisioning threads are free to work on other resources while
+            servers boot. If False, each thread waits for the server it
+            created.
+        @keyword batch_servers: Optional; default False. If True, Servers
+            that have the same image, flavor, security groups, nics, key and
+            other creation arguments (typically the instances of a
+            MultiResource) are created with a single request using
+            min_count/max_count, rather than one request per server. Nova
+            names batched servers with a "-<n>" suffix; the actual name is
+            available from each Server's provisionedName attribute. Servers
+            that set min_count, max_count or reservation_id themselves are
+            never batched.
+        @keyword deprovision_threads: Optional; default None. The number of
+            threads to use to delete resources in
+            L{deprovision_infra_from_record}. None means to use num_threads.
+            Deletions are mostly waiting on Openstack, so this can usually be
+            larger than num_threads.
+        @keyword journal_path: Optional; default None. Path of a file to
+            journal the ids of all created Openstack resources to as they are
+            created, so that provisioning can be resumed if it dies part way
+            through. See L{ProvisioningJournal}.
+        @keyword resume: Optional; default False. Only used if journal_path
+            is given. If True and the journal exists, resources the journal
+            says were completely provisioned aren't provisioned again; their
+            osids and other provisioned values are filled in from the journal
+            and only the remaining resources are provisioned. Resources that
+            were created but never completed are put in the returned record
+            (under "orphaned:" ids) so they are removed by deprovisioning. If
+            False, any existing journal is replaced. The journal is marked as
+            finished when provisioning completes and when
+            L{deprovision_infra_from_record} deletes a record's resources, so
+            a resume only applies to a run that didn't complete.
+        @keyword max_threads: Optional; default None. If given, the number of
+            provisioning threads grows and shrinks between num_threads and
+            max_threads with the number of resources ready to be provisioned
+            and how long Openstack is taking, and never exceeds the number of
+            resources that can be provisioned at once (see
+            L{actuator.exec_agents.pool.PoolSizer}). Deprovisioning uses it
+            too unless deprovision_threads is given. None means a fixed
+            num_threads threads.
         """
         self.os_creds = OpenstackCredentials(username, password, tenant_name, auth_url)
         self.agent = None
         self.num_threads = num_threads
+        self.max_threads = max_threads
+        self.client_pool_size = client_pool_size
+        self.client_max_age = client_max_age
+        self.lookup_ttls = lookup_ttls
+        self.poll_servers = poll_servers
+        self.batch_servers = batch_servers
+        self.deprovision_threads = deprovision_threads
+        self.journal_path = journal_path
+        self.resume = resume
         root_logger.setLevel(log_level)
         self.logger = root_logger.getChild(self.LOG_SUFFIX)
         
     def _provision(self, inframodel_instance):
         self.logger.info("Starting to provision...")
-        self.agent = ResourceTaskSequencerAgent(inframodel_instance,
-                                                self.os_creds,
-                                                num_threads=self.num_threads)
-        self.agent.perform_config()
+        journal = resume_state = None
+        if self.journal_path is not None:
+            if self.resume and os.path.exists(self.journal_path):
+                resume_state = load_journal(self.journal_path)
+            journal = ProvisioningJournal(self.journal_path, resume=self.resume)
+        try:
+            self.agent = ResourceTaskSequencerAgent(inframodel_instance,
+                                                    self.os_creds,
+                                                    num_threads=self.num_threads,
+                                                    max_threads=self.max_threads,
+                                                    client_pool_size=self.client_pool_size,
+                                                    client_max_age=self.client_max_age,
+                                                    lookup_ttls=self.lookup_ttls,
+                                                    poll_servers=self.poll_servers,
+                                                    batch_servers=self.batch_servers,
+                                                    journal=journal,
+                                                    resume_state=resume_state,
+                                                    resource_listener=self.resource_listener)
+            self.agent.perform_config()
+            if journal is not None:
+                #there's nothing left for a later run to resume
+                journal.add_finished()
+        finally:
+            if journal is not None:
+                journal.close()
         self.logger.info("...provisioning complete.")
         return self.agent.record
+    
+    def _simulate(self, inframodel_instance, **kwargs):
+        #the agent is only used to build the graph and schedule it; none of
+        #its clients are made
+        agent = ResourceTaskSequencerAgent(inframodel_instance,
+                                           self.os_creds,
+                                           num_threads=self.num_threads,
+                                           max_threads=self.max_threads,
+                                           client_pool_size=self.client_pool_size,
+                                           client_max_age=self.client_max_age,
+                                           lookup_ttls=self.lookup_ttls,
+                                           poll_servers=self.poll_servers,
+                                           batch_servers=self.batch_servers)
+        kwargs.setdefault("phase", "provision")
+        return agent.simulate(**kwargs)
+    
+    def _deprovision(self, record):
+        if not isinstance(record, OpenstackProvisioningRecord):
+            raise ProvisionerException("Record must be an OpenstackProvisioningRecord")
+        self.logger.info("Starting to deprovision...")
+        if self.deprovision_threads is not None:
+            num_threads, max_threads = self.deprovision_threads, None
+        else:
+            num_threads, max_threads = self.num_threads, self.max_threads
+        self.agent = DeprovisioningTaskSequencerAgent(record, self.os_creds,
+                                                      num_threads=num_threads,
+                                                      max_threads=max_threads,
+                                                      client_pool_size=self.client_pool_size,
+                                                      client_max_age=self.client_max_age)
+        self.agent.perform_config()
+        if self.journal_path is not None and os.path.exists(self.journal_path):
+            #a resume mustn't restore the resources that were just deleted
+            journal = ProvisioningJournal(self.journal_path, resume=True)
+            try:
+                journal.add_finished()
+            finally:
+                journal.close()
+        self.logger.info("...deprovisioning complete.")
+        return record
     
\ No newline at end of file
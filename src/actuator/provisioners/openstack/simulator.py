@@ -0,0 +1,502 @@
+#
+# Copyright (c) 2015 Tom Carroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+An in-process simulation of the parts of the Nova and Neutron client APIs
+that the Openstack provisioner uses.
+
+The simulator is meant for exercising and measuring the provisioner without
+a real cloud. A L{SimulatedCloud} holds the state of the simulated cloud and
+the knobs that control its behaviour:
+    - per-call latency, as a distribution for each API call
+    - how long servers take to boot before they have addresses
+    - a limit on the rate of API calls, past which calls fail like Nova's
+      OverLimit
+    - the probability that any particular call fails, or that a server goes
+      into the ERROR state while booting
+
+To use it, create a cloud and install it, which sets the client classes in
+L{openstack_class_factory}; any provisioner created afterwards will talk to
+the simulated cloud: ::
+
+    cloud = SimulatedCloud(latency={"*":uniform(0.01, 0.05)},
+                           boot_time=uniform(1, 3))
+    cloud.install()
+    try:
+        OpenstackProvisioner(...).provision_infra_model(model)
+    finally:
+        cloud.uninstall()
+    print cloud.calls
+'''
+import threading
+import time
+import random
+import uuid
+import itertools
+import math
+import re
+
+from actuator.provisioners.openstack import openstack_class_factory as ocf
+
+
+class SimulatorException(Exception):
+    """
+    Raised by simulated API calls; code is the HTTP status the real API
+    would have returned.
+    """
+    code = 500
+    def __init__(self, msg, code=None):
+        super(SimulatorException, self).__init__(msg)
+        if code is not None:
+            self.code = code
+
+
+class SimNotFound(SimulatorException):
+    code = 404
+
+
+class SimOverLimit(SimulatorException):
+    code = 413
+
+
+def constant(secs):
+    """
+    A latency distribution that always gives secs
+    """
+    return lambda rnd: secs
+
+
+def uniform(lo, hi):
+    """
+    A latency distribution uniform between lo and hi seconds
+    """
+    return lambda rnd: rnd.uniform(lo, hi)
+
+
+def lognormal(median, sigma=0.5):
+    """
+    A latency distribution with a long tail; half of the values are below
+    median seconds
+    """
+    mu = math.log(median)
+    return lambda rnd: rnd.lognormvariate(mu, sigma)
+
+
+class _SimObject(object):
+    #internal; a simple attribute holder, like the novaclient resource classes
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SimServer(object):
+    """
+    A simulated Nova server. The server has no addresses and a status of
+    BUILD until its boot time has passed; it then either is ACTIVE and has
+    an address, or if its boot was chosen to fail, goes into ERROR.
+    """
+    def __init__(self, cloud, name, nics, ready_at, boot_fails, metadata,
+                 launch_index):
+        self.cloud = cloud
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.nics = nics
+        self.ready_at = ready_at
+        self.boot_fails = boot_fails
+        self.metadata = dict(metadata or {})
+        setattr(self, "OS-EXT-SRV-ATTR:launch_index", launch_index)
+        self.ip = cloud._next_ip()
+
+    def _get_status(self):
+        if time.time() < self.ready_at:
+            return "BUILD"
+        return "ERROR" if self.boot_fails else "ACTIVE"
+
+    status = property(_get_status)
+
+    def _get_addresses(self):
+        if self.status != "ACTIVE":
+            return {}
+        labels = [self.cloud.network_label(n) for n in self.nics] or ["private"]
+        return {labels[0]:[{u"addr":self.ip}]}
+
+    addresses = property(_get_addresses)
+
+    def get(self):
+        #novaclient's Server.get() refreshes the server from the API
+        self.cloud._call("servers.get")
+        if self.id not in self.cloud.servers:
+            raise SimNotFound("No server with id %s" % self.id)
+
+
+class _SimServers(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def create(self, name, image, flavor, meta=None, min_count=None,
+               max_count=None, nics=None, **kwargs):
+        cloud = self.cloud
+        cloud._call("servers.create")
+        count = max_count or min_count or 1
+        nic_ids = [n["net-id"] for n in (nics or [])]
+        made = []
+        for i in range(count):
+            srvr = SimServer(cloud, "%s-%d" % (name, i + 1) if count > 1 else name,
+                             nic_ids, time.time() + cloud._boot_time(),
+                             cloud._chance(cloud.boot_failure_rate),
+                             meta, i)
+            made.append(srvr)
+        with cloud.lock:
+            for srvr in made:
+                cloud.servers[srvr.id] = srvr
+        #like novaclient, only the first server is returned
+        return made[0]
+
+    def list(self, search_opts=None):
+        self.cloud._call("servers.list")
+        with self.cloud.lock:
+            servers = list(self.cloud.servers.values())
+        if search_opts and "name" in search_opts:
+            #Nova's name filter is a regular expression
+            servers = [s for s in servers
+                       if re.search(search_opts["name"], s.name)]
+        return servers
+
+    def get(self, server_id):
+        self.cloud._call("servers.get")
+        return self.cloud._get("servers", server_id)
+
+    def delete(self, server_id):
+        self.cloud._call("servers.delete")
+        self.cloud._delete("servers", server_id)
+
+    def add_floating_ip(self, server, fip, fixed_address=None):
+        self.cloud._call("servers.add_floating_ip")
+
+
+class _SimCollection(object):
+    #internal; the nova managers that only list, create and delete
+    def __init__(self, cloud, kind, make=None):
+        self.cloud = cloud
+        self.kind = kind
+        self.make = make
+
+    def create(self, *args, **kwargs):
+        self.cloud._call("%s.create" % self.kind)
+        obj = self.make(*args, **kwargs)
+        with self.cloud.lock:
+            getattr(self.cloud, self.kind)[obj.id] = obj
+        return obj
+
+    def list(self):
+        self.cloud._call("%s.list" % self.kind)
+        with self.cloud.lock:
+            return list(getattr(self.cloud, self.kind).values())
+
+    def delete(self, osid):
+        self.cloud._call("%s.delete" % self.kind)
+        self.cloud._delete(self.kind, osid)
+
+
+class SimNovaClient(object):
+    """
+    The simulated nova client. Use L{SimulatedCloud.nova_client_class} to get
+    a class bound to a particular cloud.
+    """
+    cloud = None
+    def __init__(self, version, username, password, tenant_name, auth_url):
+        cloud = self.cloud
+        cloud._call("nova.auth")
+        self.servers = _SimServers(cloud)
+        self.images = _SimCollection(cloud, "images")
+        self.flavors = _SimCollection(cloud, "flavors")
+        self.networks = _SimNetworks(cloud)
+        self.security_groups = _SimCollection(cloud, "security_groups",
+                                              lambda name=None, description=None:
+                                              _SimObject(id=str(uuid.uuid4()),
+                                                         name=name,
+                                                         description=description))
+        self.security_group_rules = _SimCollection(cloud, "security_group_rules",
+                                                   lambda *args, **kwargs:
+                                                   _SimObject(id=str(uuid.uuid4())))
+        self.floating_ips = _SimCollection(cloud, "floating_ips",
+                                           lambda pool=None:
+                                           _SimObject(id=str(uuid.uuid4()),
+                                                      ip=cloud._next_ip(),
+                                                      pool=pool))
+
+
+class _SimNetworks(object):
+    #internal; nova's view of the networks neutron manages
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def list(self):
+        self.cloud._call("networks.list")
+        with self.cloud.lock:
+            return [_SimObject(id=n["id"], label=n["name"])
+                    for n in self.cloud.networks.values()]
+
+
+class SimNeutronClient(object):
+    """
+    The simulated neutron client. Use L{SimulatedCloud.neutron_client_class}
+    to get a class bound to a particular cloud.
+    """
+    cloud = None
+    def __init__(self, username=None, password=None, auth_url=None,
+                 tenant_name=None):
+        self.cloud._call("neutron.auth")
+
+    def _add(self, kind, **fields):
+        d = dict(fields, id=str(uuid.uuid4()))
+        with self.cloud.lock:
+            getattr(self.cloud, kind)[d["id"]] = d
+        return d
+
+    def create_network(self, body=None):
+        self.cloud._call("create_network")
+        return {"network":self._add("networks", name=body["network"]["name"])}
+
+    def create_subnet(self, body=None):
+        self.cloud._call("create_subnet")
+        return {"subnets":[self._add("subnets", **sn) for sn in body["subnets"]]}
+
+    def list_subnets(self):
+        self.cloud._call("list_subnets")
+        with self.cloud.lock:
+            return {"subnets":list(self.cloud.subnets.values())}
+
+    def create_router(self, body=None):
+        self.cloud._call("create_router")
+        return {"router":self._add("routers", name=body["router"]["name"])}
+
+    def list_routers(self, *args, **kwargs):
+        self.cloud._call("list_routers")
+        with self.cloud.lock:
+            return {"routers":list(self.cloud.routers.values())}
+
+    def add_gateway_router(self, router_id, body=None):
+        self.cloud._call("add_gateway_router")
+        self.cloud._get("routers", router_id)["gateway"] = body
+        return {}
+
+    def remove_gateway_router(self, router_id):
+        self.cloud._call("remove_gateway_router")
+        self.cloud._get("routers", router_id).pop("gateway", None)
+
+    def add_interface_router(self, router_id, body=None):
+        self.cloud._call("add_interface_router")
+        self.cloud._get("routers", router_id)
+        port = self._add("ports", device_id=router_id,
+                         device_owner="network:router_interface",
+                         subnet_id=body.get(u"subnet_id"))
+        return {u"id":router_id, u"port_id":port["id"],
+                u"subnet_id":body.get(u"subnet_id")}
+
+    def remove_interface_router(self, router_id, body=None):
+        self.cloud._call("remove_interface_router")
+        self.cloud._delete("ports", body[u"port_id"])
+
+    def list_ports(self, **filters):
+        self.cloud._call("list_ports")
+        with self.cloud.lock:
+            ports = list(self.cloud.ports.values())
+        return {"ports":[p for p in ports
+                         if all([p.get(k) == v for k, v in filters.items()])]}
+
+    def delete_router(self, router_id):
+        self.cloud._call("delete_router")
+        self.cloud._delete("routers", router_id)
+
+    def delete_subnet(self, subnet_id):
+        self.cloud._call("delete_subnet")
+        self.cloud._delete("subnets", subnet_id)
+
+    def delete_network(self, network_id):
+        self.cloud._call("delete_network")
+        self.cloud._delete("networks", network_id)
+
+
+class SimulatedCloud(object):
+    """
+    The state and behaviour of a simulated Openstack cloud; see the module
+    doc for an overview.
+
+    Calls are named after the client method, with the nova manager as a
+    prefix for nova calls ("servers.create", "images.list") and bare for
+    neutron calls ("create_network"). Creating a client is "nova.auth" or
+    "neutron.auth". Server.get() is counted as "servers.get".
+    """
+    def __init__(self, latency=None, boot_time=None, rate_limit=None,
+                 failures=None, boot_failure_rate=0.0, time_scale=1.0,
+                 images=(u"Ubuntu 13.10", u"CentOS 6.5 x86_64"),
+                 flavors=(u"m1.small", u"m1.medium", u"m1.large"),
+                 networks=(u"external",), seed=None):
+        """
+        @keyword latency: Optional dict; keys are call names or "*" for
+            all calls not otherwise named, values are latency distributions
+            (see L{constant}, L{uniform}, L{lognormal}) or a number of
+            seconds. No latency if not supplied.
+        @keyword boot_time: Optional distribution or number of seconds;
+            how long a server is in BUILD before it has addresses. Default 0.
+        @keyword rate_limit: Optional; the max number of API calls per
+            second. Calls beyond this raise L{SimOverLimit}. Default None,
+            meaning unlimited.
+        @keyword failures: Optional dict; keys are call names or "*",
+            values are the probability (0 to 1) that the call raises a
+            L{SimulatorException}.
+        @keyword boot_failure_rate: Optional, default 0. Probability that a
+            server goes into ERROR rather than becoming ACTIVE.
+        @keyword time_scale: Optional, default 1.0. Multiplies all latencies
+            and boot times, so that a realistic profile can be run faster.
+        @keyword images: Optional; names of the images in the cloud
+        @keyword flavors: Optional; names of the flavors in the cloud
+        @keyword networks: Optional; names of networks that already exist
+        @keyword seed: Optional; seed for the simulator's random numbers
+        """
+        self.latency = dict(latency) if latency else {}
+        self.boot_time = boot_time
+        self.rate_limit = rate_limit
+        self.failures = dict(failures) if failures else {}
+        self.boot_failure_rate = boot_failure_rate
+        self.time_scale = time_scale
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.rejected = 0
+        self.failed = 0
+        self._window = []   #times of the calls in the last second
+        self._ips = itertools.count(1)
+        self.servers = {}
+        self.images = dict([(i.id, i) for i in [_SimObject(id=str(uuid.uuid4()), name=n)
+                                                for n in images]])
+        self.flavors = dict([(f.id, f) for f in [_SimObject(id=str(uuid.uuid4()), name=n)
+                                                 for n in flavors]])
+        self.networks = {}
+        for n in networks:
+            nid = str(uuid.uuid4())
+            self.networks[nid] = {"id":nid, "name":n}
+        self.subnets = {}
+        self.routers = {}
+        self.ports = {}
+        self.security_groups = {}
+        self.security_group_rules = {}
+        self.floating_ips = {}
+        self._prev_classes = None
+
+    def nova_client_class(self):
+        """
+        Returns a nova client class whose instances use this cloud
+        """
+        return type("SimNovaClient", (SimNovaClient,), {"cloud":self})
+
+    def neutron_client_class(self):
+        """
+        Returns a neutron client class whose instances use this cloud
+        """
+        return type("SimNeutronClient", (SimNeutronClient,), {"cloud":self})
+
+    def install(self):
+        """
+        Make the openstack_class_factory hand out clients for this cloud
+        """
+        self._prev_classes = (ocf.get_nova_client_class(),
+                              ocf.get_neutron_client_class())
+        ocf.set_nova_client_class(self.nova_client_class())
+        ocf.set_neutron_client_class(self.neutron_client_class())
+
+    def uninstall(self):
+        """
+        Restore the client classes that were in place before install()
+        """
+        if self._prev_classes is not None:
+            ocf.set_nova_client_class(self._prev_classes[0])
+            ocf.set_neutron_client_class(self._prev_classes[1])
+            self._prev_classes = None
+
+    def total_calls(self):
+        """
+        Returns the number of API calls made, including failed ones
+        """
+        with self.lock:
+            return sum(self.calls.values())
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls.clear()
+            self.rejected = 0
+            self.failed = 0
+
+    def network_label(self, network_id):
+        with self.lock:
+            net = self.networks.get(network_id)
+        return net["name"] if net else network_id
+
+    def _call(self, name):
+        #internal; account for an API call, and apply the rate limit,
+        #failure injection, and latency
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.rate_limit is not None:
+                now = time.time()
+                self._window = [t for t in self._window if now - t < 1.0]
+                if len(self._window) >= self.rate_limit:
+                    self.rejected += 1
+                    raise SimOverLimit("Rate limit exceeded for %s" % name)
+                self._window.append(now)
+            if self._chance(self.failures.get(name, self.failures.get("*", 0))):
+                self.failed += 1
+                raise SimulatorException("Injected failure in %s" % name)
+            delay = self._draw(self.latency.get(name, self.latency.get("*")))
+        if delay > 0:
+            time.sleep(delay * self.time_scale)
+
+    def _draw(self, dist):
+        #internal; call with the lock held
+        if dist is None:
+            return 0
+        if callable(dist):
+            return max(0, dist(self.random))
+        return dist
+
+    def _chance(self, probability):
+        with self.lock:
+            return probability > 0 and self.random.random() < probability
+
+    def _boot_time(self):
+        with self.lock:
+            return self._draw(self.boot_time) * self.time_scale
+
+    def _next_ip(self):
+        n = self._ips.next()
+        return u"10.%d.%d.%d" % ((n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+    def _get(self, kind, osid):
+        with self.lock:
+            obj = getattr(self, kind).get(osid)
+        if obj is None:
+            raise SimNotFound("No %s with id %s" % (kind, osid))
+        return obj
+
+    def _delete(self, kind, osid):
+        with self.lock:
+            if getattr(self, kind).pop(osid, None) is None:
+                raise SimNotFound("No %s with id %s" % (kind, osid))
@@ -25,7 +25,16 @@ of Openstack resources that have been provisioned for a model, and a class that
 can retrieves and caches identifiers for Openstack resources that may be needed
 when provisioning infra for a model.
 '''
-from actuator.provisioners.core import BaseProvisioningRecord
+import threading
+import time
+import random
+import os
+import json
+from collections import OrderedDict
+
+from actuator.provisioners.core import BaseProvisioningRecord, ProvisionerException
+from actuator.exec_agents.core import TaskFuture
+from actuator.utils import root_logger
 
 
 class OpenstackProvisioningRecord(BaseProvisioningRecord):
@@ -44,6 +53,8 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         self.secgroup_rule_ids = dict()
         self.server_ids = dict()
         self.port_ids = dict()
+        self.journal = None
+        self.journal_keys = {}
         
     def __getstate__(self):
         d = super(OpenstackProvisioningRecord, self).__getstate__()
@@ -53,16 +64,55 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
                    "router_ids":self.router_ids,
                    "router_iface_ids":self.router_iface_ids,
                    "secgroup_ids":self.secgroup_ids,
+                   "secgroup_rule_ids":self.secgroup_rule_ids,
                    "server_ids":self.server_ids,
                    "port_ids":self.port_ids} )
         return d
     
     def __setstate__(self, d):
         super(OpenstackProvisioningRecord, self).__setstate__(d)
+        self.journal = None
+        self.journal_keys = {}
+        #records pickled before secgroup rules were saved won't have them
+        self.secgroup_rule_ids = dict()
         keys = d.keys()
         for k in keys:
-            setattr(self, k, set(d[k]))
+            setattr(self, k, dict(d[k]))
             del d[k]
+            
+    def attach_journal(self, journal, journal_keys):
+        """
+        Write all ids subsequently added to this record to a journal
+        
+        @param journal: a L{ProvisioningJournal}
+        @param journal_keys: dict mapping Actuator resource ids to the stable
+            keys to journal them under; ids for resources without a key
+            aren't journaled
+        """
+        self.journal = journal
+        self.journal_keys = journal_keys
+        
+    def _journal_id(self, attr, rid, osid):
+        #internal
+        if self.journal is not None:
+            key = self.journal_keys.get(rid)
+            if key is not None:
+                self.journal.add_id(attr, key, osid)
+                
+    def journal_done(self, rid, osid, state=None):
+        """
+        Note in the journal, if any, that provisioning a resource has
+        completed
+        
+        @param rid: Actuator resource id
+        @param osid: Openstack resource id, or None if the resource has none
+        @keyword state: Optional dict of JSON-able values needed to restore
+            the resource's provisioned state when resuming
+        """
+        if self.journal is not None:
+            key = self.journal_keys.get(rid)
+            if key is not None:
+                self.journal.add_done(key, osid, state)
         
     def add_port_id(self, rid, osid):
         """
@@ -72,6 +122,7 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.port_ids[rid] = osid
+        self._journal_id("port_ids", rid, osid)
         
     def add_server_id(self, rid, osid):
         """
@@ -81,6 +132,7 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.server_ids[rid] = osid
+        self._journal_id("server_ids", rid, osid)
         
     def add_secgroup_id(self, rid, osid):
         """
@@ -90,6 +142,7 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.secgroup_ids[rid] = osid
+        self._journal_id("secgroup_ids", rid, osid)
         
     def add_secgroup_rule_id(self, rid, osid):
         """
@@ -99,6 +152,7 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.secgroup_rule_ids[rid] = osid
+        self._journal_id("secgroup_rule_ids", rid, osid)
         
     def add_router_id(self, rid, osid):
         """
@@ -108,6 +162,7 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.router_ids[rid] = osid
+        self._journal_id("router_ids", rid, osid)
         
     def add_router_iface_id(self, rid, osid):
         """
@@ -117,6 +172,7 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.router_iface_ids[rid] = osid
+        self._journal_id("router_iface_ids", rid, osid)
         
     def add_floating_ip_id(self, rid, osid):
         """
@@ -126,6 +182,7 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.floating_ip_ids[rid] = osid
+        self._journal_id("floating_ip_ids", rid, osid)
         
     def add_subnet_id(self, rid, osid):
         """
@@ -135,6 +192,7 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.subnet_ids[rid] = osid
+        self._journal_id("subnet_ids", rid, osid)
         
     def add_network_id(self, rid, osid):
         """
@@ -144,16 +202,191 @@ class OpenstackProvisioningRecord(BaseProvisioningRecord):
         @param osid: Openstack resource id
         """
         self.network_ids[rid] = osid
+        self._journal_id("network_ids", rid, osid)
         
         
+class ProvisioningJournal(object):
+    """
+    Append-only file of the Openstack ids created while provisioning, so that
+    provisioning that dies part way through can be resumed (see
+    L{load_journal}) rather than started over.
+    
+    Each line is a JSON object, one of:
+        - {"op":"run"}: provisioning was started (or resumed)
+        - {"op":"id", "attr":..., "key":..., "osid":...}: the Openstack id
+          osid was added to the record attribute attr for the resource with
+          the stable key 'key'
+        - {"op":"done", "key":..., "osid":..., "state":{...}}: the resource
+          with this key finished provisioning
+        - {"op":"finished"}: nothing above this line needs resuming, because
+          provisioning completed or its resources have been deprovisioned
+          
+    Each line is written to the file as soon as it is added, so it will
+    survive the death of the process. The file is also fsync'ed, so that the
+    lines survive the death of the host, once sync_every lines have been added
+    since the last sync or sync_interval seconds have passed, and on close().
+    """
+    RUN = "run"
+    ID = "id"
+    DONE = "done"
+    FINISHED = "finished"
+    def __init__(self, path, resume=False, sync_every=20, sync_interval=1.0):
+        """
+        @param path: path to the journal file
+        @keyword resume: Optional, default False. If True, add to an existing
+            journal; if False, any existing journal at path is replaced
+        @keyword sync_every: Optional, default 20. Number of lines to add
+            before the file is fsync'ed
+        @keyword sync_interval: Optional, default 1.0. Max number of seconds
+            since the last sync before a newly added line causes a sync
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.syncs = 0
+        self.file = open(path, "a" if resume else "w")
+        self._write({"op":self.RUN, "time":time.time()})
+        
+    def add_id(self, attr, key, osid):
+        self._write({"op":self.ID, "attr":attr, "key":key, "osid":osid})
+        
+    def add_done(self, key, osid, state=None):
+        self._write({"op":self.DONE, "key":key, "osid":osid,
+                     "state":state if state is not None else {}})
+        
+    def add_finished(self):
+        self._write({"op":self.FINISHED, "time":time.time()})
+        self.sync()
+        
+    def _write(self, entry):
+        #internal
+        line = json.dumps(entry, default=str) + "\n"
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line)
+            self.file.flush()
+            self.unsynced += 1
+            if (self.unsynced >= self.sync_every or
+                    time.time() - self.last_sync >= self.sync_interval):
+                self._sync()
+                
+    def _sync(self):
+        #internal; call with the lock held
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.syncs += 1
+        
+    def sync(self):
+        """
+        Force all added lines to disk
+        """
+        with self.lock:
+            if self.file is not None and self.unsynced:
+                self._sync()
+                
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+                
+                
+class JournalState(object):
+    """
+    What a L{ProvisioningJournal} says about earlier provisioning runs.
+    
+    done is a dict whose keys are the stable keys of completely provisioned
+    resources, and whose values are (osid, state, ids) tuples, where ids is a
+    list of (record attr, osid) pairs for the resource. orphans is a list of
+    (record attr, key, osid) tuples for Openstack resources that were created
+    by a run that didn't finish provisioning them; these will get created anew
+    when resuming, so the orphans should be deprovisioned. finished is True if
+    the journal ends with provisioning having completed or its resources
+    having been deprovisioned, in which case there is nothing to resume and
+    done and orphans are empty.
+    """
+    def __init__(self):
+        self.done = {}
+        self.orphans = []
+        self.finished = False
+
+
+def load_journal(path):
+    """
+    Read a L{ProvisioningJournal} file and return a L{JournalState}. A line
+    that can't be parsed, such as one that was being written when the process
+    died, is ignored.
+    
+    @param path: path to the journal file
+    """
+    state = JournalState()
+    pending = {}   #keys are resource keys, values are lists of (attr, osid)
+    def orphan_pending():
+        for key, ids in pending.items():
+            state.orphans.extend([(attr, key, osid) for attr, osid in ids])
+        pending.clear()
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            op = entry.get("op")
+            if op == ProvisioningJournal.RUN:
+                #anything not finished by the previous run never will be
+                orphan_pending()
+                state.finished = False
+            elif op == ProvisioningJournal.FINISHED:
+                state.done.clear()
+                del state.orphans[:]
+                pending.clear()
+                state.finished = True
+            elif op == ProvisioningJournal.ID:
+                pending.setdefault(entry["key"], []).append((entry["attr"],
+                                                             entry["osid"]))
+            elif op == ProvisioningJournal.DONE:
+                state.done[entry["key"]] = (entry["osid"], entry.get("state", {}),
+                                            pending.pop(entry["key"], []))
+    orphan_pending()
+    return state
+
+
 class _OSMaps(object):
     """
     Utility class that creates a cache of Openstack resources. The resources
     are mapped by their "natural" key to their appropriate Openstack API
     client object (nova, neutron, etc).
+    
+    Each kind of map can be given a time-to-live; a refresh of a map that is
+    younger than its TTL is skipped. Refreshes are single-flight: if several
+    threads ask for the same map to be refreshed at once, one thread does the
+    work while the others wait for it and then use the result. This allows
+    one instance to be shared by all the threads of a provisioner.
     """
-    def __init__(self, os_provisioner):
+    IMAGES = "images"
+    FLAVORS = "flavors"
+    NETWORKS = "networks"
+    SECGROUPS = "secgroups"
+    ROUTERS = "routers"
+    SUBNETS = "subnets"
+    
+    def __init__(self, os_provisioner, ttls=None):
+        """
+        @param os_provisioner: an object with 'nvclient' and 'nuclient'
+            attributes that supply Nova and Neutron clients
+        @keyword ttls: Optional dict; keys are the kind of map (IMAGES,
+            FLAVORS, etc), values are the number of seconds a refreshed map is
+            considered current. Kinds not in the dict have a TTL of 0, meaning
+            every call to refresh reloads the map.
+        """
         self.os_provisioner = os_provisioner
+        self.ttls = dict(ttls) if ttls else {}
         self.image_map = {}
         self.flavor_map = {}
         self.network_map = {}
@@ -161,6 +394,66 @@ class _OSMaps(object):
         self.secgroup_rule_map = {}
         self.router_map = {}
         self.subnet_map = {}
+        self.loaders = {self.IMAGES:self._load_images,
+                        self.FLAVORS:self._load_flavors,
+                        self.NETWORKS:self._load_networks,
+                        self.SECGROUPS:self._load_secgroups,
+                        self.ROUTERS:self._load_routers,
+                        self.SUBNETS:self._load_subnets}
+        self.maps = {self.IMAGES:"image_map",
+                     self.FLAVORS:"flavor_map",
+                     self.NETWORKS:"network_map",
+                     self.SECGROUPS:"secgroup_map",
+                     self.ROUTERS:"router_map",
+                     self.SUBNETS:"subnet_map"}
+        self.locks = {k:threading.Lock() for k in self.loaders}
+        self.loaded_at = {}
+        self.loads = {k:0 for k in self.loaders}
+        
+    def refresh(self, kind, force=False):
+        """
+        Refresh one kind of map, unless it is still within its TTL
+        
+        @param kind: one of IMAGES, FLAVORS, NETWORKS, SECGROUPS, ROUTERS,
+            SUBNETS
+        @keyword force: Optional, default False. If True, the map is reloaded
+            regardless of its TTL, unless another thread finished reloading
+            it while this thread was waiting to do the same.
+        """
+        loads_seen = self.loads[kind]
+        with self.locks[kind]:
+            if self.loads[kind] != loads_seen and force:
+                return
+            loaded_at = self.loaded_at.get(kind)
+            if (not force and loaded_at is not None and
+                    time.time() - loaded_at < self.ttls.get(kind, 0)):
+                return
+            self.loaders[kind]()
+            self.loaded_at[kind] = time.time()
+            self.loads[kind] += 1
+            
+    def invalidate(self, kind):
+        """
+        Mark a kind of map as out of date so the next refresh reloads it
+        
+        @param kind: one of IMAGES, FLAVORS, NETWORKS, SECGROUPS, ROUTERS,
+            SUBNETS
+        """
+        self.loaded_at.pop(kind, None)
+        
+    def lookup(self, kind, key):
+        """
+        Refresh a map if needed and return the value for key, or None
+        
+        If the key isn't found in a map that was reused because of its TTL,
+        the map is reloaded once more before giving up.
+        """
+        self.refresh(kind)
+        value = getattr(self, self.maps[kind]).get(key)
+        if value is None:
+            self.refresh(kind, force=True)
+            value = getattr(self, self.maps[kind]).get(key)
+        return value
         
     def refresh_all(self):
         """
@@ -178,6 +471,9 @@ class _OSMaps(object):
         Refresh the subnets map, subnet_map.
         Keys are the subnet name, value is the neutron subnet dict.
         """
+        self.refresh(self.SUBNETS)
+        
+    def _load_subnets(self):
         response = self.os_provisioner.nuclient.list_subnets()
         self.subnet_map = {d['name']:d for d in response['subnets']}
         
@@ -186,6 +482,9 @@ class _OSMaps(object):
         Refresh the routers map, router_map
         Keys are the Openstack ID for the router, values are the same ID
         """
+        self.refresh(self.ROUTERS)
+        
+    def _load_routers(self):
         response = self.os_provisioner.nuclient.list_routers()
         self.router_map = {d['id']:d['id'] for d in response["routers"]}
         
@@ -194,16 +493,23 @@ class _OSMaps(object):
         Refresh the networks map, network_map.
         Keys are the network id, values are nova Network objects
         """
+        self.refresh(self.NETWORKS)
+        
+    def _load_networks(self):
         networks = self.os_provisioner.nvclient.networks.list()
-        self.network_map = {n.label:n for n in networks}
+        network_map = {n.label:n for n in networks}
         for network in networks:
-            self.network_map[network.id] = network
+            network_map[network.id] = network
+        self.network_map = network_map
 
     def refresh_images(self):
         """
         Refresh the images map, image_map
         Keys are image names, values are nova Image objects.
         """
+        self.refresh(self.IMAGES)
+        
+    def _load_images(self):
         self.image_map = {i.name:i for i in self.os_provisioner.nvclient.images.list()}
 
     def refresh_flavors(self):
@@ -211,6 +517,9 @@ class _OSMaps(object):
         Refresh the flavors map, flavor_map
         Keys are flavor names, values are nova Flavor objects
         """
+        self.refresh(self.FLAVORS)
+        
+    def _load_flavors(self):
         self.flavor_map = {f.name:f for f in self.os_provisioner.nvclient.flavors.list()}
 
     def refresh_secgroups(self):
@@ -219,6 +528,227 @@ class _OSMaps(object):
         Keys are secgroup names and secgroup ids, values are nova SecGroup
         objects.
         """
+        self.refresh(self.SECGROUPS)
+        
+    def _load_secgroups(self):
         secgroups = list(self.os_provisioner.nvclient.security_groups.list())
-        self.secgroup_map = {sg.name:sg for sg in secgroups}
-        self.secgroup_map.update({sg.id:sg for sg in secgroups})
+        secgroup_map = {sg.name:sg for sg in secgroups}
+        secgroup_map.update({sg.id:sg for sg in secgroups})
+        self.secgroup_map = secgroup_map
+
+
+#default TTLs, in seconds, for the lookup maps shared by a provisioner's threads.
+#networks and security groups created by the provisioner invalidate their
+#maps, so these only bound how stale externally created resources can be
+DEFAULT_LOOKUP_TTLS = {_OSMaps.IMAGES:300,
+                       _OSMaps.FLAVORS:300,
+                       _OSMaps.NETWORKS:60,
+                       _OSMaps.SECGROUPS:60,
+                       _OSMaps.ROUTERS:60,
+                       _OSMaps.SUBNETS:60}
+
+
+class ClientPool(object):
+    """
+    Hands out Openstack API client objects, one per thread, reusing them
+    
+    Creating a Nova or Neutron client usually means another round-trip to
+    Keystone to authenticate, so rather than make a new client each time one
+    is needed, a pool hangs onto the client it made for each thread and
+    returns that client on subsequent requests from the same thread. Clients
+    are retired once they reach max_age seconds old so that a new one, with a
+    new token, is created before the old token expires. At most 'size' clients
+    are retained; if more threads than that use the pool, the client of the
+    thread that least recently used the pool is dropped.
+    """
+    def __init__(self, factory, size=5, max_age=3000):
+        """
+        @param factory: callable with no arguments that returns a new client
+        @keyword size: Optional, default 5. The maximum number of clients to
+            retain. None means there's no limit.
+        @keyword max_age: Optional, default 3000. The number of seconds a
+            client is used before it is replaced. Set this less than the
+            lifetime of your Keystone tokens. None means clients are never
+            replaced.
+        """
+        self.factory = factory
+        self.size = size
+        self.max_age = max_age
+        self.clients = OrderedDict()  #keys are threads, values are (created, client)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.creations = 0
+        
+    def get(self):
+        """
+        Returns a client for the calling thread, creating a new one if need be
+        """
+        thread = threading.current_thread()
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            entry = self.clients.pop(thread, None)
+            if entry is not None and (self.max_age is None or
+                                      now - entry[0] < self.max_age):
+                self.clients[thread] = entry
+                return entry[1]
+        #make the new client outside the lock since this is the slow part
+        client = self.factory()
+        with self.lock:
+            self.creations += 1
+            self.clients[thread] = (now, client)
+            while self.size is not None and len(self.clients) > self.size:
+                _ = self.clients.popitem(last=False)
+        return client
+    
+    def clear(self):
+        """
+        Drop all retained clients
+        """
+        with self.lock:
+            self.clients.clear()
+
+
+class ServerReadinessPoller(object):
+    """
+    Watches booting servers until they have addresses, using one API call
+    for all of them.
+    
+    Rather than having each provisioning thread poll its own server until the
+    server gets an address, threads hand the server's id to the poller and get
+    back a L{TaskFuture} that is completed with the server object once it has
+    addresses. The poller runs a single thread that lists all servers once per
+    cycle; the time between cycles starts at min_interval, and grows by a
+    factor of 'backoff' each cycle that no server becomes ready, up to
+    max_interval. Each pause is randomly varied by +/- jitter (a fraction) so
+    that several pollers don't fall into lockstep. The thread is started when
+    the first server is watched and runs until stop() is called.
+    """
+    def __init__(self, client_source, min_interval=0.25, max_interval=5.0,
+                 backoff=1.5, jitter=0.2, timeout=1800):
+        """
+        @param client_source: callable with no args that returns a nova client
+        @keyword min_interval: Optional, default 0.25. Minimum secs between polls
+        @keyword max_interval: Optional, default 5.0. Maximum secs between polls
+        @keyword backoff: Optional, default 1.5. Factor the interval grows by
+            after a poll in which no servers became ready
+        @keyword jitter: Optional, default 0.2. Fraction by which each pause
+            is randomly lengthened or shortened
+        @keyword timeout: Optional, default 1800. Secs to wait for a server to
+            become ready before failing its future. None waits forever.
+        """
+        self.client_source = client_source
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        self.pending = {}  #keys are server ids, values are (start time, TaskFuture)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopped = False
+        self.list_calls = 0
+        self.logger = root_logger.getChild("os_server_poller")
+        
+    def watch(self, server_id):
+        """
+        Start watching a server; returns a L{TaskFuture} whose result will be
+        the nova server object once it has addresses
+        
+        @param server_id: Openstack id of the server to watch
+        """
+        future = TaskFuture()
+        with self.lock:
+            self.pending[server_id] = (time.time(), future)
+            self.stopped = False
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name="os_server_poller")
+                self.thread.daemon = True
+                self.thread.start()
+        #a new server restarts the backoff
+        self.wakeup.set()
+        return future
+    
+    def stop(self):
+        """
+        Stop watching; fails the futures of any servers still being watched
+        and lets the polling thread exit
+        """
+        with self.lock:
+            self.stopped = True
+            pending, self.pending = self.pending, {}
+        for server_id, (_, future) in pending.items():
+            future.set_exception(ProvisionerException("Stopped watching server %s "
+                                                      "before it was ready" % server_id))
+        self.wakeup.set()
+            
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self.lock:
+                if self.stopped:
+                    self.thread = None
+                    return
+                idle = not self.pending
+            if idle:
+                self.wakeup.wait(1.0)
+                self.wakeup.clear()
+                interval = self.min_interval
+                continue
+            ready = self.poll()
+            if ready:
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+            pause = interval * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+            if self.wakeup.wait(pause):
+                interval = self.min_interval
+            self.wakeup.clear()
+            
+    def poll(self):
+        """
+        Make one poll for the servers being watched. Returns the number of
+        servers that became ready.
+        """
+        try:
+            servers = self.client_source().servers.list()
+            self.list_calls += 1
+        except Exception, e:
+            self.logger.warning("Listing servers failed: %s" % str(e))
+            servers = []
+        ready = 0
+        now = time.time()
+        finished = []
+        with self.lock:
+            for srvr in servers:
+                entry = self.pending.get(srvr.id)
+                if entry is None:
+                    continue
+                if getattr(srvr, "status", None) == "ERROR":
+                    finished.append((srvr.id, entry[1],
+                                     ProvisionerException("Server %s went into ERROR state" %
+                                                          srvr.id),
+                                     None))
+                elif srvr.addresses:
+                    finished.append((srvr.id, entry[1], None, srvr))
+                    ready += 1
+            if self.timeout is not None:
+                done_ids = set([f[0] for f in finished])
+                for server_id, (started, future) in self.pending.items():
+                    if server_id not in done_ids and now - started > self.timeout:
+                        finished.append((server_id, future,
+                                         ProvisionerException("Timed out waiting for server %s "
+                                                              "to get an address" % server_id),
+                                         None))
+            for server_id, _, _, _ in finished:
+                del self.pending[server_id]
+        #complete the futures outside the lock; their callbacks may take a while
+        for _, future, exc, srvr in finished:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(srvr)
+        return ready
+
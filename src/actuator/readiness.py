@@ -0,0 +1,621 @@
+#
+# Copyright (c) 2015 Tom Carroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Support for starting configuration as soon as the infra it needs is ready.
+
+A L{ResourceReadiness} object is told by a provisioner as each resource of an
+infra model is provisioned, and a L{PipelineGate} uses it to hold back each
+config task only until the resources the task's Roles refer to are ready,
+rather than until the whole infra model has been provisioned. A
+L{HostProber} checks that the hosts tasks will run on actually accept ssh
+connections, and a L{HostCircuitBreaker} stops tasks from repeatedly trying
+to reach a host that has stopped responding.
+'''
+import threading
+import socket
+import time
+
+from actuator.modeling import (AbstractModelReference, ModelInstanceReference)
+from actuator.infra import StaticServer
+from actuator.config import StructuralTask, ConfigException
+from actuator.exec_agents.core import ExecutionException, HostUnreachableException
+from actuator.utils import root_logger
+
+
+class ResourceReadiness(object):
+    """
+    Tracks which resources of an infra model have been provisioned, and calls
+    back whoever is waiting on a set of resources once they all are.
+
+    The resource_provisioned() method is meant to be given to a provisioner
+    with L{actuator.provisioners.core.BaseProvisioner.set_resource_listener};
+    whoever drives the provisioner then calls provisioning_complete() or
+    provisioning_failed() once it is done.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.provisioned = set()
+        self.complete = False
+        self.failure = None
+        #list of [set of resources not yet provisioned, callback]
+        self.waiters = []
+
+    def resource_provisioned(self, rsrc):
+        """
+        Note that a resource has been provisioned, calling any callbacks that
+        were only waiting on it
+
+        @param rsrc: the infra model resource that was provisioned
+        """
+        with self.lock:
+            self.provisioned.add(rsrc)
+            ready = []
+            for waiter in self.waiters:
+                waiter[0].discard(rsrc)
+                if not waiter[0]:
+                    ready.append(waiter[1])
+            if ready:
+                self.waiters = [w for w in self.waiters if w[0]]
+        for callback in ready:
+            self._call(callback)
+
+    def provisioning_complete(self):
+        """
+        Note that provisioning is done; every resource is now considered
+        ready and all remaining callbacks are called
+        """
+        with self.lock:
+            self.complete = True
+            waiters, self.waiters = self.waiters, []
+        for _, callback in waiters:
+            self._call(callback)
+
+    def provisioning_failed(self, exc):
+        """
+        Note that provisioning has failed. The remaining callbacks are called
+        so that whoever is waiting finds out; the failure attribute is then
+        set, and no further callbacks are accepted by when_ready()
+
+        @param exc: the exception provisioning failed with
+        """
+        with self.lock:
+            self.failure = exc
+            waiters, self.waiters = self.waiters, []
+        for _, callback in waiters:
+            self._call(callback)
+
+    def is_ready(self, rsrcs):
+        """
+        Returns True if all the resources in the iterable rsrcs are ready
+        """
+        with self.lock:
+            return self.complete or not (set(rsrcs) - self.provisioned)
+
+    def when_ready(self, rsrcs, callback):
+        """
+        Arrange for callback to be called once all the resources in rsrcs are
+        ready.
+
+        If they're ready already, the callback isn't called and the method
+        returns True; otherwise it returns False and the callback is called
+        with no arguments, on the provisioner's thread, when the last of the
+        resources is provisioned or provisioning fails. Once provisioning has
+        failed, resources that aren't ready never will be, and the method
+        returns False without keeping the callback.
+
+        @param rsrcs: iterable of infra model resources
+        @param callback: a callable that takes no arguments
+        """
+        with self.lock:
+            if self.complete:
+                return True
+            pending = set(rsrcs) - self.provisioned
+            if not pending:
+                return True
+            if self.failure is None:
+                self.waiters.append([pending, callback])
+            return False
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception, _:
+            root_logger.getChild("readiness").exception("Readiness callback raised")
+
+
+def task_run_host(task):
+    """
+    Returns the host a config task will be run on: the host of its run_from
+    Role if it has one, otherwise the host of its task_role. Returns None if
+    the host can't be determined.
+    """
+    try:
+        run_role = task.get_run_from()
+        if run_role is not None:
+            run_role.fix_arguments()
+            return task.get_run_host()
+        task.get_task_role().fix_arguments()
+        return task.get_task_host()
+    except Exception, _:
+        #roles without a host_ref, or host_refs that don't resolve yet; the
+        #execution agent will report these properly when it runs the task
+        return None
+
+
+def run_hosts(tasks):
+    """
+    Returns the set of hosts that the given config tasks will be run on,
+    leaving out structural tasks, which don't run anywhere
+    """
+    hosts = set([task_run_host(t) for t in tasks
+                 if not isinstance(t, StructuralTask)])
+    hosts.discard(None)
+    return hosts
+
+
+class HostProber(object):
+    """
+    Actively checks that hosts can be reached over ssh, so that config can
+    start as soon as they can rather than after a fixed pause.
+    
+    A host is probed by opening a TCP connection to its ssh port, optionally
+    followed by reading the ssh server's identification string. Failed
+    attempts are repeated after a delay that starts at initial_delay and is
+    multiplied by backoff after each attempt, up to max_delay, until timeout
+    seconds have passed. Each host is probed on its own thread so any number
+    of hosts can be probed at once, and the outcome for each host is
+    remembered for the life of the prober.
+    """
+    def __init__(self, port=22, connect_timeout=5.0, initial_delay=1.0,
+                 backoff=2.0, max_delay=15.0, timeout=600.0,
+                 check_banner=False, banner_timeout=10.0):
+        """
+        @keyword port: Optional; int, default 22. The port to connect to.
+        @keyword connect_timeout: Optional; float, default 5.0. Seconds to
+            wait for each connection attempt.
+        @keyword initial_delay: Optional; float, default 1.0. Seconds to wait
+            after the first failed attempt.
+        @keyword backoff: Optional; float, default 2.0. Factor the delay is
+            multiplied by after each failed attempt.
+        @keyword max_delay: Optional; float, default 15.0. Longest delay
+            between attempts.
+        @keyword timeout: Optional; float, default 600.0. Seconds after which
+            a host that still can't be reached is given up on.
+        @keyword check_banner: Optional; boolean, default False. If True, a
+            host is only reachable once the server on port sends an ssh
+            identification string (one starting with "SSH-"); a port can
+            accept connections before sshd is ready to talk.
+        @keyword banner_timeout: Optional; float, default 10.0. Seconds to
+            wait for the identification string.
+        """
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.initial_delay = initial_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.check_banner = check_banner
+        self.banner_timeout = banner_timeout
+        self.lock = threading.Lock()
+        self.reachable = set()
+        self.unreachable = set()
+        #keys are hosts being probed, values lists of callbacks
+        self.probing = {}
+        self.attempts = 0
+        self.logger = root_logger.getChild("host_prober")
+        
+    def probe(self, host):
+        """
+        Make a single attempt to reach host; returns True if it can be
+        """
+        with self.lock:
+            self.attempts += 1
+        sock = None
+        try:
+            sock = socket.create_connection((host, self.port), self.connect_timeout)
+            if not self.check_banner:
+                return True
+            sock.settimeout(self.banner_timeout)
+            banner = ""
+            while "\n" not in banner and len(banner) < 255:
+                data = sock.recv(255)
+                if not data:
+                    break
+                banner += data
+            return banner.startswith("SSH-")
+        except (socket.error, socket.timeout), _:
+            return False
+        finally:
+            if sock is not None:
+                sock.close()
+                
+    def when_reachable(self, host, callback):
+        """
+        Arrange for callback to be called once host can be reached, or has
+        been given up on.
+        
+        Returns True, without calling callback, if host is already known to
+        be reachable. Otherwise returns False, and callback is called with
+        the host and a boolean that is True if the host could be reached,
+        either straight away if the host has already been given up on, or on
+        the probing thread.
+        
+        @param host: string; host name or IP address
+        @param callback: callable that takes a host and a boolean
+        """
+        with self.lock:
+            if host in self.reachable:
+                return True
+            if host not in self.unreachable:
+                callbacks = self.probing.get(host)
+                if callbacks is None:
+                    self.probing[host] = [callback]
+                    t = threading.Thread(target=self._probe_until, args=(host,),
+                                         name="probe-%s" % host)
+                    t.daemon = True
+                    t.start()
+                else:
+                    callbacks.append(callback)
+                return False
+        self._call(callback, host, False)
+        return False
+    
+    def wait_for(self, hosts):
+        """
+        Probe all the hosts at once, returning when each one has either been
+        reached or given up on. Returns a list of the hosts that couldn't be
+        reached.
+        
+        @param hosts: iterable of host names or IP addresses
+        """
+        hosts = set(hosts)
+        done = threading.Condition()
+        pending = set(hosts)
+        
+        def finished(host, _):
+            with done:
+                pending.discard(host)
+                done.notify()
+                
+        for host in hosts:
+            if self.when_reachable(host, finished):
+                finished(host, True)
+        with done:
+            while pending:
+                done.wait(1.0)
+        with self.lock:
+            return [h for h in hosts if h in self.unreachable]
+    
+    def _probe_until(self, host):
+        #internal; runs on its own thread, probing host until it can be
+        #reached or the timeout has passed
+        start = time.time()
+        delay = self.initial_delay
+        attempts = 1
+        ok = self.probe(host)
+        while not ok:
+            remaining = start + self.timeout - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * self.backoff, self.max_delay)
+            attempts += 1
+            ok = self.probe(host)
+        if ok:
+            self.logger.info("Host %s reachable after %d attempts, %.1f secs" %
+                             (host, attempts, time.time() - start))
+        else:
+            self.logger.error("Host %s still unreachable after %d attempts, "
+                              "%.1f secs; giving up" %
+                              (host, attempts, time.time() - start))
+        with self.lock:
+            (self.reachable if ok else self.unreachable).add(host)
+            callbacks = self.probing.pop(host)
+        for callback in callbacks:
+            self._call(callback, host, ok)
+            
+    def _call(self, callback, host, ok):
+        try:
+            callback(host, ok)
+        except Exception, _:
+            self.logger.exception("Host probe callback raised")
+            
+
+class PipelineGate(object):
+    """
+    Decides when a config task may be performed while the infra it uses is
+    still being provisioned. An instance is installed as the task_gate of an
+    L{actuator.exec_agents.core.ExecutionAgent}.
+
+    A task is held back until the resources that its task_role and run_from
+    Roles refer to are provisioned: the resource each Role's host_ref refers
+    to, and the resources referred to by model references in the Vars the
+    Role can see. Vars whose values come from callables or context
+    expressions can't be inspected, so tasks that need such values to see
+    other hosts (a list of all the IPs in a cluster, say) should depend on
+    a task that runs on those hosts, or not be pipelined at all.
+
+    Tasks are fixed when the config model is first processed, before much of
+    the infra exists, so each task's arguments are fixed again once its
+    resources are ready. If a L{HostProber} is supplied, the task is then
+    held until the host it runs on can be reached.
+    """
+    def __init__(self, readiness, infra_model, prober=None):
+        """
+        @param readiness: a L{ResourceReadiness} that the provisioner for
+            infra_model reports to
+        @param infra_model: the infra model instance being provisioned
+        @keyword prober: Optional; a L{HostProber} to check that each task's
+            host can be reached before the task is admitted
+        """
+        self.readiness = readiness
+        self.infra_model = infra_model
+        self.prober = prober
+        #count of the times tasks had to wait for resources or hosts
+        self.parked = 0
+
+    def admit(self, task, release):
+        """
+        Returns True if task can be performed now. If not, release is called
+        with no arguments once it can, at which point the task should be
+        offered to admit() again.
+
+        @param task: the config task about to be performed
+        @param release: callable that takes no arguments
+        @raise ExecutionException: if provisioning failed before all the
+            resources the task needs were provisioned, or the task's host
+            couldn't be reached
+        """
+        if isinstance(task, StructuralTask):
+            return True
+        needed = self.required_resources(task)
+        if (self.readiness.failure is not None and
+                not self.readiness.is_ready(needed)):
+            raise ExecutionException("Provisioning failed before the infra "
+                                     "for task %s was ready: %s" %
+                                     (task.name, self.readiness.failure))
+        if not self.readiness.when_ready(needed, release):
+            self.parked += 1
+            return False
+        task.refix_arguments()
+        if self.prober is not None:
+            host = task_run_host(task)
+            if host is not None:
+                if host in self.prober.unreachable:
+                    raise ExecutionException("Host %s for task %s can't be reached" %
+                                             (host, task.name))
+                if not self.prober.when_reachable(host, lambda h, ok: release()):
+                    self.parked += 1
+                    return False
+        return True
+
+    def required_resources(self, task):
+        """
+        Returns the set of infra resources that must be provisioned before
+        task can be performed
+        """
+        rsrcs = set()
+        roles = []
+        for t in getattr(task, "fused_tasks", None) or [task]:
+            roles.extend(self._task_roles(t))
+        for role in roles:
+            refs = set()
+            for v in role.get_visible_vars().values():
+                refs |= v._get_model_refs()
+            if isinstance(role.host_ref, AbstractModelReference):
+                refs.add(role.host_ref)
+            for ref in refs:
+                rsrc = self._resource_for(ref)
+                #StaticServers already exist
+                if rsrc is not None and not isinstance(rsrc, StaticServer):
+                    rsrcs.add(rsrc)
+        return rsrcs
+
+    def _task_roles(self, task):
+        #internal; the Roles whose references a task needs
+        roles = []
+        try:
+            roles.append(task.get_task_role())
+        except ConfigException, _:
+            pass
+        run_from = task.get_run_from()
+        if run_from is not None:
+            roles.append(run_from)
+        return [r.value() if isinstance(r, AbstractModelReference) else r
+                for r in roles]
+
+    def _resource_for(self, ref):
+        #internal; the model component an infra reference is part of
+        if not isinstance(ref, ModelInstanceReference):
+            ref = self.infra_model.get_inst_ref(ref)
+            if ref is None:
+                return None
+        return ref.get_containing_component()
+
+
+class HostCircuitBreaker(object):
+    """
+    Keeps tasks from tying up an execution agent's workers by repeatedly
+    trying to reach a host that has stopped responding.
+    
+    The agent tells the breaker about each task that reaches its host and
+    each one that can't. After threshold consecutive unreachable results
+    for a host, the host's circuit opens: the tasks for it that are waiting
+    or retrying either fail straight away with a L{HostUnreachableException}
+    (on_open=FAIL), or are parked (on_open=PARK) instead of each going
+    through its own connect timeouts and retries. While a circuit is open a
+    single L{HostProber} probes the host every probe_interval seconds; when
+    the host can be reached again the circuit closes and parked tasks are
+    released to be performed. If the host still can't be reached after
+    probe_timeout seconds, parked tasks fail.
+    
+    The counts of circuits opened, tasks failed fast, and tasks parked and
+    released are in the attributes of the same names; see summary().
+    """
+    FAIL = "fail"
+    PARK = "park"
+    
+    def __init__(self, threshold=3, on_open=FAIL, probe_interval=5.0,
+                 probe_timeout=300.0, port=22, connect_timeout=5.0):
+        """
+        @keyword threshold: Optional; int, default 3. The number of
+            consecutive unreachable results for a host that opens its
+            circuit.
+        @keyword on_open: Optional; either HostCircuitBreaker.FAIL (the
+            default) or HostCircuitBreaker.PARK. What happens to tasks for a
+            host whose circuit is open.
+        @keyword probe_interval: Optional; float, default 5.0. Seconds
+            between probes of a host whose circuit is open.
+        @keyword probe_timeout: Optional; float, default 300.0. Seconds after
+            which a host whose circuit is open is given up on.
+        @keyword port: Optional; int, default 22. The port probes connect to.
+        @keyword connect_timeout: Optional; float, default 5.0. Seconds to
+            wait for each probe's connection.
+        """
+        if on_open not in (self.FAIL, self.PARK):
+            raise ExecutionException("on_open must be HostCircuitBreaker.FAIL "
+                                     "or HostCircuitBreaker.PARK")
+        self.threshold = threshold
+        self.on_open = on_open
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        #consecutive unreachable results for each host
+        self.failures = {}
+        #keys are hosts with an open circuit, values lists of parked callbacks
+        self.open_hosts = {}
+        self.dead = set()
+        self.opened = 0
+        self.fast_failed = 0
+        self.parked = 0
+        self.released = 0
+        self.logger = root_logger.getChild("circuit_breaker")
+        
+    def is_open(self, host):
+        """
+        Returns True if the circuit for host is open, or the host has been
+        given up on
+        """
+        with self.lock:
+            return host in self.open_hosts or host in self.dead
+        
+    def record_success(self, host):
+        """
+        Record that a task reached host
+        """
+        with self.lock:
+            self.failures.pop(host, None)
+            
+    def record_unreachable(self, host):
+        """
+        Record that a task couldn't reach host. Returns True if this opened
+        the host's circuit.
+        """
+        with self.lock:
+            if host in self.open_hosts or host in self.dead:
+                return False
+            count = self.failures[host] = self.failures.get(host, 0) + 1
+            if count < self.threshold:
+                return False
+            self.open_hosts[host] = []
+            self.opened += 1
+        self.logger.warning("Host %s unreachable %d times in a row; circuit opened" %
+                            (host, count))
+        prober = self.make_prober()
+        if prober.when_reachable(host, self._probed):
+            self._probed(host, True)
+        return True
+    
+    def hold(self, host, callback):
+        """
+        Called for a task whose host's circuit is open. Returns False if the
+        task should fail now. Otherwise returns True, and callback is called
+        with a boolean once the circuit closes (True) or the host is given
+        up on (False); the task should be parked until then. If the circuit
+        closed in the meantime, callback is called before this returns.
+        
+        @param host: the host the task runs on
+        @param callback: callable taking a boolean
+        """
+        with self.lock:
+            if host in self.dead or self.on_open == self.FAIL:
+                self.fast_failed += 1
+                return False
+            waiters = self.open_hosts.get(host)
+            self.parked += 1
+            if waiters is not None:
+                waiters.append(callback)
+                return True
+            self.released += 1
+        callback(True)
+        return True
+    
+    def unreachable_exception(self, host, task=None):
+        """
+        Returns the L{HostUnreachableException} to fail a task for host with
+        """
+        return HostUnreachableException("Circuit for host {} is open; {} not "
+                                        "attempted".format(host,
+                                                           "task %s" % task.name
+                                                           if task is not None
+                                                           else "task"),
+                                        host=host)
+    
+    def make_prober(self):
+        """
+        Returns the L{HostProber} used to probe a host whose circuit has just
+        opened; a new prober is used each time, as a prober remembers the
+        outcome for each host.
+        """
+        return HostProber(port=self.port, connect_timeout=self.connect_timeout,
+                          initial_delay=self.probe_interval, backoff=1.0,
+                          max_delay=self.probe_interval,
+                          timeout=self.probe_timeout)
+    
+    def summary(self):
+        """
+        Returns a one line description of what the breaker did
+        """
+        return ("host circuits: %d opened, %d tasks failed fast, %d parked, "
+                "%d released" % (self.opened, self.fast_failed, self.parked,
+                                 self.released))
+        
+    def _probed(self, host, ok):
+        #internal; the outcome of probing a host whose circuit is open
+        with self.lock:
+            waiters = self.open_hosts.pop(host, [])
+            if ok:
+                self.failures.pop(host, None)
+                self.released += len(waiters)
+            else:
+                self.dead.add(host)
+        self.logger.info("Host %s %s; %d parked tasks %s" %
+                         (host, "reachable again, circuit closed" if ok
+                          else "given up on", len(waiters),
+                          "released" if ok else "failed"))
+        for callback in waiters:
+            try:
+                callback(ok)
+            except Exception, e:
+                self.logger.error("Releasing a task for %s failed: %s" % (host, e))
@@ -41,7 +41,20 @@ class ClassMapper(dict):
     """
     Internal; used to map a class, and its derived classes, to some other object.
     Really just a kind of dict that has some more interesting properties.
+    
+    The result of looking up a class via [] is remembered, so the search of
+    the class's __mro__ is only done the first time a particular class is
+    seen. The remembered results are discarded whenever the mapping itself
+    changes. The attributes 'lookups' and 'resolutions' count the number
+    of [] lookups and the number of those that required an __mro__ search,
+    respectively.
     """
+    def __init__(self, *args, **kwargs):
+        super(ClassMapper, self).__init__(*args, **kwargs)
+        self._resolved = {}
+        self.lookups = 0
+        self.resolutions = 0
+        
     def __getitem__(self, item):
         """
         This method differs from normal __getitem__ in that since item is expected to be
@@ -49,20 +62,64 @@ class ClassMapper(dict):
         of the bases on the __mro__ is subsequently searched for. Only if all of these
         searches are exhausted with no results do we raise a KeyError.
         """
-        val = None
-        try:
-            val = dict.__getitem__(self, item)
-        except KeyError, _:
-            for cls in item.__mro__:
-                try:
-                    val = dict.__getitem__(self, cls)
-                    break
-                except KeyError, _:
-                    pass
+        self.lookups += 1
+        val = self._resolved.get(item, _unresolved)
+        if val is _unresolved:
+            val = self._resolve(item)
+            self._resolved[item] = val
         if not val:
             raise KeyError("Can not find a value for %s" % item)
         return val
     
+    def _resolve(self, item):
+        #private; the uncached __mro__ search
+        self.resolutions += 1
+        if dict.__contains__(self, item):
+            return dict.__getitem__(self, item)
+        for cls in item.__mro__:
+            if dict.__contains__(self, cls):
+                return dict.__getitem__(self, cls)
+        return None
+    
+    def _invalidate(self):
+        #private; unpickling can set items before the instance's attributes
+        #are restored, and then there's nothing to invalidate
+        resolved = getattr(self, "_resolved", None)
+        if resolved is not None:
+            resolved.clear()
+    
+    def __setitem__(self, key, value):
+        self._invalidate()
+        super(ClassMapper, self).__setitem__(key, value)
+        
+    def __delitem__(self, key):
+        self._invalidate()
+        super(ClassMapper, self).__delitem__(key)
+        
+    def update(self, *args, **kwargs):
+        self._invalidate()
+        super(ClassMapper, self).update(*args, **kwargs)
+        
+    def setdefault(self, key, default=None):
+        self._invalidate()
+        return super(ClassMapper, self).setdefault(key, default)
+        
+    def pop(self, key, *args):
+        self._invalidate()
+        return super(ClassMapper, self).pop(key, *args)
+    
+    def popitem(self):
+        self._invalidate()
+        return super(ClassMapper, self).popitem()
+    
+    def clear(self):
+        self._invalidate()
+        super(ClassMapper, self).clear()
+        
+
+#private; marks a class that hasn't been looked up yet
+_unresolved = object()
+
 
 _all_mappers = {}
 
@@ -87,6 +144,19 @@ def get_mapper(domain):
     return _all_mappers.get(domain)
 
 
+def dispatch_stats():
+    """
+    Returns a dict of domain:(lookups, resolutions) for all mapping domains.
+    
+    'lookups' is the number of class lookups performed in the domain, while
+    'resolutions' is the number of those lookups that had to search a class's
+    __mro__; once the set of classes being dispatched on has been seen,
+    'resolutions' should stop growing no matter how many lookups are done.
+    """
+    return {domain:(mapper.lookups, mapper.resolutions)
+            for domain, mapper in _all_mappers.items()}
+
+
 MODIFIERS = "__actuator_modifiers__"
 
 
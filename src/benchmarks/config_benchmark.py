@@ -0,0 +1,212 @@
+#
+# Copyright (c) 2015 Tom Carroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+Config throughput benchmark.
+
+Runs a hadoop-like config model for an increasing number of slave nodes with
+the local execution agent, so each node's tasks run in a sandbox directory on
+this machine rather than over ssh, and reports for each size the makespan
+(wall clock time to perform the whole model) and the throughput of tasks that
+do work on a host.
+
+Run from the directory that contains the 'actuator' package, for example:
+
+    python benchmarks/config_benchmark.py --sizes 10,100,500 --threads 10
+
+Package installs and downloads are replaced with no-ops; everything else
+(directory creation, copies, template processing, shell commands) is really
+performed in the sandboxes.
+
+With --simulate, nothing is performed; instead the run is simulated for each
+of the given thread counts, with and without the pause before each task, with
+every host task taking --task-secs seconds:
+
+    python benchmarks/config_benchmark.py --sizes 500 --simulate 5,20,50
+'''
+import sys
+import os
+import shutil
+import tempfile
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from actuator import (NamespaceModel, ConfigModel, Var, Role, MultiRole,
+                      MultiTask, ConfigClassTask, PingTask, CommandTask,
+                      ShellTask, CopyFileTask, ProcessCopyFileTask,
+                      with_variables, with_dependencies, LocalExecutionAgent,
+                      what_if)
+from actuator.utils import LOG_WARN
+
+#stands in for the hadoop config templates
+TEMPLATE = """<configuration>
+  <property>
+    <name>fs.default.name</name>
+    <value>hdfs://!{NAMENODE_IP}:!{NAMENODE_PORT}</value>
+  </property>
+</configuration>
+"""
+
+#the number of tasks in NodeConfig below
+NODE_TASKS = 7
+
+
+def make_models(num_slaves, template_file):
+    """
+    Returns a namespace model instance with a name node and num_slaves slaves,
+    and a config model instance that sets up each of them and then the name
+    node, much as the hadoop example does
+    """
+    class BenchNamespace(NamespaceModel):
+        with_variables(Var("NAMENODE_IP", "10.0.0.1"),
+                       Var("NAMENODE_PORT", "50071"),
+                       Var("HADOOP_PREP", "tmp/hadoop"),
+                       Var("HADOOP_DATA", "!{HADOOP_PREP}/data"),
+                       Var("HADOOP_CONF_DIR", "!{HADOOP_PREP}/conf"))
+        name_node = Role("name_node", host_ref="10.0.0.1")
+        slaves = MultiRole(Role("slave", host_ref="10.1.!{SLAVE_HI}.!{SLAVE_LO}"))
+        
+    class NodeConfig(ConfigModel):
+        ping = PingTask("ping")
+        install = CommandTask("install", "/usr/bin/sudo apt-get -y install java")
+        make_home = CommandTask("make_home", "/bin/mkdir -p !{HADOOP_PREP}",
+                                creates="!{HADOOP_PREP}")
+        make_data = ShellTask("make_data",
+                              "/bin/mkdir -p !{HADOOP_DATA}; /bin/chmod 755 !{HADOOP_DATA}")
+        fetch = CommandTask("fetch", "/usr/bin/wget -q http://example.com/hadoop.tgz",
+                            chdir="!{HADOOP_PREP}")
+        send_key = CopyFileTask("send_key", "!{HADOOP_PREP}/key", content="KEY\n",
+                                mode="0600")
+        send_site = ProcessCopyFileTask("send_site", "!{HADOOP_CONF_DIR}/core-site.xml",
+                                        src=template_file)
+        with_dependencies(ping | (install & make_home))
+        with_dependencies(make_home | (make_data & fetch & send_key) | send_site)
+        
+    class BenchConfig(ConfigModel):
+        select_all = BenchNamespace.q.union(BenchNamespace.q.name_node,
+                                            BenchNamespace.q.slaves.all())
+        node_setup = MultiTask("node_setup", ConfigClassTask("setup", NodeConfig),
+                               select_all)
+        slave_list = ShellTask("slave_list",
+                               "for i in $SLAVES; do echo $i; done > !{HADOOP_CONF_DIR}/slaves",
+                               task_role=BenchNamespace.name_node)
+        with_dependencies(node_setup | slave_list)
+        
+    ns = BenchNamespace()
+    for i in range(num_slaves):
+        slave = ns.slaves[i]
+        slave.add_variable(Var("SLAVE_HI", str(i / 250)),
+                           Var("SLAVE_LO", str(i % 250 + 1)))
+    ns.name_node.add_variable(Var("SLAVES", " ".join(["10.1.%d.%d" % (i / 250, i % 250 + 1)
+                                                      for i in range(num_slaves)])))
+    return ns, BenchConfig()
+
+
+def run(num_slaves, num_threads=5):
+    """
+    Perform the config for num_slaves slaves with the local agent, and return
+    a dict of measurements
+    """
+    work_dir = tempfile.mkdtemp(prefix="actuator-config-bench-")
+    try:
+        template_file = os.path.join(work_dir, "core-site.xml")
+        with open(template_file, "w") as f:
+            f.write(TEMPLATE)
+        ns, cfg = make_models(num_slaves, template_file)
+        ea = LocalExecutionAgent(config_model_instance=cfg,
+                                 namespace_model_instance=ns,
+                                 sandbox_root=os.path.join(work_dir, "hosts"),
+                                 commands={"/usr/bin/sudo":"/bin/true",
+                                           "/usr/bin/wget":"/bin/true"},
+                                 num_threads=num_threads, log_level=LOG_WARN)
+        start = time.time()
+        ea.perform_config()
+        makespan = time.time() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    #each node's setup tasks, plus slave_list
+    num_tasks = NODE_TASKS * (num_slaves + 1) + 1
+    return {"slaves":num_slaves,
+            "hosts":len(ea.sandboxes),
+            "makespan":makespan,
+            "tasks":num_tasks,
+            "throughput":num_tasks / makespan if makespan > 0 else 0.0}
+
+
+def simulate(num_slaves, thread_counts, task_secs=1.0):
+    """
+    Simulate the config for num_slaves slaves with each number of threads in
+    thread_counts, with and without jitter, and return the list of
+    SimulationResults
+    """
+    work_dir = tempfile.mkdtemp(prefix="actuator-config-bench-")
+    try:
+        template_file = os.path.join(work_dir, "core-site.xml")
+        ns, cfg = make_models(num_slaves, template_file)
+        ea = LocalExecutionAgent(config_model_instance=cfg,
+                                 namespace_model_instance=ns,
+                                 sandbox_root=os.path.join(work_dir, "hosts"),
+                                 log_level=LOG_WARN)
+        return what_if(ea, thread_counts=thread_counts, seed=1,
+                       default_duration=task_secs)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Config throughput benchmark "
+                                                 "using the local execution agent")
+    parser.add_argument("--sizes", default="10,50,100",
+                        help="comma separated numbers of slave nodes")
+    parser.add_argument("--threads", type=int, default=5)
+    parser.add_argument("--simulate", default=None,
+                        help="comma separated thread counts to simulate rather "
+                             "than performing the config")
+    parser.add_argument("--task-secs", type=float, default=1.0,
+                        help="with --simulate, the seconds each host task takes")
+    args = parser.parse_args(argv)
+    
+    if args.simulate:
+        counts = [int(n) for n in args.simulate.split(",")]
+        print "%8s %8s %7s %10s %10s %8s" % ("slaves", "threads", "jitter",
+                                            "makespan", "critical", "peak")
+        for size in [int(s) for s in args.sizes.split(",")]:
+            for r in simulate(size, counts, task_secs=args.task_secs):
+                print "%8d %8d %7s %10.1f %10.1f %8d" % (size, r.num_threads,
+                                                        "yes" if r.jitter else "no",
+                                                        r.makespan, r.critical_length,
+                                                        r.peak_parallelism)
+        return 0
+    
+    print "%8s %8s %10s %8s %10s" % ("slaves", "hosts", "makespan", "tasks",
+                                     "tasks/sec")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        r = run(size, num_threads=args.threads)
+        print "%8d %8d %10.2f %8d %10.1f" % (r["slaves"], r["hosts"], r["makespan"],
+                                             r["tasks"], r["throughput"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+#
+# Copyright (c) 2015 Tom Carroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Provisioning throughput benchmark.
+
+Provisions synthetic infra models of increasing size against the simulated
+Openstack cloud in actuator.provisioners.openstack.simulator, and reports for
+each size the makespan (wall clock time to provision the whole model), the
+number of API calls made, and how busy the provisioner's threads were.
+
+Run from the directory that contains the 'actuator' package, for example:
+
+    python benchmarks/provisioning_benchmark.py --sizes 10,100,1000 --threads 10
+
+Latencies and boot times are scaled by --time-scale so that a realistic cloud
+profile (sub-second API calls, servers that take tens of seconds to boot) can
+be run in a reasonable time.
+'''
+import sys
+import os
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from actuator import InfraModel, MultiResource, ctxt
+from actuator.provisioners.openstack.resources import (Server, Network, Subnet,
+                                                        Router, RouterGateway,
+                                                        RouterInterface,
+                                                        FloatingIP, SecGroup,
+                                                        SecGroupRule)
+from actuator.provisioners.openstack.resource_tasks import OpenstackProvisioner
+from actuator.provisioners.openstack.simulator import (SimulatedCloud,
+                                                       lognormal)
+from actuator.utils import LOG_WARN
+
+#the resources every benchmark model has besides its servers, fips and rules
+FIXED_RESOURCES = 6
+
+
+def make_model(size):
+    """
+    Returns an infra model instance with about size resources; one network
+    with its subnet and router, a security group, and otherwise 80% servers,
+    10% floating IPs and 10% security group rules.
+    """
+    rest = max(size - FIXED_RESOURCES, 1)
+    num_servers = max(1, int(rest * 0.8))
+    num_fips = int(rest * 0.1)
+    num_rules = rest - num_servers - num_fips
+
+    class BenchInfra(InfraModel):
+        net = Network("bench_net")
+        subnet = Subnet("bench_subnet", ctxt.model.net, u"10.0.0.0/8",
+                        dns_nameservers=[u"8.8.8.8"])
+        router = Router("bench_router")
+        gateway = RouterGateway("bench_gateway", ctxt.model.router, "external")
+        iface = RouterInterface("bench_iface", ctxt.model.router,
+                                ctxt.model.subnet)
+        secgroup = SecGroup("bench_sg", "benchmark security group")
+        rules = MultiResource(SecGroupRule("bench_rule", ctxt.model.secgroup,
+                                           ip_protocol="tcp",
+                                           from_port=1024, to_port=1024))
+        servers = MultiResource(Server("bench_node", u"Ubuntu 13.10", "m1.small",
+                                       nics=[ctxt.model.net],
+                                       security_groups=[ctxt.model.secgroup]))
+        fips = MultiResource(FloatingIP("bench_fip",
+                                        ctxt.model.servers[ctxt.name],
+                                        ctxt.model.servers[ctxt.name].iface0.addr0,
+                                        pool="external"))
+
+    model = BenchInfra("bench_%d" % size)
+    for i in range(num_servers):
+        _ = model.servers[i]
+    for i in range(num_fips):
+        _ = model.fips[i]
+    for i in range(num_rules):
+        _ = model.rules[i]
+    return model
+
+
+def run(size, num_threads=5, cloud_args=None, provisioner_args=None):
+    """
+    Provision a model of the given size against a new simulated cloud, and
+    return a dict of measurements
+    """
+    cloud = SimulatedCloud(**(cloud_args or {}))
+    model = make_model(size)
+    cloud.install()
+    try:
+        prov = OpenstackProvisioner("bench", "bench", "bench", "http://sim",
+                                    num_threads=num_threads, log_level=LOG_WARN,
+                                    **(provisioner_args or {}))
+        start = time.time()
+        prov.provision_infra_model(model)
+        makespan = time.time() - start
+    finally:
+        cloud.uninstall()
+    timings = prov.agent.task_timings
+    busy = sum([end - begin for _, _, begin, end in timings])
+    if prov.agent.pool_sizer is not None:
+        num_threads = prov.agent.pool_sizer.peak
+    return {"size":size,
+            "resources":len(model.components()),
+            "makespan":makespan,
+            "api_calls":cloud.total_calls(),
+            "calls":dict(cloud.calls),
+            "rejected":cloud.rejected,
+            "tasks":len(timings),
+            "utilization":(busy / (num_threads * makespan)
+                           if makespan > 0
+                           else 0.0)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Openstack provisioning "
+                                                 "throughput benchmark")
+    parser.add_argument("--sizes", default="10,100,1000,5000",
+                        help="comma separated model sizes (resources)")
+    parser.add_argument("--threads", type=int, default=5)
+    parser.add_argument("--max-threads", type=int, default=None,
+                        help="let the thread count adapt up to this many")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="median API call latency, seconds")
+    parser.add_argument("--boot", type=float, default=30.0,
+                        help="median server boot time, seconds")
+    parser.add_argument("--time-scale", type=float, default=0.01,
+                        help="factor applied to all latencies and boot times")
+    parser.add_argument("--rate-limit", type=int, default=None,
+                        help="max API calls per second")
+    parser.add_argument("--batch-servers", action="store_true")
+    parser.add_argument("--no-poll", action="store_true",
+                        help="wait for each server in its own thread")
+    parser.add_argument("--show-calls", action="store_true",
+                        help="print the API call counts by call")
+    args = parser.parse_args(argv)
+
+    cloud_args = {"latency":{"*":lognormal(args.latency)},
+                  "boot_time":lognormal(args.boot, 0.25),
+                  "time_scale":args.time_scale,
+                  "rate_limit":args.rate_limit,
+                  "seed":1}
+    provisioner_args = {"batch_servers":args.batch_servers,
+                        "poll_servers":not args.no_poll,
+                        "max_threads":args.max_threads}
+    print "%8s %10s %10s %10s %8s %8s" % ("size", "resources", "makespan",
+                                          "api calls", "tasks", "util")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        r = run(size, num_threads=args.threads, cloud_args=cloud_args,
+                provisioner_args=provisioner_args)
+        print "%8d %10d %10.2f %10d %8d %7.0f%%" % (r["size"], r["resources"],
+                                                   r["makespan"], r["api_calls"],
+                                                   r["tasks"],
+                                                   r["utilization"] * 100)
+        if args.show_calls:
+            for name, count in sorted(r["calls"].items()):
+                print "%30s %8d" % (name, count)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -31,12 +31,20 @@ import socket
 import os
 import os.path
 import stat
+import shutil
+import tempfile
+import threading
+import ansible.constants as C
 from actuator import (NamespaceModel, Var, Role, ConfigModel, PingTask,
                       with_variables, ExecutionException, CommandTask,
                       ScriptTask, CopyFileTask, InfraModel, StaticServer,
                       ProcessCopyFileTask, ctxt, with_config_options,
-                      NullTask, TaskGroup)
-from actuator.exec_agents.ansible.agent import AnsibleExecutionAgent
+                      NullTask, TaskGroup, ShellTask)
+from actuator.exec_agents.ansible.agent import (AnsibleExecutionAgent, FusedTask,
+                                                FusedTaskProcessor)
+from actuator.exec_agents.ansible.agent import CopyFileProcessor
+from actuator.exec_agents.ansible.connections import SSHConnectionManager
+from actuator.exec_agents.ansible.transfer import PayloadStage, TransferStats
 from actuator.utils import find_file
 
 
@@ -745,6 +753,503 @@ def test023():
     assert ea._get_run_host(cfg.t) == "127.0.0.1"
 
 
+_FAKE_SSH = """#!%s
+#stands in for ssh; opening a master creates its control socket path, and
+#"-O exit" removes it. Hosts named bad* can't be connected to
+import sys, os, time
+args = sys.argv[1:]
+opts = dict(a.split("=", 1) for a in args if "=" in a)
+host = args[-1]
+open(os.environ["FAKE_SSH_LOG"], "a").write(" ".join(args) + "\\n")
+if "-O" in args:
+    os.remove(opts["ControlPath"])
+elif "-M" in args:
+    if host.startswith("bad"):
+        sys.stderr.write("ssh: connect to host %%s port 22: No route to host\\n" %% host)
+        sys.exit(255)
+    time.sleep(0.05)
+    path = (opts["ControlPath"].replace("%%r", opts["User"])
+            .replace("%%h", host).replace("%%p", "22"))
+    open(path, "w").close()
+"""
+
+
+def _fake_ssh():
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, "ssh")
+    with open(path, "w") as f:
+        f.write(_FAKE_SSH % sys.executable)
+    os.chmod(path, stat.S_IRWXU)
+    os.environ["FAKE_SSH_LOG"] = os.path.join(d, "log")
+    return d, path
+
+
+def test024():
+    #one master connection per host/user, shared by later tasks
+    d, ssh = _fake_ssh()
+    saved = C.ANSIBLE_SSH_ARGS
+    try:
+        mgr = SSHConnectionManager(ssh_command=ssh).open()
+        assert mgr.transport == "ssh"
+        assert "ControlPath=%s" % mgr.control_dir in C.ANSIBLE_SSH_ARGS
+        assert C.ANSIBLE_SSH_ARGS.endswith(saved or "")
+        assert mgr.acquire("10.0.0.1", user="fred") > 0
+        assert mgr.is_connected("10.0.0.1", "fred")
+        assert not mgr.is_connected("10.0.0.1", "barney")
+        assert mgr.acquire("10.0.0.1", user="fred") is None
+        mgr.acquire("10.0.0.2", user="fred", private_key_file="/keys/fred")
+        threads = [threading.Thread(target=mgr.acquire, args=("10.0.0.3", "fred"))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert mgr.acquire("bad-host", user="fred", timeout=3) is None
+        assert (mgr.handshakes, mgr.reuses, mgr.failures) == (3, 8, 1), \
+            (mgr.handshakes, mgr.reuses, mgr.failures)
+        assert mgr.handshake_time > 0
+        assert "3 opened" in mgr.summary() and "8 reused" in mgr.summary()
+        control_dir = mgr.control_dir
+        mgr.close()
+        assert C.ANSIBLE_SSH_ARGS == saved
+        assert not os.path.exists(control_dir)
+        log = open(os.environ["FAKE_SSH_LOG"]).read()
+        assert log.count("-M -N -f") == 4
+        assert log.count("-O exit") == 3
+        assert "IdentityFile=/keys/fred" in log
+        assert "ConnectTimeout=3" in log and "ConnectTimeout=20" in log
+    finally:
+        C.ANSIBLE_SSH_ARGS = saved
+        shutil.rmtree(d)
+        
+        
+def test025():
+    #an ssh without ControlPersist means using paramiko's connection cache
+    d = tempfile.mkdtemp()
+    ssh = os.path.join(d, "ssh")
+    with open(ssh, "w") as f:
+        f.write("#!/bin/sh\necho 'command-line: Bad configuration option: ControlPersist' >&2\n"
+                "exit 255\n")
+    os.chmod(ssh, stat.S_IRWXU)
+    saved = C.ANSIBLE_SSH_ARGS
+    try:
+        mgr = SSHConnectionManager(ssh_command=ssh).open()
+        assert mgr.transport == "paramiko"
+        assert C.ANSIBLE_SSH_ARGS == saved
+        mgr.acquire("10.0.0.9", user="wilma")
+        assert mgr.handshakes == 1 and not mgr.is_connected("10.0.0.9", "wilma")
+        mgr.close()
+    finally:
+        shutil.rmtree(d)
+        
+        
+def test026():
+    #with persistent connections an agent skips the pre-task pause for
+    #hosts it is already connected to
+    class NS026(NamespaceModel):
+        r = Role("r", host_ref="10.1.1.1")
+    ns = NS026()
+    
+    class C026(ConfigModel):
+        t = NullTask("null", task_role=NS026.r, remote_user="fred")
+    cfg = C026()
+    d, ssh = _fake_ssh()
+    saved = C.ANSIBLE_SSH_ARGS
+    try:
+        ea = AnsibleExecutionAgent(config_model_instance=cfg,
+                                   namespace_model_instance=ns,
+                                   persistent_ssh=True)
+        cfg.set_namespace(ns)
+        assert ea._pre_task_delay(cfg.t.value()) > 0
+        ea.connections = SSHConnectionManager(ssh_command=ssh).open()
+        assert ea._pre_task_delay(cfg.t.value()) > 0
+        ea.connections.acquire("10.1.1.1", user="fred")
+        assert ea._pre_task_delay(cfg.t.value()) == 0
+        ea.connections.close()
+    finally:
+        C.ANSIBLE_SSH_ARGS = saved
+        shutil.rmtree(d)
+
+
+
+
+def _fused_models():
+    class NS027(NamespaceModel):
+        a = Role("a", host_ref="10.2.2.1")
+        b = Role("b", host_ref="10.2.2.2")
+    ns = NS027()
+    
+    class C027(ConfigModel):
+        t1 = CommandTask("t1", "/bin/mkdir -p /tmp/x", task_role=NS027.a)
+        t2 = ShellTask("t2", "echo hi > /tmp/x/f", task_role=NS027.a)
+        t3 = CommandTask("t3", "/bin/ls /tmp/x", task_role=NS027.a,
+                         chdir="/tmp", creates="/tmp/x/g")
+        t4 = CommandTask("t4", "/bin/true", task_role=NS027.b)
+        t5 = CommandTask("t5", "/bin/true", task_role=NS027.a, repeat_count=3)
+        t6 = CommandTask("t6", "/bin/true", task_role=NS027.a)
+        t7 = CommandTask("t7", "/bin/true", task_role=NS027.a)
+        with_dependencies(t1 | t2 | t3 | t4 | t5 | t6 | t7)
+    cfg = C027(remote_user="fred")
+    cfg.set_namespace(ns)
+    return ns, cfg
+
+
+def test027():
+    #linear chains on one host are fused; host changes and repeated tasks
+    #break chains
+    ns, cfg = _fused_models()
+    ea = AnsibleExecutionAgent(config_model_instance=cfg,
+                               namespace_model_instance=ns, fuse_tasks=True)
+    graph = cfg.get_graph(with_fix=True)
+    fused_graph = ea.fuse_task_chains(graph)
+    assert len(graph.nodes()) == 7
+    fused = [t for t in fused_graph.nodes() if isinstance(t, FusedTask)]
+    assert len(fused) == 2
+    chains = sorted([[t.name for t in f.fused_tasks] for f in fused])
+    assert chains == [["t1", "t2", "t3"], ["t6", "t7"]], chains
+    assert len(fused_graph.nodes()) == 4
+    first = [f for f in fused if f.fused_tasks[0].name == "t1"][0]
+    assert [t.name for t in fused_graph.successors(first)] == ["t4"]
+    assert first.get_task_host() == "10.2.2.1"
+    assert first.get_remote_user() == "fred"
+    
+    
+def test028():
+    #the fused script runs the tasks in order and stops at the first failure,
+    #which is attributed to the failing task
+    import subprocess
+    ns, cfg = _fused_models()
+    ea = AnsibleExecutionAgent(config_model_instance=cfg,
+                               namespace_model_instance=ns, fuse_tasks=True)
+    fused = [t for t in ea.fuse_task_chains(cfg.get_graph(with_fix=True)).nodes()
+             if isinstance(t, FusedTask) and t.fused_tasks[0].name == "t1"][0]
+    d = tempfile.mkdtemp()
+    try:
+        fused.fused_tasks[0].free_form = "/bin/mkdir -p '%s/a dir'" % d
+        fused.fused_tasks[1].free_form = "echo $((1 + 1)) > '%s/a dir/out'" % d
+        fused.fused_tasks[2].free_form = "/bin/ls no-such-file"
+        fused.fused_tasks[2].chdir = d
+        fused.fused_tasks[2].creates = None
+        proc = subprocess.Popen(["/bin/sh", "-c", FusedTaskProcessor().script(fused)],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        assert proc.returncode != 0
+        assert open(os.path.join(d, "a dir", "out")).read().strip() == "2"
+        result = {"dark":{}, "contacted":{"10.2.2.1":{"rc":proc.returncode,
+                                                      "stdout":out, "stderr":err}}}
+        try:
+            FusedTaskProcessor().result_check(fused, result)
+            assert False, "result_check should have raised"
+        except ExecutionException, e:
+            assert e.failed_task is fused.fused_tasks[2]
+            assert e.message.startswith("t3 ")
+        ea.record_aborted_task(fused, ExecutionException, e, None)
+        assert ea.get_aborted_tasks()[0][0] is fused.fused_tasks[2]
+    finally:
+        shutil.rmtree(d)
+        
+        
+def test029():
+    #creates/removes guards skip a task, as the command module would
+    ns, cfg = _fused_models()
+    ea = AnsibleExecutionAgent(config_model_instance=cfg,
+                               namespace_model_instance=ns, fuse_tasks=True)
+    fused = [t for t in ea.fuse_task_chains(cfg.get_graph(with_fix=True)).nodes()
+             if isinstance(t, FusedTask) and t.fused_tasks[0].name == "t1"][0]
+    script = FusedTaskProcessor().script(fused)
+    assert "( cd /tmp && if [ ! -e /tmp/x/g ]; then /bin/ls /tmp/x; fi )" in script
+    assert "/bin/sh -c 'echo hi > /tmp/x/f'" in script
+
+
+
+
+class _LocalModuleAgent(object):
+    #stands in for an AnsibleExecutionAgent, performing the stat, copy and
+    #shell modules on local files
+    def __init__(self, compress_threshold):
+        self.compress_threshold = compress_threshold
+        self.payloads = PayloadStage()
+        self.transfer_stats = TransferStats()
+        self.runs = []
+        
+    def run_module(self, kwargs, logfile=None):
+        import hashlib, subprocess
+        host = kwargs["host_list"][0]
+        name = kwargs["module_name"]
+        cmplx = kwargs.get("complex_args", {})
+        self.runs.append((name, dict(cmplx)))
+        if name == "stat":
+            path = cmplx["path"]
+            st = {"exists":os.path.exists(path), "isdir":os.path.isdir(path)}
+            if os.path.isfile(path):
+                st["checksum"] = hashlib.sha1(open(path, "rb").read()).hexdigest()
+                st["mode"] = "%04o" % stat.S_IMODE(os.stat(path).st_mode)
+            return {"dark":{}, "contacted":{host:{"stat":st}}}
+        elif name == "copy":
+            content = open(cmplx["src"], "rb").read()
+            dest = cmplx["dest"]
+            changed = not os.path.exists(dest) or open(dest, "rb").read() != content
+            if changed:
+                shutil.copy(cmplx["src"], dest)
+            if cmplx.get("mode"):
+                os.chmod(dest, int(cmplx["mode"], 8))
+            return {"dark":{}, "contacted":{host:{"changed":changed}}}
+        elif name == "shell":
+            proc = subprocess.Popen(["/bin/sh", "-c", kwargs["module_args"]],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            return {"dark":{}, "contacted":{host:{"rc":proc.returncode,
+                                                  "stdout":out, "stderr":err}}}
+        assert False, "unexpected module %s" % name
+        
+        
+def _copy_task(name, dest, **kwargs):
+    class NS030(NamespaceModel):
+        r = Role("r", host_ref="10.3.3.3")
+    ns = NS030()
+    
+    class C030(ConfigModel):
+        copy = CopyFileTask(name, dest, task_role=NS030.r, **kwargs)
+    cfg = C030()
+    cfg.set_namespace(ns)
+    task = cfg.copy.value()
+    task.fix_arguments()
+    task.get_task_role().fix_arguments()
+    return task
+
+
+def test030():
+    #staged content is written and compressed once per digest
+    import gzip
+    stage = PayloadStage()
+    try:
+        p1 = stage.stage("x" * 1000, name="/some/dir/a.conf")
+        p2 = stage.stage("x" * 1000, name="/some/dir/a.conf")
+        assert p1 == p2 and os.path.basename(p1) == "a.conf"
+        digest, size = stage.checksum(p1)
+        assert size == 1000
+        gz = stage.compressed(p1, digest)
+        assert gz == stage.compressed(p1, digest)
+        assert gzip.open(gz).read() == "x" * 1000
+        assert os.path.getsize(gz) < 100
+        stage_dir = stage.stage_dir
+    finally:
+        stage.close()
+    assert not os.path.exists(stage_dir)
+    stats = TransferStats()
+    stats.record(1000, 0, skipped=True)
+    stats.record(1000, 40, compressed=True)
+    assert stats.summary() == ("file copies: 2 (1 skipped as unchanged, 1 compressed), "
+                               "2000 bytes of content, 40 bytes sent")
+    
+    
+def test031():
+    #big copies are sent compressed, and skipped when the host has them
+    d = tempfile.mkdtemp()
+    agent = _LocalModuleAgent(compress_threshold=1024)
+    try:
+        dest = os.path.join(d, "big file.conf")
+        content = "".join(["line %d of the config\n" % i for i in range(1000)])
+        task = _copy_task("big", dest, content=content, mode="0640", backup=True)
+        proc = CopyFileProcessor()
+        proc.perform(agent, task, proc.make_args(task, ["10.3.3.3"]))
+        assert open(dest).read() == content
+        assert stat.S_IMODE(os.stat(dest).st_mode) == 0640
+        assert [r[0] for r in agent.runs] == ["stat", "copy", "shell"]
+        assert "content" not in agent.runs[1][1]
+        assert agent.transfer_stats.compressed == 1
+        assert 0 < agent.transfer_stats.sent_bytes < len(content) / 4
+        assert sorted(os.listdir(d)) == ["big file.conf"]
+        
+        agent.runs = []
+        proc.perform(agent, task, proc.make_args(task, ["10.3.3.3"]))
+        assert [r[0] for r in agent.runs] == ["stat"]
+        assert agent.transfer_stats.skipped == 1
+        
+        #changed content replaces the old, keeping a backup
+        task = _copy_task("big", dest, content=content + "more\n", mode="0640",
+                          backup=True)
+        proc.perform(agent, task, proc.make_args(task, ["10.3.3.3"]))
+        assert open(dest).read() == content + "more\n"
+        assert len(os.listdir(d)) == 2
+        assert agent.transfer_stats.copies == 3
+    finally:
+        agent.payloads.close()
+        shutil.rmtree(d)
+        
+        
+def test032():
+    #small copies go to the copy module as staged files, which counts skips
+    d = tempfile.mkdtemp()
+    agent = _LocalModuleAgent(compress_threshold=1024)
+    try:
+        dest = os.path.join(d, "small.conf")
+        task = _copy_task("small", dest, content="small\n")
+        proc = CopyFileProcessor()
+        for _ in range(2):
+            proc.perform(agent, task, proc.make_args(task, ["10.3.3.3"]))
+        assert open(dest).read() == "small\n"
+        assert [r[0] for r in agent.runs] == ["copy", "copy"]
+        assert agent.runs[0][1]["src"].startswith(agent.payloads.stage_dir)
+        stats = agent.transfer_stats
+        assert (stats.copies, stats.skipped, stats.sent_bytes) == (2, 1, 6)
+    finally:
+        agent.payloads.close()
+        shutil.rmtree(d)
+
+
+
+
+def test033():
+    #an unreachable host is reported as such, naming the host
+    from actuator import HostUnreachableException
+    from actuator.exec_agents.ansible.agent import PingProcessor
+    class NS033(NamespaceModel):
+        r = Role("r", host_ref="10.4.4.4")
+    ns = NS033()
+    
+    class C033(ConfigModel):
+        ping = PingTask("ping", task_role=NS033.r)
+    cfg = C033()
+    cfg.set_namespace(ns)
+    task = cfg.ping.value()
+    task.fix_arguments()
+    task.get_task_role().fix_arguments()
+    result = {"dark":{"10.4.4.4":{"msg":"SSH Error: connection timed out"}},
+              "contacted":{}}
+    try:
+        PingProcessor().result_check(task, result)
+        assert False, "result_check should have raised"
+    except HostUnreachableException, e:
+        assert e.host == "10.4.4.4"
+        assert "connection timed out" in e.message
+
+
+def test034():
+    #connect timeouts are learned from the time taken to open connections
+    from actuator import LatencyHistory
+    class NS034(NamespaceModel):
+        r = Role("r", host_ref="10.5.5.5")
+    ns = NS034()
+    
+    class C034(ConfigModel):
+        ping = PingTask("ping", task_role=NS034.r, remote_user="fred")
+    cfg = C034()
+    cfg.set_namespace(ns)
+    timeouts = []
+    class TimeoutAgent(AnsibleExecutionAgent):
+        def run_module(self, kwargs, logfile=None):
+            timeouts.append(kwargs["timeout"])
+            return {"dark":{}, "contacted":{"10.5.5.5":{"ping":"pong"}}}
+    hist = LatencyHistory(min_samples=1)
+    ea = TimeoutAgent(config_model_instance=cfg, namespace_model_instance=ns,
+                      persistent_ssh=True, latency_history=hist)
+    task = cfg.ping.value()
+    assert ea.connect_key(task) == "connect/r"
+    #without a history the default is used
+    assert AnsibleExecutionAgent(config_model_instance=cfg,
+                                 namespace_model_instance=ns).connect_timeout(task) == 20
+    d, ssh = _fake_ssh()
+    saved = C.ANSIBLE_SSH_ARGS
+    try:
+        ea.connections = SSHConnectionManager(ssh_command=ssh).open()
+        ea._perform_task(task)
+        ea._perform_task(task)
+        ea.connections.close()
+    finally:
+        C.ANSIBLE_SSH_ARGS = saved
+        shutil.rmtree(d)
+    #only the first task opened a connection
+    assert hist.histogram("connect/r").count == 1
+    assert timeouts == [20, hist.min_timeout], str(timeouts)
+
+
+def _run_locally(kwargs):
+    #runs a module on this machine with the Runner args for a task
+    from ansible.runner import Runner
+    from ansible.inventory import Inventory
+    kwargs = dict(kwargs)
+    host = kwargs.pop("host_list")[0]
+    inventory = Inventory([host])
+    inventory.get_host(host).set_variable("ansible_python_interpreter",
+                                          sys.executable)
+    return Runner(pattern=host, inventory=inventory, transport="local",
+                  forks=1, **kwargs).run()
+
+
+def test035():
+    #a fused chain leaves the same results as running each task with its
+    #own module; tasks the command module would expand aren't fused
+    import networkx as nx
+    from actuator.exec_agents.ansible.agent import _agent_domain
+    from actuator.utils import get_mapper
+    def run(home, fuse):
+        class NS035(NamespaceModel):
+            r = Role("r", host_ref="127.0.0.1")
+        ns = NS035()
+        work = os.path.join(home, "work")
+        class C035(ConfigModel):
+            t1 = CommandTask("t1", "/bin/mkdir -p ~/data/$USER", task_role=NS035.r)
+            t2 = CommandTask("t2", "/bin/touch made", task_role=NS035.r,
+                             chdir=work, creates="marker")
+            t3 = CommandTask("t3", "/bin/touch removed", task_role=NS035.r,
+                             chdir=work, removes="marker")
+            t4 = ShellTask("t4", "echo $HOME > where", task_role=NS035.r,
+                           chdir=work)
+            with_dependencies(t1 | t2 | t3 | t4)
+        cfg = C035()
+        cfg.set_namespace(ns)
+        ea = AnsibleExecutionAgent(config_model_instance=cfg,
+                                   namespace_model_instance=ns, fuse_tasks=fuse)
+        graph = ea._prepare_graph(cfg.get_graph(with_fix=True))
+        fused = [t for t in graph.nodes() if isinstance(t, FusedTask)]
+        if fuse:
+            assert [[t.name for t in f.fused_tasks] for f in fused] == [["t2", "t3", "t4"]]
+        for task in nx.topological_sort(graph):
+            if isinstance(task, FusedTask):
+                proc = FusedTaskProcessor()
+            else:
+                proc = get_mapper(_agent_domain)[task.__class__]()
+            kwargs = proc.make_args(task, [ea._get_run_host(task)],
+                                    env={"HOME":home, "USER":"actuator"})
+            proc.result_check(task, _run_locally(kwargs))
+    
+    d = tempfile.mkdtemp()
+    try:
+        found = []
+        for fuse in (False, True):
+            home = os.path.join(d, str(fuse))
+            os.makedirs(os.path.join(home, "work"))
+            open(os.path.join(home, "work", "marker"), "w").close()
+            run(home, fuse)
+            files = set()
+            for dirpath, dirnames, filenames in os.walk(home):
+                rel = os.path.relpath(dirpath, home)
+                files.update([os.path.join(rel, n) for n in dirnames + filenames])
+            files.discard(".ansible")
+            found.append(files)
+            assert open(os.path.join(home, "work", "where")).read().strip() == home
+        assert found[0] == found[1], found
+        assert "data/actuator" in found[0] and "work/removed" in found[0]
+        assert "work/made" not in found[0]
+    finally:
+        shutil.rmtree(d)
+    
+    
+def test036():
+    #the same content can be staged under more than one name
+    stage = PayloadStage()
+    try:
+        p1 = stage.stage("same", name="a.conf")
+        p2 = stage.stage("same", name="b.conf")
+        assert p1 != p2 and os.path.dirname(p1) == os.path.dirname(p2)
+        assert os.path.basename(p2) == "b.conf"
+        assert open(p1).read() == open(p2).read() == "same"
+        assert stage.stage("same", name="b.conf") == p2
+    finally:
+        stage.close()
+
+
 def do_all():
     setup()
     for k, v in globals().items():
@@ -23,6 +23,9 @@
 Created on Jan 15, 2015
 '''
 
+import socket
+import threading
+import time
 import ost_support
 from actuator.provisioners.openstack import openstack_class_factory as ocf
 from actuator.namespace import NamespaceModel, with_variables
@@ -31,9 +34,16 @@ ocf.set_nova_client_class(ost_support.MockNovaClient)
 
 from actuator import (InfraModel, ProvisionerException, MultiResourceGroup,
                       MultiResource, ctxt, Var, ResourceGroup, Role,
-                      MultiRole, NullTask, LOG_DEBUG, LOG_INFO, ConfigModel,
-                      MultiTask, ConfigClassTask)
-from actuator.provisioners.openstack.resource_tasks import OpenstackProvisioner
+                      MultiRole, NullTask, LOG_DEBUG, LOG_INFO, LOG_CRIT,
+                      ConfigModel, MultiTask, ConfigClassTask,
+                      ActuatorOrchestration, ExecutionAgent, ExecutionException,
+                      PingTask)
+from actuator.exec_agents.core import HostUnreachableException
+from actuator.config import StructuralTask, with_dependencies
+from actuator.readiness import (ResourceReadiness, PipelineGate, HostProber,
+                                HostCircuitBreaker)
+from actuator.provisioners.openstack.resource_tasks import (OpenstackProvisioner,
+                                                            ProvisionServerTask)
 from actuator.provisioners.openstack.resources import (Server, Network,
                                                         Router, FloatingIP,
                                                         Subnet, SecGroup,
@@ -41,6 +51,7 @@ from actuator.provisioners.openstack.resources import (Server, Network,
                                                         RouterInterface)
 from actuator.exec_agents.ansible.agent import AnsibleExecutionAgent
 from actuator.modeling import AbstractModelReference
+from actuator.exec_agents.hedging import StragglerHedger
 
 
 external_connection = ResourceGroup("route_out",
@@ -156,6 +167,620 @@ def test001():
                            basestring))
 
 
+class RecordingAgent(ExecutionAgent):
+    #performs nothing; for each task notes whether all the resources its
+    #task_role refers to had been provisioned when it was performed
+    def __init__(self, **kwargs):
+        super(RecordingAgent, self).__init__(**kwargs)
+        self.performed = {}
+        
+    def _perform_task(self, task, logfile=None):
+        if not isinstance(task, StructuralTask):
+            needed = self.task_gate.required_resources(task)
+            self.performed[task.name] = (len(needed),
+                                         all([r.osid is not None for r in needed]))
+        task.perform()
+        
+        
+def _make_pipeline_models(num_slaves, image=ubuntu_img):
+    class Infra(InfraModel):
+        gateway = external_connection
+        slave_secgroup = make_std_secgroup
+        slaves = MultiResourceGroup("slaves",
+                                     slave=Server("slave", image,
+                                                  "m1.small",
+                                                  nics=[ctxt.model.gateway.net],
+                                                  security_groups=[ctxt.model.slave_secgroup.group],
+                                                  **common_kwargs),
+                                     slave_fip=FloatingIP("sn_fip",
+                                                          ctxt.comp.container.slave,
+                                                          ctxt.comp.container.slave.iface0.addr0,
+                                                          pool="external"))
+    infra = Infra("pipeline")
+    
+    class Namespace(NamespaceModel):
+        slaves = MultiRole(Role("slave",
+                                host_ref=ctxt.model.infra.slaves[ctxt.name].slave_fip,
+                                variables=[Var("NET_NAME", Infra.gateway.net.name)]))
+    ns = Namespace()
+    for i in range(num_slaves):
+        _ = ns.slaves[i]
+        
+    class Config(ConfigModel):
+        setup = MultiTask("setup", NullTask("slave_setup"),
+                          Namespace.q.slaves.all())
+    cfg = Config()
+    return infra, ns, cfg
+
+
+def test002():
+    #pipelined orchestration only performs each config task once the
+    #resources its role needs are provisioned
+    infra, ns, cfg = _make_pipeline_models(4)
+    os_prov = OpenstackProvisioner("it", "doesn't", "it", "matter", num_threads=3)
+    orch = ActuatorOrchestration(infra_model_inst=infra, provisioner=os_prov,
+                                 namespace_model_inst=ns, config_model_inst=cfg,
+                                 pipeline=True, log_level=LOG_INFO)
+    orch.config_ea = RecordingAgent(config_model_instance=cfg,
+                                    namespace_model_instance=ns,
+                                    num_threads=3, no_delay=True)
+    assert orch.initiate_system()
+    assert orch.is_complete()
+    assert len(orch.config_ea.performed) == 4, orch.config_ea.performed
+    #the fip (which depends on the server) and the net named in the role's Var
+    assert all([n == 2 and ok for n, ok in orch.config_ea.performed.values()]), \
+        orch.config_ea.performed
+    assert os_prov.resource_listener is None
+    
+    
+def test003():
+    #resource readiness callbacks
+    readiness = ResourceReadiness()
+    calls = []
+    a, b, c = object(), object(), object()
+    assert readiness.when_ready([], lambda: calls.append("none"))
+    assert not readiness.when_ready([a, b], lambda: calls.append("ab"))
+    assert not readiness.when_ready([c], lambda: calls.append("c"))
+    readiness.resource_provisioned(a)
+    assert calls == []
+    readiness.resource_provisioned(b)
+    assert calls == ["ab"]
+    assert readiness.is_ready([a, b]) and not readiness.is_ready([c])
+    assert readiness.when_ready([a], lambda: calls.append("a"))
+    readiness.provisioning_complete()
+    assert calls == ["ab", "c"]
+    assert readiness.is_ready([c, object()])
+    
+    
+def test004():
+    #a task can't be admitted once provisioning of its infra has failed
+    infra, ns, cfg = _make_pipeline_models(1)
+    ns.set_infra_model(infra)
+    ns.compute_provisioning_for_environ(infra)
+    cfg.update_nexus(ns.nexus)
+    graph = cfg.get_graph(with_fix=True)
+    task = [t for t in graph.nodes() if t.name.startswith("slave_setup")][0]
+    readiness = ResourceReadiness()
+    gate = PipelineGate(readiness, infra)
+    released = []
+    assert (set([r.name for r in gate.required_resources(task)]) ==
+            set(["sn_fip", "ro_net"]))
+    assert not gate.admit(task, lambda: released.append(task))
+    assert gate.parked == 1
+    readiness.provisioning_failed(ProvisionerException("nope"))
+    assert released == [task]
+    try:
+        gate.admit(task, lambda: released.append(task))
+        assert False, "admit should have raised"
+    except ExecutionException, _:
+        pass
+    
+    
+def test005():
+    #a provisioning failure during pipelined orchestration aborts it
+    infra, ns, cfg = _make_pipeline_models(2, image="no such image")
+    os_prov = OpenstackProvisioner("it", "doesn't", "it", "matter", num_threads=3)
+    orch = ActuatorOrchestration(infra_model_inst=infra, provisioner=os_prov,
+                                 namespace_model_inst=ns, config_model_inst=cfg,
+                                 pipeline=True, log_level=LOG_CRIT)
+    orch.config_ea = RecordingAgent(config_model_instance=cfg,
+                                    namespace_model_instance=ns,
+                                    num_threads=3, no_delay=True)
+    assert not orch.initiate_system()
+    assert orch.status == orch.ABORT_PROVISION
+    assert orch.config_ea.performed == {}
+
+
+class _Listener(object):
+    #a local TCP server standing in for sshd; sends banner to each
+    #connection, if there is one
+    def __init__(self, banner=None, port=0):
+        self.banner = banner
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.port = self.sock.getsockname()[1]
+        self.sock.listen(50)
+        self.sock.settimeout(0.1)
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def _serve(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout, _:
+                continue
+            if self.banner:
+                conn.sendall(self.banner)
+            conn.close()
+        self.sock.close()
+        
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        
+        
+def _closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def test006():
+    #single probes, with and without the ssh banner check
+    ssh = _Listener(banner="SSH-2.0-OpenSSH_6.6\r\n")
+    http = _Listener(banner="HTTP/1.1 400 Bad Request\r\n")
+    try:
+        assert HostProber(port=ssh.port).probe("127.0.0.1")
+        assert HostProber(port=ssh.port, check_banner=True).probe("127.0.0.1")
+        assert HostProber(port=http.port).probe("127.0.0.1")
+        assert not HostProber(port=http.port, check_banner=True,
+                              banner_timeout=1.0).probe("127.0.0.1")
+        assert not HostProber(port=_closed_port()).probe("127.0.0.1")
+    finally:
+        ssh.stop()
+        http.stop()
+        
+        
+def test007():
+    #a host that starts listening late is found once it does; one that
+    #never does is given up on
+    port = _closed_port()
+    prober = HostProber(port=port, initial_delay=0.05, backoff=2.0,
+                        max_delay=0.2, timeout=10.0)
+    listeners = []
+    timer = threading.Timer(0.5, lambda: listeners.append(_Listener(port=port)))
+    timer.start()
+    try:
+        assert prober.wait_for(["127.0.0.1"]) == []
+        assert prober.attempts > 2
+        assert "127.0.0.1" in prober.reachable
+        assert prober.when_reachable("127.0.0.1", None)
+    finally:
+        timer.join()
+        for l in listeners:
+            l.stop()
+    prober = HostProber(port=_closed_port(), initial_delay=0.05, timeout=0.3)
+    start = time.time()
+    assert prober.wait_for(["127.0.0.1"]) == ["127.0.0.1"]
+    assert time.time() - start < 5
+    calls = []
+    assert not prober.when_reachable("127.0.0.1", lambda h, ok: calls.append(ok))
+    assert calls == [False]
+    
+    
+def _make_probe_models():
+    class Namespace(NamespaceModel):
+        local = Role("local", host_ref="127.0.0.1")
+    ns = Namespace()
+    
+    class Config(ConfigModel):
+        local_task = NullTask("local_task", task_role=Namespace.local)
+    cfg = Config()
+    return ns, cfg
+
+
+def test008():
+    #config starts once the config hosts can be reached, or not at all
+    listener = _Listener(banner="SSH-2.0-Test\r\n")
+    try:
+        ns, cfg = _make_probe_models()
+        orch = ActuatorOrchestration(namespace_model_inst=ns, config_model_inst=cfg,
+                                     host_prober=HostProber(port=listener.port,
+                                                            check_banner=True))
+        orch.config_ea = ExecutionAgent(config_model_instance=cfg,
+                                        namespace_model_instance=ns,
+                                        no_delay=True)
+        assert orch.initiate_system()
+    finally:
+        listener.stop()
+    ns, cfg = _make_probe_models()
+    orch = ActuatorOrchestration(namespace_model_inst=ns, config_model_inst=cfg,
+                                 host_prober=HostProber(port=_closed_port(),
+                                                        initial_delay=0.05,
+                                                        timeout=0.3),
+                                 log_level=LOG_CRIT)
+    assert not orch.initiate_system()
+    assert orch.status == orch.ABORT_CONFIG
+    
+    
+def test009():
+    #in pipelined mode a task whose infra is ready still waits for its host
+    port = _closed_port()
+    ns, cfg = _make_probe_models()
+    cfg.update_nexus(ns.nexus)
+    task = [t for t in cfg.get_graph(with_fix=True).nodes()
+            if t.name == "local_task"][0]
+    readiness = ResourceReadiness()
+    readiness.provisioning_complete()
+    gate = PipelineGate(readiness, None,
+                        prober=HostProber(port=port, initial_delay=0.05,
+                                          max_delay=0.1, timeout=10.0))
+    released = threading.Event()
+    assert not gate.admit(task, released.set)
+    listener = _Listener(port=port)
+    try:
+        assert released.wait(5.0)
+        assert gate.admit(task, None)
+    finally:
+        listener.stop()
+
+
+
+
+def test010():
+    #all the tasks of a role share one environment snapshot, made once
+    class NS010(NamespaceModel):
+        with_variables(Var("GREETING", "hello !{WHO}"),
+                       Var("SECRET", "shh", in_env=False))
+        nodes = MultiRole(Role("node", host_ref="10.9.9.!{WHO}",
+                               variables=[Var("WHO", ctxt.name)]))
+    ns = NS010()
+    for i in range(2):
+        _ = ns.nodes[i]
+        
+    class C010(ConfigModel):
+        tasks = MultiTask("tasks",
+                          NullTask("t", task_role=ctxt.nsref),
+                          NS010.q.nodes.all())
+        more = MultiTask("more",
+                         NullTask("m", task_role=ctxt.nsref),
+                         NS010.q.nodes.all())
+        with_dependencies(tasks | more)
+        
+    class EnvAgent(ExecutionAgent):
+        def __init__(self, **kwargs):
+            super(EnvAgent, self).__init__(**kwargs)
+            self.envs = []
+            
+        def _perform_task(self, task, logfile=None):
+            if not isinstance(task, StructuralTask):
+                task.get_task_role().fix_arguments()
+                self.envs.append((task.get_task_host(),
+                                  self.role_environment(task)))
+            task.perform()
+    cfg = C010()
+    ea = EnvAgent(config_model_instance=cfg, namespace_model_instance=ns,
+                  no_delay=True)
+    ea.perform_config()
+    assert len(ea.envs) == 4
+    assert len(ea.role_environments) == 2
+    by_role = {}
+    for name, env in ea.envs:
+        assert by_role.setdefault(name, env) is env
+    assert by_role["10.9.9.0"]["GREETING"] == "hello 0"
+    assert by_role["10.9.9.1"]["GREETING"] == "hello 1"
+    assert "SECRET" not in by_role["10.9.9.0"]
+    try:
+        by_role["10.9.9.0"]["GREETING"] = "changed"
+        assert False, "a role environment shouldn't be changeable"
+    except TypeError, _:
+        pass
+
+
+
+
+def test011():
+    #a host's circuit opens after threshold unreachable results, and closes
+    #once a probe reaches it, releasing parked tasks
+    port = _closed_port()
+    breaker = HostCircuitBreaker(threshold=2, on_open=HostCircuitBreaker.PARK,
+                                 probe_interval=0.05, probe_timeout=10.0,
+                                 port=port, connect_timeout=0.5)
+    assert not breaker.record_unreachable("127.0.0.1")
+    breaker.record_success("127.0.0.1")
+    assert not breaker.record_unreachable("127.0.0.1")
+    assert not breaker.is_open("127.0.0.1")
+    assert breaker.record_unreachable("127.0.0.1")
+    assert breaker.is_open("127.0.0.1")
+    released = []
+    done = threading.Event()
+    assert breaker.hold("127.0.0.1", lambda ok: (released.append(ok), done.set()))
+    listener = _Listener(port=port)
+    try:
+        assert done.wait(5.0)
+    finally:
+        listener.stop()
+    assert released == [True]
+    assert not breaker.is_open("127.0.0.1")
+    assert (breaker.opened, breaker.parked, breaker.released) == (1, 1, 1)
+    
+    
+def test012():
+    #in fail mode a dead host's tasks fail fast, and a given up host fails
+    #the tasks parked for it
+    breaker = HostCircuitBreaker(threshold=1)
+    breaker.make_prober = lambda: HostProber(port=_closed_port(), initial_delay=0.05,
+                                             timeout=0.2, connect_timeout=0.5)
+    assert breaker.record_unreachable("127.0.0.1")
+    assert not breaker.hold("127.0.0.1", None)
+    assert breaker.fast_failed == 1
+    parking = HostCircuitBreaker(threshold=1, on_open=HostCircuitBreaker.PARK)
+    parking.make_prober = breaker.make_prober
+    outcome = []
+    done = threading.Event()
+    parking.record_unreachable("127.0.0.1")
+    assert parking.hold("127.0.0.1", lambda ok: (outcome.append(ok), done.set()))
+    assert done.wait(5.0)
+    assert outcome == [False]
+    assert not parking.hold("127.0.0.1", None)
+    
+    
+class FlakyHostAgent(ExecutionAgent):
+    #fails tasks for hosts in down with HostUnreachableException
+    def __init__(self, down, **kwargs):
+        super(FlakyHostAgent, self).__init__(**kwargs)
+        self.down = down
+        self.attempts = {}
+        self.lock = threading.Lock()
+        
+    def _perform_task(self, task, logfile=None):
+        if not isinstance(task, (StructuralTask, NullTask)):
+            task.get_task_role().fix_arguments()
+            host = task.get_task_host()
+            with self.lock:
+                self.attempts[host] = self.attempts.get(host, 0) + 1
+            if host in self.down:
+                raise HostUnreachableException("can't reach %s" % host, host=host)
+        else:
+            task.perform()
+        
+        
+def _make_breaker_models(num_tasks):
+    class NS013(NamespaceModel):
+        up = Role("up", host_ref="10.8.8.8")
+        down = Role("down", host_ref="127.0.0.1")
+    ns = NS013()
+    
+    class C013(ConfigModel):
+        up_tasks = MultiTask("up_tasks",
+                             PingTask("p", task_role=NS013.up, repeat_count=5,
+                                      repeat_interval=0),
+                             [NS013.up] * num_tasks)
+        down_tasks = MultiTask("down_tasks",
+                               PingTask("p", task_role=NS013.down, repeat_count=5,
+                                        repeat_interval=0),
+                               [NS013.down] * num_tasks)
+    return ns, C013()
+
+
+def test013():
+    #with a breaker a dead host gets threshold attempts, not a full set of
+    #retries for every task
+    ns, cfg = _make_breaker_models(6)
+    breaker = HostCircuitBreaker(threshold=2, probe_interval=60.0)
+    ea = FlakyHostAgent(set(["127.0.0.1"]), config_model_instance=cfg,
+                        namespace_model_instance=ns, no_delay=True,
+                        num_threads=1, host_breaker=breaker)
+    try:
+        ea.perform_config()
+        assert False, "the config should have failed"
+    except ExecutionException, _:
+        pass
+    assert ea.attempts["127.0.0.1"] == 2, ea.attempts
+    assert breaker.opened == 1
+    assert all([isinstance(v, HostUnreachableException)
+                for _, _, v, _ in ea.get_aborted_tasks()])
+    
+    
+def test014():
+    #parked tasks run once their host can be reached again
+    ns, cfg = _make_breaker_models(4)
+    port = _closed_port()
+    breaker = HostCircuitBreaker(threshold=2, on_open=HostCircuitBreaker.PARK,
+                                 probe_interval=0.05, port=port,
+                                 connect_timeout=0.5)
+    down = set(["127.0.0.1"])
+    ea = FlakyHostAgent(down, config_model_instance=cfg,
+                        namespace_model_instance=ns, no_delay=True,
+                        num_threads=3, host_breaker=breaker)
+    listener = []
+    
+    def revive():
+        time.sleep(0.5)
+        down.clear()
+        listener.append(_Listener(port=port))
+    reviver = threading.Thread(target=revive)
+    reviver.start()
+    try:
+        ea.perform_config()
+    finally:
+        reviver.join()
+        listener[0].stop()
+    assert not ea.get_aborted_tasks()
+    assert breaker.opened == 1
+    assert breaker.parked >= 1 and breaker.parked == breaker.released
+    assert ea.attempts["10.8.8.8"] == 4
+
+
+class StragglerAgent(ExecutionAgent):
+    #the first attempt at each task for a host in slow takes slow_secs
+    def __init__(self, slow, slow_secs, **kwargs):
+        super(StragglerAgent, self).__init__(**kwargs)
+        self.slow = slow
+        self.slow_secs = slow_secs
+        self.attempts = {}
+        self.lock = threading.Lock()
+        
+    def _perform_task(self, task, logfile=None):
+        if isinstance(task, (StructuralTask, NullTask)):
+            task.perform()
+            return
+        task.get_task_role().fix_arguments()
+        host = task.get_task_host()
+        with self.lock:
+            tries = self.attempts[host] = self.attempts.get(host, 0) + 1
+        if host in self.slow and tries == 1:
+            time.sleep(self.slow_secs)
+        else:
+            time.sleep(0.05)
+            
+            
+def _make_hedge_models(num_nodes, rerun_safe=True):
+    class NS015(NamespaceModel):
+        nodes = MultiRole(Role("node", host_ref="10.9.9.!{N}",
+                               variables=[Var("N", ctxt.name)]))
+    ns = NS015()
+    for i in range(num_nodes):
+        _ = ns.nodes[i]
+        
+    class C015(ConfigModel):
+        pings = MultiTask("pings", PingTask("p"), NS015.q.nodes.all(),
+                          rerun_safe=rerun_safe)
+    return ns, C015()
+
+
+def test015():
+    #MultiTask instances inherit rerun_safe, and share a sibling key
+    class NS015(NamespaceModel):
+        nodes = MultiRole(Role("node", host_ref="10.9.9.!{N}",
+                               variables=[Var("N", ctxt.name)]))
+        other = Role("other", host_ref="10.9.9.100")
+    ns = NS015()
+    for i in range(3):
+        _ = ns.nodes[i]
+        
+    class Inner(ConfigModel):
+        a = PingTask("a")
+        b = PingTask("b", rerun_safe=False)
+        with_dependencies(a | b)
+        
+    class C015(ConfigModel):
+        pings = MultiTask("pings", PingTask("p"), NS015.q.nodes.all(),
+                          rerun_safe=True)
+        suites = MultiTask("suites", ConfigClassTask("s", Inner),
+                           NS015.q.nodes.all(), rerun_safe=True)
+        lone = PingTask("lone", task_role=NS015.other, rerun_safe=True)
+    cfg = C015()
+    cfg.set_namespace(ns)
+    cfg.update_nexus(ns.nexus)
+    hedger = StragglerHedger()
+    keys = {}
+    for task in cfg.get_graph(with_fix=True).nodes():
+        keys.setdefault(task.name, set()).add(hedger.sibling_key(task))
+    ping_keys = set.union(*[v for k, v in keys.items() if k.startswith("p-")])
+    assert len(ping_keys) == 1 and None not in ping_keys
+    assert len(keys["a"]) == 1 and None not in keys["a"]
+    assert keys["a"] != ping_keys
+    assert keys["b"] == set([None])
+    assert keys["lone"] == set([None])
+    
+    
+def test016():
+    #a straggling rerun_safe task is hedged, and the hedge wins
+    ns, cfg = _make_hedge_models(5)
+    hedger = StragglerHedger(percentile=50, min_siblings=3, min_wait=0.2)
+    ea = StragglerAgent(set(["10.9.9.4"]), 2.0, config_model_instance=cfg,
+                        namespace_model_instance=ns, no_delay=True,
+                        num_threads=5, hedger=hedger)
+    start = time.time()
+    ea.perform_config()
+    assert time.time() - start < 1.5
+    assert hedger.hedged == 1 and hedger.hedge_wins == 1, hedger.summary()
+    assert ea.attempts["10.9.9.4"] == 2
+    
+    
+def test017():
+    #tasks that aren't rerun_safe aren't hedged
+    ns, cfg = _make_hedge_models(4, rerun_safe=False)
+    hedger = StragglerHedger(percentile=50, min_siblings=2, min_wait=0.1)
+    ea = StragglerAgent(set(["10.9.9.3"]), 0.6, config_model_instance=cfg,
+                        namespace_model_instance=ns, no_delay=True,
+                        num_threads=4, hedger=hedger)
+    ea.perform_config()
+    assert hedger.hedged == 0
+    assert ea.attempts["10.9.9.3"] == 1
+    
+    
+def test018():
+    #the hedging threshold is a percentile of sibling times, at least min_wait
+    hedger = StragglerHedger(percentile=90, factor=2.0, min_siblings=3,
+                             min_wait=0.5)
+    hedger.record("k", 1.0)
+    hedger.record("k", 3.0)
+    assert hedger.threshold("k") is None
+    assert not hedger.should_hedge("k", 100.0)
+    hedger.record("k", 2.0)
+    assert hedger.threshold("k") == 6.0
+    assert hedger.should_hedge("k", 6.5) and not hedger.should_hedge("k", 5.0)
+    hedger.record("q", 0.01)
+    hedger.record("q", 0.01)
+    hedger.record("q", 0.01)
+    assert hedger.threshold("q") == 0.5
+
+
+def test019():
+    #simulating orchestration predicts each phase without provisioning anything
+    infra, ns, cfg = _make_pipeline_models(4)
+    os_prov = OpenstackProvisioner("it", "doesn't", "it", "matter", num_threads=3)
+    orch = ActuatorOrchestration(infra_model_inst=infra, provisioner=os_prov,
+                                 namespace_model_inst=ns, config_model_inst=cfg,
+                                 post_prov_pause=30, log_level=LOG_CRIT)
+    results = orch.simulate(jitter=False,
+                            durations={"ProvisionServerTask":(0.5, 20.0),
+                                       "NullTask":2.0})
+    assert [r.phase for r in results] == ["provision", "pause", "config"]
+    prov, pause, config = results
+    assert prov.makespan >= 20.5 and prov.peak_parallelism <= 3
+    assert ProvisionServerTask in [t.__class__ for t in prov.critical_path]
+    assert pause.makespan == 30
+    assert config.makespan == 2.0 and config.peak_parallelism == 4
+    assert os_prov.agent is None
+    assert infra.slaves[0].slave.osid.value() is None
+
+
+def test020():
+    #an abort that comes before the agent's run starts isn't lost, and an
+    #agent whose run finished can be run again
+    class NS020(NamespaceModel):
+        r = Role("r", host_ref="127.0.0.1")
+    ns = NS020()
+    
+    class C020(ConfigModel):
+        t = NullTask("t", task_role=NS020.r)
+    performed = []
+    class CountingAgent(ExecutionAgent):
+        def _perform_task(self, task, logfile=None):
+            performed.append(task.name)
+            task.perform()
+    ea = CountingAgent(config_model_instance=C020(), namespace_model_instance=ns,
+                       no_delay=True)
+    ea.abort_process_tasks()
+    ea.perform_config()
+    assert not performed
+    ea = CountingAgent(config_model_instance=C020(), namespace_model_instance=ns,
+                       no_delay=True)
+    ea.perform_config()
+    ea.perform_config()
+    assert len(performed) == 2, performed
+    assert ea.workers == 0
+
+
 def do_all():
     for k, v in globals().items():
         if k.startswith("test") and callable(v):
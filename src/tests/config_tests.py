@@ -1123,6 +1123,90 @@ def test51():
     assert "THREE" in cfg.t.task_variables() and "THREE" not in cfg.t.task_variables(for_env=True)
     
 
+def test52():
+    from actuator.exec_agents.core import TaskFuture
+    cap = Capture()
+    class DeferringAgent(ExecutionAgent):
+        def _perform_task(self, task, logfile=None):
+            future = TaskFuture()
+            def finish():
+                task.perform()
+                future.set_result()
+            threading.Timer(0.05, finish).start()
+            return future
+    class DeferNamespace(NamespaceModel):
+        target = Role("target", host_ref="127.0.0.1")
+    ns = DeferNamespace()
+    class DeferConfig(ConfigModel):
+        t1 = ReportingTask("t1", target=DeferNamespace.target, report=cap)
+        t2 = ReportingTask("t2", target=DeferNamespace.target, report=cap)
+        t3 = ReportingTask("t3", target=DeferNamespace.target, report=cap)
+        with_dependencies(t1 | t2 | t3)
+    cfg = DeferConfig()
+    ea = DeferringAgent(config_model_instance=cfg, namespace_model_instance=ns,
+                        no_delay=True, num_threads=1)
+    ea.perform_config()
+    assert [n for _, n in cap.performed] == ["t1", "t2", "t3"]
+    
+def test53():
+    from actuator.exec_agents.core import TaskFuture
+    cap = Capture()
+    class FailingDeferAgent(ExecutionAgent):
+        def _perform_task(self, task, logfile=None):
+            future = TaskFuture()
+            if task.name == "t2":
+                future.set_exception(Exception("didn't boot"))
+            else:
+                task.perform()
+                future.set_result()
+            return future
+    class DeferNamespace(NamespaceModel):
+        target = Role("target", host_ref="127.0.0.1")
+    ns = DeferNamespace()
+    class DeferConfig(ConfigModel):
+        t1 = ReportingTask("t1", target=DeferNamespace.target, report=cap)
+        t2 = ReportingTask("t2", target=DeferNamespace.target, report=cap)
+        t3 = ReportingTask("t3", target=DeferNamespace.target, report=cap)
+        with_dependencies(t1 | t2 | t3)
+    cfg = DeferConfig()
+    ea = FailingDeferAgent(config_model_instance=cfg, namespace_model_instance=ns,
+                           no_delay=True)
+    try:
+        ea.perform_config()
+        assert False, "the failed future should have aborted the config"
+    except ExecutionException, _:
+        pass
+    assert [n for _, n in cap.performed] == ["t1"]
+    assert ea.get_aborted_tasks()[0][0].name == "t2"
+
+
+def test54():
+    """
+    test54: a config model's graph can be computed more than once; the
+    ConfigClassTask's dependencies aren't used up by the first
+    """
+    class NS(NamespaceModel):
+        r = Role("r", host_ref="127.0.1.1")
+    ns = NS()
+    
+    class InnerCfg(ConfigModel):
+        t1 = NullTask("inner_task1")
+        t2 = NullTask("inner_task2")
+        with_dependencies(t1 | t2)
+        
+    class OuterCfg(ConfigModel):
+        wrapped_task = ConfigClassTask("wrapper", InnerCfg, task_role=NS.r)
+        initial = NullTask("initial", task_role=NS.r)
+        with_dependencies(initial | wrapped_task)
+        
+    cfg = OuterCfg()
+    cfg.set_namespace(ns)
+    first = cfg.get_graph(with_fix=True)
+    second = cfg.get_graph(with_fix=True)
+    assert len(first.edges()) == len(second.edges()) == 4, \
+        (len(first.edges()), len(second.edges()))
+
+
 def do_all():
     setup()
     for k, v in globals().items():
@@ -0,0 +1,148 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+Tests for latency histories and the timeouts derived from them
+'''
+
+import os
+import os.path
+import json
+import shutil
+import tempfile
+from actuator import (NamespaceModel, Role, ConfigModel, CommandTask,
+                      with_dependencies, LatencyHistory, LocalExecutionAgent)
+from actuator.exec_agents.history import LatencyHistogram
+
+
+def test001():
+    "test001: histogram percentiles are within a bucket of the true value"
+    h = LatencyHistogram()
+    for i in range(1, 101):
+        h.add(i / 10.0)
+    assert h.count == 100
+    assert abs(h.mean() - 5.05) < 1e-9
+    for p, actual in ((50, 5.0), (90, 9.0), (99, 9.9)):
+        est = h.percentile(p)
+        assert actual <= est <= actual * h.growth, (p, est)
+    assert h.percentile(100) == 10.0
+    
+    
+def test002():
+    "test002: an empty histogram has no percentiles"
+    h = LatencyHistogram()
+    assert h.percentile(50) is None and h.mean() is None
+    h.add(0)
+    assert h.percentile(50) == 0.0
+    
+
+def test003():
+    "test003: timeouts use the default until there are min_samples latencies"
+    hist = LatencyHistory(min_samples=5)
+    for _ in range(4):
+        hist.record("shell/web", 2.0)
+    assert hist.timeout("shell/web", default=20) == 20
+    hist.record("shell/web", 2.0)
+    assert hist.timeout("shell/web", default=20) == 6
+    assert hist.timeout("shell/db", default=17) == 17
+    
+    
+def test004():
+    "test004: timeouts are kept between min_timeout and max_timeout"
+    hist = LatencyHistory(factor=3.0, min_timeout=5, max_timeout=120,
+                          min_samples=1)
+    hist.record("fast", 0.1)
+    hist.record("slow", 300.0)
+    assert hist.timeout("fast") == 5
+    assert hist.timeout("slow") == 120
+    
+    
+def test005():
+    "test005: a saved history loads with the same histograms and percentiles"
+    d = tempfile.mkdtemp(prefix="history-test-")
+    try:
+        path = os.path.join(d, "latency.json")
+        hist = LatencyHistory(path=path, min_samples=1)
+        for i in range(50):
+            hist.record("command/node", 1.0 + i / 50.0)
+        hist.record("ping/node", 0.3)
+        hist.save()
+        data = json.load(open(path))
+        assert data["histograms"]["command/node"]["count"] == 50
+        assert data["histograms"]["command/node"]["p99"] is not None
+        loaded = LatencyHistory(path=path, min_samples=1)
+        for key in ("command/node", "ping/node"):
+            assert loaded.histogram(key).count == hist.histogram(key).count
+            assert loaded.percentile(key, 99) == hist.percentile(key, 99)
+            assert loaded.timeout(key) == hist.timeout(key)
+        #loading again replaces rather than adds to what was loaded
+        loaded.load(path)
+        assert loaded.histogram("command/node").count == 50
+        assert [f for f in os.listdir(d)] == ["latency.json"]
+    finally:
+        shutil.rmtree(d)
+        
+        
+def test006():
+    "test006: a history file that can't be read is ignored"
+    d = tempfile.mkdtemp(prefix="history-test-")
+    try:
+        path = os.path.join(d, "latency.json")
+        open(path, "w").write("not json")
+        hist = LatencyHistory(path=path)
+        assert hist.export()["histograms"] == {}
+    finally:
+        shutil.rmtree(d)
+        
+        
+def test007():
+    "test007: the agent records task latencies by task class and role and saves them"
+    class NS007(NamespaceModel):
+        r = Role("r", host_ref="box")
+    ns = NS007()
+    
+    class C007(ConfigModel):
+        one = CommandTask("one", "/bin/true")
+        two = CommandTask("two", "/bin/true")
+        with_dependencies(one | two)
+    d = tempfile.mkdtemp(prefix="history-test-")
+    try:
+        path = os.path.join(d, "latency.json")
+        hist = LatencyHistory(path=path, min_samples=2)
+        ea = LocalExecutionAgent(config_model_instance=C007(default_task_role=NS007.r),
+                                 namespace_model_instance=ns,
+                                 sandbox_root=d, latency_history=hist)
+        ea.perform_config()
+        assert hist.histogram("CommandTask/r").count == 2
+        assert os.path.exists(path)
+        assert hist.timeout("CommandTask/r", default=20) == 5
+    finally:
+        shutil.rmtree(d)
+        
+        
+def do_all():
+    for k, v in globals().items():
+        if k.startswith("test") and callable(v):
+            v()
+            
+if __name__ == "__main__":
+    do_all()
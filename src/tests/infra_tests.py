@@ -951,6 +951,75 @@ def test151():
     assert len(inst.components()) == 3
     
     
+def test152():
+    class IMT152(InfraModel):
+        server = Server("server", mem="8GB")
+        grid = MultiResource(Server("grid", mem="8GB"))
+    inst = IMT152("t152")
+    for i in range(5):
+        _ = inst.grid[i]
+    comps = inst.components()
+    assert len(comps) == 6
+    assert inst.components() == comps
+    assert inst._components_index[0] == inst._structure_version
+    comps.clear()
+    assert len(inst.components()) == 6
+    refs = inst.refs_for_components()
+    assert inst.refs_for_components() == refs
+    
+def test153():
+    class IMT153(InfraModel):
+        grid = MultiResource(Server("grid", mem="8GB"))
+    inst = IMT153("t153")
+    _ = inst.grid[0]
+    assert len(inst.components()) == 1 and len(inst.refs_for_components()) == 1
+    _ = inst.grid[1]
+    comps = inst.components()
+    assert len(comps) == 2 and len(inst.refs_for_components()) == 2
+    assert inst.grid[1].value() in comps
+    assert inst.grid[1].value().get_model_instance() is inst
+    
+def test154():
+    class IMT154(InfraModel):
+        clusters = MultiResourceGroup("cluster",
+                                      leader=Server("leader", mem="8GB"),
+                                      workers=MultiResource(Server("worker", mem="8GB")))
+    inst = IMT154("t154")
+    _ = inst.clusters[0].workers[0]
+    assert len(inst.components()) == 2
+    _ = inst.clusters[0].workers[1]
+    assert len(inst.components()) == 3
+    _ = inst.clusters[1].workers[0]
+    assert len(inst.components()) == 5
+    
+def test155():
+    class IMT155(InfraModel):
+        grid = MultiResource(Server("grid", mem="8GB"))
+    inst1 = IMT155("t155-1")
+    inst2 = IMT155("t155-2")
+    _ = inst1.grid[0]
+    _ = inst2.grid[0]
+    assert len(inst1.components()) == 1 and len(inst2.components()) == 1
+    version = inst1._structure_version
+    _ = inst2.grid[1]
+    assert inst1._structure_version == version
+    assert inst1._components_index[0] == version
+    assert len(inst1.components()) == 1 and len(inst2.components()) == 2
+    
+def test156():
+    class IMT156(InfraModel):
+        clusters = MultiResourceGroup("cluster",
+                                      workers=MultiResource(Server("worker", mem="8GB")))
+    inst = IMT156("t156")
+    _ = inst.clusters[0].workers[0]
+    assert len(inst.components()) == 1
+    _ = inst.clusters[0].workers[1]
+    comps = inst.components()
+    assert len(comps) == 2
+    assert inst.clusters[0].workers[1].value() in comps
+    assert inst.clusters[0].workers[1].value().get_model_instance() is inst
+
+
 def do_all():
     setup()
     for k, v in globals().items():
@@ -0,0 +1,261 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Tests for the local execution agent
+'''
+
+import os
+import os.path
+import stat
+import shutil
+import tempfile
+from actuator import (NamespaceModel, Var, Role, MultiRole, ConfigModel,
+                      MultiTask, ConfigClassTask, CommandTask, ShellTask, ScriptTask,
+                      CopyFileTask, ProcessCopyFileTask, PingTask,
+                      with_variables, with_dependencies, ctxt,
+                      ExecutionException, LocalExecutionAgent)
+
+
+def _sandbox_root():
+    return tempfile.mkdtemp(prefix="local-agent-test-")
+
+
+def test001():
+    "test001: tasks on different hosts run in their own sandboxes with their own Vars"
+    class NS001(NamespaceModel):
+        with_variables(Var("GREETING", "hello from !{NODE}"),
+                       Var("OUT_DIR", "out"))
+        nodes = MultiRole(Role("node", host_ref="10.0.0.!{NODE}",
+                               variables=[Var("NODE", ctxt.name)]))
+    ns = NS001()
+    for i in range(3):
+        _ = ns.nodes[i]
+        
+    class C001(ConfigModel):
+        ping = PingTask("ping")
+        mkdir = CommandTask("mkdir", "/bin/mkdir -p !{OUT_DIR}")
+        greet = ShellTask("greet", "echo $GREETING > greeting.txt",
+                          chdir="!{OUT_DIR}")
+        with_dependencies(ping | mkdir | greet)
+        
+    class Top001(ConfigModel):
+        per_node = MultiTask("per_node", ConfigClassTask("suite", C001),
+                             NS001.q.nodes.all())
+    root = _sandbox_root()
+    try:
+        cfg = Top001()
+        ea = LocalExecutionAgent(config_model_instance=cfg,
+                                 namespace_model_instance=ns,
+                                 sandbox_root=root)
+        ea.perform_config()
+        assert sorted(os.listdir(root)) == ["10.0.0.0", "10.0.0.1", "10.0.0.2"]
+        for i in range(3):
+            path = os.path.join(root, "10.0.0.%d" % i, "out", "greeting.txt")
+            assert open(path).read().strip() == "hello from %d" % i
+    finally:
+        shutil.rmtree(root)
+        
+        
+def test002():
+    "test002: creates and removes keep a task from running"
+    class NS002(NamespaceModel):
+        r = Role("r", host_ref="box")
+    ns = NS002()
+    
+    class C002(ConfigModel):
+        first = ShellTask("first", "echo 1 > marker")
+        again = ShellTask("again", "echo 2 > marker", creates="marker")
+        gone = ShellTask("gone", "echo 3 > marker", removes="no-such-file")
+        home = ShellTask("home", "echo 4 > ~/other", removes="~/marker")
+        with_dependencies(first | again | gone | home)
+    root = _sandbox_root()
+    try:
+        ea = LocalExecutionAgent(config_model_instance=C002(default_task_role=NS002.r),
+                                 namespace_model_instance=ns,
+                                 sandbox_root=root)
+        ea.perform_config()
+        assert open(os.path.join(root, "box", "marker")).read().strip() == "1"
+        assert open(os.path.join(root, "box", "other")).read().strip() == "4"
+    finally:
+        shutil.rmtree(root)
+        
+        
+def test003():
+    "test003: copies land in the sandbox, with Vars processed for ProcessCopyFileTask"
+    class NS003(NamespaceModel):
+        with_variables(Var("PORT", "8080"))
+        r = Role("r", host_ref="box")
+    ns = NS003()
+    
+    src_dir = tempfile.mkdtemp()
+    template = os.path.join(src_dir, "app.conf")
+    with open(template, "w") as f:
+        f.write("port=!{PORT}\n")
+        
+    class C003(ConfigModel):
+        plain = CopyFileTask("plain", "conf/plain.txt", content="just text\n",
+                             mode="0600")
+        processed = ProcessCopyFileTask("processed", "conf/", src=template)
+        keep = CopyFileTask("keep", "conf/plain.txt", content="replaced\n",
+                            force=False)
+        with_dependencies(plain | processed | keep)
+    root = _sandbox_root()
+    try:
+        ea = LocalExecutionAgent(config_model_instance=C003(default_task_role=NS003.r),
+                                 namespace_model_instance=ns,
+                                 sandbox_root=root)
+        ea.perform_config()
+        plain = os.path.join(root, "box", "conf", "plain.txt")
+        assert open(plain).read() == "just text\n"
+        assert stat.S_IMODE(os.stat(plain).st_mode) == 0600
+        assert open(os.path.join(root, "box", "conf", "app.conf")).read() == "port=8080\n"
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(src_dir)
+        
+        
+def test004():
+    "test004: a failing command aborts the run and is reported"
+    class NS004(NamespaceModel):
+        r = Role("r", host_ref="box")
+    ns = NS004()
+    
+    class C004(ConfigModel):
+        ok = CommandTask("ok", "/bin/true")
+        bad = ShellTask("bad", "exit 3")
+        never = CommandTask("never", "/bin/touch never")
+        with_dependencies(ok | bad | never)
+    root = _sandbox_root()
+    try:
+        ea = LocalExecutionAgent(config_model_instance=C004(default_task_role=NS004.r),
+                                 namespace_model_instance=ns,
+                                 sandbox_root=root)
+        try:
+            ea.perform_config()
+            assert False, "the config should have failed"
+        except ExecutionException, _:
+            pass
+        aborted = ea.get_aborted_tasks()
+        assert len(aborted) == 1
+        task, _, value, _ = aborted[0]
+        assert task.name == "bad"
+        assert "return code: 3" in value.message
+        assert not os.path.exists(os.path.join(root, "box", "never"))
+    finally:
+        shutil.rmtree(root)
+        
+        
+def test005():
+    "test005: commands can be replaced, and scripts are run"
+    class NS005(NamespaceModel):
+        r = Role("r", host_ref="box")
+    ns = NS005()
+    
+    script_dir = tempfile.mkdtemp()
+    script = os.path.join(script_dir, "script.sh")
+    with open(script, "w") as f:
+        f.write("echo $1 > $ACTUATOR_SANDBOX/from-script\n")
+    
+    class C005(ConfigModel):
+        install = CommandTask("install", "/usr/bin/sudo apt-get -y install something")
+        run = ScriptTask("run", "%s arg1" % script)
+        with_dependencies(install | run)
+    root = _sandbox_root()
+    try:
+        ea = LocalExecutionAgent(config_model_instance=C005(default_task_role=NS005.r),
+                                 namespace_model_instance=ns,
+                                 sandbox_root=root,
+                                 commands={"/usr/bin/sudo":"/bin/true"})
+        ea.perform_config()
+        assert open(os.path.join(root, "box", "from-script")).read() == "arg1\n"
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(script_dir)
+        
+        
+def test006():
+    "test006: a temporary sandbox root is removed after the run"
+    class NS006(NamespaceModel):
+        r = Role("r", host_ref="box")
+    ns = NS006()
+    
+    class C006(ConfigModel):
+        touch = CommandTask("touch", "/bin/touch afile")
+    ea = LocalExecutionAgent(config_model_instance=C006(default_task_role=NS006.r),
+                             namespace_model_instance=ns)
+    ea.perform_config()
+    assert ea.sandbox_root is None and not ea.sandboxes
+
+
+def test007():
+    "test007: absolute paths go in each host's sandbox unless asked otherwise"
+    class NS007(NamespaceModel):
+        nodes = MultiRole(Role("node", host_ref="10.0.7.!{NODE}",
+                               variables=[Var("NODE", ctxt.name)]))
+    ns = NS007()
+    for i in range(2):
+        _ = ns.nodes[i]
+    real = _sandbox_root()
+    
+    class C007(ConfigModel):
+        hosts = CopyFileTask("hosts", "/etc/actuator-hosts", content="!{NODE}\n")
+        skipped = ShellTask("skipped", "echo no > skipped", creates="/etc/actuator-hosts")
+        shared = CopyFileTask("shared", os.path.join(real, "shared"), content="x")
+        with_dependencies(hosts | skipped | shared)
+        
+    class Top007(ConfigModel):
+        per_node = MultiTask("per_node", ConfigClassTask("suite", C007),
+                             NS007.q.nodes.all())
+    root = _sandbox_root()
+    try:
+        ea = LocalExecutionAgent(config_model_instance=Top007(),
+                                 namespace_model_instance=ns,
+                                 sandbox_root=root)
+        ea.perform_config()
+        for i in range(2):
+            sandbox = os.path.join(root, "10.0.7.%d" % i)
+            path = os.path.join(sandbox, "etc", "actuator-hosts")
+            assert open(path).read().strip() == str(i)
+            assert not os.path.exists(os.path.join(sandbox, "skipped"))
+            assert os.path.exists(os.path.join(sandbox, real.lstrip("/"), "shared"))
+        assert not os.path.exists("/etc/actuator-hosts")
+        assert not os.path.exists(os.path.join(real, "shared"))
+        
+        class Shared007(ConfigModel):
+            shared = CopyFileTask("shared", os.path.join(real, "shared"), content="x")
+        ea = LocalExecutionAgent(config_model_instance=Shared007(default_task_role=ns.nodes[0]),
+                                 namespace_model_instance=ns,
+                                 sandbox_root=root, absolute_paths=True)
+        ea.perform_config()
+        assert open(os.path.join(real, "shared")).read() == "x"
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(real)
+
+
+def do_all():
+    for k, v in globals().items():
+        if k.startswith("test") and callable(v):
+            v()
+            
+if __name__ == "__main__":
+    do_all()
@@ -327,6 +327,258 @@ def test20():
     assert len(v.get_value(ns.s[0]).split(" ")) == 5
     
 
+def test21():
+    class Infra(InfraModel):
+        clusters = MultiComponentGroup("cluster",
+                                       leader=Server("leader", mem="8GB"),
+                                       workers=MultiComponent(Server("worker", mem="8GB")))
+    infra = Infra("infra")
+    qexp = Infra.q.clusters.key("NY").workers.keyin([1, 3, 5, 99])
+    for i in ["NY", "LN"]:
+        cluster = infra.clusters[i]
+        for j in range(10):
+            _ = cluster.workers[j]
+    ctxt = CallContext(infra, FakeReference("wibble"))
+    result = qexp(ctxt)
+    assert result == set([infra.clusters["NY"].workers[k] for k in (1, 3, 5)])
+    
+def test22():
+    class Infra(InfraModel):
+        workers = MultiComponent(Server("worker", mem="8GB"))
+    infra = Infra("infra")
+    calls = []
+    def odds_only(key):
+        calls.append(key)
+        return int(key) % 2 == 1
+    qexp = Infra.q.workers.keyin(range(5)).pred(odds_only)
+    for j in range(100):
+        _ = infra.workers[j]
+    ctxt = CallContext(infra, FakeReference("wibble"))
+    result = qexp(ctxt)
+    assert len(result) == 2
+    assert sorted(calls) == ["0", "1", "2", "3", "4"], "predicate saw: %s" % calls
+    
+def test23():
+    class Infra(InfraModel):
+        workers = MultiComponent(Server("worker", mem="8GB"))
+    infra = Infra("infra")
+    calls = []
+    def all_keys(key):
+        calls.append(key)
+        return True
+    qexp = Infra.q.workers.pred(all_keys)
+    for j in range(10):
+        _ = infra.workers[j]
+    ctxt = CallContext(infra, FakeReference("wibble"))
+    assert len(qexp(ctxt)) == 10
+    assert len(qexp(ctxt)) == 10
+    assert len(calls) == 10, "cached selection was re-evaluated"
+    _ = infra.workers[10]
+    assert len(qexp(ctxt)) == 11
+    assert len(calls) == 21
+    
+def test24():
+    class Infra(InfraModel):
+        clusters = MultiComponentGroup("cluster",
+                                       workers=MultiComponent(Server("worker", mem="8GB")))
+    infra = Infra("infra")
+    qexp = Infra.q.clusters.workers
+    _ = infra.clusters["NY"].workers[0]
+    ctxt = CallContext(infra, FakeReference("wibble"))
+    assert len(qexp(ctxt)) == 1
+    _ = infra.clusters["NY"].workers[1]
+    assert len(qexp(ctxt)) == 2
+    _ = infra.clusters["LN"].workers[0]
+    assert len(qexp(ctxt)) == 3
+    
+def test25():
+    class Infra(InfraModel):
+        workers = MultiComponent(Server("worker", mem="8GB"))
+    infra1 = Infra("infra1")
+    infra2 = Infra("infra2")
+    qexp = Infra.q.workers.key(2)
+    for j in range(3):
+        _ = infra1.workers[j]
+    _ = infra2.workers[0]
+    assert len(qexp(CallContext(infra1, FakeReference("wibble")))) == 1
+    assert len(qexp(CallContext(infra2, FakeReference("wibble")))) == 0
+    result = qexp(CallContext(infra1, FakeReference("wibble")))
+    result.clear()
+    assert len(qexp(CallContext(infra1, FakeReference("wibble")))) == 1
+    
+
+def test26():
+    class Infra(InfraModel):
+        slaves = MultiComponent(Server("slave", mem="8GB"))
+    infra = Infra("infra")
+    for j in range(300):
+        _ = infra.slaves[j]
+    ctxt = CallContext(infra, FakeReference("wibble"))
+    result = Infra.q.slaves.range(100, 200)(ctxt)
+    assert result == set([infra.slaves[i] for i in range(100, 200)])
+    
+def test27():
+    class Infra(InfraModel):
+        slaves = MultiComponent(Server("slave", mem="8GB"))
+    infra = Infra("infra")
+    for r in range(5):
+        for j in range(10):
+            _ = infra.slaves["rack%d-%d" % (r, j)]
+    ctxt = CallContext(infra, FakeReference("wibble"))
+    result = Infra.q.slaves.prefix("rack3-")(ctxt)
+    assert result == set([infra.slaves["rack3-%d" % j] for j in range(10)])
+    
+def test28():
+    class Infra(InfraModel):
+        slaves = MultiComponent(Server("slave", mem="8GB"))
+    infra = Infra("infra")
+    for j in range(20):
+        _ = infra.slaves[j]
+    _ = infra.slaves["x"]
+    assert list(infra.slaves.key_range(5, 8)) == ["5", "6", "7"]
+    assert list(infra.slaves.key_range(18)) == ["18", "19"]
+    assert list(infra.slaves.key_range("1", "12")) == ["1", "10", "11"]
+    assert list(infra.slaves.key_prefix("1")) == ["1"] + [str(i) for i in range(10, 20)]
+    _ = infra.slaves[100]
+    assert list(infra.slaves.key_prefix("10")) == ["10", "100"]
+    assert list(infra.slaves.key_range(99, 1000)) == ["100"]
+    
+def test29():
+    class Infra(InfraModel):
+        clusters = MultiComponentGroup("cluster",
+                                       workers=MultiComponent(Server("worker", mem="8GB")))
+    infra = Infra("infra")
+    for c in ["rack1-a", "rack1-b", "rack2-a"]:
+        for j in range(10):
+            _ = infra.clusters[c].workers[j]
+    ctxt = CallContext(infra, FakeReference("wibble"))
+    qexp = Infra.q.clusters.prefix("rack1-").workers.range(2, 4).keyin([3, 9])
+    assert qexp(ctxt) == set([infra.clusters["rack1-a"].workers[3],
+                              infra.clusters["rack1-b"].workers[3]])
+    
+def test30():
+    class Infra(InfraModel):
+        slaves = MultiComponent(Server("slave", mem="8GB"))
+    infra = Infra("infra")
+    for j in range(5):
+        _ = infra.slaves[j]
+    values = infra.slaves.viewvalues()
+    items = infra.slaves.viewitems()
+    assert not isinstance(values, list) and not isinstance(items, list)
+    assert len(values) == 5 and len(items) == 5
+    assert infra.slaves[3] in values and ("3", infra.slaves[3]) in items
+    assert "4" in infra.slaves.viewkeys() and "5" not in infra.slaves.viewkeys()
+    for k in infra.slaves.viewkeys():
+        _ = infra.slaves[k + "0"]
+    assert len(infra.slaves) == 10
+
+
+def test31():
+    class Infra(InfraModel):
+        slaves = MultiComponent(Server("slave", mem="8GB"))
+    infra = Infra("infra")
+    expr = ctxt.model.slaves[ctxt.name]
+    assert expr._ce_steps is None
+    ref = expr(CallContext(infra, infra.slaves[3]))
+    assert ref is infra.slaves[3]
+    steps = expr._ce_steps
+    assert len(steps) == 3
+    assert expr(CallContext(infra, infra.slaves[4])) is infra.slaves[4]
+    assert expr._ce_steps is steps
+    
+def test32():
+    from actuator.modeling import ContextExpr
+    class Infra(InfraModel):
+        server = Server("server", mem="8GB")
+        slaves = MultiComponent(Server("slave", mem="8GB"))
+    infra = Infra("infra")
+    expr = ctxt.model.server
+    ctx = CallContext(infra, infra.slaves[1])
+    ContextExpr.cache_fixed_results = True
+    try:
+        assert expr(ctx) is infra.server
+        assert not expr._results(ctx), "cached an unfixed result"
+        infra.server.fix_arguments()
+        assert expr(ctx) is infra.server
+        assert expr._results(ctx)[(expr, infra.slaves[1])] is infra.server
+        assert expr(ctx) is infra.server
+        #the cache is the model's, not the expression's
+        assert "_ce_results" not in expr.__dict__
+        other = Infra("other")
+        assert expr._results(CallContext(other, other.slaves[1])) is None
+    finally:
+        ContextExpr.cache_fixed_results = False
+        
+def test33():
+    class Infra(InfraModel):
+        server = Server("server", mem="8GB")
+    infra = Infra("infra")
+    infra.server.fix_arguments()
+    expr = ctxt.model.server
+    ctx = CallContext(infra, None)
+    _ = expr(ctx)
+    assert not expr._results(ctx), "cached results while caching is off"
+    
+def test34():
+    class Infra(InfraModel):
+        clusters = MultiComponentGroup("cluster",
+                                       workers=MultiComponent(Server("worker", mem="8GB")))
+    infra = Infra("infra")
+    for c in ["rack1-a", "rack2-a"]:
+        for j in range(3):
+            _ = infra.clusters[c].workers[j]
+    ctx = CallContext(infra, FakeReference("wibble"))
+    clusters = Infra.q.clusters
+    workers = clusters.workers
+    assert len(workers(ctx)) == 6
+    #tests added after an evaluation, to the element or one it hangs from,
+    #apply to the next one
+    workers.keyin([0, 1])
+    assert len(workers(ctx)) == 4
+    clusters.prefix("rack1-")
+    assert workers(ctx) == set([infra.clusters["rack1-a"].workers[0],
+                                infra.clusters["rack1-a"].workers[1]])
+    
+def test35():
+    class Infra(InfraModel):
+        slaves = MultiComponent(Server("slave", mem="8GB"))
+    infra = Infra("infra")
+    for j in range(5):
+        _ = infra.slaves[j]
+    keys = infra.slaves.keys()
+    values = infra.slaves.values()
+    items = infra.slaves.items()
+    assert isinstance(keys, list) and isinstance(values, list) and isinstance(items, list)
+    assert sorted(keys) == ["0", "1", "2", "3", "4"]
+    assert values[items.index(("3", infra.slaves[3]))] is infra.slaves[3]
+    
+def test36():
+    import gc
+    import weakref
+    from actuator.modeling import AbstractModelReference
+    class Infra(InfraModel):
+        slaves = MultiComponent(Server("slave", mem="8GB"))
+    sel = Infra.q.slaves.all()
+    #the reference caches keep every model they've navigated; put them
+    #back as they were so that only the selection cache could keep it
+    inst_cache = dict(AbstractModelReference._inst_cache)
+    inv_cache = dict(AbstractModelReference._inv_cache)
+    try:
+        infra = Infra("infra")
+        for j in range(3):
+            _ = infra.slaves[j]
+        assert len(sel(CallContext(infra, FakeReference("wibble")))) == 3
+        assert len(sel(CallContext(infra, FakeReference("wibble")))) == 3
+        wref = weakref.ref(infra)
+        del infra, _
+    finally:
+        AbstractModelReference._inst_cache.clear()
+        AbstractModelReference._inst_cache.update(inst_cache)
+        AbstractModelReference._inv_cache.clear()
+        AbstractModelReference._inv_cache.update(inv_cache)
+    gc.collect()
+    assert wref() is None, "the selection cache kept the model alive"
+
 def do_all():
     setup()
     test19()
@@ -29,6 +29,9 @@ end of the list of tests, and never inserted in between existing tests.
 Created on 25 Aug 2014
 '''
 
+import time
+import threading
+
 import ost_support
 from actuator.provisioners.openstack import openstack_class_factory as ocf
 from actuator.namespace import NamespaceModel, with_variables
@@ -438,6 +441,676 @@ def test030():
     prov.provision_infra_model(inst)
     assert ns.future("SERVER_IP").value()
 
+def test031():
+    class CountingNovaClient(ost_support.MockNovaClient):
+        made = 0
+        def __init__(self, *args, **kwargs):
+            #stands in for the Keystone round-trip of a real client
+            time.sleep(0.01)
+            CountingNovaClient.made += 1
+            super(CountingNovaClient, self).__init__(*args, **kwargs)
+    ocf.set_nova_client_class(CountingNovaClient)
+    try:
+        provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                           num_threads=3, log_level=LOG_INFO)
+        class Test31(InfraModel):
+            grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small",
+                                        key_name="perseverance_dev_key"))
+        model = Test31("t31")
+        for i in range(12):
+            _ = model.grid[i]
+        provisioner.provision_infra_model(model)
+        pool = provisioner.agent.nova_pool
+        #one per worker plus one for the server poller
+        assert CountingNovaClient.made <= 4, "made %d clients" % CountingNovaClient.made
+        assert pool.creations == CountingNovaClient.made
+        assert pool.requests >= 12
+    finally:
+        ocf.set_nova_client_class(ost_support.MockNovaClient)
+        
+def test032():
+    from actuator.provisioners.openstack.support import ClientPool
+    made = []
+    pool = ClientPool(lambda: made.append(1) or len(made), size=2, max_age=None)
+    assert pool.get() == 1 and pool.get() == 1
+    results = []
+    def grab():
+        results.append(pool.get())
+    threads = [threading.Thread(target=grab) for _ in range(3)]
+    for t in threads:
+        t.start()
+        t.join()
+    assert results == [2, 3, 4] and len(pool.clients) == 2
+    
+def test033():
+    from actuator.provisioners.openstack.support import ClientPool
+    made = []
+    pool = ClientPool(lambda: made.append(1) or len(made), max_age=0.05)
+    assert pool.get() == 1 and pool.get() == 1
+    time.sleep(0.1)
+    assert pool.get() == 2 and pool.creations == 2
+
+
+def test034():
+    class ListCountingNovaClient(ost_support.MockNovaClient):
+        list_calls = 0
+        def image_list_result(self):
+            ListCountingNovaClient.list_calls += 1
+            return super(ListCountingNovaClient, self).image_list_result()
+        def flavor_list_result(self):
+            ListCountingNovaClient.list_calls += 1
+            return super(ListCountingNovaClient, self).flavor_list_result()
+        def network_list_result(self):
+            ListCountingNovaClient.list_calls += 1
+            return super(ListCountingNovaClient, self).network_list_result()
+    ocf.set_nova_client_class(ListCountingNovaClient)
+    try:
+        provisioner = get_provisioner()
+        class Test34(InfraModel):
+            grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small",
+                                        nics=["wibbleNet"],
+                                        key_name="perseverance_dev_key"))
+        model = Test34("t34")
+        for i in range(30):
+            _ = model.grid[i]
+        provisioner.provision_infra_model(model)
+        assert ListCountingNovaClient.list_calls == 3, \
+            "%d list calls" % ListCountingNovaClient.list_calls
+    finally:
+        ocf.set_nova_client_class(ost_support.MockNovaClient)
+        
+def test035():
+    from actuator.provisioners.openstack.support import _OSMaps
+    class SlowSource(object):
+        calls = 0
+        class Images(object):
+            def list(self):
+                SlowSource.calls += 1
+                time.sleep(0.1)
+                return ost_support.MockNovaClient._image_list
+        class Client(object):
+            pass
+        nvclient = Client()
+        nvclient.images = Images()
+    maps = _OSMaps(SlowSource(), ttls={_OSMaps.IMAGES:60})
+    threads = [threading.Thread(target=maps.refresh_images) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert SlowSource.calls == 1 and maps.image_map
+    maps.refresh_images()
+    assert SlowSource.calls == 1
+    maps.invalidate(_OSMaps.IMAGES)
+    maps.refresh_images()
+    assert SlowSource.calls == 2
+    
+def test036():
+    from actuator.provisioners.openstack.support import _OSMaps
+    class Source(object):
+        calls = 0
+        class Flavors(object):
+            def list(self):
+                Source.calls += 1
+                return ost_support.MockNovaClient._flavor_list
+        class Client(object):
+            pass
+        nvclient = Client()
+        nvclient.flavors = Flavors()
+    maps = _OSMaps(Source(), ttls={_OSMaps.FLAVORS:60})
+    assert maps.lookup(_OSMaps.FLAVORS, "m1.small") is not None
+    assert Source.calls == 1
+    assert maps.lookup(_OSMaps.FLAVORS, "no-such-flavor") is None
+    assert Source.calls == 2
+    uncached = _OSMaps(Source())
+    uncached.refresh_flavors()
+    uncached.refresh_flavors()
+    assert Source.calls == 4
+
+
+def test037():
+    class SlowBootServers(ost_support.ServerCreate):
+        #servers only get an address after a few polls
+        def list(self):
+            servers = super(SlowBootServers, self).list()
+            for s in servers:
+                s.polls = getattr(s, "polls", 0) + 1
+                if s.polls > 3 and not s.addresses:
+                    s.addresses = s.real_addresses
+            return servers
+    class SlowBootNovaClient(ost_support.MockNovaClient):
+        def __init__(self, *args, **kwargs):
+            super(SlowBootNovaClient, self).__init__(*args, **kwargs)
+            self.servers = SlowBootServers(self.slow_server_create_result)
+        def slow_server_create_result(self, *args, **kwargs):
+            server = self.server_create_result(*args, **kwargs)
+            server.real_addresses, server.addresses = server.addresses, {}
+            return server
+    ocf.set_nova_client_class(SlowBootNovaClient)
+    try:
+        provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                           num_threads=2, log_level=LOG_INFO)
+        class Test37(InfraModel):
+            grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small",
+                                        key_name="perseverance_dev_key"))
+        model = Test37("t37")
+        for i in range(10):
+            _ = model.grid[i]
+        provisioner.provision_infra_model(model)
+        assert all(model.grid[i].iface0.addr0.value() for i in range(10))
+        #far fewer polls than one per server per cycle
+        assert provisioner.agent.poller.list_calls < 40
+    finally:
+        ocf.set_nova_client_class(ost_support.MockNovaClient)
+        
+def test038():
+    from actuator.provisioners.openstack.support import ServerReadinessPoller
+    class Srvr(object):
+        def __init__(self, id, status, addresses):
+            self.id = id
+            self.status = status
+            self.addresses = addresses
+    class Servers(object):
+        def list(self):
+            return [Srvr("a", "ERROR", {}), Srvr("b", "BUILD", {}),
+                    Srvr("c", "ACTIVE", {"net":[{"addr":"1.2.3.4"}]})]
+    class Client(object):
+        servers = Servers()
+    poller = ServerReadinessPoller(lambda: Client(), timeout=0.3,
+                                   min_interval=0.05, max_interval=0.1)
+    fa, fb, fc = poller.watch("a"), poller.watch("b"), poller.watch("c")
+    assert fc.wait(2) and fc.exception is None and fc.result.id == "c"
+    assert fa.wait(2) and isinstance(fa.exception, ProvisionerException)
+    assert fb.wait(2) and "Timed out" in str(fb.exception)
+    fd = poller.watch("d")
+    poller.stop()
+    assert fd.wait(1) and fd.exception is not None
+
+
+def test039():
+    creates = []
+    class CountingServers(ost_support.ServerCreate):
+        def create(self, *args, **kwargs):
+            creates.append(kwargs.get("max_count"))
+            return super(CountingServers, self).create(*args, **kwargs)
+    class BatchNovaClient(ost_support.MockNovaClient):
+        def __init__(self, *args, **kwargs):
+            super(BatchNovaClient, self).__init__(*args, **kwargs)
+            self.servers = CountingServers(self.server_create_result)
+    ocf.set_nova_client_class(BatchNovaClient)
+    try:
+        provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                           log_level=LOG_INFO,
+                                           batch_servers=True)
+        class Test39(InfraModel):
+            net = Network("wibble")
+            grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small",
+                                        nics=[ctxt.model.net],
+                                        key_name="perseverance_dev_key"))
+            fip = FloatingIP("fip", ctxt.model.grid[0],
+                             ctxt.model.grid[0].iface0.addr0, pool="external")
+        model = Test39("t39")
+        for i in range(8):
+            _ = model.grid[i]
+        record = provisioner.provision_infra_model(model)
+        assert creates == [8], str(creates)
+        osids = set([model.grid[i].osid.value() for i in range(8)])
+        assert len(osids) == 8
+        assert set(record.server_ids.values()) == osids
+        assert all(model.grid[i].iface0.addr0.value() for i in range(8))
+        assert model.fip.ip.value()
+        names = sorted([model.grid[i].provisionedName.value() for i in range(8)])
+        assert names == sorted(["grid-%d" % i for i in range(1, 9)]), str(names)
+    finally:
+        ocf.set_nova_client_class(ost_support.MockNovaClient)
+        
+def test040():
+    from actuator.provisioners.openstack.resource_tasks import (ResourceTaskSequencerAgent,
+                                                                OpenstackCredentials,
+                                                                ProvisionServerGroupTask)
+    class Test40(InfraModel):
+        small = MultiResource(Server("small", u"Ubuntu 13.10", "m1.small"))
+        large = MultiResource(Server("large", u"Ubuntu 13.10", "m1.large"))
+        counted = MultiResource(Server("counted", u"Ubuntu 13.10", "m1.small",
+                                       min_count=1, max_count=1))
+        lonely = Server("lonely", u"Ubuntu 13.10", "m1.medium")
+    model = Test40("t40")
+    for i in range(3):
+        _ = model.small[i]
+        _ = model.large[i]
+        _ = model.counted[i]
+    creds = OpenstackCredentials("it", "just", "doesn't", "matter")
+    agent = ResourceTaskSequencerAgent(model, creds, batch_servers=True,
+                                       poll_servers=False)
+    tasks = agent.get_graph().nodes()
+    groups = [t for t in tasks if isinstance(t, ProvisionServerGroupTask)]
+    assert len(groups) == 2
+    assert sorted([len(g.member_ids) for g in groups]) == [3, 3]
+    #3 counted servers, the lonely one, and the two groups
+    assert len(tasks) == 6, str([t.name for t in tasks])
+    unbatched = ResourceTaskSequencerAgent(model, creds, poll_servers=False)
+    assert len(unbatched.get_graph().nodes()) == 10
+        
+def test041():
+    class ShortServers(ost_support.ServerCreate):
+        def create(self, name, image, flavor, max_count=None, **kwargs):
+            #the last server never makes it
+            return super(ShortServers, self).create(name, image, flavor,
+                                                    max_count=max_count - 1,
+                                                    **kwargs)
+    class ShortNovaClient(ost_support.MockNovaClient):
+        def __init__(self, *args, **kwargs):
+            super(ShortNovaClient, self).__init__(*args, **kwargs)
+            self.servers = ShortServers(self.server_create_result)
+    ocf.set_nova_client_class(ShortNovaClient)
+    try:
+        provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                           log_level=LOG_INFO,
+                                           batch_servers=True)
+        class Test41(InfraModel):
+            grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small"))
+        model = Test41("t41")
+        for i in range(4):
+            _ = model.grid[i]
+        try:
+            provisioner.provision_infra_model(model)
+            assert False, "a short batch should have raised"
+        except ProvisionerException, _:
+            pass
+        #the servers that did get created are still recorded for cleanup
+        assert len(provisioner.agent.record.server_ids) == 3
+    finally:
+        ocf.set_nova_client_class(ost_support.MockNovaClient)
+
+
+def _make_deprov_model(name):
+    from actuator.provisioners.openstack.resources import (RouterGateway,
+                                                            RouterInterface)
+    class DeprovModel(InfraModel):
+        net = Network("wibble")
+        subnet = Subnet("dp_subnet", ctxt.model.net, u"192.168.23.0/24",
+                        dns_nameservers=[u'8.8.8.8'])
+        router = Router("dp_router")
+        gateway = RouterGateway("dp_gateway", ctxt.model.router, "external")
+        interface = RouterInterface("dp_inter", ctxt.model.router,
+                                    ctxt.model.subnet)
+        secgroup = SecGroup("wibbleGroup", description="stuff")
+        ping = SecGroupRule("pingRule", ctxt.model.secgroup,
+                            ip_protocol="icmp", from_port=-1, to_port=-1)
+        grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small",
+                                    nics=[ctxt.model.net],
+                                    security_groups=[ctxt.model.secgroup]))
+        fip = FloatingIP("fip", ctxt.model.grid[0],
+                         ctxt.model.grid[0].iface0.addr0, pool="external")
+    model = DeprovModel(name)
+    for i in range(4):
+        _ = model.grid[i]
+    return model
+
+def test042():
+    import networkx as nx
+    from actuator.provisioners.openstack.resource_tasks import (DeprovisioningTaskSequencerAgent,
+                                                                OpenstackCredentials)
+    provisioner = get_provisioner()
+    record = provisioner.provision_infra_model(_make_deprov_model("t42"))
+    assert record.port_ids and record.secgroup_rule_ids
+    creds = OpenstackCredentials("it", "just", "doesn't", "matter")
+    agent = DeprovisioningTaskSequencerAgent(record, creds)
+    graph = agent.get_graph()
+    by_kind = {}
+    for t in graph.nodes():
+        by_kind.setdefault(getattr(t, "record_attr", None), []).append(t)
+    def before(first, then):
+        return all([nx.has_path(graph, f, t)
+                    for f in by_kind[first] for t in by_kind[then]])
+    assert len(by_kind["server_ids"]) == 4
+    assert before("floating_ip_ids", "server_ids")
+    assert before("server_ids", "network_ids")
+    assert before("server_ids", "secgroup_ids")
+    assert before("server_ids", "subnet_ids")
+    assert before("router_iface_ids", "subnet_ids")
+    assert before("router_iface_ids", "router_ids")
+    assert before("subnet_ids", "network_ids")
+    assert before("secgroup_rule_ids", "secgroup_ids")
+    #servers can all go at once
+    assert not [s for s in by_kind["server_ids"]
+                if [t for t in by_kind["server_ids"] if nx.has_path(graph, s, t) and s is not t]]
+    
+def test043():
+    provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                       log_level=LOG_INFO, deprovision_threads=8)
+    record = provisioner.provision_infra_model(_make_deprov_model("t43"))
+    server_ids = set(record.server_ids.values())
+    del ost_support.MockNeutronClient.deleted[:]
+    result = provisioner.deprovision_infra_from_record(record)
+    assert result is record
+    for attr in ("network_ids", "subnet_ids", "floating_ip_ids", "router_ids",
+                 "router_iface_ids", "secgroup_ids", "secgroup_rule_ids",
+                 "server_ids", "port_ids"):
+        assert not getattr(record, attr), attr
+    assert server_ids <= ost_support.ServerCreate.gone
+    assert provisioner.agent.num_threads == 8
+    order = [m for m, _ in ost_support.MockNeutronClient.deleted]
+    assert order.index("remove_interface_router") < order.index("delete_subnet")
+    assert order.index("remove_interface_router") < order.index("delete_router")
+    assert order.index("remove_gateway_router") < order.index("delete_router")
+    assert order.index("delete_subnet") < order.index("delete_network")
+    
+def test044():
+    class StuckServers(ost_support.ServerCreate):
+        def delete(self, server_id):
+            raise Exception("Can't delete %s right now" % server_id)
+    class StuckNovaClient(ost_support.MockNovaClient):
+        def __init__(self, *args, **kwargs):
+            super(StuckNovaClient, self).__init__(*args, **kwargs)
+            self.servers = StuckServers(self.server_create_result)
+    class GoneFIPs(ost_support.Create):
+        def delete(self, osid):
+            raise ost_support.MockNotFound("No floating ip %s" % osid)
+    provisioner = get_provisioner()
+    record = provisioner.provision_infra_model(_make_deprov_model("t44"))
+    ocf.set_nova_client_class(StuckNovaClient)
+    try:
+        try:
+            provisioner.deprovision_infra_from_record(record)
+            assert False, "undeletable servers should have raised"
+        except ProvisionerException, _:
+            pass
+    finally:
+        ocf.set_nova_client_class(ost_support.MockNovaClient)
+    #what was deleted before the servers is gone; the rest is left in the
+    #record so deprovisioning can be retried
+    assert not record.floating_ip_ids
+    assert len(record.server_ids) == 4
+    assert record.network_ids and record.subnet_ids and record.secgroup_ids
+    #a record whose resources are already gone deprovisions cleanly
+    class GoneNovaClient(ost_support.MockNovaClient):
+        def __init__(self, *args, **kwargs):
+            super(GoneNovaClient, self).__init__(*args, **kwargs)
+            self.floating_ips = GoneFIPs(None)
+    record.add_floating_ip_id("gone-fip", "osid-of-gone-fip")
+    ocf.set_nova_client_class(GoneNovaClient)
+    try:
+        provisioner.deprovision_infra_from_record(record)
+    finally:
+        ocf.set_nova_client_class(ost_support.MockNovaClient)
+    assert not record.server_ids and not record.network_ids
+    assert not record.floating_ip_ids
+
+
+def test045():
+    import pickle
+    from actuator.provisioners.openstack.support import OpenstackProvisioningRecord
+    rec = OpenstackProvisioningRecord("r45")
+    rec.add_server_id("rid1", "os1")
+    rec.add_secgroup_rule_id("rid2", "os2")
+    rec2 = pickle.loads(pickle.dumps(rec))
+    assert rec2.id == "r45"
+    assert rec2.server_ids == {"rid1":"os1"}
+    assert rec2.secgroup_rule_ids == {"rid2":"os2"}
+    assert rec2.journal is None
+    
+def _make_journal_model(name):
+    class JournalModel(InfraModel):
+        net = Network("wibble")
+        grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small",
+                                    nics=[ctxt.model.net]))
+        fip = FloatingIP("fip", ctxt.model.grid[0],
+                         ctxt.model.grid[0].iface0.addr0, pool="external")
+    model = JournalModel(name)
+    for i in range(8):
+        _ = model.grid[i]
+    return model
+    
+def test046():
+    import os
+    import tempfile
+    from actuator.provisioners.openstack.support import load_journal
+    created = []
+    class FlakyServers(ost_support.ServerCreate):
+        def create(self, *args, **kwargs):
+            if args[0] in ("grid_5", "grid_6"):
+                raise Exception("no capacity for %s" % args[0])
+            created.append(args[0])
+            return super(FlakyServers, self).create(*args, **kwargs)
+    class FlakyNovaClient(ost_support.MockNovaClient):
+        def __init__(self, *args, **kwargs):
+            super(FlakyNovaClient, self).__init__(*args, **kwargs)
+            self.servers = FlakyServers(self.server_create_result)
+    fd, path = tempfile.mkstemp(suffix=".journal")
+    os.close(fd)
+    try:
+        ocf.set_nova_client_class(FlakyNovaClient)
+        try:
+            provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                               log_level=LOG_INFO, journal_path=path,
+                                               poll_servers=False)
+            try:
+                provisioner.provision_infra_model(_make_journal_model("t46"))
+                assert False, "servers should have failed"
+            except ProvisionerException, _:
+                pass
+        finally:
+            ocf.set_nova_client_class(ost_support.MockNovaClient)
+        state = load_journal(path)
+        assert "net" in state.done
+        first_run = dict([(k, v[0]) for k, v in state.done.items()])
+        assert "grid.5" not in first_run and "grid.6" not in first_run
+        del created[:]
+        ocf.set_nova_client_class(FlakyNovaClient)
+        FlakyServers.create = ost_support.ServerCreate.create.im_func
+        provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                           log_level=LOG_INFO, journal_path=path,
+                                           resume=True, poll_servers=False)
+        model = _make_journal_model("t46")
+        try:
+            record = provisioner.provision_infra_model(model)
+        finally:
+            ocf.set_nova_client_class(ost_support.MockNovaClient)
+        #only what wasn't done the first time was provisioned again
+        todo = len([k for k in first_run if k.startswith("grid.")])
+        assert len(provisioner.agent.get_graph().nodes()) == 10 - len(first_run)
+        for key, osid in first_run.items():
+            if key.startswith("grid."):
+                srvr = model.grid[int(key.split(".")[1])]
+                assert srvr.osid.value() == osid
+                assert srvr.iface0.addr0.value()
+        assert len(record.server_ids) == 8 and todo < 8
+        assert model.fip.ip.value()
+        #every resource was journaled as done by one run or the other, and the
+        #completed run marked the journal finished
+        assert len([l for l in open(path) if '"op": "done"' in l]) == 10
+        state = load_journal(path)
+        assert state.finished and not state.done
+    finally:
+        os.remove(path)
+        
+def test047():
+    import os
+    import tempfile
+    from actuator.provisioners.openstack.support import (ProvisioningJournal,
+                                                         load_journal)
+    fd, path = tempfile.mkstemp(suffix=".journal")
+    os.close(fd)
+    try:
+        j = ProvisioningJournal(path, sync_every=3, sync_interval=1000)
+        j.add_id("server_ids", "grid.0", "os-a")
+        j.add_done("grid.0", "os-a", {"addresses":{}})
+        j.add_id("server_ids", "grid.1", "os-b")
+        assert j.syncs == 1
+        j.close()
+        assert j.syncs == 2
+        #the second run dies part way through writing a line
+        j = ProvisioningJournal(path, resume=True)
+        j.add_id("server_ids", "grid.1", "os-c")
+        j.add_id("network_ids", "net", "os-n")
+        j.add_done("net", "os-n")
+        j.close()
+        with open(path, "a") as f:
+            f.write('{"op": "done", "key": "gr')
+        state = load_journal(path)
+        assert sorted(state.done.keys()) == ["grid.0", "net"]
+        assert state.done["net"] == ("os-n", {}, [("network_ids", "os-n")])
+        #os-b was left behind by the first run, os-c by the second
+        assert sorted(state.orphans) == [("server_ids", "grid.1", "os-b"),
+                                         ("server_ids", "grid.1", "os-c")]
+    finally:
+        os.remove(path)
+
+
+def test048():
+    import networkx as nx
+    from actuator.provisioners.openstack.resource_tasks import (ResourceTaskSequencerAgent,
+                                                                OpenstackCredentials)
+    class Test48(InfraModel):
+        net = Network("wibble")
+        grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small",
+                                    nics=[ctxt.model.net]))
+    model = Test48("t48")
+    for i in range(50):
+        _ = model.grid[i]
+    creds = OpenstackCredentials("it", "just", "doesn't", "matter")
+    agent = ResourceTaskSequencerAgent(model, creds, poll_servers=False)
+    graph = agent.get_graph()
+    assert isinstance(graph, nx.DiGraph)
+    assert len(graph.nodes()) == 51 and len(graph.edges()) == 50
+    #the tasks in the graph are the ones made for the model's own resources
+    assert (set([t.rsrc for t in graph.nodes()]) ==
+            set(model.components()))
+    agent.perform_config()
+    assert all([model.grid[i].osid.value() for i in range(50)])
+    
+def test049():
+    from actuator.provisioners.openstack.resource_tasks import (ResourceTaskSequencerAgent,
+                                                                OpenstackCredentials)
+    class Test49(InfraModel):
+        net1 = Network("wibble")
+        net2 = Network("wibble")
+    model = Test49("t49")
+    creds = OpenstackCredentials("it", "just", "doesn't", "matter")
+    agent = ResourceTaskSequencerAgent(model, creds, poll_servers=False)
+    t1, t2 = agent.get_graph().nodes()
+    try:
+        agent._make_graph([t1, t2], [(t1, t2), (t2, t1)])
+        assert False, "a cycle should have been caught"
+    except ProvisionerException, e:
+        assert "circular" in str(e)
+    
+def test050():
+    class Test50(InfraModel):
+        pass
+    record = get_provisioner().provision_infra_model(Test50("t50"))
+    assert not record.server_ids
+
+
+def test051():
+    #an adaptive pool provisions everything and stays within its bounds
+    provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                       log_level=LOG_INFO, num_threads=1,
+                                       max_threads=6)
+    record = provisioner.provision_infra_model(_make_deprov_model("t51"))
+    assert len(record.server_ids) == 4
+    sizer = provisioner.agent.pool_sizer
+    assert sizer is not None and 1 <= sizer.peak <= 6
+    assert provisioner.agent.nova_pool.size == 7
+
+
+def test052():
+    #servers of an identically named earlier batch aren't taken, and a batch
+    #that comes back with extra servers has all of them recorded
+    class ExtraServers(ost_support.ServerCreate):
+        def create(self, name, image, flavor, max_count=None, **kwargs):
+            return super(ExtraServers, self).create(name, image, flavor,
+                                                    max_count=max_count + 1,
+                                                    **kwargs)
+    class ExtraNovaClient(ost_support.MockNovaClient):
+        def __init__(self, *args, **kwargs):
+            super(ExtraNovaClient, self).__init__(*args, **kwargs)
+            self.servers = ExtraServers(self.server_create_result)
+    class Test52(InfraModel):
+        grid = MultiResource(Server("grid52", u"Ubuntu 13.10", "m1.small"))
+    first = Test52("t52a")
+    for i in range(3):
+        _ = first.grid[i]
+    provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                       log_level=LOG_INFO, batch_servers=True)
+    record = provisioner.provision_infra_model(first)
+    first_ids = set(record.server_ids.values())
+    assert len(first_ids) == 3
+    ocf.set_nova_client_class(ExtraNovaClient)
+    try:
+        second = Test52("t52b")
+        for i in range(3):
+            _ = second.grid[i]
+        provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                           log_level=LOG_INFO,
+                                           batch_servers=True)
+        try:
+            provisioner.provision_infra_model(second)
+            assert False, "a batch with extra servers should have raised"
+        except ProvisionerException, _:
+            pass
+        ids = set(provisioner.agent.record.server_ids.values())
+        assert len(ids) == 4 and not ids & first_ids
+    finally:
+        ocf.set_nova_client_class(ost_support.MockNovaClient)
+    
+def test053():
+    from actuator.provisioners.openstack.resource_tasks import (_DeprovisionServerTask,
+                                                                _DeprovisionRouterInterfaceTask,
+                                                                _DeprovisionPhaseTask)
+    for task in (_DeprovisionServerTask("s1", ["r1"], repeat_count=3),
+                 _DeprovisionRouterInterfaceTask("rt1", ["r2"], port_ids=["p1"],
+                                                 repeat_count=3),
+                 _DeprovisionPhaseTask("server", repeat_count=3)):
+        assert task._repeat_count == 3
+        args, kwargs = task.get_init_args()
+        assert task.__class__(*args, **kwargs)._repeat_count == 3
+    
+def test054():
+    #a resume only applies to a run that didn't complete; a completed run
+    #or a deprovisioned record leave nothing to restore
+    import os
+    import tempfile
+    from actuator.provisioners.openstack.support import (ProvisioningJournal,
+                                                         load_journal)
+    fd, path = tempfile.mkstemp(suffix=".journal")
+    os.close(fd)
+    try:
+        provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                           log_level=LOG_INFO, journal_path=path,
+                                           resume=True, poll_servers=False)
+        record = provisioner.provision_infra_model(_make_journal_model("t54"))
+        first_ids = set(record.server_ids.values())
+        state = load_journal(path)
+        assert state.finished and not state.done and not state.orphans
+        #a journal that's been finished doesn't restore anything
+        provisioner.deprovision_infra_from_record(record)
+        assert load_journal(path).finished
+        model = _make_journal_model("t54")
+        record = provisioner.provision_infra_model(model)
+        assert len(provisioner.agent.get_graph().nodes()) == 10
+        assert len(record.server_ids) == 8
+        assert not set(record.server_ids.values()) & first_ids
+        #a run after a finished one is resumable again
+        j = ProvisioningJournal(path, resume=True)
+        j.add_id("network_ids", "net", "os-n")
+        j.add_done("net", "os-n")
+        j.add_id("server_ids", "grid.0", "os-a")
+        j.close()
+        state = load_journal(path)
+        assert not state.finished and state.done.keys() == ["net"]
+        assert state.orphans == [("server_ids", "grid.0", "os-a")]
+        provisioner = OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                           log_level=LOG_INFO, journal_path=path,
+                                           poll_servers=False)
+        provisioner.deprovision_infra_from_record(record)
+        state = load_journal(path)
+        assert state.finished and not state.done and not state.orphans
+    finally:
+        os.remove(path)
+
+
 def do_all():
     for k, v in globals().items():
         if k.startswith("test") and callable(v):
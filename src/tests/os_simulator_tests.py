@@ -0,0 +1,154 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Created on 13 Jul 2014
+'''
+'''
+Tests for the simulated Openstack cloud
+'''
+from actuator import InfraModel, ProvisionerException, MultiResource, ctxt
+from actuator.provisioners.openstack import openstack_class_factory as ocf
+from actuator.provisioners.openstack.resource_tasks import OpenstackProvisioner
+from actuator.provisioners.openstack.resources import (Server, Network, Subnet,
+                                                        Router, RouterGateway,
+                                                        RouterInterface,
+                                                        FloatingIP, SecGroup,
+                                                        SecGroupRule)
+from actuator.provisioners.openstack.simulator import (SimulatedCloud,
+                                                       SimOverLimit,
+                                                       SimNotFound, constant,
+                                                       uniform)
+from actuator.utils import LOG_WARN
+
+
+def get_provisioner(**kwargs):
+    return OpenstackProvisioner("it", "just", "doesn't", "matter",
+                                log_level=LOG_WARN, **kwargs)
+
+
+class SimModel(InfraModel):
+    net = Network("sim_net")
+    subnet = Subnet("sim_subnet", ctxt.model.net, u"192.168.23.0/24",
+                    dns_nameservers=[u'8.8.8.8'])
+    router = Router("sim_router")
+    gateway = RouterGateway("sim_gateway", ctxt.model.router, "external")
+    iface = RouterInterface("sim_iface", ctxt.model.router, ctxt.model.subnet)
+    secgroup = SecGroup("sim_sg", "simulated")
+    ping = SecGroupRule("ping", ctxt.model.secgroup, ip_protocol="icmp",
+                        from_port=-1, to_port=-1)
+    grid = MultiResource(Server("grid", u"Ubuntu 13.10", "m1.small",
+                                nics=[ctxt.model.net],
+                                security_groups=[ctxt.model.secgroup]))
+    fip = FloatingIP("fip", ctxt.model.grid[0],
+                     ctxt.model.grid[0].iface0.addr0, pool="external")
+    
+    
+def make_model(name, servers=5):
+    model = SimModel(name)
+    for i in range(servers):
+        _ = model.grid[i]
+    return model
+
+
+def test01():
+    cloud = SimulatedCloud(latency={"*":uniform(0.001, 0.005)},
+                           boot_time=constant(0.2), seed=1)
+    cloud.install()
+    try:
+        model = make_model("s1")
+        get_provisioner().provision_infra_model(model)
+    finally:
+        cloud.uninstall()
+    assert ocf.get_nova_client_class() is not cloud.nova_client_class()
+    assert len(cloud.servers) == 5 and len(cloud.ports) == 1
+    assert all([model.grid[i].iface0.addr0.value() for i in range(5)])
+    assert model.fip.ip.value()
+    assert cloud.calls["servers.create"] == 5
+    assert cloud.calls["create_network"] == 1
+    assert cloud.total_calls() == sum(cloud.calls.values())
+    
+def test02():
+    cloud = SimulatedCloud(boot_time=constant(0.05), seed=2)
+    cloud.install()
+    try:
+        prov = get_provisioner()
+        record = prov.provision_infra_model(make_model("s2"))
+        prov.deprovision_infra_from_record(record)
+    finally:
+        cloud.uninstall()
+    assert not cloud.servers and not cloud.routers and not cloud.ports
+    assert not cloud.subnets and not cloud.security_groups
+    assert not cloud.floating_ips and not cloud.security_group_rules
+    #only the pre-existing external network is left
+    assert [n["name"] for n in cloud.networks.values()] == [u"external"]
+    
+def test03():
+    cloud = SimulatedCloud(failures={"create_network":1.0})
+    cloud.install()
+    try:
+        get_provisioner().provision_infra_model(make_model("s3", servers=1))
+        assert False, "network creation should have failed"
+    except ProvisionerException, _:
+        pass
+    finally:
+        cloud.uninstall()
+    assert cloud.failed >= 1 and not cloud.servers
+    
+def test04():
+    cloud = SimulatedCloud(rate_limit=3)
+    nova = cloud.nova_client_class()("1.1", "u", "p", "t", "url")
+    _ = nova.images.list()
+    _ = nova.flavors.list()
+    try:
+        _ = nova.images.list()
+        assert False, "should have been over the limit"
+    except SimOverLimit, e:
+        assert e.code == 413
+    assert cloud.rejected == 1
+    
+def test05():
+    cloud = SimulatedCloud(boot_time=constant(10), boot_failure_rate=1.0)
+    nova = cloud.nova_client_class()("1.1", "u", "p", "t", "url")
+    srvr = nova.servers.create("s", None, None)
+    assert srvr.status == "BUILD" and not srvr.addresses
+    srvr.ready_at = 0
+    assert srvr.status == "ERROR" and not srvr.addresses
+    nova.servers.delete(srvr.id)
+    try:
+        nova.servers.get(srvr.id)
+        assert False, "server should be gone"
+    except SimNotFound, e:
+        assert e.code == 404
+        
+def test06():
+    cloud = SimulatedCloud(boot_time=constant(0.05))
+    cloud.install()
+    try:
+        prov = get_provisioner(batch_servers=True, num_threads=2)
+        model = make_model("s6", servers=20)
+        prov.provision_infra_model(model)
+    finally:
+        cloud.uninstall()
+    assert cloud.calls["servers.create"] == 1 and len(cloud.servers) == 20
+    #every task was timed, and none took longer than provisioning did
+    assert len(prov.agent.task_timings) == len(prov.agent.get_graph().nodes())
+    assert all([end >= start for _, _, start, end in prov.agent.task_timings])
@@ -23,6 +23,7 @@
 Created on 25 Aug 2014
 '''
 import random
+import re
 import uuid
 import itertools
 
@@ -30,13 +31,21 @@ from faker import Faker
 fake = Faker()
 fake.seed(22)
 
+class MockNotFound(Exception):
+    code = 404
+
+
 class Create(object):
     def __init__(self, get_result):
         self.get_result = get_result
+        self.deleted = []
         
     def create(self, *args, **kwargs):
         return self.get_result(*args, **kwargs)
     
+    def delete(self, osid):
+        self.deleted.append(osid)
+    
 
 class CreateAndList(Create):
     def __init__(self, get_result, list_result):
@@ -51,12 +60,46 @@ class FakeOSServer(object):
     addresses = {"eth0":[{"addr":"127.0.0.1"}]}
 
 class ServerCreate(Create):
+    #servers made by any client, so they can be listed by any other client
+    created = {}
+    #ids of servers that have been deleted
+    gone = set()
+    
+    #like novaclient's, create() returns the first server, whatever the count
+    def create(self, name, image, flavor, meta=None, min_count=None,
+               max_count=None, **kwargs):
+        count = max_count or 1
+        made = []
+        for i in range(count):
+            server = super(ServerCreate, self).create(name, image, flavor, **kwargs)
+            server.metadata = dict(meta or {})
+            server.name = ("%s-%d" % (name, i + 1)
+                           if count > 1
+                           else name)
+            ServerCreate.created[server.id] = server
+            made.append(server)
+        return made[0]
+    
+    def list(self, search_opts=None):
+        servers = list(ServerCreate.created.values())
+        if search_opts and "name" in search_opts:
+            servers = [s for s in servers
+                       if re.search(search_opts["name"], s.name)]
+        return servers
+    
     def add_floating_ip(self, *args, **kwargs):
         return
     
     def get(self, server_id):
+        if server_id in ServerCreate.gone:
+            raise MockNotFound("No server %s" % server_id)
         return FakeOSServer()
     
+    def delete(self, server_id):
+        super(ServerCreate, self).delete(server_id)
+        ServerCreate.created.pop(server_id, None)
+        ServerCreate.gone.add(server_id)
+    
 
 class MockNovaClient(object):
     def __init__(self, version, username, password, tenant_name, auth_url):
@@ -132,7 +175,8 @@ class MockNovaClient(object):
     class NetworkResult(object):
         def __init__(self, label):
             self.label = label
-            self.id = uuid.uuid4()
+            #Openstack ids are strings
+            self.id = str(uuid.uuid4())
             
     _networks_list = [NetworkResult(n) for n in (u'wibbleNet', u'wibble', u'test1Net', u'network',
                                                  u'external')]
@@ -176,6 +220,31 @@ class MockNeutronClient(object):
         return {}
     
     def add_interface_router(self, *args, **kwargs):
-        return {u'id':uuid.uuid4()}
+        return {u'id':uuid.uuid4(), u'port_id':uuid.uuid4()}
+    
+    #everything deleted by any client, as (method name, args) tuples
+    deleted = []
+    
+    def _deleted(self, method, *args):
+        MockNeutronClient.deleted.append((method, args))
+        return None
+    
+    def delete_network(self, network_id):
+        return self._deleted("delete_network", network_id)
+    
+    def delete_subnet(self, subnet_id):
+        return self._deleted("delete_subnet", subnet_id)
+    
+    def delete_router(self, router_id):
+        return self._deleted("delete_router", router_id)
+    
+    def remove_gateway_router(self, router_id):
+        return self._deleted("remove_gateway_router", router_id)
+    
+    def remove_interface_router(self, router_id, body=None):
+        return self._deleted("remove_interface_router", router_id, body)
+    
+    def list_ports(self, **kwargs):
+        return {'ports':[]}
     
     
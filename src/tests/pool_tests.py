@@ -0,0 +1,198 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+Tests for sizing an execution agent's worker pool
+'''
+
+import threading
+import time
+import networkx as nx
+from actuator import (NamespaceModel, Role, MultiRole, Var, ConfigModel,
+                      MultiTask, PingTask, NullTask, ExecutionAgent, ctxt)
+from actuator.config import StructuralTask
+from actuator.exec_agents.pool import (PoolSizer, antichain_width,
+                                     chain_cover_width)
+
+
+def _graph(edges, nodes=()):
+    g = nx.DiGraph()
+    g.add_nodes_from(nodes)
+    g.add_edges_from(edges)
+    return g
+
+
+def test001():
+    "test001: a chain is one wide, a fan as wide as its branches"
+    assert antichain_width(_graph([(1, 2), (2, 3), (3, 4)])) == 1
+    fan = _graph([(0, i) for i in range(1, 7)] + [(i, 7) for i in range(1, 7)])
+    assert antichain_width(fan) == 6
+    assert antichain_width(_graph([])) == 0
+    assert antichain_width(_graph([], nodes=[1, 2, 3])) == 3
+    
+    
+def test002():
+    "test002: width counts tasks on different levels that don't depend on each other"
+    #a is on level 1, c on level 2, but neither leads to the other
+    g = _graph([("s", "a"), ("s", "b"), ("b", "c"), ("a", "t"), ("c", "t")])
+    assert chain_cover_width(g) == 2
+    assert antichain_width(g) == 2
+    g.add_edge("s", "d")
+    assert antichain_width(g) == 3
+    
+    
+def test003():
+    "test003: large graphs fall back to a bound that is never below the width"
+    fan = _graph([(0, i) for i in range(1, 31)])
+    assert antichain_width(fan, exact_limit=10) == chain_cover_width(fan) == 30
+    g = _graph([("s", "a"), ("s", "b"), ("b", "c"), ("a", "t"), ("c", "t")])
+    assert antichain_width(g, exact_limit=3) >= antichain_width(g)
+    
+    
+def test004():
+    "test004: the pool grows to take waiting tasks, up to its ceiling"
+    sizer = PoolSizer(2, 10, width=8)
+    assert sizer.ceiling() == 8
+    assert sizer.target(2, 2, 3) == 5
+    assert sizer.target(5, 5, 20) == 8
+    assert sizer.target(8, 8, 20) == 8
+    assert sizer.peak == 8 and sizer.grown == 2
+    
+    
+def test005():
+    "test005: quick tasks grow the pool a worker at a time"
+    sizer = PoolSizer(1, 10)
+    sizer.observe(0.01)
+    assert sizer.target(1, 1, 20) == 2
+    
+    
+def test006():
+    "test006: idle workers are retired one at a time, down to min_threads"
+    sizer = PoolSizer(2, 10, idle_ticks=3)
+    assert sizer.target(4, 1, 0) == 4
+    assert sizer.target(4, 1, 0) == 4
+    assert sizer.target(4, 1, 0) == 3
+    for _ in range(9):
+        current = sizer.target(2, 0, 0)
+    assert current == 2
+    assert sizer.shrunk == 1
+    
+    
+def test007():
+    "test007: host capacity limits the ceiling"
+    assert PoolSizer(1, 20, width=50, host_capacity=6).ceiling() == 6
+    assert PoolSizer(4, 20, host_capacity=2).ceiling() == 4
+    
+    
+class SleepyAgent(ExecutionAgent):
+    #every host task takes 0.3 seconds; notes the most running at once
+    def __init__(self, **kwargs):
+        super(SleepyAgent, self).__init__(**kwargs)
+        self.running = 0
+        self.most = 0
+        self.lock = threading.Lock()
+        
+    def _perform_task(self, task, logfile=None):
+        if isinstance(task, (StructuralTask, NullTask)):
+            task.perform()
+            return
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        time.sleep(0.3)
+        with self.lock:
+            self.running -= 1
+            
+            
+def _fan_models(num_nodes):
+    class NS008(NamespaceModel):
+        nodes = MultiRole(Role("node", host_ref="10.7.7.!{N}",
+                               variables=[Var("N", ctxt.name)]))
+    ns = NS008()
+    for i in range(num_nodes):
+        _ = ns.nodes[i]
+        
+    class C008(ConfigModel):
+        pings = MultiTask("pings", PingTask("p"), NS008.q.nodes.all())
+    return ns, C008()
+    
+    
+def test008():
+    "test008: an agent with max_threads grows its pool to run a wide fan in parallel"
+    ns, cfg = _fan_models(12)
+    ea = SleepyAgent(config_model_instance=cfg, namespace_model_instance=ns,
+                     no_delay=True, num_threads=1, max_threads=8)
+    start = time.time()
+    ea.perform_config()
+    assert time.time() - start < 12 * 0.3 / 2
+    assert ea.pool_sizer.width == 12
+    assert ea.most > 1 and ea.pool_sizer.peak <= 8
+    
+    
+def test009():
+    "test009: max_per_host limits the pool to the hosts' capacity"
+    ns, cfg = _fan_models(3)
+    ea = SleepyAgent(config_model_instance=cfg, namespace_model_instance=ns,
+                     no_delay=True, num_threads=1, max_threads=8,
+                     max_per_host=1)
+    ea.perform_config()
+    assert ea.pool_sizer.host_capacity == 3
+    assert ea.most <= 3
+    
+    
+def test010():
+    "test010: without max_threads the pool stays at num_threads"
+    ns, cfg = _fan_models(4)
+    ea = SleepyAgent(config_model_instance=cfg, namespace_model_instance=ns,
+                     no_delay=True, num_threads=2)
+    ea.perform_config()
+    assert ea.pool_sizer is None
+    assert ea.most <= 2
+
+
+def test011():
+    "test011: long chains are one wide, exactly or not, and don't take long"
+    chain = _graph([(i, i + 1) for i in range(2499)])
+    start = time.time()
+    assert antichain_width(chain) == 1
+    assert antichain_width(chain, exact_limit=2500) == 1
+    assert time.time() - start < 10
+    
+    
+def test012():
+    "test012: layered graphs get their layer width"
+    edges = []
+    for layer in range(9):
+        for i in range(20):
+            edges.extend([((layer, i), (layer + 1, j)) for j in range(20)])
+    g = _graph(edges)
+    assert antichain_width(g) == chain_cover_width(g) == 20
+    assert antichain_width(g, exact_limit=1000) == 20
+
+
+def do_all():
+    for k, v in globals().items():
+        if k.startswith("test") and callable(v):
+            v()
+            
+if __name__ == "__main__":
+    do_all()
@@ -0,0 +1,182 @@
+# 
+# Copyright (c) 2014 Tom Carroll
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+Tests for simulating runs on a virtual clock
+'''
+
+import threading
+from actuator import (NamespaceModel, Role, MultiRole, Var, ConfigModel,
+                      MultiTask, ConfigClassTask, PingTask, NullTask,
+                      ExecutionAgent, LatencyHistory, with_dependencies, ctxt,
+                      what_if)
+from actuator.config import StructuralTask
+
+
+class RecordingAgent(ExecutionAgent):
+    #notes the order tasks are performed in
+    def __init__(self, **kwargs):
+        super(RecordingAgent, self).__init__(**kwargs)
+        self.performed = []
+        self.lock = threading.Lock()
+        
+    def _perform_task(self, task, logfile=None):
+        with self.lock:
+            self.performed.append(task)
+        if isinstance(task, (StructuralTask, NullTask)):
+            task.perform()
+            
+            
+def _fan_agent(num_nodes, **kwargs):
+    class NS(NamespaceModel):
+        nodes = MultiRole(Role("node", host_ref="10.6.6.!{N}",
+                               variables=[Var("N", ctxt.name)]))
+    ns = NS()
+    for i in range(num_nodes):
+        _ = ns.nodes[i]
+        
+    class C(ConfigModel):
+        pings = MultiTask("pings", PingTask("p"), NS.q.nodes.all())
+    kwargs.setdefault("no_delay", True)
+    return RecordingAgent(config_model_instance=C(), namespace_model_instance=ns,
+                          **kwargs)
+
+
+def test001():
+    "test001: a fan is limited by the number of threads"
+    ea = _fan_agent(12, num_threads=5)
+    r = ea.simulate(durations={"PingTask":1.0})
+    assert r.makespan == 3.0, r.summary()
+    assert r.peak_parallelism == 5
+    assert r.critical_length == 1.0
+    assert len(r.critical_path) == 3
+    assert not ea.performed
+    
+    
+def test002():
+    "test002: more threads than the fan is wide only helps up to its width"
+    ea = _fan_agent(12, num_threads=5)
+    r = ea.simulate(num_threads=50, durations={"PingTask":1.0})
+    assert r.makespan == 1.0 and r.peak_parallelism == 12
+    
+    
+def test003():
+    "test003: jitter lengthens the run, and is repeatable with a seed"
+    ea = _fan_agent(6, num_threads=6)
+    plain = ea.simulate(jitter=False, durations={"PingTask":1.0})
+    jittered = ea.simulate(jitter=True, seed=3, durations={"PingTask":1.0})
+    again = ea.simulate(jitter=True, seed=3, durations={"PingTask":1.0})
+    assert not plain.jitter and jittered.jitter
+    assert jittered.makespan > plain.makespan
+    assert jittered.makespan == again.makespan
+    
+    
+def test004():
+    "test004: durations come from the latency history when there are no hints"
+    hist = LatencyHistory()
+    hist.record("PingTask/node", 2.0)
+    hist.record("PingTask/node", 4.0)
+    ea = _fan_agent(3, num_threads=3, latency_history=hist)
+    assert ea.simulate().makespan == 3.0
+    assert ea.simulate(durations={"PingTask":1.0}).makespan == 1.0
+    
+    
+def test005():
+    "test005: tasks that hand off free their worker for the rest of their time"
+    ea = _fan_agent(4, num_threads=1)
+    assert ea.simulate(durations={"PingTask":(0.5, 2.0)}).makespan == 4.0
+    assert ea.simulate(durations={"PingTask":2.5}).makespan == 10.0
+    
+    
+def test006():
+    "test006: an adaptive pool is simulated with the agent's pool sizer"
+    ea = _fan_agent(20, num_threads=1, max_threads=10)
+    fixed = ea.simulate(max_threads=1, durations={"PingTask":5.0})
+    adaptive = ea.simulate(durations={"PingTask":5.0})
+    assert fixed.peak_threads == 1
+    assert adaptive.peak_threads == 10
+    assert adaptive.makespan < fixed.makespan / 4
+    
+    
+def test007():
+    "test007: the critical path is the longest chain of dependent tasks"
+    class NS(NamespaceModel):
+        r = Role("r", host_ref="box")
+        
+    class C(ConfigModel):
+        a = PingTask("a")
+        b = PingTask("b")
+        c = PingTask("c")
+        side = PingTask("side")
+        with_dependencies(a | b | c, a | side)
+    ea = RecordingAgent(config_model_instance=C(default_task_role=NS.r),
+                        namespace_model_instance=NS(), no_delay=True)
+    r = ea.simulate(durations={"a":1.0, "b":2.0, "c":3.0, "side":4.0})
+    assert [t.name for t in r.critical_path] == ["a", "b", "c"]
+    assert r.critical_length == 6.0 and r.makespan == 6.0
+    
+    
+def test008():
+    "test008: a simulated run leaves the agent able to perform the real one"
+    class NS(NamespaceModel):
+        nodes = MultiRole(Role("node", host_ref="10.6.7.!{N}",
+                               variables=[Var("N", ctxt.name)]))
+    ns = NS()
+    for i in range(3):
+        _ = ns.nodes[i]
+        
+    class Inner(ConfigModel):
+        a = PingTask("a")
+        b = PingTask("b")
+        with_dependencies(a | b)
+        
+    class C(ConfigModel):
+        suites = MultiTask("suites", ConfigClassTask("s", Inner),
+                           NS.q.nodes.all())
+    ea = RecordingAgent(config_model_instance=C(), namespace_model_instance=ns,
+                        no_delay=True, num_threads=3)
+    r = ea.simulate(durations={"a":1.0, "b":1.0})
+    assert r.makespan == 2.0
+    ea.perform_config()
+    names = [t.name for t in ea.performed]
+    assert names.count("a") == 3 and names.count("b") == 3
+    assert names.index("a") < names.index("b")
+    assert names[-1] == "suites-rendezvous"
+    
+    
+def test009():
+    "test009: what_if covers each thread count with and without jitter"
+    ea = _fan_agent(10, num_threads=5)
+    results = what_if(ea, thread_counts=(1, 10), seed=1,
+                      durations={"PingTask":1.0})
+    assert [(r.num_threads, r.jitter) for r in results] == [(1, False), (1, True),
+                                                            (10, False), (10, True)]
+    assert results[0].makespan == 10.0 and results[2].makespan == 1.0
+
+
+def do_all():
+    for k, v in globals().items():
+        if k.startswith("test") and callable(v):
+            v()
+            
+if __name__ == "__main__":
+    do_all()
@@ -147,3 +147,65 @@ def test12():
     assert (Test12.a == 1 and Test12.b == 2 and Test12.c == "c" and Test12.d == 4.3
             and set(Test12.MAGIC_ARGS) == set([1,2,3,4,5]))
 
+def test13():
+    class Base(object): pass
+    class Derived(Base): pass
+    cm = ClassMapper()
+    cm[Base] = "base"
+    for _ in range(1000):
+        assert cm[Derived] == "base"
+    assert cm.lookups == 1000 and cm.resolutions == 1
+    
+def test14():
+    class Base(object): pass
+    class Derived(Base): pass
+    cm = ClassMapper()
+    cm[Base] = "base"
+    assert cm[Derived] == "base"
+    cm[Derived] = "derived"
+    assert cm[Derived] == "derived" and cm[Base] == "base"
+    del cm[Derived]
+    assert cm[Derived] == "base"
+    
+def test15():
+    class Unmapped(object): pass
+    cm = ClassMapper()
+    for _ in range(3):
+        try:
+            _ = cm[Unmapped]
+            assert False, "should have raised KeyError"
+        except KeyError, _:
+            pass
+    assert cm.resolutions == 1
+    cm.update({Unmapped:"now mapped"})
+    assert cm[Unmapped] == "now mapped"
+    
+def test16():
+    class Dom3Source(object): pass
+    class Dom3SourceKid(Dom3Source): pass
+    dom3 = "dom3"
+    @capture_mapping(dom3, Dom3SourceKid)
+    class Dom3KidTarget(object): pass
+    assert get_mapper(dom3)[Dom3SourceKid] is Dom3KidTarget
+    try:
+        _ = get_mapper(dom3)[Dom3Source]
+        assert False, "should have raised KeyError"
+    except KeyError, _:
+        pass
+    @capture_mapping(dom3, Dom3Source)
+    class Dom3Target(object): pass
+    assert get_mapper(dom3)[Dom3Source] is Dom3Target
+    lookups, resolutions = dispatch_stats()[dom3]
+    assert lookups == 3 and resolutions == 3
+    
+def test17():
+    import pickle
+    cm = ClassMapper()
+    cm[Exception] = "exception"
+    assert cm[ValueError] == "exception"
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        cm2 = pickle.loads(pickle.dumps(cm, protocol))
+        assert dict(cm2) == {Exception:"exception"}
+        assert cm2[ValueError] == "exception"
+        cm2[ValueError] = "value error"
+        assert cm2[ValueError] == "value error" and cm[ValueError] == "exception"